@@ -0,0 +1,223 @@
+"""
+Cola de peticiones con control de admisión
+Número fijo de workers de modelo, cola acotada (las peticiones que no caben
+se rechazan) y admisión por memoria: cada petición reserva el KV-cache
+estimado a partir de la longitud del prompt y max_new_tokens. Las peticiones
+urgentes pasan delante y desplazan a las de rutina en ejecución
+"""
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# ESTIMACIÓN DEL KV-CACHE
+# ============================================================================
+
+def estimate_kv_bytes(text_config: Any, num_tokens: int, element_size: int = 2) -> int:
+    """
+    Bytes de KV-cache (keys + values) de una secuencia de num_tokens.
+    Las capas de atención local (sliding window) solo guardan la ventana.
+    """
+    num_layers = int(getattr(text_config, "num_hidden_layers", 0) or 0)
+    num_kv_heads = int(getattr(text_config, "num_key_value_heads", None) or getattr(text_config, "num_attention_heads", 0) or 0)
+    head_dim = getattr(text_config, "head_dim", None)
+    if head_dim is None and num_kv_heads:
+        head_dim = int(getattr(text_config, "hidden_size", 0)) // int(getattr(text_config, "num_attention_heads", 1))
+    window = getattr(text_config, "sliding_window", None)
+    layer_types = getattr(text_config, "layer_types", None) or ["full_attention"] * num_layers
+    tokens = sum(
+        min(num_tokens, int(window)) if layer == "sliding_attention" and window else num_tokens
+        for layer in layer_types[:num_layers]
+    )
+    return 2 * tokens * num_kv_heads * int(head_dim or 0) * int(element_size)
+
+
+# ============================================================================
+# COLA Y ADMISIÓN
+# ============================================================================
+
+class AdmissionRejected(Exception):
+    """La petición no entra: cola llena o KV estimado mayor que el presupuesto."""
+
+
+# Clases de prioridad, de mayor a menor (urgente: p. ej. TC de cráneo de urgencias)
+PRIORITY_CLASSES = ("urgent", "routine")
+
+
+def priority_rank(priority: str) -> int:
+    """0 = más prioritaria; clases desconocidas cuentan como rutina."""
+    return PRIORITY_CLASSES.index(priority) if priority in PRIORITY_CLASSES else len(PRIORITY_CLASSES) - 1
+
+
+class AdmissionTicket:
+    """Una petición en cola o en ejecución."""
+
+    __slots__ = ("kv_bytes", "priority", "rank", "enqueued_at", "admitted_at", "released")
+
+    def __init__(self, kv_bytes: int, priority: str = "routine"):
+        self.kv_bytes = int(kv_bytes)
+        self.rank = priority_rank(priority)
+        self.priority = PRIORITY_CLASSES[self.rank]
+        self.enqueued_at = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.released = False
+
+    @property
+    def admitted(self) -> bool:
+        return self.admitted_at is not None
+
+
+class AdmissionController:
+    """
+    Cola por prioridad (FIFO dentro de cada clase) con max_workers peticiones
+    en ejecución por clase y max_queue en espera. La cabeza de la cola entra
+    cuando hay worker libre y su KV estimado cabe en kv_budget_bytes junto con
+    el de las que ya se ejecutan (sin saltos de turno dentro de la cola).
+
+    Una urgente no espera a las de rutina en ejecución: entra si hay worker y
+    KV libres entre las urgentes, y las de rutina se pausan en el siguiente
+    paso de decodificación (su KV queda guardado, ver urgent_active()).
+    Mientras haya urgentes en ejecución no se admiten nuevas de rutina.
+    """
+
+    def __init__(self, max_workers: int = 1, max_queue: int = 16, kv_budget_bytes: int = 0, ema_alpha: float = 0.2, ttft_window: int = 200):
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(0, int(max_queue))
+        self.kv_budget_bytes = int(kv_budget_bytes)
+        self.ema_alpha = ema_alpha
+        self._waiting: List[AdmissionTicket] = []
+        self._running = {p: 0 for p in PRIORITY_CLASSES}
+        self._reserved = {p: 0 for p in PRIORITY_CLASSES}
+        self._ttft = {p: deque(maxlen=ttft_window) for p in PRIORITY_CLASSES}
+        self._cond = threading.Condition()
+        self.admitted = 0
+        self.rejected = 0
+        self.abandoned = 0
+        self.queue_seconds = 0.0
+        self.service_ema: Optional[float] = None
+
+    def enqueue(self, kv_bytes: int = 0, priority: str = "routine") -> AdmissionTicket:
+        """Pone la petición en cola (o la admite ya); AdmissionRejected si no cabe."""
+        ticket = AdmissionTicket(kv_bytes, priority)
+        with self._cond:
+            if self.kv_budget_bytes and kv_bytes > self.kv_budget_bytes:
+                self.rejected += 1
+                raise AdmissionRejected(
+                    f"La petición necesita ~{kv_bytes / 1024 / 1024:.0f} MB de KV-cache "
+                    f"(máximo {self.kv_budget_bytes / 1024 / 1024:.0f} MB). Reduce la cantidad de caracteres."
+                )
+            at_head = all(t.rank > ticket.rank for t in self._waiting)
+            if len(self._waiting) >= self.max_queue and not (at_head and self._can_admit(ticket)):
+                self.rejected += 1
+                raise AdmissionRejected(f"Servidor ocupado: {len(self._waiting)} peticiones en cola. Inténtalo en unos segundos.")
+            # Detrás de las de su misma clase o más prioritarias
+            index = next((i for i, t in enumerate(self._waiting) if t.rank > ticket.rank), len(self._waiting))
+            self._waiting.insert(index, ticket)
+            self._admit_ready()
+        return ticket
+
+    def _can_admit(self, ticket: AdmissionTicket) -> bool:
+        if ticket.rank == 0:
+            running, reserved = self._running[ticket.priority], self._reserved[ticket.priority]
+        else:
+            if self._running[PRIORITY_CLASSES[0]]:
+                return False
+            running, reserved = sum(self._running.values()), sum(self._reserved.values())
+        if running >= self.max_workers:
+            return False
+        return not self.kv_budget_bytes or reserved + ticket.kv_bytes <= self.kv_budget_bytes
+
+    def _admit_ready(self) -> None:
+        """Admite desde la cabeza mientras haya worker y memoria (llamar con el lock)."""
+        admitted_any = False
+        while self._waiting and self._can_admit(self._waiting[0]):
+            ticket = self._waiting.pop(0)
+            ticket.admitted_at = time.perf_counter()
+            self._running[ticket.priority] += 1
+            self._reserved[ticket.priority] += ticket.kv_bytes
+            self.admitted += 1
+            self.queue_seconds += ticket.admitted_at - ticket.enqueued_at
+            admitted_any = True
+        if admitted_any:
+            self._cond.notify_all()
+
+    def wait(self, ticket: AdmissionTicket, timeout: Optional[float] = None) -> bool:
+        """Espera a que la petición sea admitida; False si vence el timeout antes."""
+        with self._cond:
+            return self._cond.wait_for(lambda: ticket.admitted, timeout)
+
+    def leave(self, ticket: AdmissionTicket) -> None:
+        """Fin de la petición: libera su worker y su KV, o la saca de la cola si aún esperaba."""
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.admitted:
+                self._running[ticket.priority] -= 1
+                self._reserved[ticket.priority] -= ticket.kv_bytes
+                service = time.perf_counter() - ticket.admitted_at
+                self.service_ema = service if self.service_ema is None else (
+                    self.ema_alpha * service + (1 - self.ema_alpha) * self.service_ema
+                )
+            else:
+                self._waiting.remove(ticket)
+                self.abandoned += 1
+            self._admit_ready()
+
+    def urgent_active(self) -> bool:
+        """True mientras haya urgentes en ejecución (las de rutina deben ceder el paso)."""
+        return self._running[PRIORITY_CLASSES[0]] > 0
+
+    def record_ttft(self, priority: str, seconds: float) -> None:
+        """Tiempo hasta el primer token (desde el clic) de una petición de la clase."""
+        with self._cond:
+            self._ttft[PRIORITY_CLASSES[priority_rank(priority)]].append(float(seconds))
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        """Posición en la cola (1 = la siguiente); 0 si ya está admitida o fuera de la cola."""
+        with self._cond:
+            for i, waiting in enumerate(self._waiting):
+                if waiting is ticket:
+                    return i + 1
+            return 0
+
+    def estimated_wait(self, ticket: AdmissionTicket) -> Optional[float]:
+        """Segundos estimados hasta la admisión (por tandas de max_workers) o None sin historial."""
+        position = self.position(ticket)
+        if position == 0:
+            return 0.0
+        if self.service_ema is None:
+            return None
+        return self.service_ema * math.ceil(position / self.max_workers)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            ttft = {}
+            for priority, samples in self._ttft.items():
+                values = sorted(samples)
+                ttft[priority] = {
+                    "count": len(values),
+                    "mean_seconds": sum(values) / len(values) if values else None,
+                    "p95_seconds": values[min(len(values) - 1, int(0.95 * len(values)))] if values else None,
+                }
+            return {
+                "running": sum(self._running.values()),
+                "running_urgent": self._running[PRIORITY_CLASSES[0]],
+                "waiting": len(self._waiting),
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "reserved_kv_mb": round(sum(self._reserved.values()) / 1024 / 1024, 1),
+                "kv_budget_mb": round(self.kv_budget_bytes / 1024 / 1024, 1),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "abandoned": self.abandoned,
+                "mean_queue_seconds": self.queue_seconds / self.admitted if self.admitted else 0.0,
+                "service_ema_seconds": self.service_ema,
+                "ttft": ttft,
+            }
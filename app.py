@@ -9,8 +9,10 @@ import time
 import logging
 import signal
 import sys
+import threading
 from datetime import datetime
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List, Callable
+import numpy as np
 import torch
 import gradio as gr
 from PIL import Image
@@ -154,7 +156,41 @@ from config import (
     IMAGE_TOKEN,
     VALID_IMAGE_TOKENS,
     CPU_NUM_THREADS,
-    CPU_INTEROP_THREADS
+    CPU_INTEROP_THREADS,
+    PREFIX_CACHE_ENABLED,
+    VISION_CACHE_ENABLED,
+    MODEL_ID,
+    BATCHING_ENABLED,
+    BATCH_MAX_SIZE,
+    BATCH_MAX_WAIT_MS,
+    CONTINUOUS_BATCHING_ENABLED,
+    MICRO_BATCHING_ENABLED,
+    ENGINE_MAX_SLOTS,
+    ENGINE_KV_BLOCK_SIZE,
+    ENGINE_KV_BUDGET_TOKENS,
+    STARTUP_WARMUP_ENABLED,
+    WARMUP_MAX_NEW_TOKENS,
+    WARMUP_TEMPLATE,
+    SPECULATIVE_NUM_TOKENS,
+    PROMPT_LOOKUP_ENABLED,
+    PROMPT_LOOKUP_NGRAM_MAX,
+    PROMPT_LOOKUP_NUM_TOKENS,
+    STREAMING_ENABLED,
+    STREAM_RENDER_INTERVAL_SECONDS,
+    JSON_STOP_ENABLED,
+    JSON_CONSTRAINED_DECODING,
+    EDIT_FORMAT,
+    TEMPLATE_LINE_CONSTRAINT,
+    TEMPLATE_INDEX_CACHE_SIZE,
+    NORMAL_FASTPATH_ENABLED,
+    FEWSHOT_VISUAL_ENABLED,
+    NORMAL_FASTPATH_MODE,
+    NORMAL_FASTPATH_MAX_NEW_TOKENS,
+    PREFETCH_ENABLED,
+    MODEL_WORKERS,
+    QUEUE_MAX_SIZE,
+    ADMISSION_KV_BUDGET_MB,
+    QUEUE_POLL_SECONDS
 )
 
 # Optimización CPU
@@ -170,11 +206,28 @@ try:
     )
 except Exception as e:
     logger.warning(f"No se pudo ajustar threads CPU: {e}")
-from model_loader import load_model, prepare_inputs
-from prompt_builder import build_prompt, save_good_example, build_repair_prompt
+from model_loader import load_model, load_draft_model, prepare_inputs, MODEL_INFO
+from prompt_builder import build_prompt_parts, build_lookup_corpus, save_good_example, build_repair_prompt, approved_example_embeddings
+from prompt_budget import token_counter_for
+from prefix_cache import make_prefix_key, prepare_prefix_cached_inputs
+from vision_cache import image_cache_key, get_image_features_cached, merge_image_features
+from batching import MicroBatchScheduler, BatchStreamerFanout, collate_inputs, split_outputs
+from admission import AdmissionController, AdmissionRejected, estimate_kv_bytes, priority_rank
+from continuous_batching import get_decode_engine
+from readiness import READINESS, start_background_warmup
+from normal_classifier import NORMAL_FAST_PATH, pool_image_features, edits_are_normal
+from speculative import DraftModelProposer, PromptLookupProposer, SpeculationGate, SpeculationTimer, speculative_generate
+from decoding import (
+    JsonBlockStoppingCriteria, CancellationStoppingCriteria, CancellationRegistry, CancellationToken,
+    PreemptionStoppingCriteria, PausableMaxTimeCriteria, FirstTokenCallback,
+)
+from json_constraint import get_schema_index, warm_template_index, SchemaConstrainedLogitsProcessor
+from prefetch import PREFETCHER, PrefetchTask, image_content_key
+from transformers import StoppingCriteriaList, LogitsProcessorList, NoRepeatNGramLogitsProcessor
 from report_processor import (
     validate_image_quality,
     extract_json_block,
+    complete_partial_json,
     apply_edits,
     analyze_uncertainty_tokens,
     audit_report_internal,
@@ -190,13 +243,40 @@ from template_manager import (
 
 # Cargar modelo bajo demanda (evita side-effects en imports/tests)
 model, processor, USE_DML = None, None, False
+# Modelo borrador para decodificación especulativa (None si DRAFT_MODEL_ID no está configurado)
+draft_model = None
+# Serializa la carga entre el warm-up en segundo plano y los clics de la UI
+_MODEL_LOCK = threading.Lock()
 
 
 def ensure_model_loaded():
-    """Carga el modelo solo cuando se necesita (lazy load)."""
-    global model, processor, USE_DML
+    """Carga el modelo solo cuando se necesita (lazy load); thread-safe."""
+    if model is not None and processor is not None:
+        return
+    with _MODEL_LOCK:
+        # Sin warm-up al arrancar, la primera generación refleja la carga en READINESS
+        lazy = READINESS.status in ("idle", "error")
+        if lazy:
+            READINESS.set("loading")
+        try:
+            _load_model_globals()
+        except Exception as e:
+            if lazy:
+                READINESS.set("error", str(e))
+            raise
+        if lazy:
+            READINESS.set("ready")
+
+
+def _load_model_globals():
+    """Carga modelo y processor en las variables globales (llamar con _MODEL_LOCK)."""
+    global model, processor, USE_DML, draft_model
     if model is None or processor is None:
         model, processor, USE_DML = load_model()
+        try:
+            draft_model = load_draft_model(processor)
+        except Exception as e:
+            logger.warning(f"No se pudo cargar el modelo borrador, decodificación normal: {e}")
         # Alinear el token de imagen entre tokenizer y modelo
         try:
             tokenizer = getattr(processor, "tokenizer", None)
@@ -343,8 +423,24 @@ def _normalize_eos_token_id(token_id: Any) -> Optional[int]:
     return None
 
 
-def generate_with_beam_search(inputs: Dict[str, Any], model: Any, processor: Any, max_new_tokens: int, num_beams: int = 1) -> Any:
-    """Genera con beam search (simplificado)."""
+def generate_with_beam_search(inputs: Dict[str, Any], model: Any, processor: Any, max_new_tokens: int, num_beams: int = 1, prefix_key: Optional[Any] = None, streamer: Optional[Any] = None, constrain_json: bool = False, image_key: Optional[str] = None, lookup_texts: Optional[List[str]] = None, template_text: Optional[str] = None, lookup_tokens: Optional[List[List[int]]] = None, cancel_token: Optional[Any] = None, priority: str = "routine", on_first_token: Optional[Callable[[], None]] = None, decode_info: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Genera con beam search (simplificado).
+    Si se indica prefix_key, reutiliza el KV-cache del prefijo estático del prompt.
+    Si se indica image_key, reutiliza las features de imagen cacheadas (sin vision tower).
+    Si se indica streamer, model.generate() le envía los tokens a medida que se generan.
+    Si constrain_json, la salida se restringe al esquema JSON de ediciones
+    (y, con template_text, remove/replace.from a líneas de esa plantilla).
+    lookup_texts (plantilla, ediciones aprobadas) alimentan la especulativa por prompt lookup;
+    lookup_tokens es ese mismo corpus ya tokenizado (preparación anticipada).
+    cancel_token (CancellationToken, o una lista con uno por fila del batch) detiene
+    la decodificación en el siguiente paso cuando el usuario pulsa Detener.
+    priority ("urgent"/"routine"): una de rutina cede el paso entre dos pasos de
+    decodificación (conservando su KV-cache) mientras haya urgentes en ejecución.
+    on_first_token se llama tras el primer token generado (TTFT).
+    decode_info (dict opcional) recibe "constrained": si la restricción al esquema
+    estuvo realmente activa (puede fallar al construirse y decodificar libre).
+    """
     # Filtrar inputs: solo pasar parámetros válidos para model.generate()
     # Remover claves del processor que no son de generate
     # No pasar token_type_ids a generate(): Gemma/MedGemma no lo espera aquí
@@ -369,28 +465,553 @@ def generate_with_beam_search(inputs: Dict[str, Any], model: Any, processor: Any
             pad_token_id = eos_token_id
 
     logger.debug(f"eos_token_id={eos_token_id}, pad_token_id={pad_token_id}")
+
+    # Features de imagen cacheadas: se inyectan como inputs_embeds en lugar de pixel_values
+    image_embeds = None
+    if image_key is not None and VISION_CACHE_ENABLED and filtered_inputs["input_ids"].shape[0] == 1:
+        try:
+            features = get_image_features_cached(model, filtered_inputs["pixel_values"], image_key)
+            image_embeds = merge_image_features(model, filtered_inputs["input_ids"], features)
+        except Exception as vision_err:
+            logger.warning(f"Caché de visión no disponible, se usa pixel_values: {vision_err}")
+
+    # Reutilizar KV del prefijo estático: solo se prefilla imagen + plantilla + contexto
+    prefix_used = False
+    if prefix_key is not None and PREFIX_CACHE_ENABLED and num_beams == 1:
+        try:
+            cached_inputs = prepare_prefix_cached_inputs(model, filtered_inputs, prefix_key, inputs_embeds=image_embeds)
+            if cached_inputs is not None:
+                filtered_inputs = cached_inputs
+                prefix_used = True
+        except Exception as cache_err:
+            logger.warning(f"Prefix KV cache no disponible, prefill completo: {cache_err}")
+
+    if image_embeds is not None and not prefix_used:
+        filtered_inputs = {
+            "input_ids": filtered_inputs["input_ids"],
+            "attention_mask": filtered_inputs["attention_mask"],
+            "inputs_embeds": image_embeds,
+        }
+    
+    generate_kwargs = {}
+    if streamer is not None and num_beams == 1:
+        generate_kwargs["streamer"] = streamer
+
+    # Parar en cuanto se cierra el bloque JSON (evita decodificar prosa final)
+    json_stop = None
+    if JSON_STOP_ENABLED and hasattr(processor, "tokenizer"):
+        json_stop = JsonBlockStoppingCriteria(processor.tokenizer, filtered_inputs["input_ids"].shape[-1])
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList([json_stop])
+
+    # Botón Detener: se comprueba tras cada paso de decodificación
+    if cancel_token is not None:
+        generate_kwargs.setdefault("stopping_criteria", StoppingCriteriaList()).append(CancellationStoppingCriteria(cancel_token))
+
+    # Decodificación restringida al esquema (sustituye a la pasada de reparación)
+    schema_proc = None
+    no_repeat_ngram_size = 2
+    if constrain_json and JSON_CONSTRAINED_DECODING and hasattr(processor, "tokenizer"):
+        try:
+            index = get_schema_index(
+                processor.tokenizer, [eos_token_id] if eos_token_id is not None else [], edit_format=EDIT_FORMAT,
+                template_text=template_text if TEMPLATE_LINE_CONSTRAINT else None,
+                template_cache_size=TEMPLATE_INDEX_CACHE_SIZE,
+            )
+            schema_proc = SchemaConstrainedLogitsProcessor(index, filtered_inputs["input_ids"].shape[-1])
+            generate_kwargs["logits_processor"] = LogitsProcessorList([schema_proc])
+            # La estructura JSON repite bigramas (",\"", "],") de forma legítima
+            no_repeat_ngram_size = 0
+        except Exception as schema_err:
+            logger.warning(f"Decodificación restringida no disponible: {schema_err}")
+    if decode_info is not None:
+        decode_info["constrained"] = schema_proc is not None
     
+    single_greedy = num_beams == 1 and filtered_inputs["input_ids"].shape[0] == 1
+    engine = None
+    if CONTINUOUS_BATCHING_ENABLED and single_greedy:
+        engine = get_decode_engine(model, ENGINE_MAX_SLOTS, ENGINE_KV_BLOCK_SIZE, ENGINE_KV_BUDGET_TOKENS // ENGINE_KV_BLOCK_SIZE)
+    engine_stats = engine.stats() if engine is not None else {"active": 0, "waiting": 0}
+    engine_busy = engine_stats["active"] + engine_stats["waiting"] > 0
+    # Motor libre y ninguna otra especulativa en curso: especulativa (latencia por
+    # petición); si no, batching continuo (throughput) en lugar de competir por la CPU
+    speculate = single_greedy and (engine is None or (not engine_busy and SPECULATION_GATE.active == 0))
+    proposer, num_draft_tokens = None, 0
+    if speculate and draft_model is not None:
+        proposer, num_draft_tokens = DraftModelProposer(draft_model), SPECULATIVE_NUM_TOKENS
+    elif speculate and PROMPT_LOOKUP_ENABLED and hasattr(processor, "tokenizer"):
+        corpus = lookup_tokens if lookup_tokens is not None else [
+            processor.tokenizer.encode(text, add_special_tokens=False) for text in (lookup_texts or [])
+        ]
+        proposer, num_draft_tokens = PromptLookupProposer(corpus, PROMPT_LOOKUP_NGRAM_MAX), PROMPT_LOOKUP_NUM_TOKENS
+    # La comprobación definitiva es atómica: de dos peticiones simultáneas, la segunda va al motor
+    gated = proposer is not None and engine is not None
+    if gated and not SPECULATION_GATE.try_enter(engine_busy):
+        proposer, gated = None, False
+    use_speculative = proposer is not None
+    use_engine = engine is not None and not use_speculative
+    if on_first_token is not None:
+        generate_kwargs.setdefault("stopping_criteria", StoppingCriteriaList()).append(FirstTokenCallback(on_first_token))
+    # El motor continuo aparca él mismo a las de rutina; fuera de él esperan entre pasos
+    preemption = None
+    if priority_rank(priority) > 0 and not use_engine:
+        preemption = PreemptionStoppingCriteria(
+            ADMISSION.urgent_active, cancel_token=cancel_token if isinstance(cancel_token, CancellationToken) else None,
+        )
+        generate_kwargs.setdefault("stopping_criteria", StoppingCriteriaList()).append(preemption)
+    # max_time sin el tiempo aparcado (el motor continuo ya descuenta el suyo)
+    if not use_engine:
+        generate_kwargs.setdefault("stopping_criteria", StoppingCriteriaList()).append(
+            PausableMaxTimeCriteria(MAX_TIME_SECONDS, [preemption] if preemption is not None else [])
+        )
+    processors = LogitsProcessorList()
+    if no_repeat_ngram_size:
+        processors.append(NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+    processors.extend(generate_kwargs.get("logits_processor", []))
+
     # Usar inference_mode para CPU/GPU
+    t_decode = time.perf_counter()
     try:
-        with torch.inference_mode():
-            return model.generate(
-                **filtered_inputs,
-                max_new_tokens=int(max_new_tokens),
+        if use_speculative:
+            # El proponente sugiere num_draft_tokens tokens y el modelo los verifica en un forward
+            out, spec_stats = speculative_generate(
+                model,
+                filtered_inputs,
+                proposer,
+                int(max_new_tokens),
+                [eos_token_id] if eos_token_id is not None else [],
+                num_draft_tokens=num_draft_tokens,
+                logits_processor=processors,
+                stopping_criteria=generate_kwargs.get("stopping_criteria"),
+                streamer=generate_kwargs.get("streamer"),
+            )
+        elif use_engine:
+            # Motor de batching continuo: comparte el bucle de decodificación con otras peticiones
+            out = engine.generate(
+                filtered_inputs,
+                int(max_new_tokens),
+                [eos_token_id] if eos_token_id is not None else [],
+                logits_processor=processors,
+                stopping_criteria=generate_kwargs.get("stopping_criteria"),
+                streamer=generate_kwargs.get("streamer"),
                 max_time=MAX_TIME_SECONDS,
-                do_sample=False,
-                num_beams=num_beams,
-                no_repeat_ngram_size=2,
-                eos_token_id=eos_token_id,
-                pad_token_id=pad_token_id,
+                priority=priority_rank(priority),
+            )
+            stats = engine.stats()
+            logger.info(
+                f"Motor continuo: {stats['tokens_per_second']:.1f} tokens/s sostenidos, "
+                f"{stats['active']} activas, {stats['waiting']} en espera, {stats['free_blocks']} bloques KV libres"
             )
+        else:
+            with torch.inference_mode():
+                out = model.generate(
+                    **filtered_inputs,
+                    max_new_tokens=int(max_new_tokens),
+                    do_sample=False,
+                    num_beams=num_beams,
+                    no_repeat_ngram_size=no_repeat_ngram_size,
+                    eos_token_id=eos_token_id,
+                    pad_token_id=pad_token_id,
+                    **generate_kwargs,
+                )
+        if single_greedy:
+            SPECULATION_TIMER.record(use_speculative, time.perf_counter() - t_decode, out.shape[1] - filtered_inputs["input_ids"].shape[1])
+        if use_speculative:
+            measured = SPECULATION_TIMER.stats()
+            speedup = f"x{measured['measured_speedup']:.2f} medida" if measured["measured_speedup"] else "sin referencia aún"
+            logger.info(
+                f"Especulativa ({proposer.name}): aceptación {spec_stats['acceptance_rate']:.0%}, "
+                f"{spec_stats['tokens_per_step']:.2f} tokens/paso, {spec_stats['generated']} tokens en "
+                f"{time.perf_counter() - t_decode:.1f}s de extremo a extremo; aceleración {speedup} "
+                f"frente a las peticiones sin especular"
+            )
+        if json_stop is not None and json_stop.stopped_at and json_stop.stopped_at[0] is not None:
+            logger.info(
+                f"Parada por cierre de JSON tras {json_stop.stopped_at[0]} tokens: "
+                f"ahorrados {json_stop.tokens_saved(max_new_tokens)} de max_new_tokens={int(max_new_tokens)}"
+            )
+        if schema_proc is not None and schema_proc.step_times:
+            logger.info(
+                f"Esquema JSON: {len(schema_proc.step_times)} pasos, "
+                f"{1000 * sum(schema_proc.step_times) / len(schema_proc.step_times):.2f} ms/paso de overhead, "
+                f"completo={schema_proc.is_complete}"
+            )
+        return out
     except Exception as e:
-        logger.error(f"Error durante model.generate(): {e}")
+        backend = "la decodificación especulativa" if use_speculative else ("el motor continuo" if use_engine else "model.generate()")
+        logger.error(f"Error durante {backend}: {e}")
         logger.error(f"Input shapes: {[(k, v.shape if hasattr(v, 'shape') else type(v)) for k, v in filtered_inputs.items()]}")
         raise
+    finally:
+        if gated:
+            SPECULATION_GATE.leave()
+
+
+def run_generation_batch(requests: List[Any]) -> List[Any]:
+    """
+    Ejecuta un micro-batch de peticiones (ver batching.MicroBatchScheduler).
+    Con una sola petición se mantiene el camino normal (caché de prefijo KV y
+    de visión); con varias se hace un único model.generate() con batch.
+    """
+    if len(requests) == 1:
+        req = requests[0]
+        return [generate_with_beam_search(req.inputs, model, processor, req.max_new_tokens, num_beams=1, **req.options)]
+
+    pad_token_id = _normalize_eos_token_id(getattr(processor.tokenizer, "pad_token_id", None))
+    if pad_token_id is None:
+        pad_token_id = _normalize_eos_token_id(getattr(processor.tokenizer, "eos_token_id", None)) or 0
+    batch_inputs = collate_inputs([req.inputs for req in requests], pad_token_id)
+    streamers = [req.options.get("streamer") for req in requests]
+    templates = {req.options.get("template_text") for req in requests}
+    decode_info: Dict[str, Any] = {}
+    out = generate_with_beam_search(
+        batch_inputs, model, processor,
+        max(req.max_new_tokens for req in requests),
+        num_beams=1,
+        streamer=BatchStreamerFanout(streamers) if any(s is not None for s in streamers) else None,
+        constrain_json=all(req.options.get("constrain_json", False) for req in requests),
+        # Un único índice de líneas por batch: solo si todas usan la misma plantilla
+        template_text=templates.pop() if len(templates) == 1 else None,
+        cancel_token=[req.options.get("cancel_token") for req in requests],
+        decode_info=decode_info,
+    )
+    for req in requests:
+        if req.options.get("decode_info") is not None:
+            req.options["decode_info"].update(decode_info)
+    return split_outputs(out, requests, batch_inputs["input_ids"].shape[-1])
 
 
-def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion: str, extras: str, template_file: str, max_new_tokens: int, max_tokens_limit: int) -> str:
-    """Función principal de generación de informes."""
+# Especulativas en curso (fuera del motor continuo): con una activa, el resto va al motor
+SPECULATION_GATE = SpeculationGate()
+# s/token de extremo a extremo con y sin especulativa (aceleración medida, en /health)
+SPECULATION_TIMER = SpeculationTimer()
+
+# Agrupa peticiones concurrentes de la UI en un único model.generate()
+GENERATION_SCHEDULER = MicroBatchScheduler(run_generation_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+# Generación en curso por sesión de la UI (botón Detener)
+GENERATION_CANCEL = CancellationRegistry()
+
+# Generaciones simultáneas que admite la UI (el motor continuo o el micro-batching las agrupan)
+if BATCHING_ENABLED and CONTINUOUS_BATCHING_ENABLED:
+    logger.warning("BATCHING_ENABLED se ignora: el batching continuo ya agrupa las peticiones concurrentes")
+if CONTINUOUS_BATCHING_ENABLED:
+    GENERATION_CONCURRENCY = ENGINE_MAX_SLOTS
+elif MICRO_BATCHING_ENABLED:
+    GENERATION_CONCURRENCY = BATCH_MAX_SIZE
+else:
+    GENERATION_CONCURRENCY = 1
+
+# Cola de la UI: workers de modelo, cola acotada y admisión por KV-cache estimado
+ADMISSION = AdmissionController(MODEL_WORKERS or GENERATION_CONCURRENCY, QUEUE_MAX_SIZE, ADMISSION_KV_BUDGET_MB * 1024 * 1024)
+
+
+def prompt_token_counter() -> Callable[[str], int]:
+    """Cuenta tokens con el tokenizer cargado (estimación si aún no hay), con caché por texto."""
+    return token_counter_for(getattr(processor, "tokenizer", None) if processor is not None else None)
+
+
+def estimate_request_kv_bytes(modalidad: str, region: str, indicacion: str, extras: str, template_file: str, max_new_tokens: int) -> int:
+    """KV-cache estimado de la petición (prompt + imagen + max_new_tokens); 0 si el modelo aún no está cargado."""
+    if model is None or processor is None:
+        return 0
+    template_text = (read_template(template_file).get("template_text") or "") if template_file else ""
+    count_tokens = prompt_token_counter()
+    prompt_prefix, prompt_suffix = build_prompt_parts(modalidad, region, indicacion, extras, template_text, count_tokens=count_tokens)
+    # El prefijo se repite entre peticiones: su conteo sale de la caché del contador
+    text_tokens = count_tokens(prompt_prefix) + count_tokens(prompt_suffix)
+    image_tokens = int(getattr(model.config, "mm_tokens_per_image", 256) or 256)
+    element_size = model.get_input_embeddings().weight.element_size()
+    text_config = getattr(model.config, "text_config", model.config)
+    return estimate_kv_bytes(text_config, text_tokens + image_tokens + int(max_new_tokens), element_size)
+
+
+def queue_status_message(ticket: Any) -> str:
+    """Texto de la UI mientras la petición espera turno."""
+    position = ADMISSION.position(ticket)
+    wait = ADMISSION.estimated_wait(ticket)
+    eta = f"~{wait:.0f} s" if wait is not None else "calculando..."
+    label = "urgente" if ticket.priority == "urgent" else "rutina"
+    return f"⏳ En cola ({label}): posición {position} ({ADMISSION.stats()['running']} en ejecución). Espera estimada: {eta}"
+
+
+def repair_json_with_model(decoded: str, template_text: str, max_new_tokens: int) -> Dict[str, Any]:
+    """Segunda pasada: pide al modelo convertir una salida no-JSON en el JSON de ediciones."""
+    repair_prompt = build_repair_prompt(decoded, template_text)
+    repair_inputs = None
+    if hasattr(processor, "apply_chat_template"):
+        repair_messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": repair_prompt}
+                ],
+            }
+        ]
+        repair_inputs = processor.apply_chat_template(
+            repair_messages,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt"
+        )
+    else:
+        repair_inputs = processor(text=repair_prompt, return_tensors="pt")
+    model_dtype = getattr(model, "dtype", None)
+    repair_inputs = prepare_inputs(repair_inputs, model, dtype=model_dtype)
+    repair_out = generate_with_beam_search(repair_inputs, model, processor, int(max_new_tokens), num_beams=1)
+    repair_len = repair_inputs["input_ids"].shape[-1]
+    repair_text = processor.tokenizer.batch_decode(repair_out[:, repair_len:], skip_special_tokens=True)[0]
+    del repair_inputs, repair_out
+    return json.loads(extract_json_block(repair_text))
+
+
+def build_generation_inputs(img: Image.Image, prompt_prefix: str, prompt_suffix: str) -> Dict[str, Any]:
+    """
+    Construye los inputs multimodales (prefijo estático + imagen + plantilla/contexto)
+    con apply_chat_template y los mueve al device/dtype del modelo.
+    """
+    prompt_text = f"{prompt_prefix}\n{prompt_suffix}"
+    t0 = time.time()
+
+    # Usar apply_chat_template con estructura de mensajes (forma correcta para MedGemma)
+    try:
+        logger.debug(f"Prompt texto: {len(prompt_text)} chars")
+        
+        # Construir mensaje multimodal: prefijo estático + imagen + plantilla/contexto
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt_prefix},
+                {"type": "image", "image": img},
+                {"type": "text", "text": prompt_suffix}
+            ]
+        }]
+        
+        # Generar tokens con apply_chat_template (inserta <image> automáticamente)
+        inputs = processor.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt"
+        )
+        
+        # Validar que inputs no sea None y tenga las claves requeridas
+        if inputs is None:
+            raise ValueError("processor.apply_chat_template() devolvió None")
+        
+        required_keys = {'input_ids', 'attention_mask', 'pixel_values'}
+        missing_keys = required_keys - set(inputs.keys())
+        if missing_keys:
+            raise ValueError(f"Faltan claves en inputs: {missing_keys}. Presentes: {list(inputs.keys())}")
+        
+        logger.info("OK: Inputs construidos con apply_chat_template")
+        logger.debug(f"Input keys: {list(inputs.keys())}")
+        logger.debug(f"input_ids shape: {inputs['input_ids'].shape}")
+        logger.debug(f"pixel_values shape: {inputs['pixel_values'].shape}")
+        logger.debug(f"attention_mask shape: {inputs['attention_mask'].shape}")
+
+        # Verificar presencia de tokens de imagen en input_ids
+        try:
+            tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else None
+            if tokenizer is not None:
+                image_token_counts = {}
+                for tok in VALID_IMAGE_TOKENS:
+                    tok_id = tokenizer.convert_tokens_to_ids(tok)
+                    if tok_id is not None and tok_id != tokenizer.unk_token_id:
+                        count = int((inputs["input_ids"] == tok_id).sum().item())
+                        image_token_counts[tok] = count
+                logger.info(f"Tokens de imagen en input_ids: {image_token_counts}")
+                # Conteo usando el token configurado en el modelo
+                model_image_token_id = getattr(model.config, "image_token_id", None)
+                if model_image_token_id is not None:
+                    count_model_tok = int((inputs["input_ids"] == model_image_token_id).sum().item())
+                    logger.info(
+                        f"Tokens con model.config.image_token_id={model_image_token_id}: {count_model_tok}"
+                    )
+        except Exception as tok_err:
+            logger.debug(f"No se pudo verificar tokens de imagen: {tok_err}")
+        
+    except Exception as e:
+        logger.error(f"Fallo en apply_chat_template: {e}")
+        logger.debug(f"Prompt length: {len(prompt_text)}, Image size: {img.size if img else 'None'}")
+        raise ValueError(f"Processor Gemma3 falló: {e}")
+
+    if prompt_text:
+        logger.info(f"Prompt texto longitud: {len(prompt_text)} chars")
+        logger.debug(f"Prompt (primeros 200 chars): {prompt_text[:200]}")
+
+    logger.debug(f"Processor timing: {time.time()-t0:.2f}s")
+    
+    # Mover inputs al device correcto (y dtype del modelo si aplica)
+    try:
+        model_dtype = getattr(model, "dtype", None)
+        logger.debug(f"Preparando inputs... (model_dtype={model_dtype})")
+        inputs = prepare_inputs(inputs, model, dtype=model_dtype)
+        logger.info("OK: Inputs movidos a device correcto")
+    except Exception as prep_err:
+        logger.error(f"Error en prepare_inputs: {prep_err}")
+        raise ValueError(f"Fallo al preparar inputs para GPU: {prep_err}")
+    return inputs
+
+
+def prepare_image(img: Image.Image) -> Dict[str, Any]:
+    """Convierte a RGB, valida la calidad y redimensiona a MAX_IMAGE_SIZE."""
+    img = img.convert("RGB")
+    is_valid, validation_msg = validate_image_quality(img)
+    if is_valid:
+        img.thumbnail(MAX_IMAGE_SIZE)
+    return {"image": img, "valid": is_valid, "message": validation_msg, "image_key": None}
+
+
+def _prefetch_image_job(task: PrefetchTask, raw_img: Image.Image) -> Dict[str, Any]:
+    """
+    Preparación anticipada de la imagen: conversión, validación, miniatura y,
+    con el modelo ya cargado, processor + vision encoder (las features quedan
+    en la caché de visión, donde generate() las encuentra).
+    """
+    prepared = prepare_image(raw_img)
+    task.check()
+    if not prepared["valid"] or model is None or processor is None:
+        return prepared
+    img = prepared["image"]
+    prepared["image_key"] = image_cache_key(img, MODEL_ID, MODEL_INFO.get("quantization") or getattr(model, "dtype", None))
+    if VISION_CACHE_ENABLED and hasattr(model, "get_image_features"):
+        pixel_values = _image_pixel_values(img)
+        task.check()
+        get_image_features_cached(model, pixel_values, prepared["image_key"])
+    return prepared
+
+
+def _image_pixel_values(img: Image.Image) -> Any:
+    """pixel_values de la imagen sola (sin prompt) en el device/dtype del modelo."""
+    pixel_values = processor.image_processor(images=img, return_tensors="pt")["pixel_values"]
+    return pixel_values.to(device=model.device, dtype=getattr(model, "dtype", None) or pixel_values.dtype)
+
+
+def study_image_embedding(img: Image.Image, image_key: str) -> np.ndarray:
+    """
+    Embedding agrupado de la imagen (pool_image_features) para el clasificador
+    de normales y la búsqueda de casos parecidos; las features quedan en la
+    caché de visión y la generación no repite el vision tower.
+    """
+    return pool_image_features(get_image_features_cached(model, _image_pixel_values(img), image_key))
+
+
+def _prefetch_template_job(task: PrefetchTask, template_file: str) -> Dict[str, Any]:
+    """
+    Preparación anticipada de la plantilla: lectura, corpus de prompt lookup
+    tokenizado e índice del esquema restringido a sus líneas con las máscaras
+    de remove/replace.from ya calculadas.
+    """
+    template_text = (read_template(template_file).get("template_text") or "").strip()
+    prepared: Dict[str, Any] = {"template_text": template_text, "lookup_texts": None, "lookup_tokens": None}
+    if not template_text or processor is None or not hasattr(processor, "tokenizer"):
+        return prepared
+    tokenizer = processor.tokenizer
+    prepared["lookup_texts"] = build_lookup_corpus(template_file, template_text)
+    prepared["lookup_tokens"] = [tokenizer.encode(text, add_special_tokens=False) for text in prepared["lookup_texts"]]
+    task.check()
+    if JSON_CONSTRAINED_DECODING and TEMPLATE_LINE_CONSTRAINT:
+        eos_token_id = _normalize_eos_token_id(getattr(tokenizer, "eos_token_id", None))
+        index = get_schema_index(
+            tokenizer, [eos_token_id] if eos_token_id is not None else [], edit_format=EDIT_FORMAT,
+            template_text=template_text, template_cache_size=TEMPLATE_INDEX_CACHE_SIZE,
+        )
+        task.check()
+        n_states = warm_template_index(index, tokenizer, template_text, EDIT_FORMAT)
+        logger.debug(f"Índice de plantilla {template_file}: {n_states} estados precalculados")
+    return prepared
+
+
+def _session_id(request: Optional[gr.Request]) -> str:
+    return getattr(request, "session_hash", None) or "default"
+
+
+def on_image_change(image: Optional[Image.Image], request: gr.Request = None) -> None:
+    """Evento change de la imagen: lanza (o cancela) su preparación anticipada."""
+    if not PREFETCH_ENABLED:
+        return
+    session = _session_id(request)
+    if image is None:
+        PREFETCHER.cancel(session, "image")
+        return
+    PREFETCHER.submit(session, "image", image_content_key(image), lambda task: _prefetch_image_job(task, image))
+
+
+def on_template_change(template_file: Optional[str], request: gr.Request = None) -> None:
+    """Evento change del desplegable de plantillas: pre-tokeniza la plantilla elegida."""
+    if not PREFETCH_ENABLED:
+        return
+    session = _session_id(request)
+    if not template_file:
+        PREFETCHER.cancel(session, "template")
+        return
+    PREFETCHER.submit(session, "template", template_file, lambda task: _prefetch_template_job(task, template_file))
+
+
+def warmup_model() -> None:
+    """
+    Generación sintética corta tras la carga: compila el índice del esquema
+    JSON, llena el KV del prefijo de TC y calienta allocator y kernels, para
+    que la primera petición real no pague ese coste.
+    """
+    ensure_model_loaded()
+    templates = list_templates()
+    template_file = WARMUP_TEMPLATE or ("TC_craneo_simple.json" if "TC_craneo_simple.json" in templates else (templates[0] if templates else None))
+    template_text = (read_template(template_file).get("template_text") or "").strip() if template_file else ""
+    if not template_text:
+        template_text = "Hallazgos: Sin alteraciones.\nConclusión: Estudio dentro de la normalidad."
+
+    # Imagen sintética con contraste (gradiente + ruido), como un corte anonimizado
+    rng = np.random.default_rng(0)
+    gradient = np.tile(np.linspace(40, 200, 512, dtype=np.float32), (512, 1))
+    pixels = np.clip(gradient + rng.normal(0, 20, (512, 512)), 0, 255).astype(np.uint8)
+    img = Image.fromarray(pixels).convert("RGB")
+    img.thumbnail(MAX_IMAGE_SIZE)
+
+    prompt_prefix, prompt_suffix = build_prompt_parts("TC", "Cráneo", "Warm-up", "", template_text, count_tokens=prompt_token_counter())
+    inputs = build_generation_inputs(img, prompt_prefix, prompt_suffix)
+    generate_with_beam_search(
+        inputs, model, processor, WARMUP_MAX_NEW_TOKENS, num_beams=1,
+        prefix_key=make_prefix_key("TC", prompt_prefix), constrain_json=True, template_text=template_text,
+    )
+    logger.info(f"Warm-up completado con plantilla {template_file or '(por defecto)'}")
+
+
+def prepare_normal_fast_path() -> None:
+    """
+    Siembra (una sola vez) las muestras del clasificador de normales con el
+    historial de valoraciones y lo entrena en segundo plano al arrancar.
+    """
+    try:
+        NORMAL_FAST_PATH.seed_from_history(FEEDBACK_CSV, approved_example_embeddings())
+    except Exception as e:
+        logger.warning(f"No se pudieron sembrar las muestras del clasificador de normales: {e}")
+    NORMAL_FAST_PATH.retrain_async()
+
+
+def health_payload() -> Tuple[Dict[str, Any], int]:
+    """Cuerpo y código HTTP de /health (503 hasta que el modelo esté listo)."""
+    payload = READINESS.snapshot()
+    payload["model"] = MODEL_ID
+    payload["normal_fast_path"] = NORMAL_FAST_PATH.stats()
+    payload["speculative"] = SPECULATION_TIMER.stats()
+    payload["prefetch"] = PREFETCHER.stats()
+    payload["queue"] = ADMISSION.stats()
+    return payload, (200 if payload["ready"] else 503)
+
+
+def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion: str, extras: str, template_file: str, max_new_tokens: int, max_tokens_limit: int, streamer: Optional[Any] = None, full_generation: bool = False, cancel_token: Optional[CancellationToken] = None, priority: str = "routine", request_start: Optional[float] = None) -> str:
+    """
+    Función principal de generación de informes.
+    streamer (opcional) recibe los tokens de la generación principal (no la de reparación).
+    full_generation desactiva la vía rápida de estudios probablemente normales.
+    cancel_token (botón Detener) corta la decodificación; el borrador parcial se completa.
+    priority ("urgent"/"routine") y request_start (perf_counter del clic, incluye la
+    cola) sirven para ceder el paso a las urgentes y medir el TTFT por clase.
+    """
+    request_start = request_start if request_start is not None else time.perf_counter()
     try:
         # Validación exhaustiva de inputs
         is_valid, error_msg = validate_inputs(img, modalidad, region, template_file, max_new_tokens, max_tokens_limit)
@@ -404,118 +1025,105 @@ def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion
         if not template_text:
             return "⚠️ Plantilla vacía."
 
-        # Preparar imagen
-        img = img.convert("RGB")
-        is_valid, validation_msg = validate_image_quality(img)
-        if not is_valid:
-            return f"❌ Validación fallida: {validation_msg}"
-        
-        img.thumbnail(MAX_IMAGE_SIZE)
+        # Preparar imagen (o recoger la preparación anticipada lanzada al subirla)
+        prepared = PREFETCHER.take("image", image_content_key(img)) if PREFETCH_ENABLED else None
+        if prepared is None:
+            prepared = prepare_image(img)
+        else:
+            logger.info("Imagen preparada de antemano (conversión, validación y vision encoder)")
+        img = prepared["image"]
+        if not prepared["valid"]:
+            return f"❌ Validación fallida: {prepared['message']}"
+
+        # Plantilla pre-tokenizada al elegirla (corpus de prompt lookup e índice de líneas)
+        prepared_tpl = PREFETCHER.take("template", template_file) if PREFETCH_ENABLED else None
+        if prepared_tpl is not None and prepared_tpl["template_text"] != template_text:
+            prepared_tpl = None
 
         # Procesar con modelo
         ensure_model_loaded()
 
         # Construir texto del prompt (sin tokens especiales - solo para referencia humana)
-        # El processor.apply_chat_template insertará automáticamente los tokens <image>
-        prompt_text = build_prompt(modalidad, region, indicacion, extras, template_text, image_token="")
-        
-        log_memory_stats("before_generation")
-        t0 = time.time()
-
-        # Usar apply_chat_template con estructura de mensajes (forma correcta para MedGemma)
-        try:
-            logger.debug(f"Prompt texto: {len(prompt_text)} chars")
-            
-            # Construir mensaje multimodal con imagen + texto
-            messages = [{
-                "role": "user",
-                "content": [
-                    {"type": "image", "image": img},
-                    {"type": "text", "text": prompt_text}
-                ]
-            }]
-            
-            # Generar tokens con apply_chat_template (inserta <image> automáticamente)
-            inputs = processor.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt"
-            )
-            
-            # Validar que inputs no sea None y tenga las claves requeridas
-            if inputs is None:
-                raise ValueError("processor.apply_chat_template() devolvió None")
-            
-            required_keys = {'input_ids', 'attention_mask', 'pixel_values'}
-            missing_keys = required_keys - set(inputs.keys())
-            if missing_keys:
-                raise ValueError(f"Faltan claves en inputs: {missing_keys}. Presentes: {list(inputs.keys())}")
-            
-            logger.info("OK: Inputs construidos con apply_chat_template")
-            logger.debug(f"Input keys: {list(inputs.keys())}")
-            logger.debug(f"input_ids shape: {inputs['input_ids'].shape}")
-            logger.debug(f"pixel_values shape: {inputs['pixel_values'].shape}")
-            logger.debug(f"attention_mask shape: {inputs['attention_mask'].shape}")
-
-            # Verificar presencia de tokens de imagen en input_ids
+        # Un modelo cuantizado no comparte entradas con el de precisión completa
+        image_key = prepared["image_key"] or image_cache_key(img, MODEL_ID, MODEL_INFO.get("quantization") or getattr(model, "dtype", None))
+
+        # Embedding de imagen para el clasificador de normales y los casos
+        # aprobados parecidos (queda en la caché de visión, así que la
+        # generación no repite el vision tower)
+        study_embedding, normal_prob = None, None
+        if NORMAL_FASTPATH_ENABLED or FEWSHOT_VISUAL_ENABLED:
             try:
-                tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else None
-                if tokenizer is not None:
-                    image_token_counts = {}
-                    for tok in VALID_IMAGE_TOKENS:
-                        tok_id = tokenizer.convert_tokens_to_ids(tok)
-                        if tok_id is not None and tok_id != tokenizer.unk_token_id:
-                            count = int((inputs["input_ids"] == tok_id).sum().item())
-                            image_token_counts[tok] = count
-                    logger.info(f"Tokens de imagen en input_ids: {image_token_counts}")
-                    # Conteo usando el token configurado en el modelo
-                    model_image_token_id = getattr(model.config, "image_token_id", None)
-                    if model_image_token_id is not None:
-                        count_model_tok = int((inputs["input_ids"] == model_image_token_id).sum().item())
-                        logger.info(
-                            f"Tokens con model.config.image_token_id={model_image_token_id}: {count_model_tok}"
-                        )
-            except Exception as tok_err:
-                logger.debug(f"No se pudo verificar tokens de imagen: {tok_err}")
-            
-        except Exception as e:
-            logger.error(f"Fallo en apply_chat_template: {e}")
-            logger.debug(f"Prompt length: {len(prompt_text)}, Image size: {img.size if img else 'None'}")
-            raise ValueError(f"Processor Gemma3 falló: {e}")
-
-        if prompt_text:
-            logger.info(f"Prompt texto longitud: {len(prompt_text)} chars")
-            logger.debug(f"Prompt (primeros 200 chars): {prompt_text[:200]}")
+                study_embedding = study_image_embedding(img, image_key)
+                if NORMAL_FASTPATH_ENABLED and not full_generation:
+                    normal_prob = NORMAL_FAST_PATH.predict(study_embedding)
+            except Exception as clf_err:
+                logger.warning(f"Embedding de imagen no disponible: {clf_err}")
+
+        fast_path = NORMAL_FAST_PATH.is_normal(normal_prob)
+        if normal_prob is not None:
+            clf_stats = NORMAL_FAST_PATH.stats()
+            logger.info(
+                f"Clasificador de normales: p={normal_prob:.2f} ({'vía rápida' if fast_path else 'completa'}), "
+                f"{clf_stats['mean_latency_ms']:.2f} ms medio, vía rápida en {clf_stats['fast_path_rate']:.0%} "
+                f"de {clf_stats['predictions']} estudios"
+            )
+        fast_path_note = ""
+        if fast_path:
+            fast_path_note = (
+                f"ℹ️ Estudio probablemente normal (p={normal_prob:.0%}). "
+                "Si hay hallazgos, marca 'Generación completa' y vuelve a generar.\n\n"
+            )
+            if NORMAL_FASTPATH_MODE == "template":
+                # Sin prompt ni decodificación: la plantilla intacta para que el radiólogo la confirme
+                final_report = fast_path_note + template_text
+                NORMAL_FAST_PATH.remember(final_report, study_embedding, template_file, template_text, True, True)
+                return final_report
+            max_new_tokens = min(int(max_new_tokens), NORMAL_FASTPATH_MAX_NEW_TOKENS)
 
-        logger.debug(f"Processor timing: {time.time()-t0:.2f}s")
+        # El processor.apply_chat_template insertará automáticamente los tokens <image>
+        # Segmento estático ANTES de la imagen para reutilizar su KV-cache
+        prompt_prefix, prompt_suffix = build_prompt_parts(
+            modalidad, region, indicacion, extras, template_text,
+            image_embedding=study_embedding if FEWSHOT_VISUAL_ENABLED else None,
+            count_tokens=prompt_token_counter(),
+        )
+        prompt_text = f"{prompt_prefix}\n{prompt_suffix}"
+        prefix_key = make_prefix_key(modalidad, prompt_prefix)
         
-        # Mover inputs al device correcto (y dtype del modelo si aplica)
-        try:
-            model_dtype = getattr(model, "dtype", None)
-            logger.debug(f"Preparando inputs... (model_dtype={model_dtype})")
-            inputs = prepare_inputs(inputs, model, dtype=model_dtype)
-            logger.info("OK: Inputs movidos a device correcto")
-        except Exception as prep_err:
-            logger.error(f"Error en prepare_inputs: {prep_err}")
-            raise ValueError(f"Fallo al preparar inputs para GPU: {prep_err}")
-
+        log_memory_stats("before_generation")
+        inputs = build_generation_inputs(img, prompt_prefix, prompt_suffix)
 
+        if cancel_token is not None and cancel_token.cancelled:
+            return "⏹️ Generación detenida antes de empezar a decodificar."
 
         # Generar
         t1 = time.time()
         logger.info("Iniciando model.generate()...")
+        decode_info: Dict[str, Any] = {}
         try:
-            out = generate_with_beam_search(inputs, model, processor, int(max_new_tokens), num_beams=1)
+            gen_options = dict(
+                prefix_key=prefix_key, streamer=streamer, constrain_json=True, image_key=image_key, template_text=template_text,
+                cancel_token=cancel_token, priority=priority, decode_info=decode_info,
+                on_first_token=lambda: ADMISSION.record_ttft(priority, time.perf_counter() - request_start),
+            )
+            if prepared_tpl is not None and prepared_tpl["lookup_tokens"] is not None:
+                gen_options.update(lookup_texts=prepared_tpl["lookup_texts"], lookup_tokens=prepared_tpl["lookup_tokens"])
+            else:
+                gen_options["lookup_texts"] = build_lookup_corpus(template_file, template_text)
+            if MICRO_BATCHING_ENABLED and priority_rank(priority) > 0:
+                # Las de rutina se agrupan; las urgentes no esperan a la ventana ni al batch en curso
+                gen_options.pop("priority")
+                out = GENERATION_SCHEDULER.run(inputs, int(max_new_tokens), **gen_options)
+            else:
+                out = generate_with_beam_search(inputs, model, processor, int(max_new_tokens), num_beams=1, **gen_options)
             logger.info(f"OK: Generacion completada en {time.time()-t1:.2f}s")
         except Exception as gen_err:
             logger.error(f"Error en generate_with_beam_search: {type(gen_err).__name__}: {gen_err}")
             # Fallback: reintentar con prompt manual y processor(text, images)
             if isinstance(gen_err, ValueError) and "image tokens" in str(gen_err).lower():
                 try:
-                    logger.warning("Reintentando con prompt manual <image> + processor(text, images)")
-                    manual_prompt = f"<image>\n{prompt_text}"
+                    logger.warning("Reintentando con prompt manual (prefijo + <image> + sufijo) y processor(text, images)")
+                    manual_prompt = f"{prompt_prefix}\n<image>\n\n{prompt_suffix}"
                     retry_inputs = processor(
                         text=manual_prompt,
                         images=img,
@@ -524,7 +1132,8 @@ def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion
                     model_dtype = getattr(model, "dtype", None)
                     retry_inputs = prepare_inputs(retry_inputs, model, dtype=model_dtype)
                     out = generate_with_beam_search(
-                        retry_inputs, model, processor, int(max_new_tokens), num_beams=1
+                        retry_inputs, model, processor, int(max_new_tokens), num_beams=1, constrain_json=True, image_key=image_key,
+                        template_text=template_text, cancel_token=cancel_token, priority=priority, decode_info=decode_info,
                     )
                     inputs = retry_inputs
                     logger.info(f"OK: Generacion completada en {time.time()-t1:.2f}s (fallback)")
@@ -536,9 +1145,10 @@ def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion
         logger.debug(f"Generation timing: {time.time()-t1:.2f}s")
         log_memory_stats("after_generation")
 
-        # Decodificar
+        # Decodificar solo los tokens nuevos (el prompt contiene su propio esqueleto ```json```)
         t2 = time.time()
-        generated_text = processor.tokenizer.batch_decode(out, skip_special_tokens=True)[0]
+        prompt_len = inputs["input_ids"].shape[-1]
+        generated_text = processor.tokenizer.batch_decode(out[:, prompt_len:], skip_special_tokens=True)[0]
         logger.debug(f"Decode timing: {time.time()-t2:.2f}s")
 
         # Limpiar salida
@@ -554,6 +1164,9 @@ def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion
                 generated_text = generated_text.split(bt)[0]
 
         decoded = generated_text.strip()
+        cancelled = cancel_token is not None and cancel_token.cancelled
+        if cancelled:
+            logger.info(f"Generación detenida por el usuario tras {out.shape[-1] - prompt_len} tokens; se aprovecha el borrador parcial")
 
         # Extraer y parsear JSON
         json_fallback_used = False
@@ -564,35 +1177,15 @@ def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion
         except ValueError as e:
             logger.warning(f"No se encontró JSON en la salida: {e}")
             try:
-                repair_prompt = build_repair_prompt(decoded, template_text)
-                repair_inputs = None
-                if hasattr(processor, "apply_chat_template"):
-                    repair_messages = [
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": repair_prompt}
-                            ],
-                        }
-                    ]
-                    repair_inputs = processor.apply_chat_template(
-                        repair_messages,
-                        add_generation_prompt=True,
-                        tokenize=True,
-                        return_dict=True,
-                        return_tensors="pt"
-                    )
+                if decode_info.get("constrained") or cancelled:
+                    # Con decodificación restringida (o detenida por el usuario) solo
+                    # puede faltar el cierre: se completa sin segunda generación;
+                    # si la restricción no llegó a activarse, se repara con el modelo
+                    json_output = json.loads(complete_partial_json(decoded))
                 else:
-                    repair_inputs = processor(text=repair_prompt, return_tensors="pt")
-                model_dtype = getattr(model, "dtype", None)
-                repair_inputs = prepare_inputs(repair_inputs, model, dtype=model_dtype)
-                repair_out = generate_with_beam_search(repair_inputs, model, processor, int(max_new_tokens), num_beams=1)
-                repair_text = processor.tokenizer.batch_decode(repair_out, skip_special_tokens=True)[0]
-                json_text = extract_json_block(repair_text)
-                json_output = json.loads(json_text)
+                    json_output = repair_json_with_model(decoded, template_text, int(max_new_tokens))
                 json_repaired = True
                 json_fallback_used = False
-                del repair_inputs, repair_out
             except Exception as repair_err:
                 logger.warning(f"Falló reparación de JSON: {repair_err}")
                 json_fallback_used = True
@@ -616,8 +1209,10 @@ def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion
         json_text = json.dumps(json_output, ensure_ascii=False, indent=2)
 
         # Aplicar ediciones a plantilla
-        final_report = apply_edits(template_text, json_text)
-        if json_repaired:
+        final_report = apply_edits(template_text, json_text, EDIT_FORMAT)
+        if cancelled:
+            final_report = "⏹️ Generación detenida: borrador parcial con las ediciones completas hasta ese momento.\n\n" + final_report
+        elif json_repaired:
             final_report = "ℹ️ JSON reconstruido automáticamente a partir del borrador del modelo.\n\n" + final_report
         elif json_fallback_used:
             final_report = "⚠️ El modelo no devolvió JSON; se muestra la plantilla sin cambios. Reintenta con otra imagen o ajusta el prompt.\n\n" + final_report
@@ -627,7 +1222,10 @@ def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion
         
         # Auditoría final
         adds = json_output.get("add_findings", [])
-        final_report = audit_report_internal(final_report, template_text, bool(adds))
+        final_report = fast_path_note + audit_report_internal(final_report, template_text, bool(adds))
+        if study_embedding is not None and not json_fallback_used and not cancelled:
+            # Se etiqueta cuando llegue la valoración de este informe
+            NORMAL_FAST_PATH.remember(final_report, study_embedding, template_file, template_text, edits_are_normal(json_output), fast_path)
         
         # Liberar memoria GPU para evitar OOM en generaciones sucesivas
         del inputs, out
@@ -690,6 +1288,75 @@ def generate(img: Optional[Image.Image], modalidad: str, region: str, indicacion
         return error_msg
 
 
+# ============================================================================
+# GENERACIÓN EN STREAMING (salida progresiva en la UI)
+# ============================================================================
+
+def render_partial_report(template_text: str, partial_text: str, n_chunks: int) -> str:
+    """
+    Renderiza un borrador progresivo a partir de la salida parcial del modelo.
+    Si el bloque JSON ya tiene algún valor completo, aplica las ediciones a la plantilla;
+    si no, muestra el texto generado hasta ahora.
+    """
+    header = f"⏳ Generando borrador... ({n_chunks} fragmentos recibidos)\n\n"
+    try:
+        partial_json = complete_partial_json(partial_text)
+        if json.loads(partial_json):
+            return header + apply_edits(template_text, partial_json, EDIT_FORMAT)
+    except (ValueError, TypeError, AttributeError):
+        pass
+    return header + partial_text
+
+
+def generate_stream(img: Optional[Image.Image], modalidad: str, region: str, indicacion: str, extras: str, template_file: str, max_new_tokens: int, max_tokens_limit: int, full_generation: bool = False, cancel_token: Optional[CancellationToken] = None, priority: str = "routine", request_start: Optional[float] = None):
+    """
+    Versión streaming de generate(): ejecuta generate() en un hilo worker con un
+    TextIteratorStreamer y va devolviendo (yield) el borrador parcial.
+    El último valor devuelto es siempre el resultado final de generate().
+    """
+    from transformers import TextIteratorStreamer
+
+    is_valid, error_msg = validate_inputs(img, modalidad, region, template_file, max_new_tokens, max_tokens_limit)
+    if not is_valid:
+        yield error_msg
+        return
+
+    try:
+        template_text = (read_template(template_file).get("template_text") or "").strip()
+        ensure_model_loaded()
+    except Exception:
+        # generate() reporta el error con su contexto completo
+        yield generate(img, modalidad, region, indicacion, extras, template_file, max_new_tokens, max_tokens_limit, full_generation=full_generation, cancel_token=cancel_token, priority=priority, request_start=request_start)
+        return
+
+    streamer = TextIteratorStreamer(processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    result: Dict[str, str] = {}
+
+    def _worker():
+        try:
+            result["report"] = generate(img, modalidad, region, indicacion, extras, template_file, max_new_tokens, max_tokens_limit, streamer=streamer, full_generation=full_generation, cancel_token=cancel_token, priority=priority, request_start=request_start)
+        finally:
+            # Desbloquea al consumidor aunque generate() falle antes de model.generate()
+            streamer.end()
+
+    worker = threading.Thread(target=_worker, name="radiapp-generate", daemon=True)
+    worker.start()
+
+    partial_text = ""
+    n_chunks = 0
+    last_render = 0.0
+    for chunk in streamer:
+        partial_text += chunk
+        n_chunks += 1
+        now = time.time()
+        if now - last_render >= STREAM_RENDER_INTERVAL_SECONDS:
+            last_render = now
+            yield render_partial_report(template_text, partial_text, n_chunks)
+
+    worker.join()
+    yield result.get("report", "❌ Error: la generación terminó sin resultado (ver radiapp.log)")
+
+
 # ============================================================================
 # FEEDBACK
 # ============================================================================
@@ -709,6 +1376,10 @@ def save_feedback(template_file: str, modalidad: str, region: str, indicacion: s
     with open(FEEDBACK_CSV, "a", encoding="utf-8", newline="") as f:
         w = csv.writer(f)
         w.writerow([ts, template_file, modalidad, region, indicacion, output, rating, comentario, version_final])
+    try:
+        NORMAL_FAST_PATH.record_outcome(output, rating, version_final)
+    except Exception as clf_err:
+        logger.warning(f"No se pudo registrar la muestra del clasificador de normales: {clf_err}")
     return f"✅ Feedback guardado: {ts}"
 
 
@@ -738,6 +1409,8 @@ create_default_template()
 
 with gr.Blocks(title="RadiAPP – MedGemma") as demo:
     gr.Markdown("## 🩻 RadiAPP – Informes radiológicos\nSube imágenes **anonimizadas**.")
+    readiness_md = gr.Markdown(READINESS.markdown())
+    gr.Timer(2).tick(READINESS.markdown, outputs=[readiness_md])
 
     with gr.Tab("Generar"):
         with gr.Row():
@@ -757,8 +1430,15 @@ with gr.Blocks(title="RadiAPP – MedGemma") as demo:
                         label="Cantidad de caracteres deseados"
                     )
                     unlimited_tokens = gr.Checkbox(value=False, label="Sin límite (más lento)")
+                    full_generation = gr.Checkbox(value=False, label="Generación completa (sin vía rápida de normales)")
+                priority_radio = gr.Radio(
+                    choices=[("Rutina", "routine"), ("Urgente", "urgent")], value="routine", label="Prioridad",
+                    info="Las urgentes pasan delante en la cola y pausan las de rutina en curso",
+                )
 
-        btn = gr.Button("Generar borrador")
+        with gr.Row():
+            btn = gr.Button("Generar borrador", scale=3)
+            stop_btn = gr.Button("⏹️ Detener", scale=1, variant="stop")
         output = gr.Code(label="Salida (usa el botón Copy)", language="markdown")  # trae Copy nativo
         
         # Estados para guardar contexto de generación
@@ -775,12 +1455,19 @@ with gr.Blocks(title="RadiAPP – MedGemma") as demo:
                 if not output_text or output_text.startswith("❌") or output_text.startswith("⚠️"):
                     return "❌ No hay output válido para guardar"
                 
+                # Embedding de la imagen del informe (antes de que record_outcome lo consuma)
+                embedding = NORMAL_FAST_PATH.embedding_for(output_text)
+
                 # Guardar feedback automático con rating máximo
                 ensure_feedback_header()
                 ts = datetime.now().isoformat(timespec="seconds")
                 with open(FEEDBACK_CSV, "a", encoding="utf-8", newline="") as f:
                     w = csv.writer(f)
                     w.writerow([ts, template_file, modalidad, region, indicacion, output_text, "5", "Aprobado automático - borrador bueno", output_text])
+                try:
+                    NORMAL_FAST_PATH.record_outcome(output_text, 5)
+                except Exception as clf_err:
+                    logger.warning(f"No se pudo registrar la muestra del clasificador de normales: {clf_err}")
                 
                 # Extraer JSON para guardar como ejemplo bueno
                 try:
@@ -790,7 +1477,7 @@ with gr.Blocks(title="RadiAPP – MedGemma") as demo:
                     # Crear etiqueta descriptiva del ejemplo
                     label = f"{modalidad} - {region} ({ts[-8:-3]})"
                     example_with_label = {"label": label, **json_obj}
-                    save_good_example(example_with_label)
+                    save_good_example(example_with_label, modalidad, region, embedding=embedding)
                     
                     return f"✅ ¡Excelente! Borrador guardado como ejemplo bueno.\n📚 MedGemma aprenderá de este patrón en futuras generaciones."
                 except (json.JSONDecodeError, ValueError):
@@ -811,11 +1498,46 @@ with gr.Blocks(title="RadiAPP – MedGemma") as demo:
         feedback_status = gr.Markdown("")
         
         # Lógica del flujo
-        def generate_and_store(img_input, mod, reg, ind, ext, tpl, tokens, is_unlimited):
-            """Genera y guarda estado"""
+        def generate_and_store(img_input, mod, reg, ind, ext, tpl, tokens, is_unlimited, is_full, priority, request: gr.Request = None):
+            """Genera (en streaming si está activo) y guarda estado al final"""
+            request_start = time.perf_counter()
             max_limit = MAX_MAX_TOKENS_UNLIMITED if is_unlimited else MAX_MAX_TOKENS
-            result = generate(img_input, mod, reg, ind, ext, tpl, tokens, max_limit)
-            return result, result, tpl, mod, reg, ind
+            session = _session_id(request)
+            cancel_token = GENERATION_CANCEL.start(session)
+            ticket = None
+            try:
+                # Turno en la cola de generación (posición y espera estimada en vivo)
+                try:
+                    kv_bytes = estimate_request_kv_bytes(mod, reg, ind, ext, tpl, tokens)
+                    ticket = ADMISSION.enqueue(kv_bytes, priority)
+                except AdmissionRejected as rejected:
+                    yield f"⚠️ {rejected}", gr.skip(), gr.skip(), gr.skip(), gr.skip(), gr.skip()
+                    return
+                while not ADMISSION.wait(ticket, QUEUE_POLL_SECONDS):
+                    if cancel_token.cancelled:
+                        yield "⏹️ Petición retirada de la cola.", gr.skip(), gr.skip(), gr.skip(), gr.skip(), gr.skip()
+                        return
+                    yield queue_status_message(ticket), gr.skip(), gr.skip(), gr.skip(), gr.skip(), gr.skip()
+
+                if not STREAMING_ENABLED:
+                    result = generate(img_input, mod, reg, ind, ext, tpl, tokens, max_limit, full_generation=is_full, cancel_token=cancel_token, priority=priority, request_start=request_start)
+                    yield result, result, tpl, mod, reg, ind
+                    return
+                result = ""
+                for result in generate_stream(img_input, mod, reg, ind, ext, tpl, tokens, max_limit, is_full, cancel_token, priority, request_start):
+                    # Borrador parcial: solo se actualiza la salida, no el estado
+                    yield result, gr.skip(), gr.skip(), gr.skip(), gr.skip(), gr.skip()
+                yield result, result, tpl, mod, reg, ind
+            finally:
+                if ticket is not None:
+                    ADMISSION.leave(ticket)
+                GENERATION_CANCEL.finish(session, cancel_token)
+
+        def stop_generation(request: gr.Request = None):
+            """Botón Detener: corta la generación en curso de esta sesión"""
+            if GENERATION_CANCEL.cancel(_session_id(request)):
+                return "⏹️ Deteniendo... se mostrará el borrador parcial."
+            return "No hay ninguna generación en curso."
         
         def clear_output():
             """Limpia salida"""
@@ -828,10 +1550,20 @@ with gr.Blocks(title="RadiAPP – MedGemma") as demo:
         # Conectar generación
         btn.click(
             generate_and_store,
-            inputs=[img, modalidad, region, indicacion, extras, template_dd, max_new_tokens, unlimited_tokens],
-            outputs=[output, last_output_state, last_template_state, last_modalidad_state, last_region_state, last_indicacion_state]
+            inputs=[img, modalidad, region, indicacion, extras, template_dd, max_new_tokens, unlimited_tokens, full_generation, priority_radio],
+            outputs=[output, last_output_state, last_template_state, last_modalidad_state, last_region_state, last_indicacion_state],
+            # Sin límite en Gradio: la cola propia (ADMISSION) limita las generaciones en
+            # ejecución, muestra la posición y rechaza lo que no cabe
+            concurrency_limit=None
         )
 
+        stop_btn.click(stop_generation, outputs=[feedback_status], queue=False)
+
+        # Preparación anticipada mientras se rellenan región e indicación
+        img.change(on_image_change, inputs=[img], outputs=None, queue=False, show_progress="hidden")
+        template_dd.change(on_template_change, inputs=[template_dd], outputs=None, queue=False, show_progress="hidden")
+        demo.load(on_template_change, inputs=[template_dd], outputs=None, queue=False, show_progress="hidden")
+
         # Toggle límite de tokens
         def toggle_unlimited(is_unlimited):
             if is_unlimited:
@@ -970,4 +1702,19 @@ if __name__ == "__main__":
     server_name = os.getenv("GRADIO_SERVER_NAME", "127.0.0.1")
     port_env = os.getenv("GRADIO_SERVER_PORT")
     server_port = int(port_env) if port_env else None
-    demo.launch(server_name=server_name, server_port=server_port, pwa=True)
+    if NORMAL_FASTPATH_ENABLED:
+        threading.Thread(target=prepare_normal_fast_path, name="normal-classifier-seed", daemon=True).start()
+    if STARTUP_WARMUP_ENABLED:
+        # Gradio sirve la UI mientras el modelo se carga y calienta
+        start_background_warmup(ensure_model_loaded, warmup_model)
+    # Hilos para las peticiones en ejecución y en cola además del resto de eventos de la UI
+    max_threads = max(40, ADMISSION.max_workers + ADMISSION.max_queue + 8)
+    demo.launch(server_name=server_name, server_port=server_port, pwa=True, prevent_thread_lock=True, max_threads=max_threads)
+    from fastapi.responses import JSONResponse
+
+    def _health():
+        payload, status_code = health_payload()
+        return JSONResponse(payload, status_code=status_code)
+
+    demo.app.add_api_route("/health", _health, methods=["GET"])
+    demo.block_thread()
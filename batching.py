@@ -0,0 +1,190 @@
+"""
+Micro-batching de peticiones de generación
+Agrupa las peticiones que llegan dentro de una ventana corta y las ejecuta
+en un único model.generate() con batch (input_ids con padding a la izquierda
+y pixel_values apilados)
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# PETICIONES Y COLACIÓN DE INPUTS
+# ============================================================================
+
+class BatchRequest:
+    """Una petición de generación pendiente y su resultado (Future)."""
+
+    __slots__ = ("inputs", "max_new_tokens", "options", "future", "enqueued_at")
+
+    def __init__(self, inputs: Dict[str, Any], max_new_tokens: int, options: Optional[Dict[str, Any]] = None):
+        self.inputs = inputs
+        self.max_new_tokens = int(max_new_tokens)
+        self.options = options or {}
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+def collate_inputs(inputs_list: List[Dict[str, Any]], pad_token_id: int) -> Dict[str, Any]:
+    """
+    Une los inputs de varias peticiones en un batch.
+    input_ids/attention_mask se rellenan a la izquierda (decoder-only) y
+    pixel_values se concatenan en el orden de las peticiones.
+    """
+    max_len = max(inp["input_ids"].shape[-1] for inp in inputs_list)
+    input_ids, attention_mask = [], []
+    for inp in inputs_list:
+        ids = inp["input_ids"]
+        mask = inp.get("attention_mask", torch.ones_like(ids))
+        pad = max_len - ids.shape[-1]
+        input_ids.append(torch.cat([torch.full((ids.shape[0], pad), int(pad_token_id), dtype=ids.dtype, device=ids.device), ids], dim=-1))
+        attention_mask.append(torch.cat([torch.zeros((mask.shape[0], pad), dtype=mask.dtype, device=mask.device), mask], dim=-1))
+
+    batch = {
+        "input_ids": torch.cat(input_ids, dim=0),
+        "attention_mask": torch.cat(attention_mask, dim=0),
+    }
+    if all("pixel_values" in inp for inp in inputs_list):
+        batch["pixel_values"] = torch.cat([inp["pixel_values"] for inp in inputs_list], dim=0)
+    return batch
+
+
+def split_outputs(out: torch.Tensor, requests: List[BatchRequest], padded_len: int) -> List[torch.Tensor]:
+    """
+    Separa la salida del batch por petición: prompt original + sus tokens
+    nuevos (recortados a su propio max_new_tokens). Así cada petición puede
+    decodificar out[:, prompt_len:] igual que sin batching.
+    """
+    results = []
+    for row, req in enumerate(requests):
+        new_tokens = out[row:row + 1, padded_len:padded_len + req.max_new_tokens]
+        results.append(torch.cat([req.inputs["input_ids"].to(out.device), new_tokens], dim=-1))
+    return results
+
+
+class BatchStreamerFanout(BaseStreamer):
+    """Reparte los tokens de un generate() con batch a un streamer por fila."""
+
+    def __init__(self, streamers: List[Optional[Any]]):
+        self.streamers = streamers
+
+    def put(self, value: torch.Tensor) -> None:
+        # Primera llamada: prompt completo (batch, seq); después: (batch,)
+        for row, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.put(value[row:row + 1])
+
+    def end(self) -> None:
+        for streamer in self.streamers:
+            if streamer is not None:
+                streamer.end()
+
+
+# ============================================================================
+# SCHEDULER
+# ============================================================================
+
+class MicroBatchScheduler:
+    """
+    Cola de peticiones con un hilo que forma batches de hasta max_batch_size
+    esperando como máximo max_wait_ms desde la primera petición del batch.
+    run_batch(requests) debe devolver un resultado por petición, en orden.
+    """
+
+    def __init__(self, run_batch: Callable[[List[BatchRequest]], List[Any]], max_batch_size: int = 4, max_wait_ms: float = 50.0):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue: "queue.Queue[BatchRequest]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.batches = 0
+        self.requests = 0
+        self.total_wait = 0.0
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._loop, name="microbatch", daemon=True)
+                self._thread.start()
+
+    def submit(self, inputs: Dict[str, Any], max_new_tokens: int, **options) -> Future:
+        """Encola una petición; el Future se resuelve con su resultado."""
+        request = BatchRequest(inputs, max_new_tokens, options)
+        self._ensure_worker()
+        self._queue.put(request)
+        return request.future
+
+    def run(self, inputs: Dict[str, Any], max_new_tokens: int, **options) -> Any:
+        """Encola y espera el resultado (propaga la excepción del batch)."""
+        return self.submit(inputs, max_new_tokens, **options).result()
+
+    def _collect(self) -> List[BatchRequest]:
+        """Bloquea hasta la primera petición y agrupa las que lleguen en la ventana."""
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=0.5)
+                break
+            except queue.Empty:
+                continue
+        else:
+            return []
+
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.total_wait += sum(started - req.enqueued_at for req in batch)
+            logger.info(f"Micro-batch: {len(batch)} petición(es)")
+            try:
+                results = self.run_batch(batch)
+                for req, result in zip(batch, results):
+                    req.future.set_result(result)
+            except Exception as e:
+                logger.error(f"Error en micro-batch de {len(batch)} peticiones: {e}")
+                for req in batch:
+                    if not req.future.done():
+                        req.future.set_exception(e)
+
+    def shutdown(self) -> None:
+        """Detiene el hilo tras el batch en curso."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        """Batches ejecutados, tamaño medio y espera media en cola."""
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "avg_batch_size": (self.requests / self.batches) if self.batches else 0.0,
+                "avg_wait_ms": (1000 * self.total_wait / self.requests) if self.requests else 0.0,
+            }
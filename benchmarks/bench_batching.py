@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark del micro-batching (batching.py)
+Curvas de throughput y latencia para distintos BATCH_MAX_SIZE y
+BATCH_MAX_WAIT_MS con llegadas concurrentes (proceso de Poisson).
+
+Por defecto usa un Gemma3 diminuto con pesos aleatorios (mide el efecto del
+batching, no la calidad); con --real carga MODEL_ID vía model_loader.
+
+Uso:
+    python benchmarks/bench_batching.py [--requests 16] [--rate 4] [--real]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import MicroBatchScheduler, collate_inputs, split_outputs
+
+
+def tiny_model():
+    """Gemma3 diminuto con pesos aleatorios y prompts sintéticos"""
+    from transformers import Gemma3Config, Gemma3ForConditionalGeneration
+    cfg = Gemma3Config(
+        text_config=dict(vocab_size=300, hidden_size=128, intermediate_size=256, num_hidden_layers=4,
+                         num_attention_heads=4, num_key_value_heads=1, head_dim=32, sliding_window=64,
+                         max_position_embeddings=4096),
+        vision_config=dict(hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=2,
+                           image_size=64, patch_size=8),
+        mm_tokens_per_image=16, image_token_index=299, boi_token_index=297, eoi_token_index=298,
+    )
+    torch.manual_seed(0)
+    model = Gemma3ForConditionalGeneration(cfg).eval()
+
+    def make_inputs(rng):
+        text = [rng.randrange(5, 290) for _ in range(rng.randint(150, 300))]
+        ids = torch.tensor([[2] + text[:100] + [297] + [299] * 16 + [298] + text[100:]])
+        return {"input_ids": ids, "attention_mask": torch.ones_like(ids), "pixel_values": torch.randn(1, 3, 64, 64)}
+
+    return model, make_inputs, 0
+
+
+def real_model():
+    """MedGemma real con una imagen y prompt de ejemplo"""
+    from PIL import Image
+    from model_loader import load_model, prepare_inputs
+    from prompt_builder import build_prompt_parts
+    model, processor, _ = load_model()
+
+    def make_inputs(rng):
+        prefix, suffix = build_prompt_parts("TC", "Cráneo", f"Cefalea {rng.randint(1, 99)}", "", "Sin hallazgos.")
+        img = Image.new("RGB", (512, 512), color=(rng.randint(0, 255),) * 3)
+        messages = [{"role": "user", "content": [
+            {"type": "text", "text": prefix}, {"type": "image", "image": img}, {"type": "text", "text": suffix}]}]
+        inputs = processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=True, return_dict=True, return_tensors="pt")
+        return prepare_inputs(inputs, model, dtype=getattr(model, "dtype", None))
+
+    return model, make_inputs, processor.tokenizer.pad_token_id or 0
+
+
+def run_point(model, make_inputs, pad_token_id, batch_size, wait_ms, n_requests, rate, max_new_tokens):
+    """Lanza n_requests con llegadas de Poisson y mide latencias y throughput"""
+    def run_batch(requests):
+        if len(requests) == 1:
+            req = requests[0]
+            with torch.inference_mode():
+                return [model.generate(**req.inputs, max_new_tokens=req.max_new_tokens, do_sample=False)]
+        batch = collate_inputs([r.inputs for r in requests], pad_token_id)
+        with torch.inference_mode():
+            out = model.generate(**batch, max_new_tokens=max(r.max_new_tokens for r in requests), do_sample=False)
+        return split_outputs(out, requests, batch["input_ids"].shape[-1])
+
+    scheduler = MicroBatchScheduler(run_batch, batch_size, wait_ms)
+    rng = random.Random(0)
+    inputs = [make_inputs(rng) for _ in range(n_requests)]
+    latencies = []
+    lock = threading.Lock()
+
+    def client(inp):
+        t0 = time.perf_counter()
+        scheduler.run(inp, max_new_tokens)
+        with lock:
+            latencies.append(time.perf_counter() - t0)
+
+    threads = []
+    t_start = time.perf_counter()
+    for inp in inputs:
+        th = threading.Thread(target=client, args=(inp,))
+        th.start()
+        threads.append(th)
+        time.sleep(rng.expovariate(rate))
+    for th in threads:
+        th.join()
+    elapsed = time.perf_counter() - t_start
+    scheduler.shutdown()
+
+    latencies.sort()
+    stats = scheduler.stats()
+    return {
+        "req_s": n_requests / elapsed,
+        "tok_s": n_requests * max_new_tokens / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        "avg_batch": stats["avg_batch_size"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=4.0, help="llegadas por segundo")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--batch-sizes", default="1,2,4,8")
+    parser.add_argument("--waits-ms", default="0,50,200")
+    parser.add_argument("--real", action="store_true")
+    args = parser.parse_args()
+
+    model, make_inputs, pad_token_id = real_model() if args.real else tiny_model()
+    print(f"{'batch':>5} {'wait_ms':>7} {'req/s':>7} {'tok/s':>8} {'p50 s':>7} {'p95 s':>7} {'batch medio':>11}")
+    for batch_size in [int(x) for x in args.batch_sizes.split(",")]:
+        for wait_ms in [float(x) for x in args.waits_ms.split(",")]:
+            r = run_point(model, make_inputs, pad_token_id, batch_size, wait_ms, args.requests, args.rate, args.max_new_tokens)
+            print(f"{batch_size:>5} {wait_ms:>7.0f} {r['req_s']:>7.2f} {r['tok_s']:>8.1f} {r['p50']:>7.2f} {r['p95']:>7.2f} {r['avg_batch']:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Benchmark del arranque en frío de model_loader.load_model()
+Compara la ruta antigua (from_pretrained desde MODEL_ID + conversión de dtype)
+con la carga desde el snapshot local pre-convertido. Cada medición se hace en
+un proceso nuevo para no reutilizar memoria ni caché de Python.
+
+Uso:
+    python benchmarks/bench_cold_start.py [--runs 2]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = (
+    "import json, model_loader; model_loader.load_model(); "
+    "t = model_loader.SNAPSHOT_THREAD; t.join() if t is not None else None; "
+    "print('RESULT ' + json.dumps({k: str(v) for k, v in model_loader.MODEL_INFO.items()}))"
+)
+
+
+def cold_start(snapshot_enabled: bool) -> dict:
+    """Lanza load_model() en un proceso nuevo; devuelve MODEL_INFO y el tiempo total"""
+    env = dict(os.environ, WEIGHT_SNAPSHOT_ENABLED="1" if snapshot_enabled else "0")
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    lines = [l for l in proc.stdout.splitlines() if l.startswith("RESULT ")]
+    if proc.returncode != 0 or not lines:
+        raise RuntimeError(proc.stderr[-2000:])
+    info = json.loads(lines[-1][len("RESULT "):])
+    info["wall_seconds"] = round(wall, 2)
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=2)
+    args = parser.parse_args()
+
+    # Primer arranque con snapshot activo: si no existe, se crea aquí
+    first = cold_start(True)
+    print(f"Preparación: origen={first['source']} carga={first['load_seconds']}s")
+
+    print(f"{'ruta':>9} {'carga s':>8} {'proceso s':>10}")
+    for label, enabled in (("antigua", False), ("snapshot", True)):
+        for _ in range(args.runs):
+            info = cold_start(enabled)
+            print(f"{label:>9} {float(info['load_seconds']):>8.1f} {info['wall_seconds']:>10.1f}  (origen={info['source']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark del batching continuo (continuous_batching.py)
+Tokens/s sostenidos bajo carga mixta (informes cortos y largos tipo
+"Sin límite") comparando micro-batching estático frente al motor continuo.
+
+Uso:
+    python benchmarks/bench_continuous_batching.py [--requests 24] [--rate 8] [--real]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from batching import MicroBatchScheduler, collate_inputs, split_outputs
+from continuous_batching import ContinuousBatchingEngine
+from bench_batching import tiny_model, real_model
+
+
+def drive(submit, inputs, budgets, rate):
+    """Lanza las peticiones con llegadas de Poisson; devuelve (tokens, segundos, latencias)"""
+    rng = random.Random(1)
+    latencies, tokens = [], [0]
+    lock = threading.Lock()
+
+    def client(inp, max_new):
+        t0 = time.perf_counter()
+        out = submit(inp, max_new)
+        with lock:
+            latencies.append(time.perf_counter() - t0)
+            tokens[0] += out.shape[-1] - inp["input_ids"].shape[-1]
+
+    threads = []
+    t_start = time.perf_counter()
+    for inp, max_new in zip(inputs, budgets):
+        th = threading.Thread(target=client, args=(inp, max_new))
+        th.start()
+        threads.append(th)
+        time.sleep(rng.expovariate(rate))
+    for th in threads:
+        th.join()
+    return tokens[0], time.perf_counter() - t_start, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=24)
+    parser.add_argument("--rate", type=float, default=8.0, help="llegadas por segundo")
+    parser.add_argument("--short", type=int, default=16, help="max_new_tokens de informes cortos")
+    parser.add_argument("--long", type=int, default=160, help="max_new_tokens de informes largos")
+    parser.add_argument("--slots", type=int, default=8)
+    parser.add_argument("--real", action="store_true")
+    args = parser.parse_args()
+
+    model, make_inputs, pad_token_id = real_model() if args.real else tiny_model()
+    rng = random.Random(0)
+    inputs = [make_inputs(rng) for _ in range(args.requests)]
+    budgets = [args.long if rng.random() < 0.25 else args.short for _ in range(args.requests)]
+    no_eos = [10 ** 9]
+
+    def run_batch(requests):
+        batch = collate_inputs([r.inputs for r in requests], pad_token_id)
+        with torch.inference_mode():
+            out = model.generate(**batch, max_new_tokens=max(r.max_new_tokens for r in requests),
+                                 min_new_tokens=max(r.max_new_tokens for r in requests), do_sample=False)
+        return split_outputs(out, requests, batch["input_ids"].shape[-1])
+
+    scheduler = MicroBatchScheduler(run_batch, args.slots, 50)
+    engine = ContinuousBatchingEngine(model, max_slots=args.slots)
+    modes = {
+        "estático": lambda inp, n: scheduler.run(inp, n),
+        "continuo": lambda inp, n: engine.generate(inp, n, no_eos),
+    }
+
+    print(f"{args.requests} peticiones ({budgets.count(args.long)} largas de {args.long} tokens, resto de {args.short})")
+    print(f"{'modo':>9} {'tokens/s':>9} {'p50 s':>7} {'p95 s':>7}")
+    for name, submit in modes.items():
+        tokens, elapsed, lat = drive(submit, inputs, budgets, args.rate)
+        p95 = lat[min(len(lat) - 1, int(0.95 * len(lat)))]
+        print(f"{name:>9} {tokens / elapsed:>9.1f} {lat[len(lat) // 2]:>7.2f} {p95:>7.2f}")
+    scheduler.shutdown()
+    engine.shutdown()
+
+
+if __name__ == "__main__":
+    main()
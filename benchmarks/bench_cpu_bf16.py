@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de prefill y decode en CPU: float32 frente a bfloat16
+Usa un decoder Gemma3 con las dimensiones de capa de MedGemma 4B (hidden 2560,
+MLP 10240, 8 cabezas / 4 KV) y pesos aleatorios; --layers y --vocab permiten
+acercarse al modelo completo (34 capas, 262208 tokens) si hay memoria.
+Imprime también las capacidades de CPU que usa CPU_DTYPE=auto.
+
+Uso:
+    python benchmarks/bench_cpu_bf16.py [--layers 4] [--prompt-len 512] [--decode-tokens 32]
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_loader import detect_cpu_features, select_cpu_dtype
+
+
+def build_decoder(layers, vocab, dtype):
+    """Decoder Gemma3 de texto con dimensiones de MedGemma 4B"""
+    from transformers import Gemma3ForCausalLM, Gemma3TextConfig
+    cfg = Gemma3TextConfig(
+        vocab_size=vocab, hidden_size=2560, intermediate_size=10240, num_hidden_layers=layers,
+        num_attention_heads=8, num_key_value_heads=4, head_dim=256, sliding_window=1024,
+        max_position_embeddings=8192,
+    )
+    torch.manual_seed(0)
+    return Gemma3ForCausalLM(cfg).to(dtype).eval()
+
+
+def measure(model, prompt_len, decode_tokens, runs):
+    """Mejor tiempo de prefill (tokens/s) y de decode token a token (tokens/s)"""
+    ids = torch.randint(5, model.config.vocab_size, (1, prompt_len))
+    prefill, decode = [], []
+    with torch.inference_mode():
+        for _ in range(runs + 1):
+            t0 = time.perf_counter()
+            out = model(input_ids=ids, use_cache=True)
+            t1 = time.perf_counter()
+            past = out.past_key_values
+            next_id = out.logits[:, -1:].argmax(-1)
+            for _ in range(decode_tokens):
+                out = model(input_ids=next_id, past_key_values=past, use_cache=True)
+                past = out.past_key_values
+                next_id = out.logits[:, -1:].argmax(-1)
+            t2 = time.perf_counter()
+            prefill.append(t1 - t0)
+            decode.append(t2 - t1)
+    # La primera pasada calienta allocator y kernels de oneDNN
+    return prompt_len / min(prefill[1:]), decode_tokens / min(decode[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--vocab", type=int, default=32000)
+    parser.add_argument("--prompt-len", type=int, default=512)
+    parser.add_argument("--decode-tokens", type=int, default=32)
+    parser.add_argument("--runs", type=int, default=2)
+    args = parser.parse_args()
+
+    features = detect_cpu_features()
+    auto_dtype, reason = select_cpu_dtype("auto", features)
+    print(f"CPU: {features} | hilos torch: {torch.get_num_threads()}")
+    print(f"CPU_DTYPE=auto → {auto_dtype} ({reason})")
+
+    results = {}
+    print(f"{'dtype':>9} {'prefill tok/s':>14} {'decode tok/s':>13}")
+    for dtype in (torch.float32, torch.bfloat16):
+        model = build_decoder(args.layers, args.vocab, dtype)
+        results[dtype] = measure(model, args.prompt_len, args.decode_tokens, args.runs)
+        del model
+        print(f"{str(dtype).replace('torch.', ''):>9} {results[dtype][0]:>14.1f} {results[dtype][1]:>13.2f}")
+
+    fp32, bf16 = results[torch.float32], results[torch.bfloat16]
+    print(f"speedup bf16: prefill x{bf16[0] / fp32[0]:.2f} | decode x{bf16[1] / fp32[1]:.2f}")
+
+
+if __name__ == "__main__":
+    main()
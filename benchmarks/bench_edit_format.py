@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Benchmark del formato de ediciones: líneas copiadas ("text") frente a números
+de línea ("index", EDIT_FORMAT)
+
+1) Sin modelo: para cada plantilla construye el mismo conjunto de ediciones en
+   ambos formatos (elimina ~1/3 y reemplaza ~1/4 de las líneas de HALLAZGOS) y
+   cuenta los tokens del JSON compacto con el tokenizer de MODEL_ID.
+2) Con --generate: carga el modelo y, para cada imagen, genera con decodificación
+   restringida en cada formato, con y sin restricción a líneas de la plantilla
+   (TEMPLATE_LINE_CONSTRAINT); mide tokens generados por informe, latencia de
+   extremo a extremo (prompt + generación + apply_edits) y ediciones perdidas
+   (remove/replace.from que no referencian ninguna línea).
+
+Uso:
+    python benchmarks/bench_edit_format.py [--templates TCAR.json,TC_craneo_simple.json] [--generate] [--images DIR]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FORMATS = ("text", "index")
+
+
+def findings_lines(template_text):
+    """Números de línea (base 1) no vacíos entre HALLAZGOS y CONCLUSIÓN"""
+    numbers, inside = [], False
+    for i, line in enumerate(template_text.splitlines(), 1):
+        upper = line.strip().upper()
+        if upper.startswith("HALLAZGOS"):
+            inside = True
+        elif upper.startswith("CONCLUSIÓN"):
+            inside = False
+        elif inside and line.strip():
+            numbers.append(i)
+    return numbers
+
+
+def synthetic_edits(template_text, edit_format):
+    """Mismas ediciones en ambos formatos, serializadas como JSON compacto"""
+    lines = template_text.splitlines()
+    numbers = findings_lines(template_text)
+    removed = numbers[::3]
+    replaced = [n for n in numbers[1::4] if n not in removed]
+
+    def ref(n):
+        return n if edit_format == "index" else lines[n - 1].strip()
+
+    edits = {
+        "remove": [ref(n) for n in removed],
+        "replace": [{"from": ref(n), "to": "Hallazgo alterado en la imagen."} for n in replaced],
+        "add_findings": [], "lesiometro_missing": [], "confidence_scores": {},
+        "conclusion": {"positives": [], "impression": [], "ddx": [], "recommendations": []},
+    }
+    return json.dumps(edits, ensure_ascii=False, separators=(",", ":"))
+
+
+def wasted_edits(template_text, edits):
+    """remove/replace.from que apply_edits ignoraría por no referenciar ninguna línea"""
+    lines = template_text.splitlines()
+    stripped = {ln.strip() for ln in lines}
+    refs = list(edits.get("remove", [])) + [r.get("from") for r in edits.get("replace", []) if isinstance(r, dict)]
+    wasted = 0
+    for ref in refs:
+        if isinstance(ref, int) and not isinstance(ref, bool):
+            wasted += not (1 <= ref <= len(lines))
+        else:
+            wasted += not (isinstance(ref, str) and ref.strip() in stripped)
+    return wasted
+
+
+def static_comparison(tokenizer, templates):
+    """Tokens del JSON de ediciones equivalente en cada formato"""
+    from report_processor import apply_edits
+    from template_manager import read_template
+
+    print(f"{'plantilla':>24} {'líneas':>7} {'tokens text':>12} {'tokens index':>13} {'ahorro':>7} {'mismo informe':>14}")
+    for name in templates:
+        template_text = read_template(name)["template_text"]
+        payloads = {fmt: synthetic_edits(template_text, fmt) for fmt in FORMATS}
+        tokens = {fmt: len(tokenizer.encode(p, add_special_tokens=False)) for fmt, p in payloads.items()}
+        same = apply_edits(template_text, payloads["text"], "text") == apply_edits(template_text, payloads["index"], "index")
+        saved = 1 - tokens["index"] / tokens["text"] if tokens["text"] else 0.0
+        print(f"{name:>24} {len(template_text.splitlines()):>7} {tokens['text']:>12} {tokens['index']:>13} "
+              f"{saved:>7.0%} {str(same):>14}")
+
+
+def generate_comparison(args, templates):
+    """Tokens generados y latencia de extremo a extremo por formato y plantilla"""
+    import torch
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+    from bench_quantization import load_images
+    from decoding import JsonBlockStoppingCriteria
+    from json_constraint import SchemaConstrainedLogitsProcessor, get_schema_index
+    from model_loader import load_model, prepare_inputs
+    from prompt_builder import build_prompt_parts
+    from report_processor import apply_edits, complete_partial_json, extract_json_block
+    from template_manager import read_template
+
+    model, processor, _ = load_model()
+    tokenizer = processor.tokenizer
+    eos = tokenizer.eos_token_id
+    eos_ids = list(eos) if isinstance(eos, (list, tuple)) else [eos]
+    images = load_images(args.images, args.n_images)
+
+    print(f"{'plantilla':>24} {'formato':>8} {'líneas':>7} {'tokens/informe':>15} {'latencia s':>11} {'JSON ok':>8} {'perdidas':>9}")
+    for name in templates:
+        template_text = read_template(name)["template_text"]
+        for fmt, constrained in [(fmt, c) for fmt in FORMATS for c in (False, True)]:
+            index = get_schema_index(tokenizer, eos_ids, edit_format=fmt, template_text=template_text if constrained else None)
+            tokens = seconds = valid = wasted = 0
+            for img in images:
+                t0 = time.perf_counter()
+                prefix, suffix = build_prompt_parts("TC", "Tórax", "Control", "", template_text, edit_format=fmt)
+                messages = [{"role": "user", "content": [
+                    {"type": "text", "text": prefix}, {"type": "image", "image": img}, {"type": "text", "text": suffix}]}]
+                inputs = processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=True, return_dict=True, return_tensors="pt")
+                inputs = prepare_inputs(inputs, model, dtype=getattr(model, "dtype", None))
+                prompt_len = inputs["input_ids"].shape[-1]
+                with torch.inference_mode():
+                    out = model.generate(
+                        **inputs, max_new_tokens=args.max_new_tokens, do_sample=False,
+                        logits_processor=LogitsProcessorList([SchemaConstrainedLogitsProcessor(index, prompt_len)]),
+                        stopping_criteria=StoppingCriteriaList([JsonBlockStoppingCriteria(tokenizer, prompt_len)]),
+                    )
+                decoded = processor.decode(out[0, prompt_len:], skip_special_tokens=True)
+                try:
+                    json_text = extract_json_block(decoded)
+                    valid += 1
+                except ValueError:
+                    json_text = complete_partial_json(decoded)
+                apply_edits(template_text, json_text, fmt)
+                seconds += time.perf_counter() - t0
+                wasted += wasted_edits(template_text, json.loads(json_text))
+                tokens += int(out.shape[1] - prompt_len)
+            n = len(images)
+            print(f"{name:>24} {fmt:>8} {'sí' if constrained else 'no':>7} {tokens / n:>15.1f} {seconds / n:>11.2f} "
+                  f"{valid / n:>8.0%} {wasted:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--templates", default="TCAR.json,TC_craneo_simple.json")
+    parser.add_argument("--tokenizer", default=None, help="tokenizer para el conteo sin modelo (por defecto MODEL_ID)")
+    parser.add_argument("--generate", action="store_true", help="generar con el modelo además del conteo estático")
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--n-images", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    from config import MODEL_ID
+
+    templates = [t.strip() for t in args.templates.split(",")]
+    static_comparison(AutoTokenizer.from_pretrained(args.tokenizer or MODEL_ID), templates)
+    if args.generate:
+        generate_comparison(args, templates)
+
+
+if __name__ == "__main__":
+    main()
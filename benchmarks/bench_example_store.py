@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark del almacén de ejemplos buenos
+Con --existing ejemplos ya guardados, mide aprobaciones por segundo del
+antiguo good_examples.json (leer todo + añadir + reescribir) frente al
+almacén SQLite (una inserción), con uno y varios hilos a la vez, y comprueba
+que no se pierde ninguna. También mide la migración y la lectura completa.
+
+Uso:
+    python benchmarks/bench_example_store.py [--existing 10000,50000] [--appends 200] [--threads 8]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from example_store import GoodExampleStore
+
+
+def make_example(i):
+    """Ejemplo de tamaño realista (~600 bytes de JSON)"""
+    return {
+        "label": f"TC - Cráneo ({i % 24:02d}:{i % 60:02d})",
+        "example": {
+            "remove": ["Sin hallazgos relevantes"],
+            "replace": [{"from": "Ventrículos normales", "to": f"Ventrículos comprimidos ({i})"}],
+            "add_findings": [f"Hematoma epidural de {i % 30} mm con efecto de masa", "Desviación de línea media de ~3 mm"],
+            "lesiometro_missing": [],
+            "conclusion": {"positives": ["Hematoma epidural agudo"], "impression": [], "ddx": [], "recommendations": []},
+        },
+    }
+
+
+def legacy_append(path, example):
+    """Lo que hacía save_good_example(): leer todo, añadir y reescribir"""
+    with open(path, "r", encoding="utf-8") as f:
+        examples = json.load(f)
+    examples.append(example)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(examples, f, ensure_ascii=False, indent=2)
+
+
+def run_appends(append, appends, threads):
+    """appends inserciones repartidas entre threads hilos; devuelve (aprobaciones/s, hechas, errores)"""
+    per_thread = appends // threads
+    errors = []
+
+    def worker(w):
+        for i in range(per_thread):
+            try:
+                append(make_example(w * per_thread + i))
+            except Exception as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(w,)) for w in range(threads)]
+    t0 = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    done = per_thread * threads
+    return done / (time.perf_counter() - t0), done, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--existing", default="10000,50000")
+    parser.add_argument("--appends", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{'existentes':>10} {'almacén':<18} {'hilos':>5} {'aprob./s':>10} {'perdidas':>9} {'errores':>8}")
+    for existing in [int(n) for n in args.existing.split(",")]:
+        base = [make_example(i) for i in range(existing)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir)
+            for threads in (1, args.threads):
+                legacy = tmp / f"legacy_{threads}.json"
+                legacy.write_text(json.dumps(base, ensure_ascii=False, indent=2), encoding="utf-8")
+                # La versión JSON es O(n) por aprobación: menos repeticiones
+                rate, done, errors = run_appends(lambda ex: legacy_append(legacy, ex), max(threads, min(args.appends, 20)), threads)
+                try:
+                    lost = existing + done - len(json.loads(legacy.read_text(encoding="utf-8")))
+                except json.JSONDecodeError:
+                    lost = "JSON roto"
+                print(f"{existing:>10} {'JSON reescrito':<18} {threads:>5} {rate:>10.1f} {lost!s:>9} {len(errors):>8}")
+
+                store = GoodExampleStore(tmp / f"store_{threads}.sqlite3")
+                t0 = time.perf_counter()
+                store.migrate(base, ["TC"])
+                migrate_s = time.perf_counter() - t0
+                rate, done, errors = run_appends(store.append, args.appends, threads)
+                lost = existing + done - store.count()
+                print(f"{existing:>10} {'SQLite (append)':<18} {threads:>5} {rate:>10.1f} {lost:>9} {len(errors):>8}")
+
+            t0 = time.perf_counter()
+            rows = store.all()
+            read_s = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            subset = store.by_modality("TC", "Cráneo")
+            query_s = time.perf_counter() - t0
+            print(f"{'':>10} migración {migrate_s:.2f}s, lectura completa ({len(rows)}) {read_s * 1000:.0f} ms, "
+                  f"por modalidad/región ({len(subset)}) {query_s * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la selección few-shot por recuperación
+Con --examples ejemplos sintéticos (varias modalidades y regiones), mide el
+tiempo de construir el índice BM25, la latencia de consulta (p50/p99) por
+modalidad y región y el coste de añadir un ejemplo aprobado de forma
+incremental frente a reconstruir el índice.
+
+Uso:
+    python benchmarks/bench_fewshot_retrieval.py [--examples 1000,10000] [--queries 2000] [--k 2]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from example_index import ExampleIndex
+
+STUDIES = {
+    "TC": ["Cráneo", "Tórax", "Abdomen", "Columna lumbar", "Senos paranasales"],
+    "RM": ["Cerebro", "Rodilla", "Hombro", "Columna cervical"],
+    "RX": ["Tórax", "Rodilla", "Mano", "Pelvis"],
+    "US": ["Abdomen", "Tiroides", "Renal"],
+}
+FINDINGS = [
+    "Hematoma subdural agudo", "Nódulo pulmonar espiculado", "Consolidación basal", "Derrame pleural",
+    "Apendicitis aguda", "Litiasis renal", "Rotura meniscal", "Hernia discal", "Fractura de radio distal",
+    "Esteatosis hepática", "Nódulo tiroideo TI-RADS 3", "Sinusitis maxilar", "Infarto lacunar",
+]
+
+
+def make_example(i, rng):
+    modality = rng.choice(list(STUDIES))
+    region = rng.choice(STUDIES[modality])
+    return {
+        "label": f"{modality} - {region} ({i % 24:02d}:{i % 60:02d})",
+        "modality": modality,
+        "region": region,
+        "example": {
+            "remove": ["Sin hallazgos relevantes"],
+            "add_findings": rng.sample(FINDINGS, 2),
+            "conclusion": {"positives": [rng.choice(FINDINGS)], "impression": [], "ddx": []},
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--examples", default="1000,10000")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--k", type=int, default=2)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'ejemplos':>9} {'construcción ms':>16} {'consulta p50 µs':>16} {'consulta p99 µs':>16} "
+          f"{'añadir µs':>10} {'reconstruir ms':>15}")
+    for n in [int(x) for x in args.examples.split(",")]:
+        examples = [make_example(i, rng) for i in range(n)]
+        index = ExampleIndex(STUDIES)
+        t0 = time.perf_counter()
+        index.sync(examples)
+        build_ms = (time.perf_counter() - t0) * 1000
+
+        latencies = []
+        for _ in range(args.queries):
+            modality = rng.choice(list(STUDIES))
+            region = rng.choice(STUDIES[modality])
+            t0 = time.perf_counter()
+            index.search(region, modality, args.k)
+            latencies.append(time.perf_counter() - t0)
+        latencies = np.array(latencies) * 1e6
+
+        # Aprobación nueva: añadir + primera consulta (materializa los arrays tocados)
+        adds = []
+        for i in range(50):
+            examples.append(make_example(n + i, rng))
+            t0 = time.perf_counter()
+            index.sync(examples)
+            index.search("Tórax", "RX", args.k)
+            adds.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        ExampleIndex(STUDIES).sync(examples)
+        rebuild_ms = (time.perf_counter() - t0) * 1000
+
+        print(f"{n:>9} {build_ms:>16.1f} {np.percentile(latencies, 50):>16.0f} {np.percentile(latencies, 99):>16.0f} "
+              f"{np.median(adds) * 1e6:>10.0f} {rebuild_ms:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Evaluación del clasificador de estudios normales (vía rápida)
+Validación cruzada k-fold sobre las muestras etiquetadas con las valoraciones
+(NORMAL_SAMPLES_FILE): tasa de vía rápida (estudios marcados como normales),
+precisión de esas marcas, estudios con hallazgos marcados por error, y
+latencia de entrenamiento y de predicción.
+
+Uso:
+    python benchmarks/bench_normal_classifier.py [--samples feedback/normal_samples.jsonl] [--thresholds 0.8,0.9,0.95]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import NORMAL_SAMPLES_FILE
+from normal_classifier import NormalFastPath, NormalStudyClassifier
+
+
+def cross_validate(X, y, folds, seed=0):
+    """Probabilidad fuera de muestra para cada estudio y tiempos medios"""
+    order = np.random.default_rng(seed).permutation(len(y))
+    probs = np.zeros(len(y))
+    train_seconds, predict_seconds = [], []
+    for fold in np.array_split(order, folds):
+        train = np.setdiff1d(order, fold)
+        t0 = time.perf_counter()
+        clf = NormalStudyClassifier().fit(X[train], y[train])
+        train_seconds.append(time.perf_counter() - t0)
+        for i in fold:
+            t0 = time.perf_counter()
+            probs[i] = clf.predict_proba(X[i])
+            predict_seconds.append(time.perf_counter() - t0)
+    return probs, float(np.mean(train_seconds)), float(np.mean(predict_seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", default=str(NORMAL_SAMPLES_FILE))
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--thresholds", default="0.8,0.9,0.95")
+    args = parser.parse_args()
+
+    X, y = NormalFastPath(args.samples).load_samples()
+    n_normal = int(y.sum())
+    print(f"Muestras: {len(y)} ({n_normal} normales, {len(y) - n_normal} con hallazgos), dim={X.shape[1] if len(y) else 0}")
+    if len(y) < args.folds or n_normal == 0 or n_normal == len(y):
+        print("No hay muestras suficientes de ambas clases: valora más informes en la app")
+        return
+
+    probs, train_s, predict_s = cross_validate(X, y, args.folds)
+    print(f"Entrenamiento: {train_s * 1000:.1f} ms | predicción: {predict_s * 1e6:.0f} µs por estudio")
+    print(f"{'umbral':>7} {'vía rápida':>11} {'precisión':>10} {'normales cubiertos':>19} {'anormales marcados':>19}")
+    for threshold in (float(t) for t in args.thresholds.split(",")):
+        flagged = probs >= threshold
+        precision = (y[flagged] == 1).mean() if flagged.any() else 0.0
+        recall = flagged[y == 1].mean()
+        false_normal = int((flagged & (y == 0)).sum())
+        print(f"{threshold:>7.2f} {flagged.mean():>11.0%} {precision:>10.0%} {recall:>19.0%} {false_normal:>19}")
+
+
+if __name__ == "__main__":
+    main()
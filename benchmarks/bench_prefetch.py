@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la preparación anticipada (PREFETCH_ENABLED)
+Simula el flujo de la UI: se sube la imagen, el usuario tarda --think segundos
+en escribir región e indicación y pulsa "Generar borrador". Mide la latencia
+desde el clic hasta el borrador con y sin preparación anticipada (conversión,
+validación, miniatura, vision encoder y plantilla pre-tokenizada).
+
+Cada modo usa imágenes distintas (espejadas) y la caché de visión en disco se
+desactiva, para que ningún modo reutilice las features del otro.
+
+Uso:
+    python benchmarks/bench_prefetch.py [--images DIR] [--n-images 3] [--think 5] [--template TC_craneo_simple.json]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["VISION_CACHE_DISK_MAX_MB"] = "0"
+
+from bench_quantization import load_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--n-images", type=int, default=3)
+    parser.add_argument("--think", type=float, default=5.0, help="segundos entre subir la imagen y pulsar Generar")
+    parser.add_argument("--template", default="TC_craneo_simple.json")
+    parser.add_argument("--max-new-tokens", type=int, default=300)
+    args = parser.parse_args()
+
+    from PIL import ImageOps
+    import app
+
+    app.ensure_model_loaded()
+    images = load_images(args.images, args.n_images)
+    modes = {"sin prefetch": (False, images), "con prefetch": (True, [ImageOps.mirror(img) for img in images])}
+
+    print(f"{'modo':>14} {'clic→borrador s':>16} {'espera prefetch ms':>19}")
+    for name, (enabled, mode_images) in modes.items():
+        app.PREFETCH_ENABLED = enabled
+        seconds = 0.0
+        for i, img in enumerate(mode_images):
+            app.on_template_change(args.template)
+            app.on_image_change(img)
+            time.sleep(args.think)
+            t0 = time.perf_counter()
+            app.generate(img, "TC", "Cráneo", "Control", "", args.template, args.max_new_tokens, args.max_new_tokens)
+            seconds += time.perf_counter() - t0
+        stats = app.PREFETCHER.stats()
+        print(f"{name:>14} {seconds / len(mode_images):>16.2f} {stats['mean_wait_ms'] if enabled else 0.0:>19.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark de las clases de prioridad (urgente/rutina)
+Lanza --routine peticiones de rutina y, cuando ya se están decodificando,
+--urgent peticiones urgentes escalonadas. Compara el tiempo hasta el primer
+token (TTFT, desde el clic e incluida la cola) y la latencia total por clase
+con prioridades y sin ellas (todas como rutina, FIFO).
+
+Uso:
+    python benchmarks/bench_priority.py [--routine 6] [--urgent 2] [--workers 2] [--max-new-tokens 300]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_quantization import load_images
+
+
+def run_round(app, images, args, use_priority):
+    """Rutina primero y urgentes después; devuelve {clase: [latencias totales]}"""
+    from admission import AdmissionController
+
+    app.ADMISSION = AdmissionController(args.workers, args.routine + args.urgent)
+    latencies = {"urgent": [], "routine": []}
+    lock = threading.Lock()
+
+    def client(img, kind, delay):
+        time.sleep(delay)
+        priority = kind if use_priority else "routine"
+        t0 = time.perf_counter()
+        ticket = app.ADMISSION.enqueue(0, priority)
+        try:
+            app.ADMISSION.wait(ticket)
+            app.generate(img, "TC", "Cráneo", "Control", "", args.template, args.max_new_tokens, args.max_new_tokens,
+                         priority=priority, request_start=t0)
+        finally:
+            app.ADMISSION.leave(ticket)
+        with lock:
+            latencies[kind].append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=client, args=(images[i % len(images)], "routine", 0.0)) for i in range(args.routine)]
+    threads += [
+        threading.Thread(target=client, args=(images[(args.routine + i) % len(images)], "urgent", args.urgent_delay * (i + 1)))
+        for i in range(args.urgent)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, app.ADMISSION.stats()["ttft"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--routine", type=int, default=6)
+    parser.add_argument("--urgent", type=int, default=2)
+    parser.add_argument("--urgent-delay", type=float, default=3.0, help="segundos entre llegadas de urgentes")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--template", default="TC_craneo_simple.json")
+    parser.add_argument("--max-new-tokens", type=int, default=300)
+    args = parser.parse_args()
+
+    import app
+
+    app.ensure_model_loaded()
+    images = load_images(args.images, args.routine + args.urgent)
+
+    print(f"{'modo':<14} {'clase':<8} {'TTFT medio s':>12} {'TTFT p95 s':>11} {'total p50 s':>12} {'total máx s':>12}")
+    for use_priority in (False, True):
+        latencies, ttft = run_round(app, images, args, use_priority)
+        mode = "con prioridad" if use_priority else "FIFO"
+        for kind in ("urgent", "routine"):
+            lat = np.array(latencies[kind])
+            if not len(lat):
+                continue
+            # Sin prioridad todas se registran como rutina: el TTFT por clase solo es separable con prioridad
+            stats = ttft[kind] if use_priority else ttft["routine"]
+            p95 = stats["p95_seconds"] if stats["p95_seconds"] is not None else float("nan")
+            mean = stats["mean_seconds"] if stats["mean_seconds"] is not None else float("nan")
+            print(f"{mode:<14} {kind:<8} {mean:>12.2f} {p95:>11.2f} {np.percentile(lat, 50):>12.1f} {lat.max():>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
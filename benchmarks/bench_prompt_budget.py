@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Benchmark del prompt compacto y del presupuesto de tokens
+
+1) Sin modelo: para cada modalidad cuenta con el tokenizer de MODEL_ID los
+   tokens de cada sección del prompt en tres variantes: el formato anterior
+   (ejemplos con indent=2 y el esquema dos veces), el compacto y el compacto
+   recortado a --budget tokens (el prefijo, a --prefix-budget).
+2) Con --generate: carga el modelo y, por modalidad y variante, mide el
+   tiempo de prefill (un forward del prompt con la imagen, sin caché de
+   prefijo) y la tasa de JSON válido sin reparación sobre --n-images
+   imágenes. Sin --constrained la decodificación es libre, que es donde el
+   formato del prompt decide la validez. Termina con código 1 si la variante
+   compacta pierde más de --max-validity-drop de tasa de JSON válido
+   (prueba de regresión).
+
+Uso:
+    python benchmarks/bench_prompt_budget.py [--studies TC:Cráneo,RM:Cerebro,RX:Tórax,US:Abdomen] [--template TCAR.json] [--budget 1536] [--prefix-budget 1024] [--generate] [--images DIR]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+VARIANTS = ("anterior", "compacto", "recortado")
+
+
+def variant_options(variant, budget, prefix_budget):
+    return {
+        "anterior": {"compact": False, "token_budget": 0, "prefix_budget": 0},
+        "compacto": {"compact": True, "token_budget": 0, "prefix_budget": 0},
+        "recortado": {"compact": True, "token_budget": budget, "prefix_budget": prefix_budget},
+    }[variant]
+
+
+def section_report(count_tokens, studies, template_text, budget, prefix_budget):
+    """Tokens por sección y total (prefijo + dinámico) de cada variante y modalidad"""
+    from prompt_budget import section_tokens
+    from prompt_builder import build_prompt_parts, build_prompt_sections, fit_prompt_sections
+
+    names = None
+    for modalidad, region in studies:
+        for variant in VARIANTS:
+            options = variant_options(variant, budget, prefix_budget)
+            prefix_sections, suffix_sections = build_prompt_sections(
+                modalidad, region, "Control", "", template_text, compact=options["compact"])
+            fit_prompt_sections(prefix_sections, suffix_sections, count_tokens, options["token_budget"], options["prefix_budget"])
+            tokens = section_tokens(prefix_sections + suffix_sections, count_tokens)
+            prefix, suffix = build_prompt_parts(modalidad, region, "Control", "", template_text,
+                                                count_tokens=count_tokens, **options)
+            if names is None:
+                names = list(tokens)
+                print(f"{'estudio':<12} {'variante':<10} " + " ".join(f"{n[:12]:>12}" for n in names)
+                      + f" {'prefijo':>8} {'dinámico':>9} {'total':>6}")
+            prefix_tokens, suffix_tokens = count_tokens(prefix), count_tokens(suffix)
+            print(f"{modalidad + ' ' + region:<12} {variant:<10} " + " ".join(f"{tokens[n]:>12}" for n in names)
+                  + f" {prefix_tokens:>8} {suffix_tokens:>9} {prefix_tokens + suffix_tokens:>6}")
+
+
+def generate_report(args, studies, template_text):
+    """Prefill y tasa de JSON válido por modalidad y variante; devuelve {variante: tasa}"""
+    import torch
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+    from bench_quantization import load_images
+    from decoding import JsonBlockStoppingCriteria
+    from json_constraint import SchemaConstrainedLogitsProcessor, get_schema_index
+    from model_loader import load_model, prepare_inputs
+    from prompt_budget import token_counter_for
+    from prompt_builder import build_prompt_parts
+    from report_processor import extract_json_block
+
+    model, processor, _ = load_model()
+    tokenizer = processor.tokenizer
+    count_tokens = token_counter_for(tokenizer)
+    eos = tokenizer.eos_token_id
+    eos_ids = list(eos) if isinstance(eos, (list, tuple)) else [eos]
+    images = load_images(args.images, args.n_images)
+    index = get_schema_index(tokenizer, eos_ids) if args.constrained else None
+
+    validity = {variant: [] for variant in VARIANTS}
+    print(f"\n{'estudio':<12} {'variante':<10} {'tokens prompt':>14} {'prefill ms':>11} {'JSON válido':>12}")
+    for modalidad, region in studies:
+        for variant in VARIANTS:
+            prefix, suffix = build_prompt_parts(modalidad, region, "Control", "", template_text,
+                                                count_tokens=count_tokens, **variant_options(variant, args.budget, args.prefix_budget))
+            prefill, valid, prompt_len = [], 0, 0
+            for img in images:
+                messages = [{"role": "user", "content": [
+                    {"type": "text", "text": prefix}, {"type": "image", "image": img}, {"type": "text", "text": suffix}]}]
+                inputs = processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=True, return_dict=True, return_tensors="pt")
+                inputs = prepare_inputs(inputs, model, dtype=getattr(model, "dtype", None))
+                prompt_len = inputs["input_ids"].shape[-1]
+                with torch.inference_mode():
+                    t0 = time.perf_counter()
+                    model(**inputs, use_cache=True)
+                    prefill.append(time.perf_counter() - t0)
+                    processors = [SchemaConstrainedLogitsProcessor(index, prompt_len)] if index is not None else []
+                    out = model.generate(
+                        **inputs, max_new_tokens=args.max_new_tokens, do_sample=False,
+                        logits_processor=LogitsProcessorList(processors),
+                        stopping_criteria=StoppingCriteriaList([JsonBlockStoppingCriteria(tokenizer, prompt_len)]),
+                    )
+                decoded = processor.decode(out[0, prompt_len:], skip_special_tokens=True)
+                try:
+                    json.loads(extract_json_block(decoded))
+                    valid += 1
+                except ValueError:
+                    pass
+            rate = valid / len(images)
+            validity[variant].append(rate)
+            prefill.sort()
+            print(f"{modalidad + ' ' + region:<12} {variant:<10} {prompt_len:>14} {1000 * prefill[len(prefill) // 2]:>11.0f} {rate:>12.0%}")
+    return {variant: sum(rates) / len(rates) for variant, rates in validity.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", default="TC:Cráneo,RM:Cerebro,RX:Tórax,US:Abdomen")
+    parser.add_argument("--template", default="TCAR.json")
+    parser.add_argument("--budget", type=int, default=None, help="presupuesto de la variante recortada (por defecto PROMPT_TOKEN_BUDGET o, si está desactivado, 1536)")
+    parser.add_argument("--prefix-budget", type=int, default=None, help="presupuesto del prefijo (por defecto PROMPT_PREFIX_TOKEN_BUDGET o, si está desactivado, 1024)")
+    parser.add_argument("--tokenizer", default=None, help="tokenizer para el conteo sin modelo (por defecto MODEL_ID)")
+    parser.add_argument("--generate", action="store_true", help="medir prefill y JSON válido con el modelo")
+    parser.add_argument("--constrained", action="store_true", help="generar con la decodificación restringida al esquema")
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--n-images", type=int, default=5)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--max-validity-drop", type=float, default=0.0)
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    from config import MODEL_ID, PROMPT_PREFIX_TOKEN_BUDGET, PROMPT_TOKEN_BUDGET
+    from prompt_budget import token_counter_for
+    from template_manager import read_template
+
+    # Con el presupuesto desactivado en config se mide el candidato a activar
+    args.budget = (PROMPT_TOKEN_BUDGET or 1536) if args.budget is None else args.budget
+    args.prefix_budget = (PROMPT_PREFIX_TOKEN_BUDGET or 1024) if args.prefix_budget is None else args.prefix_budget
+    studies = [tuple(s.split(":", 1)) for s in args.studies.split(",")]
+    template_text = read_template(args.template)["template_text"]
+    count_tokens = token_counter_for(AutoTokenizer.from_pretrained(args.tokenizer or MODEL_ID))
+    section_report(count_tokens, studies, template_text, args.budget, args.prefix_budget)
+    if args.generate:
+        validity = generate_report(args, studies, template_text)
+        print("\nJSON válido medio: " + ", ".join(f"{v} {rate:.0%}" for v, rate in validity.items()))
+        if validity["compacto"] < validity["anterior"] - args.max_validity_drop:
+            print(f"❌ Regresión: el prompt compacto baja la tasa de JSON válido más de {args.max_validity_drop:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Benchmark de los modos cuantizados de CPU (CPU_DTYPE=int8 / int4)
+Para cada modo carga MODEL_ID en un proceso nuevo vía model_loader, genera el
+JSON de ediciones sobre un conjunto fijo de imágenes y mide memoria, tokens/s
+y concordancia de las ediciones con la referencia float32. La memoria se da
+como pico de RSS durante la carga (donde cargar en precisión completa y
+cuantizar después duplicaba el modelo), RSS estable tras cargar y pico total;
+la columna origen indica si se cargó desde el Hub o desde el snapshot (la
+segunda ejecución de un modo cuantizado lee el snapshot ya cuantizado).
+
+Imágenes: --images DIR (png/jpg, orden alfabético) o, por defecto, un conjunto
+sintético fijo (gradiente + ruido con semilla).
+
+Uso:
+    python benchmarks/bench_quantization.py [--modes float32,int8,int4] [--images DIR] [--max-new-tokens 192]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_images(images_dir, n):
+    """Conjunto fijo de imágenes: las de images_dir o sintéticas deterministas"""
+    import numpy as np
+    from PIL import Image
+    from config import MAX_IMAGE_SIZE
+    if images_dir:
+        names = sorted(f for f in os.listdir(images_dir) if f.lower().endswith((".png", ".jpg", ".jpeg")))[:n]
+        images = [Image.open(os.path.join(images_dir, f)).convert("RGB") for f in names]
+    else:
+        images = []
+        for seed in range(n):
+            rng = np.random.default_rng(seed)
+            base = np.tile(np.linspace(30 + 10 * seed, 210, 512, dtype=np.float32), (512, 1))
+            pixels = np.clip((base.T if seed % 2 else base) + rng.normal(0, 25, (512, 512)), 0, 255).astype(np.uint8)
+            images.append(Image.fromarray(pixels).convert("RGB"))
+    for img in images:
+        img.thumbnail(MAX_IMAGE_SIZE)
+    return images
+
+
+def peak_rss_mb():
+    """Pico de memoria residente del proceso (MB) o None si no se puede medir"""
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 1024 / 1024
+        except Exception:
+            return None
+
+
+def current_rss_mb():
+    """Memoria residente actual del proceso (MB) o None sin psutil"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+
+def worker(args):
+    """Proceso hijo: carga el modelo con el CPU_DTYPE del entorno y genera"""
+    import torch
+    from model_loader import MODEL_INFO, load_model, prepare_inputs
+    from prompt_builder import build_prompt_parts
+    from template_manager import read_template
+
+    model, processor, _ = load_model()
+    # Proceso nuevo: el pico hasta aquí es el de la carga
+    load_peak_rss = peak_rss_mb()
+    load_rss = current_rss_mb()
+    template_text = read_template(args.template)["template_text"]
+    prefix, suffix = build_prompt_parts("TC", "Cráneo", "Control", "", template_text)
+    outputs, tokens, seconds = [], 0, 0.0
+    for img in load_images(args.images, args.n_images):
+        messages = [{"role": "user", "content": [
+            {"type": "text", "text": prefix}, {"type": "image", "image": img}, {"type": "text", "text": suffix}]}]
+        inputs = processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=True, return_dict=True, return_tensors="pt")
+        inputs = prepare_inputs(inputs, model, dtype=getattr(model, "dtype", None))
+        t0 = time.perf_counter()
+        with torch.inference_mode():
+            out = model.generate(**inputs, max_new_tokens=args.max_new_tokens, do_sample=False)
+        seconds += time.perf_counter() - t0
+        new = out[0, inputs["input_ids"].shape[-1]:]
+        tokens += int(new.shape[0])
+        outputs.append(processor.decode(new, skip_special_tokens=True))
+
+    result = {
+        "quantization": MODEL_INFO["quantization"],
+        "load_seconds": MODEL_INFO["load_seconds"],
+        "source": MODEL_INFO["source"],
+        "load_peak_rss_mb": load_peak_rss,
+        "rss_after_load_mb": load_rss,
+        "model_mb": sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers())) / 1024 / 1024,
+        "peak_rss_mb": peak_rss_mb(),
+        "tok_s": tokens / seconds if seconds else 0.0,
+        "outputs": outputs,
+    }
+    print("RESULT " + json.dumps(result, ensure_ascii=False))
+
+
+def run_mode(mode, args):
+    """Lanza el worker en un proceso nuevo con CPU_DTYPE=mode"""
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--template", args.template,
+           "--n-images", str(args.n_images), "--max-new-tokens", str(args.max_new_tokens)]
+    if args.images:
+        cmd += ["--images", args.images]
+    env = dict(os.environ, CPU_DTYPE=mode)
+    proc = subprocess.run(cmd, cwd=ROOT, env=env, capture_output=True, text=True)
+    lines = [l for l in proc.stdout.splitlines() if l.startswith("RESULT ")]
+    if proc.returncode != 0 or not lines:
+        raise RuntimeError(proc.stderr[-2000:])
+    return json.loads(lines[-1][len("RESULT "):])
+
+
+def edit_items(text):
+    """Conjunto normalizado de ediciones del JSON generado (None si no es JSON válido)"""
+    from report_processor import extract_json_block
+    try:
+        data = json.loads(extract_json_block(text))
+    except Exception:
+        return None
+    if not isinstance(data, dict):
+        return None
+    items = {f"remove:{s.strip()}" for s in data.get("remove", []) if isinstance(s, str)}
+    items |= {f"replace:{(r.get('from') or '').strip()}→{(r.get('to') or '').strip()}"
+              for r in data.get("replace", []) if isinstance(r, dict)}
+    items |= {f"add:{s.strip()}" for s in data.get("add_findings", []) if isinstance(s, str)}
+    return items
+
+
+def agreement(reference, outputs):
+    """JSON válido, coincidencia exacta de ediciones y Jaccard medio frente a la referencia"""
+    valid = exact = 0
+    jaccard = []
+    for ref_text, text in zip(reference, outputs):
+        ref, got = edit_items(ref_text), edit_items(text)
+        if got is None:
+            jaccard.append(0.0)
+            continue
+        valid += 1
+        if ref is None:
+            continue
+        exact += ref == got
+        union = ref | got
+        jaccard.append(len(ref & got) / len(union) if union else 1.0)
+    n = len(outputs)
+    return valid / n, exact / n, (sum(jaccard) / len(jaccard) if jaccard else 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="float32,int8,int4")
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--n-images", type=int, default=6)
+    parser.add_argument("--template", default="TC_craneo_simple.json")
+    parser.add_argument("--max-new-tokens", type=int, default=192)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    modes = [m.strip() for m in args.modes.split(",")]
+    if "float32" not in modes:
+        modes.insert(0, "float32")
+    results = {mode: run_mode(mode, args) for mode in modes}
+    reference = results["float32"]["outputs"]
+
+    def mb(value):
+        return f"{value:.0f}" if value else "-"
+
+    print(f"{'modo':>8} {'origen':>8} {'modelo MB':>10} {'pico carga MB':>14} {'RSS carga MB':>13} {'pico RSS MB':>12} "
+          f"{'carga s':>8} {'tok/s':>7} {'JSON ok':>8} {'exacto':>7} {'Jaccard':>8}")
+    for mode, r in results.items():
+        valid, exact, jac = agreement(reference, r["outputs"])
+        print(f"{mode:>8} {r['source']:>8} {r['model_mb']:>10.0f} {mb(r['load_peak_rss_mb']):>14} {mb(r['rss_after_load_mb']):>13} "
+              f"{mb(r['peak_rss_mb']):>12} {r['load_seconds']:>8.1f} {r['tok_s']:>7.2f} {valid:>8.0%} {exact:>7.0%} {jac:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la cola de generación con control de admisión
+Lanza --requests peticiones simultáneas (como clics concurrentes en la UI) y
+las hace pasar por AdmissionController con distintos números de workers de
+modelo. Mide latencia de extremo a extremo (cola + generación) p50/p95/máx,
+tiempo medio en cola y peticiones por minuto.
+
+Uso:
+    python benchmarks/bench_queue.py [--requests 8] [--workers 1,2,4,0] [--max-new-tokens 300]
+    (--workers 0 = sin límite, todas compiten a la vez)
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_quantization import load_images
+
+
+def run_round(app, admission, images, args):
+    """Peticiones simultáneas a través de la cola; devuelve latencias y esperas en cola"""
+    latencies, queued = [], []
+    lock = threading.Lock()
+
+    def client(img):
+        t0 = time.perf_counter()
+        ticket = admission.enqueue(app.estimate_request_kv_bytes("TC", "Cráneo", "Control", "", args.template, args.max_new_tokens))
+        try:
+            admission.wait(ticket)
+            waited = time.perf_counter() - t0
+            app.generate(img, "TC", "Cráneo", "Control", "", args.template, args.max_new_tokens, args.max_new_tokens)
+        finally:
+            admission.leave(ticket)
+        with lock:
+            latencies.append(time.perf_counter() - t0)
+            queued.append(waited)
+
+    threads = [threading.Thread(target=client, args=(images[i % len(images)],)) for i in range(args.requests)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, queued, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--workers", default="1,2,4,0")
+    parser.add_argument("--template", default="TC_craneo_simple.json")
+    parser.add_argument("--max-new-tokens", type=int, default=300)
+    parser.add_argument("--kv-budget-mb", type=int, default=None, help="presupuesto de KV (por defecto, config)")
+    args = parser.parse_args()
+
+    import app
+    from admission import AdmissionController
+    from config import ADMISSION_KV_BUDGET_MB
+
+    app.ensure_model_loaded()
+    images = load_images(args.images, args.requests)
+    kv_budget = (args.kv_budget_mb if args.kv_budget_mb is not None else ADMISSION_KV_BUDGET_MB) * 1024 * 1024
+
+    print(f"{'workers':>8} {'p50 s':>7} {'p95 s':>7} {'máx s':>7} {'cola media s':>13} {'pet/min':>8}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        admission = AdmissionController(workers or args.requests, args.requests, kv_budget)
+        latencies, queued, wall = run_round(app, admission, images, args)
+        lat = np.array(latencies)
+        print(f"{workers or 'sin lím.':>8} {np.percentile(lat, 50):>7.1f} {np.percentile(lat, 95):>7.1f} {lat.max():>7.1f} "
+              f"{np.mean(queued):>13.1f} {60 * len(lat) / wall:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark de decodificación especulativa en CPU
+Para cada imagen genera el JSON de ediciones con greedy (model.generate) y con
+prompt-lookup sembrado con la plantilla y las ediciones aprobadas de feedback.csv
+(y con DRAFT_MODEL_ID si se pasa --draft). Mide tokens aceptados por paso, tasa
+de aceptación, tiempo de extremo a extremo (prefill incluido) sin y con
+especulativa, la aceleración medida entre ambos y si la salida es idéntica a greedy.
+
+Imágenes: --images DIR (png/jpg, orden alfabético) o el conjunto sintético fijo
+de bench_quantization.py.
+
+Uso:
+    python benchmarks/bench_speculative.py [--template TC_craneo_simple.json] [--num-tokens 8] [--draft]
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_quantization import load_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None)
+    parser.add_argument("--n-images", type=int, default=4)
+    parser.add_argument("--template", default="TC_craneo_simple.json")
+    parser.add_argument("--max-new-tokens", type=int, default=192)
+    parser.add_argument("--num-tokens", type=int, default=None, help="tokens propuestos por paso (por defecto, config)")
+    parser.add_argument("--ngram-max", type=int, default=None)
+    parser.add_argument("--draft", action="store_true", help="incluir el modelo borrador DRAFT_MODEL_ID")
+    args = parser.parse_args()
+
+    from config import PROMPT_LOOKUP_NGRAM_MAX, PROMPT_LOOKUP_NUM_TOKENS, SPECULATIVE_NUM_TOKENS
+    from model_loader import load_draft_model, load_model, prepare_inputs
+    from prompt_builder import build_lookup_corpus, build_prompt_parts
+    from speculative import DraftModelProposer, PromptLookupProposer, speculative_generate
+    from template_manager import read_template
+
+    model, processor, _ = load_model()
+    tokenizer = processor.tokenizer
+    eos = tokenizer.eos_token_id
+    eos_ids = list(eos) if isinstance(eos, (list, tuple)) else [eos]
+    template_text = read_template(args.template)["template_text"]
+    prefix, suffix = build_prompt_parts("TC", "Cráneo", "Control", "", template_text)
+    corpus = [tokenizer.encode(t, add_special_tokens=False) for t in build_lookup_corpus(args.template, template_text)]
+
+    modes = {"prompt_lookup": (
+        lambda: PromptLookupProposer(corpus, args.ngram_max or PROMPT_LOOKUP_NGRAM_MAX),
+        args.num_tokens or PROMPT_LOOKUP_NUM_TOKENS,
+    )}
+    if args.draft:
+        draft_model = load_draft_model(processor)
+        if draft_model is None:
+            print("DRAFT_MODEL_ID no configurado o incompatible: se omite el borrador")
+        else:
+            modes["draft"] = (lambda: DraftModelProposer(draft_model), args.num_tokens or SPECULATIVE_NUM_TOKENS)
+
+    totals = {name: {"seconds": 0.0, "steps": 0, "drafted": 0, "accepted": 0, "identical": 0} for name in modes}
+    greedy_seconds, greedy_tokens = 0.0, 0
+    images = load_images(args.images, args.n_images)
+    for img in images:
+        messages = [{"role": "user", "content": [
+            {"type": "text", "text": prefix}, {"type": "image", "image": img}, {"type": "text", "text": suffix}]}]
+        inputs = processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=True, return_dict=True, return_tensors="pt")
+        inputs = prepare_inputs(inputs, model, dtype=getattr(model, "dtype", None))
+
+        t0 = time.perf_counter()
+        with torch.inference_mode():
+            reference = model.generate(**inputs, max_new_tokens=args.max_new_tokens, do_sample=False)
+        greedy_seconds += time.perf_counter() - t0
+        greedy_tokens += reference.shape[1] - inputs["input_ids"].shape[1]
+
+        for name, (make_proposer, num_tokens) in modes.items():
+            t0 = time.perf_counter()
+            out, stats = speculative_generate(model, dict(inputs), make_proposer(), args.max_new_tokens, eos_ids, num_tokens)
+            total = totals[name]
+            total["seconds"] += time.perf_counter() - t0
+            for key in ("steps", "drafted", "accepted"):
+                total[key] += stats[key]
+            total["identical"] += torch.equal(out.cpu(), reference.cpu())
+
+    print(f"greedy: {greedy_tokens} tokens en {greedy_seconds:.1f}s ({greedy_tokens / greedy_seconds:.2f} tok/s)")
+    print(f"{'modo':>14} {'tok/paso':>9} {'aceptación':>11} {'s sin':>8} {'s con':>8} {'tok/s':>7} {'speedup':>8} {'idéntica':>9}")
+    for name, t in totals.items():
+        tokens_per_step = greedy_tokens / t["steps"] if t["steps"] else 0.0
+        acceptance = t["accepted"] / t["drafted"] if t["drafted"] else 0.0
+        print(f"{name:>14} {tokens_per_step:>9.2f} {acceptance:>11.0%} {greedy_seconds:>8.1f} {t['seconds']:>8.1f} {greedy_tokens / t['seconds']:>7.2f} "
+              f"{greedy_seconds / t['seconds']:>7.2f}x {t['identical']:>5}/{len(images)}")
+
+
+if __name__ == "__main__":
+    main()
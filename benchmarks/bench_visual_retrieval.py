@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la búsqueda de casos aprobados por similitud de imagen
+Con --examples embeddings sintéticos de dimensión --dim (la del proyector de
+MedGemma 4B es 2560) agrupados en estudios parecidos, mide para la búsqueda
+exacta y para el IVF: tiempo de construcción, latencia de consulta p50/p99,
+memoria por 10k ejemplos y recall@k del IVF frente a la exacta. También mide
+la carga de los embeddings desde el almacén SQLite.
+
+Uso:
+    python benchmarks/bench_visual_retrieval.py [--examples 10000,50000] [--dim 2560] [--queries 200] [--k 2]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from example_index import VisualExampleIndex
+from example_store import GoodExampleStore
+
+MODALITIES = ["TC", "RM", "RX", "US"]
+
+
+def make_embeddings(n, dim, rng, clusters=200):
+    """Embeddings agrupados (cortes del mismo tipo de estudio se parecen)"""
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    assign = rng.integers(0, clusters, n)
+    vectors = centers[assign] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors, [MODALITIES[c % len(MODALITIES)] for c in assign]
+
+
+def measure(index, queries, modalities, k):
+    latencies, results = [], []
+    for query, modality in zip(queries, modalities):
+        t0 = time.perf_counter()
+        results.append([payload for payload, _ in index.search(query, modality, k)])
+        latencies.append(time.perf_counter() - t0)
+    return np.array(latencies) * 1000, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--examples", default="10000,50000")
+    parser.add_argument("--dim", type=int, default=2560)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=2)
+    parser.add_argument("--n-probe", type=int, default=8)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'ejemplos':>9} {'índice':<7} {'construcción s':>15} {'p50 ms':>8} {'p99 ms':>8} {'MB/10k':>8} {'recall@k':>9}")
+    for n in [int(x) for x in args.examples.split(",")]:
+        vectors, modalities = make_embeddings(n, args.dim, rng)
+        picks = rng.integers(0, n, args.queries)
+        queries = vectors[picks] + 0.3 * rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+        query_modalities = [modalities[i] for i in picks]
+
+        exact_results = None
+        for name, ivf_min in (("exacto", n + 1), ("IVF", 0)):
+            index = VisualExampleIndex(ivf_min=ivf_min, n_probe=args.n_probe)
+            t0 = time.perf_counter()
+            index.add(vectors, list(range(n)), modalities)
+            build_s = time.perf_counter() - t0
+            latencies, results = measure(index, queries, query_modalities, args.k)
+            if exact_results is None:
+                exact_results, recall = results, 1.0
+            else:
+                recall = np.mean([len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(exact_results, results)])
+            mb_per_10k = index.memory_bytes / n * 10000 / 1024 / 1024
+            print(f"{n:>9} {name:<7} {build_s:>15.2f} {np.percentile(latencies, 50):>8.2f} "
+                  f"{np.percentile(latencies, 99):>8.2f} {mb_per_10k:>8.0f} {recall:>9.3f}")
+
+        # Carga del almacén (float16 en SQLite) al arrancar
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = GoodExampleStore(Path(tmpdir) / "ejemplos.sqlite3")
+            conn = store._conn()
+            conn.execute("BEGIN")
+            for i in range(n):
+                store._insert(conn, {"label": f"caso {i}", "example": {}}, modalities[i], None, vectors[i])
+            conn.execute("COMMIT")
+            t0 = time.perf_counter()
+            ids, _, matrix = store.embeddings()
+            load_s = time.perf_counter() - t0
+            store.close()
+        print(f"{'':>9} carga desde SQLite ({len(ids)} embeddings float16, {matrix.nbytes // 2 / 1024 / 1024:.0f} MB en disco): {load_s:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
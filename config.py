@@ -44,6 +44,11 @@ def get_env(name, default=None, cast=None):
     return value
 
 
+def _as_bool(value) -> bool:
+    """Interpreta flags de entorno tipo 1/true/yes/on."""
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
 # ============================================================================
 # RUTAS BASE
 # ============================================================================
@@ -52,7 +57,9 @@ BASE_DIR = Path(__file__).resolve().parent
 logger_env_msg = _load_dotenv_file(BASE_DIR / ".env")
 TEMPLATES_DIR = BASE_DIR / "templates"
 FEEDBACK_DIR = BASE_DIR / "feedback"
+# Formato antiguo (JSON reescrito entero); se migra a GOOD_EXAMPLES_DB al arrancar
 GOOD_EXAMPLES_FILE = FEEDBACK_DIR / "good_examples.json"
+GOOD_EXAMPLES_DB = FEEDBACK_DIR / "good_examples.sqlite3"
 FEEDBACK_CSV = FEEDBACK_DIR / "feedback.csv"
 
 # Crear directorios si no existen
@@ -69,9 +76,23 @@ HF_TOKEN = get_env("HF_TOKEN", get_env("HUGGINGFACE_HUB_TOKEN", None))
 IMAGE_TOKEN = get_env("IMAGE_TOKEN", "<image>")
 VALID_IMAGE_TOKENS = ("<image>", "<start_of_image>", "<image_soft_token>")
 MODEL_DTYPE = get_env("MODEL_DTYPE", "float16")
-CPU_DTYPE = get_env("CPU_DTYPE", "float32")
+# CPU_DTYPE: "auto" (bfloat16 si la CPU tiene AVX512-BF16/AMX, si no float32), un dtype
+# (float32, bfloat16) o un modo cuantizado: "int8" (dinámico) o "int4" (solo pesos)
+CPU_DTYPE = get_env("CPU_DTYPE", "auto")
+# Tamaño de grupo de int4 y si la torre de visión también se cuantiza
+QUANT_GROUP_SIZE = get_env("QUANT_GROUP_SIZE", 128, int)
+QUANT_VISION = get_env("QUANT_VISION", False, _as_bool)
 CPU_NUM_THREADS = get_env("CPU_NUM_THREADS", os.cpu_count() or 1, lambda v: int(v))
 CPU_INTEROP_THREADS = get_env("CPU_INTEROP_THREADS", max(1, min(4, (os.cpu_count() or 1) // 2)), lambda v: int(v))
+# Snapshot local de pesos ya convertidos al dtype de carga (arranque en frío rápido, sin Hub)
+WEIGHT_SNAPSHOT_ENABLED = get_env("WEIGHT_SNAPSHOT_ENABLED", True, _as_bool)
+WEIGHT_SNAPSHOT_DIR = Path(get_env("WEIGHT_SNAPSHOT_DIR", str(BASE_DIR / "cache" / "snapshots")))
+
+# Carga + generación de calentamiento en segundo plano al arrancar la app
+STARTUP_WARMUP_ENABLED = get_env("STARTUP_WARMUP_ENABLED", True, _as_bool)
+WARMUP_MAX_NEW_TOKENS = get_env("WARMUP_MAX_NEW_TOKENS", 16, int)
+# Plantilla representativa para el warm-up (vacío = TC_craneo_simple.json o la primera disponible)
+WARMUP_TEMPLATE = get_env("WARMUP_TEMPLATE", "")
 
 
 # ============================================================================
@@ -102,6 +123,179 @@ VALID_TEMPLATE_EXTENSIONS = [".json"]
 DEBUG_MODE = get_env("DEBUG_MODE", False, lambda v: str(v).lower() in ("1", "true", "yes", "on"))
 
 
+# ============================================================================
+# CACHÉ DE PREFIJO KV (segmento estático del prompt)
+# ============================================================================
+
+# Reutiliza past_key_values de instrucciones + guía de modalidad + few-shot + esquema
+PREFIX_CACHE_ENABLED = get_env("PREFIX_CACHE_ENABLED", True, _as_bool)
+PREFIX_CACHE_MAX_MB = get_env("PREFIX_CACHE_MAX_MB", 1024, int)
+# Tokens que se descartan antes del bloque de imagen (la tokenización puede fusionar el límite)
+PREFIX_CACHE_BOUNDARY_MARGIN = get_env("PREFIX_CACHE_BOUNDARY_MARGIN", 4, int)
+
+
+# ============================================================================
+# CACHÉ DE EMBEDDINGS DE IMAGEN (vision tower + proyector)
+# ============================================================================
+
+VISION_CACHE_ENABLED = get_env("VISION_CACHE_ENABLED", True, _as_bool)
+# Nivel en memoria (LRU por bytes)
+VISION_CACHE_MAX_MB = get_env("VISION_CACHE_MAX_MB", 256, int)
+# Nivel en disco (memory-mapped, persiste entre reinicios); 0 = desactivado
+VISION_CACHE_DIR = Path(get_env("VISION_CACHE_DIR", str(BASE_DIR / "cache" / "vision")))
+VISION_CACHE_DISK_MAX_MB = get_env("VISION_CACHE_DISK_MAX_MB", 2048, int)
+
+
+# ============================================================================
+# MICRO-BATCHING DE PETICIONES CONCURRENTES
+# ============================================================================
+
+# Alternativa al batching continuo para cuando este está desactivado: los dos
+# modos son excluyentes y, si se activan ambos, solo se usa el continuo
+BATCHING_ENABLED = get_env("BATCHING_ENABLED", False, _as_bool)
+# Máximo de peticiones por model.generate() y ventana de espera para agruparlas
+BATCH_MAX_SIZE = get_env("BATCH_MAX_SIZE", 4, int)
+BATCH_MAX_WAIT_MS = get_env("BATCH_MAX_WAIT_MS", 50, float)
+
+
+# ============================================================================
+# BATCHING CONTINUO (motor de decodificación propio)
+# ============================================================================
+
+# Sustituye model.generate(): admite/retira secuencias en cada paso de decodificación
+CONTINUOUS_BATCHING_ENABLED = get_env("CONTINUOUS_BATCHING_ENABLED", True, _as_bool)
+ENGINE_MAX_SLOTS = get_env("ENGINE_MAX_SLOTS", 8, int)
+# Presupuesto de KV-cache en tokens, repartido en bloques de ENGINE_KV_BLOCK_SIZE
+ENGINE_KV_BLOCK_SIZE = get_env("ENGINE_KV_BLOCK_SIZE", 16, int)
+ENGINE_KV_BUDGET_TOKENS = get_env("ENGINE_KV_BUDGET_TOKENS", 16384, int)
+# Micro-batching efectivo (solo sin batching continuo)
+MICRO_BATCHING_ENABLED = BATCHING_ENABLED and not CONTINUOUS_BATCHING_ENABLED
+
+
+# ============================================================================
+# DECODIFICACIÓN ESPECULATIVA
+# ============================================================================
+
+# Modelo borrador con el mismo tokenizer que MODEL_ID (p. ej. google/gemma-3-270m-it); vacío = desactivado
+DRAFT_MODEL_ID = get_env("DRAFT_MODEL_ID", "")
+# Tokens propuestos por paso de verificación
+SPECULATIVE_NUM_TOKENS = get_env("SPECULATIVE_NUM_TOKENS", 4, int)
+
+# Prompt lookup (sin borrador): copia continuaciones de la plantilla, ediciones aprobadas y el prompt
+PROMPT_LOOKUP_ENABLED = get_env("PROMPT_LOOKUP_ENABLED", True, _as_bool)
+# n-grama más largo que se busca y tokens propuestos por paso
+PROMPT_LOOKUP_NGRAM_MAX = get_env("PROMPT_LOOKUP_NGRAM_MAX", 3, int)
+PROMPT_LOOKUP_NUM_TOKENS = get_env("PROMPT_LOOKUP_NUM_TOKENS", 8, int)
+
+
+# ============================================================================
+# COLA DE PETICIONES Y CONTROL DE ADMISIÓN
+# ============================================================================
+
+# Generaciones en ejecución a la vez (0 = las que agrupa el motor continuo o el micro-batching)
+MODEL_WORKERS = get_env("MODEL_WORKERS", 0, int)
+# Peticiones en espera; las que no caben se rechazan
+QUEUE_MAX_SIZE = get_env("QUEUE_MAX_SIZE", 16, int)
+# KV-cache estimado (prompt + max_new_tokens) que pueden reservar las generaciones en curso
+ADMISSION_KV_BUDGET_MB = get_env("ADMISSION_KV_BUDGET_MB", 4096, int)
+# Refresco de la posición en cola en la UI
+QUEUE_POLL_SECONDS = get_env("QUEUE_POLL_SECONDS", 1.0, float)
+
+# ============================================================================
+# STREAMING DE TOKENS EN LA UI
+# ============================================================================
+
+STREAMING_ENABLED = get_env("STREAMING_ENABLED", True, _as_bool)
+# Intervalo mínimo entre renderizados del borrador parcial (apply_edits)
+STREAM_RENDER_INTERVAL_SECONDS = get_env("STREAM_RENDER_INTERVAL_SECONDS", 0.5, float)
+
+# Detener la decodificación al cerrar el bloque JSON de ediciones
+JSON_STOP_ENABLED = get_env("JSON_STOP_ENABLED", True, _as_bool)
+
+# Restringir la salida al esquema JSON de ediciones (evita la pasada de reparación)
+JSON_CONSTRAINED_DECODING = get_env("JSON_CONSTRAINED_DECODING", True, _as_bool)
+
+# Formato de remove/replace.from: "text" copia la línea completa de la plantilla;
+# "index" numera la plantilla en el prompt y el modelo referencia el número de línea
+EDIT_FORMAT = get_env("EDIT_FORMAT", "text", lambda v: v.strip().lower())
+
+# Restringir remove/replace.from a líneas existentes de la plantilla en curso
+TEMPLATE_LINE_CONSTRAINT = get_env("TEMPLATE_LINE_CONSTRAINT", True, _as_bool)
+# Índices de líneas por plantilla en memoria (LRU por hash del contenido)
+TEMPLATE_INDEX_CACHE_SIZE = get_env("TEMPLATE_INDEX_CACHE_SIZE", 16, int)
+
+
+# ============================================================================
+# PRESUPUESTO DE TOKENS DEL PROMPT
+# ============================================================================
+
+# Ejemplos y esquema en JSON de una línea, y el esquema una sola vez (en el
+# prefijo) en lugar de repetirlo al final del prompt. Desactivado hasta medir
+# con el modelo la tasa de JSON válido (benchmarks/bench_prompt_budget.py --generate)
+PROMPT_COMPACT = get_env("PROMPT_COMPACT", False, _as_bool)
+# Tokens de texto máximos del prompt (sin la imagen); si se superan se quitan
+# casos parecidos, ejemplos few-shot y líneas de la guía por modalidad. 0 = sin límite
+# (por defecto, hasta medir con benchmarks/bench_prompt_budget.py; candidato: 1536)
+PROMPT_TOKEN_BUDGET = get_env("PROMPT_TOKEN_BUDGET", 0, int)
+# Parte del presupuesto para el segmento estático (antes de la imagen). Se recorta
+# por separado para que una plantilla o unos extras largos no cambien el prefijo
+# (ni su KV-cache); el dinámico usa lo que quede. 0 = el presupuesto completo
+# (por defecto; candidato: 1024)
+PROMPT_PREFIX_TOKEN_BUDGET = get_env("PROMPT_PREFIX_TOKEN_BUDGET", 0, int)
+
+
+# ============================================================================
+# VÍA RÁPIDA DE ESTUDIOS NORMALES
+# ============================================================================
+
+# Clasificador sobre el embedding de imagen entrenado con las valoraciones
+NORMAL_FASTPATH_ENABLED = get_env("NORMAL_FASTPATH_ENABLED", True, _as_bool)
+# "short": decodificación restringida corta; "template": devuelve la plantilla para confirmar
+NORMAL_FASTPATH_MODE = get_env("NORMAL_FASTPATH_MODE", "short", lambda v: v.strip().lower())
+NORMAL_FASTPATH_THRESHOLD = get_env("NORMAL_FASTPATH_THRESHOLD", 0.9, float)
+NORMAL_FASTPATH_MAX_NEW_TOKENS = get_env("NORMAL_FASTPATH_MAX_NEW_TOKENS", 96, int)
+# Muestras etiquetadas necesarias antes de activar la vía rápida
+NORMAL_FASTPATH_MIN_SAMPLES = get_env("NORMAL_FASTPATH_MIN_SAMPLES", 30, int)
+# Muestras nuevas entre reentrenamientos (en segundo plano, fuera del handler de la valoración)
+NORMAL_FASTPATH_RETRAIN_EVERY = get_env("NORMAL_FASTPATH_RETRAIN_EVERY", 10, int)
+NORMAL_SAMPLES_FILE = FEEDBACK_DIR / "normal_samples.jsonl"
+# Embeddings de informes aún sin valorar (sobreviven a un reinicio)
+NORMAL_PENDING_FILE = FEEDBACK_DIR / "normal_pending.jsonl"
+
+
+# ============================================================================
+# PREPARACIÓN ANTICIPADA (al subir la imagen / elegir plantilla)
+# ============================================================================
+
+# Preprocesado + vision encoder de la imagen y tokenización de la plantilla en segundo plano
+PREFETCH_ENABLED = get_env("PREFETCH_ENABLED", True, _as_bool)
+PREFETCH_WORKERS = get_env("PREFETCH_WORKERS", 2, int)
+# Huecos (sesión, tipo de entrada) que se conservan; los más antiguos se cancelan
+PREFETCH_MAX_SESSIONS = get_env("PREFETCH_MAX_SESSIONS", 64, int)
+
+
+# ============================================================================
+# EJEMPLOS BUENOS: ALMACÉN Y SELECCIÓN FEW-SHOT
+# ============================================================================
+
+# Inserciones entre volcados del WAL de SQLite a la base (0 = solo los automáticos)
+GOOD_EXAMPLES_COMPACT_EVERY = get_env("GOOD_EXAMPLES_COMPACT_EVERY", 500, int)
+# Few-shot por recuperación (BM25 sobre etiqueta, región y hallazgos, filtrado por
+# modalidad y ponderado por valoración) en lugar de los dos últimos ejemplos
+FEWSHOT_RETRIEVAL_ENABLED = get_env("FEWSHOT_RETRIEVAL_ENABLED", True, _as_bool)
+FEWSHOT_TOP_K = get_env("FEWSHOT_TOP_K", 2, int)
+# Incluir la indicación en la consulta (los ejemplos van tras la imagen, así que
+# no afecta a la caché de prefijo KV)
+FEWSHOT_QUERY_INDICATION = get_env("FEWSHOT_QUERY_INDICATION", False, _as_bool)
+# Casos aprobados con la imagen más parecida (coseno sobre el embedding de
+# imagen guardado al aprobar). Van en el segmento dinámico, tras la imagen
+# (como los few-shot), para no romper la caché de prefijo. Búsqueda exacta hasta IVF_MIN casos
+FEWSHOT_VISUAL_ENABLED = get_env("FEWSHOT_VISUAL_ENABLED", True, _as_bool)
+FEWSHOT_VISUAL_K = get_env("FEWSHOT_VISUAL_K", 1, int)
+FEWSHOT_VISUAL_IVF_MIN = get_env("FEWSHOT_VISUAL_IVF_MIN", 20000, int)
+FEWSHOT_VISUAL_NPROBE = get_env("FEWSHOT_VISUAL_NPROBE", 8, int)
+
+
 # ============================================================================
 # REGLAS PARA EL MODELO
 # ============================================================================
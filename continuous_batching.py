@@ -0,0 +1,472 @@
+"""
+Batching continuo (a nivel de iteración) para la decodificación
+Un hilo propietario del bucle de decodificación admite secuencias nuevas en
+huecos libres en cada paso y retira las terminadas (EOS, cierre de JSON,
+max_new_tokens, max_time) de inmediato, sin esperar a la más larga del batch.
+Las secuencias de menor prioridad se aparcan (con su KV-cache) mientras haya
+otras más prioritarias
+"""
+import copy
+import logging
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+import torch
+from transformers import LogitsProcessorList, StoppingCriteriaList
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# CONTABILIDAD PAGINADA DEL KV-CACHE
+# ============================================================================
+
+class KVBlockAllocator:
+    """
+    Reparte un presupuesto de KV-cache en bloques de block_size tokens.
+    Cada secuencia reserva al admitirse los bloques de su peor caso
+    (prompt + max_new_tokens) y los libera al retirarse, de modo que el
+    bucle nunca se queda sin memoria a mitad de decodificación.
+    """
+
+    def __init__(self, num_blocks: int, block_size: int):
+        self.num_blocks = int(num_blocks)
+        self.block_size = int(block_size)
+        self._free = list(range(self.num_blocks))
+        self._owned: Dict[int, List[int]] = {}
+
+    def blocks_for(self, num_tokens: int) -> int:
+        return math.ceil(max(0, int(num_tokens)) / self.block_size)
+
+    @property
+    def free_blocks(self) -> int:
+        return len(self._free)
+
+    def can_allocate(self, num_tokens: int) -> bool:
+        return self.blocks_for(num_tokens) <= len(self._free)
+
+    def allocate(self, seq_id: int, num_tokens: int) -> List[int]:
+        """Reserva bloques para seq_id; ValueError si no hay suficientes."""
+        n = self.blocks_for(num_tokens)
+        if n > len(self._free):
+            raise ValueError(f"KV-cache sin bloques libres: se piden {n}, quedan {len(self._free)}")
+        blocks, self._free = self._free[:n], self._free[n:]
+        self._owned[seq_id] = blocks
+        return blocks
+
+    def release(self, seq_id: int) -> None:
+        self._free.extend(self._owned.pop(seq_id, []))
+
+
+# ============================================================================
+# OPERACIONES SOBRE EL KV-CACHE CON BATCH (padding a la izquierda)
+# ============================================================================
+
+def _layer_target_len(layer: Any, seq_len: int) -> int:
+    """Tokens que guarda una capa para una secuencia de seq_len (ventana deslizante o completa)."""
+    if getattr(layer, "is_sliding", False):
+        return min(seq_len, layer.sliding_window - 1)
+    return seq_len
+
+
+def _pad_cache_left(cache: Any, old_len: int, new_len: int) -> None:
+    """Extiende in-place el cache de old_len a new_len posiciones con ceros a la izquierda."""
+    if new_len == old_len:
+        return
+    for layer in cache.layers:
+        if not getattr(layer, "is_initialized", False):
+            continue
+        pad = _layer_target_len(layer, new_len) - layer.keys.shape[-2]
+        if pad > 0:
+            shape = list(layer.keys.shape)
+            shape[-2] = pad
+            zeros = layer.keys.new_zeros(shape)
+            layer.keys = torch.cat([zeros, layer.keys], dim=-2)
+            layer.values = torch.cat([zeros, layer.values], dim=-2)
+        if hasattr(layer, "cumulative_length"):
+            layer.cumulative_length = new_len
+
+
+def _trim_cache_left(cache: Any, old_len: int, new_len: int) -> None:
+    """Recorta in-place las posiciones de padding sobrantes a la izquierda."""
+    for layer in cache.layers:
+        if not getattr(layer, "is_initialized", False):
+            continue
+        drop = layer.keys.shape[-2] - _layer_target_len(layer, new_len)
+        if drop > 0:
+            layer.keys = layer.keys[..., drop:, :]
+            layer.values = layer.values[..., drop:, :]
+        if hasattr(layer, "cumulative_length"):
+            layer.cumulative_length = new_len
+
+
+def _concat_cache(batch_cache: Any, other: Any) -> None:
+    """Añade las filas de other al final del batch (mismas longitudes por capa)."""
+    for layer, new in zip(batch_cache.layers, other.layers):
+        layer.keys = torch.cat([layer.keys, new.keys], dim=0)
+        layer.values = torch.cat([layer.values, new.values], dim=0)
+
+
+def _select_rows(cache: Any, rows: torch.Tensor) -> None:
+    for layer in cache.layers:
+        if getattr(layer, "is_initialized", False):
+            layer.keys = layer.keys[rows]
+            layer.values = layer.values[rows]
+
+
+def _extract_row(cache: Any, row: int, batch_len: int, seq_len: int) -> Any:
+    """Copia la fila row del cache del batch, sin el padding de la izquierda."""
+    extracted = copy.copy(cache)
+    extracted.layers = []
+    for layer in cache.layers:
+        layer = copy.copy(layer)
+        if getattr(layer, "is_initialized", False):
+            layer.keys = layer.keys[row:row + 1].clone()
+            layer.values = layer.values[row:row + 1].clone()
+        extracted.layers.append(layer)
+    _trim_cache_left(extracted, batch_len, seq_len)
+    return extracted
+
+
+def prefill(model: Any, inputs: Dict[str, Any]):
+    """Forward del prompt (salvo lo ya cacheado); devuelve (cache, logits del último token)."""
+    input_ids = inputs["input_ids"]
+    past_key_values = inputs.get("past_key_values")
+    start = past_key_values.get_seq_length() if past_key_values is not None else 0
+    seq_len = input_ids.shape[-1]
+    kwargs = {}
+    if inputs.get("inputs_embeds") is not None:
+        kwargs["inputs_embeds"] = inputs["inputs_embeds"][:, start:]
+    else:
+        kwargs["input_ids"] = input_ids[:, start:]
+        if start == 0:
+            kwargs.update({k: v for k, v in inputs.items() if k in ("pixel_values", "image_sizes")})
+    with torch.inference_mode():
+        out = model(
+            **kwargs,
+            attention_mask=inputs.get("attention_mask", torch.ones_like(input_ids)),
+            past_key_values=past_key_values,
+            cache_position=torch.arange(start, seq_len, device=input_ids.device),
+            use_cache=True,
+            logits_to_keep=1,
+        )
+    return out.past_key_values, out.logits[:, -1, :]
+
+
+# ============================================================================
+# SECUENCIAS Y MOTOR
+# ============================================================================
+
+class _Sequence:
+    """Estado de una petición dentro del motor."""
+
+    __slots__ = (
+        "seq_id", "tokens", "prompt_len", "max_new_tokens", "eos_ids", "logits_processor",
+        "stopping_criteria", "streamer", "deadline", "cache", "future", "done", "priority", "parked_at",
+    )
+
+    def __init__(self, seq_id, tokens, max_new_tokens, eos_ids, logits_processor, stopping_criteria, streamer, deadline, cache, priority=1):
+        self.seq_id = seq_id
+        self.tokens: List[int] = tokens
+        self.prompt_len = len(tokens)
+        self.max_new_tokens = int(max_new_tokens)
+        self.eos_ids = set(eos_ids)
+        self.logits_processor = logits_processor
+        self.stopping_criteria = stopping_criteria
+        self.streamer = streamer
+        self.deadline = deadline
+        self.cache = cache
+        self.future: Future = Future()
+        self.done = False
+        self.priority = int(priority)  # 0 = urgente
+        self.parked_at: Optional[float] = None
+
+    @property
+    def generated(self) -> int:
+        return len(self.tokens) - self.prompt_len
+
+    def choose(self, logits: torch.Tensor) -> int:
+        """Aplica logits processors (greedy) y comprueba los criterios de parada."""
+        ids = torch.tensor([self.tokens], device=logits.device)
+        scores = self.logits_processor(ids, logits.unsqueeze(0).float())
+        token = int(scores.argmax(-1))
+        self.tokens.append(token)
+        if self.streamer is not None:
+            self.streamer.put(torch.tensor([token]))
+        ids = torch.tensor([self.tokens], device=logits.device)
+        self.done = (
+            token in self.eos_ids
+            or self.generated >= self.max_new_tokens
+            or (self.deadline is not None and time.perf_counter() >= self.deadline)
+            or bool(self.stopping_criteria(ids, scores).all())
+        )
+        return token
+
+
+class ContinuousBatchingEngine:
+    """
+    Motor de decodificación greedy con batching continuo.
+
+    El prefill de cada petición se hace en el hilo que llama a generate()
+    (admite past_key_values del prefijo cacheado, inputs_embeds o
+    pixel_values). El hilo del motor une su KV-cache al batch en el siguiente
+    paso, decodifica un token por secuencia activa y retira las terminadas.
+    El KV-cache se guarda denso con padding a la izquierda (los kernels de
+    atención de transformers no admiten tablas de bloques); la memoria se
+    controla con KVBlockAllocator.
+
+    Prioridad (0 = urgente): mientras haya una secuencia más prioritaria en el
+    motor, las demás se sacan del batch entre dos pasos con su KV-cache y
+    esperan aparcadas; al volver continúan donde iban, sin repetir el prefill.
+    """
+
+    def __init__(self, model: Any, max_slots: int = 8, block_size: int = 16, num_blocks: int = 2048):
+        self.model = model
+        self.max_slots = max(1, int(max_slots))
+        self.allocator = KVBlockAllocator(num_blocks, block_size)
+        self._pending: "queue.Queue[_Sequence]" = queue.Queue()
+        self._waiting: List[_Sequence] = []
+        self._active: List[_Sequence] = []
+        self._cache = None
+        self._mask: Optional[torch.Tensor] = None
+        self._length = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.steps = 0
+        self.tokens_generated = 0
+        self.busy_seconds = 0.0
+        self.max_concurrency = 0
+        self.preemptions = 0
+
+    # ------------------------------------------------------------ peticiones
+
+    def generate(self, inputs: Dict[str, Any], max_new_tokens: int, eos_token_ids: List[int], logits_processor: Optional[LogitsProcessorList] = None, stopping_criteria: Optional[StoppingCriteriaList] = None, streamer: Optional[Any] = None, max_time: Optional[float] = None, priority: int = 1) -> torch.Tensor:
+        """
+        Equivalente a model.generate(do_sample=False) para batch 1.
+
+        Args:
+            priority: 0 = urgente (aparca a las de rutina); max_time no cuenta el tiempo aparcada
+
+        Returns:
+            Tensor (1, prompt + tokens generados), como model.generate()
+        """
+        return self.submit(inputs, max_new_tokens, eos_token_ids, logits_processor, stopping_criteria, streamer, max_time, priority).result()
+
+    def submit(self, inputs: Dict[str, Any], max_new_tokens: int, eos_token_ids: List[int], logits_processor: Optional[LogitsProcessorList] = None, stopping_criteria: Optional[StoppingCriteriaList] = None, streamer: Optional[Any] = None, max_time: Optional[float] = None, priority: int = 1) -> Future:
+        input_ids = inputs["input_ids"]
+        if input_ids.shape[0] != 1:
+            raise ValueError("ContinuousBatchingEngine admite una secuencia por petición")
+        deadline = time.perf_counter() + max_time if max_time else None
+        with self._lock:
+            seq_id = self._next_id
+            self._next_id += 1
+
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+        cache, logits = self._prefill(inputs)
+        seq = _Sequence(
+            seq_id, input_ids[0].tolist(), max_new_tokens, eos_token_ids,
+            logits_processor or LogitsProcessorList(), stopping_criteria or StoppingCriteriaList(),
+            streamer, deadline, cache, priority,
+        )
+        seq.choose(logits[0])
+        if seq.done:
+            self._finish(seq)
+        else:
+            self._ensure_worker()
+            self._pending.put(seq)
+            self._wakeup.set()
+        return seq.future
+
+    def _prefill(self, inputs: Dict[str, Any]):
+        return prefill(self.model, inputs)
+
+    def _finish(self, seq: _Sequence, error: Optional[BaseException] = None) -> None:
+        if seq.streamer is not None:
+            seq.streamer.end()
+        if error is not None:
+            seq.future.set_exception(error)
+        else:
+            seq.future.set_result(torch.tensor([seq.tokens]))
+
+    # ----------------------------------------------------------------- bucle
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._loop, name="decode-engine", daemon=True)
+                self._thread.start()
+
+    def _admit(self) -> None:
+        """Mueve secuencias prefilladas a huecos libres si hay bloques de KV (por prioridad)."""
+        while True:
+            try:
+                self._waiting.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if not self._waiting:
+            return
+        top = min(s.priority for s in self._active + self._waiting)
+        victims = [s for s in self._active if s.priority > top]
+        if victims:
+            self._preempt(victims)
+        still_waiting = []
+        for seq in sorted(self._waiting, key=lambda s: (s.priority, s.seq_id)):
+            if seq.priority > top:
+                still_waiting.append(seq)
+                continue
+            worst_case = seq.prompt_len + seq.max_new_tokens
+            if len(self._active) < self.max_slots and self.allocator.can_allocate(worst_case):
+                self.allocator.allocate(seq.seq_id, worst_case)
+                self._join_batch(seq)
+            elif not self._active and not self.allocator.can_allocate(worst_case):
+                self._finish(seq, ValueError("La petición excede el presupuesto de KV-cache del motor"))
+            else:
+                still_waiting.append(seq)
+        self._waiting = still_waiting
+
+    def _join_batch(self, seq: _Sequence) -> None:
+        """Une el KV-cache (1 fila) de seq al batch, alineando por la izquierda."""
+        seq_len = len(seq.tokens) - 1  # el último token aún no está en el cache
+        device = seq.cache.layers[0].keys.device
+        seq_mask = torch.ones(1, seq_len, dtype=torch.long, device=device)
+        if seq.parked_at is not None:
+            if seq.deadline is not None:
+                seq.deadline += time.perf_counter() - seq.parked_at
+            seq.parked_at = None
+        if not self._active:
+            self._cache, self._mask, self._length = seq.cache, seq_mask, seq_len
+        else:
+            target = max(self._length, seq_len)
+            _pad_cache_left(self._cache, self._length, target)
+            _pad_cache_left(seq.cache, seq_len, target)
+            _concat_cache(self._cache, seq.cache)
+            pad = lambda m: torch.cat([m.new_zeros(m.shape[0], target - m.shape[1]), m], dim=1)
+            self._mask = torch.cat([pad(self._mask), pad(seq_mask)], dim=0)
+            self._length = target
+        seq.cache = None
+        self._active.append(seq)
+        self.max_concurrency = max(self.max_concurrency, len(self._active))
+
+    def _preempt(self, victims: List[_Sequence]) -> None:
+        """Saca del batch las secuencias victims con su KV-cache y las deja esperando."""
+        for row, seq in enumerate(self._active):
+            if seq in victims:
+                seq.cache = _extract_row(self._cache, row, self._length, len(seq.tokens) - 1)
+                seq.parked_at = time.perf_counter()
+                self.allocator.release(seq.seq_id)
+                self._waiting.append(seq)
+                self.preemptions += 1
+        logger.info(f"⏸️ {len(victims)} secuencias aparcadas por una petición más prioritaria")
+        self._keep_rows([i for i, s in enumerate(self._active) if s not in victims])
+
+    def _retire(self) -> None:
+        """Quita del batch las secuencias terminadas."""
+        for seq in self._active:
+            if seq.done:
+                self.allocator.release(seq.seq_id)
+                self._finish(seq)
+        self._keep_rows([i for i, s in enumerate(self._active) if not s.done])
+
+    def _keep_rows(self, keep: List[int]) -> None:
+        """Deja en el batch solo las filas keep y recorta el padding común."""
+        if len(keep) == len(self._active):
+            return
+        self._active = [self._active[i] for i in keep]
+        if not self._active:
+            self._cache, self._mask, self._length = None, None, 0
+            return
+        rows = torch.tensor(keep, device=self._mask.device)
+        _select_rows(self._cache, rows)
+        self._mask = self._mask[rows]
+        leading_pad = int((self._mask.cumsum(dim=1) == 0).sum(dim=1).min())
+        if leading_pad > 0:
+            new_len = self._length - leading_pad
+            _trim_cache_left(self._cache, self._length, new_len)
+            self._mask = self._mask[:, leading_pad:]
+            self._length = new_len
+
+    def _step(self) -> None:
+        """Un paso de decodificación para todas las secuencias activas."""
+        device = self._mask.device
+        input_ids = torch.tensor([[s.tokens[-1]] for s in self._active], device=device)
+        mask = torch.cat([self._mask, self._mask.new_ones(len(self._active), 1)], dim=1)
+        position_ids = mask.sum(dim=1, keepdim=True) - 1
+        with torch.inference_mode():
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                cache_position=torch.tensor([self._length], device=device),
+                use_cache=True,
+            )
+        self._cache = out.past_key_values
+        self._mask = mask
+        self._length += 1
+        logits = out.logits[:, -1, :]
+        for row, seq in enumerate(self._active):
+            seq.choose(logits[row])
+        self.steps += 1
+        self.tokens_generated += len(self._active)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            self._admit()
+            if not self._active:
+                self._wakeup.wait(timeout=0.5)
+                self._wakeup.clear()
+                continue
+            t0 = time.perf_counter()
+            try:
+                self._step()
+            except Exception as e:
+                logger.error(f"Error en el paso de decodificación ({len(self._active)} secuencias): {e}")
+                for seq in self._active:
+                    self.allocator.release(seq.seq_id)
+                    self._finish(seq, e)
+                self._active, self._cache, self._mask, self._length = [], None, None, 0
+                continue
+            self._retire()
+            self.busy_seconds += time.perf_counter() - t0
+
+    def shutdown(self) -> None:
+        """Detiene el hilo del motor tras el paso en curso."""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        """Tokens/s sostenidos del bucle, concurrencia y bloques de KV libres."""
+        return {
+            "steps": self.steps,
+            "tokens": self.tokens_generated,
+            "tokens_per_second": (self.tokens_generated / self.busy_seconds) if self.busy_seconds else 0.0,
+            "active": len(self._active),
+            "waiting": len(self._waiting) + self._pending.qsize(),
+            "max_concurrency": self.max_concurrency,
+            "preemptions": self.preemptions,
+            "free_blocks": self.allocator.free_blocks,
+        }
+
+
+_ENGINES: Dict[int, ContinuousBatchingEngine] = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_decode_engine(model: Any, max_slots: int, block_size: int, num_blocks: int) -> ContinuousBatchingEngine:
+    """Motor único por modelo cargado."""
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(id(model))
+        if engine is None or engine.model is not model:
+            engine = ContinuousBatchingEngine(model, max_slots, block_size, num_blocks)
+            _ENGINES[id(model)] = engine
+        return engine
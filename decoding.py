@@ -0,0 +1,233 @@
+"""
+Control de decodificación para model.generate()
+Criterios de parada sobre la salida JSON de ediciones, cancelación por el
+usuario y cesión del paso a peticiones urgentes
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+import torch
+from transformers import StoppingCriteria
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# PARADA AL CERRAR EL BLOQUE JSON
+# ============================================================================
+
+class _JsonScanState:
+    """Estado incremental del escáner JSON para una secuencia del batch."""
+
+    __slots__ = ("depth", "in_string", "escape", "started", "fence_open", "backticks", "done")
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.fence_open = False
+        self.backticks = 0
+        self.done = False
+
+    def feed(self, text: str) -> bool:
+        """Procesa texto nuevo; True si el bloque JSON quedó cerrado."""
+        for ch in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+
+            if ch == "`":
+                self.backticks += 1
+                if self.backticks == 3:
+                    self.backticks = 0
+                    # Cierre de fence tras haber empezado el JSON
+                    if self.fence_open and self.started:
+                        self.done = True
+                        return True
+                    self.fence_open = True
+                continue
+            self.backticks = 0
+
+            if ch == '"' and self.started:
+                self.in_string = True
+            elif ch == "{":
+                self.started = True
+                self.depth += 1
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth <= 0:
+                    self.done = True
+                    return True
+        return False
+
+
+class JsonBlockStoppingCriteria(StoppingCriteria):
+    """
+    Detiene la generación justo después del primer objeto JSON balanceado
+    (o del cierre del fence ```json). Decodifica solo los tokens nuevos en cada
+    paso y mantiene profundidad de llaves y estado de string por secuencia.
+    """
+
+    def __init__(self, tokenizer: Any, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = int(prompt_length)
+        self._states: List[_JsonScanState] = []
+        self._seen = self.prompt_length
+        self.stopped_at: List[Optional[int]] = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        batch_size, seq_len = input_ids.shape
+        if not self._states:
+            self._states = [_JsonScanState() for _ in range(batch_size)]
+            self.stopped_at = [None] * batch_size
+
+        is_done = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+        for row, state in enumerate(self._states):
+            if not state.done:
+                new_ids = input_ids[row, self._seen:seq_len].tolist()
+                if new_ids:
+                    text = self.tokenizer.decode(new_ids, skip_special_tokens=True)
+                    if state.feed(text):
+                        self.stopped_at[row] = seq_len - self.prompt_length
+            is_done[row] = state.done
+        self._seen = seq_len
+        return is_done
+
+    def tokens_saved(self, max_new_tokens: int) -> int:
+        """Tokens de decodificación ahorrados (suma sobre el batch)."""
+        return sum(max(0, int(max_new_tokens) - n) for n in self.stopped_at if n is not None)
+
+
+# ============================================================================
+# CANCELACIÓN POR EL USUARIO (botón Detener)
+# ============================================================================
+
+class CancellationToken:
+    """Marca de cancelación de una petición; el criterio de parada la consulta en cada paso."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.cancelled_at: Optional[float] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        if not self._event.is_set():
+            self.cancelled_at = time.time()
+            self._event.set()
+
+
+class CancellationStoppingCriteria(StoppingCriteria):
+    """
+    Detiene las filas cuya petición se ha cancelado (una marca por fila del
+    batch, o una sola para todo el batch). Se evalúa tras cada paso de
+    decodificación, así que el worker queda libre en un paso.
+    """
+
+    def __init__(self, tokens: Union[CancellationToken, Sequence[Optional[CancellationToken]]]):
+        self.tokens = [tokens] if isinstance(tokens, CancellationToken) else list(tokens)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        batch_size = input_ids.shape[0]
+        tokens = self.tokens * batch_size if len(self.tokens) == 1 else self.tokens
+        return torch.tensor([t is not None and t.cancelled for t in tokens[:batch_size]], dtype=torch.bool, device=input_ids.device)
+
+
+class CancellationRegistry:
+    """Marca de la generación en curso por sesión de la UI, para que Detener la encuentre."""
+
+    def __init__(self):
+        self._tokens: Dict[str, CancellationToken] = {}
+        self._lock = threading.Lock()
+
+    def start(self, session: str) -> CancellationToken:
+        token = CancellationToken()
+        with self._lock:
+            self._tokens[session] = token
+        return token
+
+    def cancel(self, session: str) -> bool:
+        """Cancela la generación en curso de la sesión; False si no había ninguna."""
+        with self._lock:
+            token = self._tokens.get(session)
+        if token is None or token.cancelled:
+            return False
+        token.cancel()
+        logger.info("Generación cancelada por el usuario")
+        return True
+
+    def finish(self, session: str, token: CancellationToken) -> None:
+        with self._lock:
+            if self._tokens.get(session) is token:
+                del self._tokens[session]
+
+
+# ============================================================================
+# PRIORIDAD Y TIEMPO HASTA EL PRIMER TOKEN
+# ============================================================================
+
+class PreemptionStoppingCriteria(StoppingCriteria):
+    """
+    Cede el paso entre dos pasos de decodificación: mientras should_yield()
+    sea True (p. ej. hay una urgente en ejecución) bloquea la generación con
+    su KV-cache intacto y después continúa. Nunca detiene la generación; la
+    cancelación del usuario (cancel_token) sí interrumpe la espera.
+    """
+
+    def __init__(self, should_yield: Callable[[], bool], poll: float = 0.05, cancel_token: Optional[CancellationToken] = None):
+        self.should_yield = should_yield
+        self.poll = poll
+        self.cancel_token = cancel_token
+        self.paused_seconds = 0.0
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.should_yield():
+            t0 = time.perf_counter()
+            while self.should_yield() and not (self.cancel_token is not None and self.cancel_token.cancelled):
+                time.sleep(self.poll)
+            self.paused_seconds += time.perf_counter() - t0
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class PausableMaxTimeCriteria(StoppingCriteria):
+    """
+    Como MaxTimeCriteria de transformers, pero sin contar el tiempo que las
+    pausas (PreemptionStoppingCriteria) tuvieron la generación aparcada: una
+    de rutina que cedió el paso a una urgente no se trunca al reanudar.
+    """
+
+    def __init__(self, max_time: float, pauses: Sequence[PreemptionStoppingCriteria] = ()):
+        self.max_time = max_time
+        self.pauses = list(pauses)
+        self.started_at = time.perf_counter()
+
+    @property
+    def paused_seconds(self) -> float:
+        return sum(p.paused_seconds for p in self.pauses)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        expired = time.perf_counter() - self.started_at - self.paused_seconds >= self.max_time
+        return torch.full((input_ids.shape[0],), expired, dtype=torch.bool, device=input_ids.device)
+
+
+class FirstTokenCallback(StoppingCriteria):
+    """Llama a callback() una sola vez, tras el primer token generado (mide el TTFT)."""
+
+    def __init__(self, callback: Callable[[], None]):
+        self.callback = callback
+        self.fired = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if not self.fired:
+            self.fired = True
+            self.callback()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,307 @@
+"""
+Índices de recuperación de ejemplos few-shot
+BM25 sobre etiqueta, región y hallazgos de los ejemplos buenos, con filtro por
+modalidad y peso por valoración (feedback.csv), y similitud coseno sobre el
+embedding de imagen de los casos aprobados (búsqueda exacta o IVF cuando el
+almacén crece). Ambos se actualizan de forma incremental al aprobar ejemplos
+nuevos; las consultas son vectorizadas con NumPy
+"""
+import json
+import math
+import re
+import threading
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from example_store import infer_modality_region
+
+# Palabras vacías frecuentes en etiquetas e indicaciones
+_STOPWORDS = frozenset(
+    "a al con de del e el en la las lo los o para por sin su un una y se que no "
+    "mm cm ml control estudio".split()
+)
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Minúsculas, sin tildes, alfanumérico; descarta palabras vacías y de una letra."""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in _TOKEN.findall(text) if len(t) > 1 and t not in _STOPWORDS]
+
+
+def example_key(example_data: Any) -> str:
+    """Forma canónica del JSON de ediciones (enlaza ejemplos y filas de feedback.csv)."""
+    return json.dumps(example_data, ensure_ascii=False, sort_keys=True)
+
+
+def example_text(example: Dict[str, Any]) -> str:
+    """Texto indexado: etiqueta, región y hallazgos (añadidos, reemplazos y conclusión)."""
+    data = example.get("example", {}) or {}
+    conclusion = data.get("conclusion", {}) or {}
+    parts = [example.get("label", ""), example.get("region") or ""]
+    parts += [str(x) for x in data.get("add_findings", []) or []]
+    parts += [str(r.get("to", "")) for r in data.get("replace", []) or [] if isinstance(r, dict)]
+    for field in ("positives", "impression", "ddx"):
+        parts += [str(x) for x in conclusion.get(field, []) or []] if isinstance(conclusion, dict) else []
+    return " ".join(parts)
+
+
+class ExampleIndex:
+    """
+    Índice invertido BM25 de ejemplos {"label", "example", "modality", "region"}.
+
+    Las listas de postings son append-only (ids de documento crecientes) y se
+    convierten a arrays de NumPy bajo demanda, así que add() es O(términos del
+    ejemplo) y search() cuesta unas operaciones vectorizadas por término de la
+    consulta. search() filtra por modalidad (los ejemplos sin modalidad valen
+    para todas; si no la traen se deduce de la etiqueta entre modalities) y
+    multiplica la puntuación por el peso de valoración.
+    """
+
+    def __init__(self, modalities: Iterable[str] = (), k1: float = 1.2, b: float = 0.75, default_weight: float = 0.8):
+        self.modalities = list(modalities)
+        self.k1 = k1
+        self.b = b
+        self.default_weight = default_weight
+        self._docs: List[Dict[str, Any]] = []
+        self._keys: List[str] = []
+        self._modality_codes: Dict[Optional[str], int] = {None: -1}
+        self._modalities: List[int] = []
+        self._modalities_array: Optional[np.ndarray] = None
+        self._lengths: List[int] = []
+        self._postings: Dict[str, List[List[int]]] = {}
+        self._arrays: Dict[str, Any] = {}
+        self._lengths_array: Optional[np.ndarray] = None
+        self._weights: Dict[str, float] = {}
+        self._weights_array: Optional[np.ndarray] = None
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    # -------------------------------------------------------- actualización
+
+    def add(self, example: Dict[str, Any]) -> None:
+        """Añade un ejemplo al final del índice."""
+        tokens = tokenize(example_text(example))
+        modality = example.get("modality") or infer_modality_region(example.get("label", ""), self.modalities)[0]
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        with self._lock:
+            doc_id = len(self._docs)
+            self._docs.append(example)
+            self._keys.append(example_key(example.get("example", {})))
+            self._modalities.append(self._modality_codes.setdefault(modality, len(self._modality_codes)))
+            self._lengths.append(len(tokens))
+            self._total_length += len(tokens)
+            for token, tf in counts.items():
+                docs, tfs = self._postings.setdefault(token, [[], []])
+                docs.append(doc_id)
+                tfs.append(tf)
+                self._arrays.pop(token, None)
+            self._lengths_array = None
+            self._weights_array = None
+            self._modalities_array = None
+
+    def sync(self, examples: List[Dict[str, Any]]) -> int:
+        """
+        Alinea el índice con la lista de ejemplos (que solo crece): añade los
+        nuevos o lo reconstruye si la lista ya no empieza por lo indexado.
+        Devuelve los ejemplos añadidos.
+        """
+        indexed = len(self._docs)
+        if indexed > len(examples) or (indexed and examples[indexed - 1] is not self._docs[-1]):
+            self.clear()
+            indexed = 0
+        for example in examples[indexed:]:
+            self.add(example)
+        return len(examples) - indexed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._docs, self._keys, self._modalities, self._lengths = [], [], [], []
+            self._postings, self._arrays = {}, {}
+            self._modality_codes = {None: -1}
+            self._lengths_array, self._weights_array, self._modalities_array = None, None, None
+            self._total_length = 0
+
+    def set_weights(self, weights: Dict[str, float]) -> None:
+        """Peso por ejemplo (clave example_key) según su valoración; el resto usa default_weight."""
+        with self._lock:
+            if weights is not self._weights:
+                self._weights = weights
+                self._weights_array = None
+
+    # -------------------------------------------------------------- consulta
+
+    def _term_arrays(self, token: str):
+        arrays = self._arrays.get(token)
+        if arrays is None:
+            docs, tfs = self._postings[token]
+            arrays = (np.asarray(docs, dtype=np.int64), np.asarray(tfs, dtype=np.float64))
+            self._arrays[token] = arrays
+        return arrays
+
+    def search(self, query: str, modality: Optional[str] = None, k: int = 2) -> List[Dict[str, Any]]:
+        """
+        Los k ejemplos más relevantes, de mayor a menor puntuación. Sin
+        coincidencias, los más recientes de la modalidad.
+        """
+        with self._lock:
+            n = len(self._docs)
+            if n == 0 or k <= 0:
+                return []
+            if self._lengths_array is None:
+                self._lengths_array = np.asarray(self._lengths, dtype=np.float64)
+                self._modalities_array = np.asarray(self._modalities, dtype=np.int64)
+            if self._weights_array is None:
+                self._weights_array = np.asarray(
+                    [self._weights.get(key, self.default_weight) for key in self._keys], dtype=np.float64
+                )
+            avgdl = max(self._total_length / n, 1.0)
+            scores = np.zeros(n, dtype=np.float64)
+            for token in set(tokenize(query)):
+                if token not in self._postings:
+                    continue
+                docs, tfs = self._term_arrays(token)
+                idf = math.log(1.0 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+                norm = self.k1 * (1.0 - self.b + self.b * self._lengths_array[docs] / avgdl)
+                scores[docs] += idf * tfs * (self.k1 + 1.0) / (tfs + norm)
+            scores *= self._weights_array
+            # Desempate (y sin coincidencias, orden) por recencia: el más reciente primero
+            scores += np.arange(n, dtype=np.float64) * 1e-12
+            if modality is not None:
+                code = self._modality_codes.get(modality, -2)
+                allowed = (self._modalities_array == code) | (self._modalities_array == -1)
+                scores[~allowed] = -np.inf
+                k = min(k, int(allowed.sum()))
+            k = min(k, n)
+            if k == 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [self._docs[i] for i in top]
+
+
+class VisualExampleIndex:
+    """
+    Top-k por similitud coseno sobre embeddings de imagen L2-normalizados.
+
+    Los vectores se guardan en una matriz float32 que crece por duplicación
+    (add() amortizado O(dim)). Hasta ivf_min vectores la búsqueda es exacta
+    (un producto matriz-vector); a partir de ahí se entrena un IVF: k-means
+    esférico con ~sqrt(n) listas, y la consulta solo puntúa los vectores de
+    las n_probe listas cuyo centroide está más cerca. El IVF se reentrena
+    cuando el índice dobla el tamaño con el que se entrenó; mientras, los
+    vectores nuevos se asignan a su centroide más cercano.
+    """
+
+    def __init__(self, ivf_min: int = 20000, n_probe: int = 8, kmeans_iters: int = 8, seed: int = 0):
+        self.ivf_min = ivf_min
+        self.n_probe = n_probe
+        self.kmeans_iters = kmeans_iters
+        self.seed = seed
+        self.clear()
+
+    def __len__(self) -> int:
+        return self._n
+
+    def clear(self) -> None:
+        self._n = 0
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._payloads: List[Any] = []
+        self._modality_codes: Dict[Optional[str], int] = {None: -1}
+        self._modalities = np.zeros(0, dtype=np.int64)
+        self._centroids: Optional[np.ndarray] = None
+        self._lists = np.zeros(0, dtype=np.int64)
+        self._trained_n = 0
+
+    @property
+    def dim(self) -> int:
+        return self._matrix.shape[1]
+
+    @property
+    def memory_bytes(self) -> int:
+        """Bytes de la matriz (ocupada), modalidades, asignaciones y centroides."""
+        centroids = 0 if self._centroids is None else self._centroids.nbytes
+        return self._n * (self.dim * 4 + 8 + (8 if self._centroids is not None else 0)) + centroids
+
+    # -------------------------------------------------------- actualización
+
+    def add(self, vectors: np.ndarray, payloads: Sequence[Any], modalities: Sequence[Optional[str]]) -> int:
+        """Añade vectores (n, dim) con su ejemplo y modalidad; ignora los de otra dimensión."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or not len(vectors):
+            return 0
+        if self._n and vectors.shape[1] != self.dim:
+            return 0
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-8)
+        start, end = self._n, self._n + len(vectors)
+        if end > len(self._matrix):
+            capacity = max(end, 2 * len(self._matrix), 64)
+            matrix = np.zeros((capacity, vectors.shape[1]), dtype=np.float32)
+            if start:
+                matrix[:start] = self._matrix[:start]
+            self._matrix = matrix
+            self._modalities = np.resize(self._modalities, capacity)
+            self._lists = np.resize(self._lists, capacity)
+        self._matrix[start:end] = vectors
+        self._modalities[start:end] = [self._modality_codes.setdefault(m, len(self._modality_codes)) for m in modalities]
+        self._payloads.extend(payloads)
+        self._n = end
+        if self._centroids is not None:
+            self._lists[start:end] = np.argmax(vectors @ self._centroids.T, axis=1)
+        if self._n >= self.ivf_min and self._n >= 2 * self._trained_n:
+            self._train_ivf()
+        return len(vectors)
+
+    def _train_ivf(self) -> None:
+        """k-means esférico sobre una muestra; asigna todos los vectores a su lista."""
+        data = self._matrix[:self._n]
+        n_lists = max(1, int(math.sqrt(self._n)))
+        rng = np.random.default_rng(self.seed)
+        sample = data[rng.choice(self._n, size=min(self._n, 32 * n_lists), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iters):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            onehot = np.zeros((n_lists, len(sample)), dtype=np.float32)
+            onehot[assign, np.arange(len(sample))] = 1.0
+            sums = onehot @ sample
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Las listas vacías conservan su centroide
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-8), centroids)
+        self._centroids = centroids
+        for start in range(0, self._n, 8192):
+            block = data[start:start + 8192]
+            self._lists[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        self._trained_n = self._n
+
+    # -------------------------------------------------------------- consulta
+
+    def search(self, vector: np.ndarray, modality: Optional[str] = None, k: int = 1) -> List[Tuple[Any, float]]:
+        """Los k más parecidos como (ejemplo, coseno), del más al menos parecido."""
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if self._n == 0 or k <= 0 or vector.shape[0] != self.dim:
+            return []
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-8)
+        if self._centroids is None:
+            ids = np.arange(self._n)
+            scores = self._matrix[:self._n] @ vector
+        else:
+            probes = np.argsort(-(self._centroids @ vector))[:self.n_probe]
+            ids = np.flatnonzero(np.isin(self._lists[:self._n], probes))
+            scores = self._matrix[ids] @ vector
+        if modality is not None:
+            modalities = self._modalities[ids]
+            allowed = (modalities == self._modality_codes.get(modality, -2)) | (modalities == -1)
+            scores = np.where(allowed, scores, -np.inf)
+            k = min(k, int(allowed.sum()))
+        k = min(k, len(ids))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self._payloads[ids[i]], float(scores[i])) for i in top]
@@ -0,0 +1,219 @@
+"""
+Almacén de ejemplos buenos (borradores aprobados) en SQLite
+Solo se añade (INSERT) al aprobar un borrador: O(1) por ejemplo, sin reescribir
+el fichero, y seguro con varias aprobaciones simultáneas (bloqueo de SQLite,
+también entre procesos). Índice por modalidad y región, embedding de imagen
+opcional (float16) y migración desde el antiguo good_examples.json
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS examples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    label TEXT NOT NULL,
+    modality TEXT,
+    region TEXT,
+    example TEXT NOT NULL,
+    embedding BLOB
+);
+CREATE INDEX IF NOT EXISTS idx_examples_modality_region ON examples (modality, region);
+"""
+
+# Etiqueta que genera la UI al aprobar: "TC - Cráneo (12:34)"
+_UI_LABEL = re.compile(r"^(?P<modality>\S+) - (?P<region>.+?) \(\d{1,2}:\d{2}\)$")
+
+
+def infer_modality_region(label: str, modalities: Iterable[str] = ()) -> Tuple[Optional[str], Optional[str]]:
+    """Modalidad y región a partir de la etiqueta (ejemplos migrados o guardados a mano)."""
+    match = _UI_LABEL.match(label or "")
+    if match:
+        return match.group("modality"), match.group("region")
+    first = (label or "").split(" ", 1)[0]
+    return (first if first in set(modalities) else None), None
+
+
+class GoodExampleStore:
+    """
+    Ejemplos {"label", "example"} con modalidad y región indexadas.
+
+    SQLite en modo WAL: las escrituras son un INSERT en una transacción
+    (BEGIN IMMEDIATE serializa a los escritores concurrentes, también de otros
+    procesos) y las lecturas no bloquean. Cada compact_every inserciones se
+    vuelca y trunca el WAL para que no crezca sin límite. Leer un almacén que
+    aún no existe no crea el fichero.
+    """
+
+    def __init__(self, path: Path, compact_every: int = 500, timeout: float = 30.0):
+        self.path = Path(path)
+        self.compact_every = int(compact_every)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._appends_since_compact = 0
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------- conexión
+
+    def _conn(self) -> sqlite3.Connection:
+        """Una conexión por hilo (sqlite3 no comparte conexiones entre hilos)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            # Bases creadas antes de guardar el embedding de imagen
+            if "embedding" not in {row[1] for row in conn.execute("PRAGMA table_info(examples)")}:
+                try:
+                    conn.execute("ALTER TABLE examples ADD COLUMN embedding BLOB")
+                except sqlite3.OperationalError:
+                    pass  # otra conexión la añadió a la vez
+            self._local.conn = conn
+        return conn
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def signature(self) -> Tuple[str, Optional[int], Optional[int], Optional[int], Optional[int]]:
+        """(ruta, mtime_ns y tamaño de la base y del WAL): cambia con cada escritura, sin abrirla."""
+        values: List[Optional[int]] = []
+        for path in (self.path, Path(f"{self.path}-wal")):
+            try:
+                st = os.stat(path)
+                values += [st.st_mtime_ns, st.st_size]
+            except OSError:
+                values += [None, None]
+        return (str(self.path), *values)
+
+    # ------------------------------------------------------------ escritura
+
+    def append(self, example: Dict[str, Any], modality: Optional[str] = None, region: Optional[str] = None, seed: Iterable[Dict[str, Any]] = (), embedding: Optional[np.ndarray] = None) -> int:
+        """
+        Añade un ejemplo normalizado {"label", "example"}; devuelve su id.
+        Si el almacén está vacío, antes inserta seed (ejemplos base) en la
+        misma transacción, como hacía el fichero JSON al guardar el primero.
+        embedding (opcional) es el de la imagen del estudio, para buscar por
+        similitud visual.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if seed and conn.execute("SELECT 1 FROM examples LIMIT 1").fetchone() is None:
+                for base in seed:
+                    self._insert(conn, base, None, None)
+            row_id = self._insert(conn, example, modality, region, embedding)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._appends_since_compact += 1
+            compact = self.compact_every > 0 and self._appends_since_compact >= self.compact_every
+            if compact:
+                self._appends_since_compact = 0
+        if compact:
+            self.compact()
+        return row_id
+
+    def _insert(self, conn: sqlite3.Connection, example: Dict[str, Any], modality: Optional[str], region: Optional[str], embedding: Optional[np.ndarray] = None) -> int:
+        blob = None if embedding is None else np.asarray(embedding, dtype=np.float16).tobytes()
+        cursor = conn.execute(
+            "INSERT INTO examples (created_at, label, modality, region, example, embedding) VALUES (?, ?, ?, ?, ?, ?)",
+            (time.time(), example.get("label", "Ejemplo"), modality or example.get("modality"), region or example.get("region"),
+             json.dumps(example.get("example", {}), ensure_ascii=False), blob),
+        )
+        return int(cursor.lastrowid)
+
+    def migrate(self, examples: List[Dict[str, Any]], modalities: Iterable[str] = ()) -> int:
+        """
+        Importa los ejemplos (normalizados) del antiguo good_examples.json si el
+        almacén está vacío; modalidad y región se deducen de la etiqueta.
+        Devuelve los ejemplos importados (0 si ya tenía datos).
+        """
+        modalities = list(modalities)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM examples LIMIT 1").fetchone() is not None:
+                conn.execute("ROLLBACK")
+                logger.warning(f"{self.path.name} ya tiene ejemplos: no se migra el fichero antiguo")
+                return 0
+            for example in examples:
+                self._insert(conn, example, *infer_modality_region(example.get("label", ""), modalities))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info(f"📦 {len(examples)} ejemplos buenos migrados a {self.path.name}")
+        return len(examples)
+
+    def compact(self) -> None:
+        """Vuelca el WAL a la base y lo trunca."""
+        self._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # -------------------------------------------------------------- lectura
+
+    def _rows(self, where: str = "", params: Tuple = ()) -> List[Dict[str, Any]]:
+        if not self.exists():
+            return []
+        rows = self._conn().execute(
+            f"SELECT id, label, modality, region, example FROM examples {where} ORDER BY id", params
+        ).fetchall()
+        return [
+            {"id": row_id, "label": label, "modality": modality, "region": region, "example": json.loads(example)}
+            for row_id, label, modality, region, example in rows
+        ]
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Todos los ejemplos, del más antiguo al más reciente."""
+        return self._rows()
+
+    def since(self, last_id: int) -> List[Dict[str, Any]]:
+        """Ejemplos con id > last_id (para actualizar índices de forma incremental)."""
+        return self._rows("WHERE id > ?", (int(last_id),))
+
+    def by_modality(self, modality: str, region: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Ejemplos de una modalidad (y región), usando el índice."""
+        if region is None:
+            return self._rows("WHERE modality = ?", (modality,))
+        return self._rows("WHERE modality = ? AND region = ?", (modality, region))
+
+    def embeddings(self, since_id: int = 0) -> Tuple[List[int], List[Optional[str]], np.ndarray]:
+        """
+        (ids, modalidades, matriz float32) de los ejemplos con id > since_id que
+        tienen embedding de imagen. Se leen aparte de all() para no cargar los
+        vectores en la caché de ejemplos del prompt.
+        """
+        rows = [] if not self.exists() else self._conn().execute(
+            "SELECT id, modality, embedding FROM examples WHERE id > ? AND embedding IS NOT NULL ORDER BY id", (int(since_id),)
+        ).fetchall()
+        if not rows:
+            return [], [], np.zeros((0, 0), dtype=np.float32)
+        dim = len(rows[-1][2]) // 2
+        rows = [row for row in rows if len(row[2]) == 2 * dim]
+        matrix = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.float16).reshape(len(rows), dim)
+        return [row[0] for row in rows], [row[1] for row in rows], matrix.astype(np.float32)
+
+    def count(self) -> int:
+        if not self.exists():
+            return 0
+        return int(self._conn().execute("SELECT COUNT(*) FROM examples").fetchone()[0])
+
+    def close(self) -> None:
+        """Cierra la conexión del hilo actual."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,538 @@
+"""
+Decodificación restringida al esquema JSON de ediciones
+Autómata de caracteres para el esquema (remove, replace, add_findings,
+lesiometro_missing, confidence_scores, conclusion) + índice por token
+precompilado una vez por tokenizer y cacheado en memoria.
+Opcionalmente remove/replace.from se restringen a las líneas de la plantilla
+(índice por plantilla, cacheado por hash de su contenido)
+"""
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+import torch
+from transformers import LogitsProcessor
+
+logger = logging.getLogger(__name__)
+
+DEAD = -1
+
+
+# ============================================================================
+# AUTÓMATA DE CARACTERES (NFA -> DFA perezoso)
+# ============================================================================
+
+def _is_str_char(ch: str) -> bool:
+    """Carácter permitido dentro de un string JSON (sin escapes ni controles)."""
+    return ch not in ('"', "\\", "\ufffd") and ord(ch) >= 0x20
+
+
+def _is_digit(ch: str) -> bool:
+    return "0" <= ch <= "9"
+
+
+STR_CHAR: Callable[[str], bool] = _is_str_char
+DIGIT: Callable[[str], bool] = _is_digit
+
+
+class CharNFA:
+    """NFA mínimo con aristas por carácter o por clase (función predicado)."""
+
+    def __init__(self):
+        self.edges: List[List[Tuple[Any, int]]] = []
+        self.eps: List[List[int]] = []
+
+    def node(self) -> int:
+        self.edges.append([])
+        self.eps.append([])
+        return len(self.edges) - 1
+
+    # Combinadores: cada fragmento es (inicio, fin)
+    def lit(self, text: str) -> Tuple[int, int]:
+        start = cur = self.node()
+        for ch in text:
+            nxt = self.node()
+            self.edges[cur].append((ch, nxt))
+            cur = nxt
+        return start, cur
+
+    def cls(self, matcher: Callable[[str], bool]) -> Tuple[int, int]:
+        start, end = self.node(), self.node()
+        self.edges[start].append((matcher, end))
+        return start, end
+
+    def seq(self, *frags: Tuple[int, int]) -> Tuple[int, int]:
+        for (_, end), (nxt, _) in zip(frags, frags[1:]):
+            self.eps[end].append(nxt)
+        return frags[0][0], frags[-1][1]
+
+    def alt(self, *frags: Tuple[int, int]) -> Tuple[int, int]:
+        start, end = self.node(), self.node()
+        for s, e in frags:
+            self.eps[start].append(s)
+            self.eps[e].append(end)
+        return start, end
+
+    def star(self, frag: Tuple[int, int]) -> Tuple[int, int]:
+        start, end = self.node(), self.node()
+        self.eps[start] += [frag[0], end]
+        self.eps[frag[1]] += [frag[0], end]
+        return start, end
+
+    def opt(self, frag: Tuple[int, int]) -> Tuple[int, int]:
+        start, end = self.node(), self.node()
+        self.eps[start] += [frag[0], end]
+        self.eps[frag[1]].append(end)
+        return start, end
+
+    def plus(self, build: Callable[[], Tuple[int, int]]) -> Tuple[int, int]:
+        return self.seq(build(), self.star(build()))
+
+
+class LazyDFA:
+    """DFA construido bajo demanda (subconjuntos del NFA) con transiciones memorizadas."""
+
+    def __init__(self, nfa: CharNFA, start: int, accept: int):
+        self.nfa = nfa
+        self.accept_node = accept
+        self._ids: Dict[FrozenSet[int], int] = {}
+        self._sets: List[FrozenSet[int]] = []
+        self._trans: Dict[Tuple[int, str], int] = {}
+        self._lock = threading.Lock()
+        self.start = self._intern(self._closure({start}))
+
+    def _closure(self, nodes) -> FrozenSet[int]:
+        stack = list(nodes)
+        seen = set(nodes)
+        while stack:
+            n = stack.pop()
+            for m in self.nfa.eps[n]:
+                if m not in seen:
+                    seen.add(m)
+                    stack.append(m)
+        return frozenset(seen)
+
+    def _intern(self, nodes: FrozenSet[int]) -> int:
+        sid = self._ids.get(nodes)
+        if sid is None:
+            sid = len(self._sets)
+            self._ids[nodes] = sid
+            self._sets.append(nodes)
+        return sid
+
+    def step(self, sid: int, ch: str) -> int:
+        key = (sid, ch)
+        nxt = self._trans.get(key)
+        if nxt is not None:
+            return nxt
+        targets = set()
+        for n in self._sets[sid]:
+            for matcher, target in self.nfa.edges[n]:
+                if (matcher == ch) if isinstance(matcher, str) else matcher(ch):
+                    targets.add(target)
+        with self._lock:
+            nxt = self._intern(self._closure(targets)) if targets else DEAD
+            self._trans[key] = nxt
+        return nxt
+
+    def walk(self, sid: int, text: str) -> int:
+        for ch in text:
+            sid = self.step(sid, ch)
+            if sid == DEAD:
+                return DEAD
+        return sid
+
+    def is_accept(self, sid: int) -> bool:
+        return self.accept_node in self._sets[sid]
+
+    def _only_string_edges(self, sid: int) -> bool:
+        for n in self._sets[sid]:
+            for matcher, _ in self.nfa.edges[n]:
+                if matcher is not STR_CHAR and matcher != '"':
+                    return False
+        return True
+
+    def string_target(self, sid: int) -> int:
+        """
+        Si sid está dentro de un string libre (solo sale por STR_CHAR o comillas),
+        devuelve el estado al que lleva cualquier carácter plano, que además se
+        absorbe a sí mismo. DEAD en otro caso.
+        """
+        if not self._only_string_edges(sid):
+            return DEAD
+        target = self.step(sid, "a")
+        if target == DEAD or not self._only_string_edges(target) or self.step(target, "a") != target:
+            return DEAD
+        return target
+
+    def candidate_chars(self, sid: int) -> Optional[set]:
+        """Caracteres con arista de salida desde sid (None = cualquier carácter)."""
+        chars = set()
+        for n in self._sets[sid]:
+            for matcher, _ in self.nfa.edges[n]:
+                if isinstance(matcher, str):
+                    chars.add(matcher)
+                elif matcher is DIGIT:
+                    chars.update("0123456789")
+                else:
+                    return None
+        return chars
+
+    @property
+    def num_states(self) -> int:
+        return len(self._sets)
+
+
+def build_edit_schema_dfa(string_builders: Optional[Dict[str, Callable[[CharNFA], Tuple[int, int]]]] = None) -> LazyDFA:
+    """
+    Autómata del JSON de ediciones en formato compacto y orden fijo de claves:
+    {"remove":[...],"replace":[{"from":..,"to":..}],"add_findings":[...],
+     "lesiometro_missing":[...],"confidence_scores":{..},"conclusion":{...}}
+
+    string_builders permite sustituir el string libre de un campo
+    (p.ej. "remove", "replace.from") por otro sub-autómata.
+    """
+    nfa = CharNFA()
+    builders = string_builders or {}
+
+    def free_string() -> Tuple[int, int]:
+        return nfa.seq(nfa.lit('"'), nfa.star(nfa.cls(STR_CHAR)), nfa.lit('"'))
+
+    def field_string(field: str) -> Tuple[int, int]:
+        builder = builders.get(field)
+        return builder(nfa) if builder else free_string()
+
+    def array_of(item: Callable[[], Tuple[int, int]]) -> Tuple[int, int]:
+        items = nfa.seq(item(), nfa.star(nfa.seq(nfa.lit(","), item())))
+        return nfa.seq(nfa.lit("["), nfa.opt(items), nfa.lit("]"))
+
+    def number() -> Tuple[int, int]:
+        zero = nfa.seq(nfa.lit("0"), nfa.opt(nfa.seq(nfa.lit("."), nfa.plus(lambda: nfa.cls(DIGIT)))))
+        one = nfa.seq(nfa.lit("1"), nfa.opt(nfa.seq(nfa.lit("."), nfa.plus(lambda: nfa.lit("0")))))
+        return nfa.alt(zero, one)
+
+    def replace_item() -> Tuple[int, int]:
+        return nfa.seq(
+            nfa.lit('{"from":'), field_string("replace.from"),
+            nfa.lit(',"to":'), field_string("replace.to"),
+            nfa.lit("}"),
+        )
+
+    def conf_pair() -> Tuple[int, int]:
+        return nfa.seq(field_string("confidence_scores"), nfa.lit(":"), number())
+
+    conf = nfa.seq(
+        nfa.lit("{"),
+        nfa.opt(nfa.seq(conf_pair(), nfa.star(nfa.seq(nfa.lit(","), conf_pair())))),
+        nfa.lit("}"),
+    )
+
+    conclusion_parts = []
+    for i, key in enumerate(("positives", "impression", "ddx", "recommendations")):
+        sep = "{" if i == 0 else ","
+        conclusion_parts.append(nfa.lit(f'{sep}"{key}":'))
+        conclusion_parts.append(array_of(lambda k=key: field_string(f"conclusion.{k}")))
+    conclusion = nfa.seq(*conclusion_parts, nfa.lit("}"))
+
+    root = nfa.seq(
+        nfa.lit('{"remove":'), array_of(lambda: field_string("remove")),
+        nfa.lit(',"replace":'), array_of(replace_item),
+        nfa.lit(',"add_findings":'), array_of(lambda: field_string("add_findings")),
+        nfa.lit(',"lesiometro_missing":'), array_of(lambda: field_string("lesiometro_missing")),
+        nfa.lit(',"confidence_scores":'), conf,
+        nfa.lit(',"conclusion":'), conclusion,
+        nfa.lit("}"),
+    )
+    return LazyDFA(nfa, root[0], root[1])
+
+
+def line_number(nfa: CharNFA) -> Tuple[int, int]:
+    """Número de línea de la plantilla (entero positivo sin ceros a la izquierda)."""
+    first = nfa.alt(*(nfa.lit(d) for d in "123456789"))
+    return nfa.seq(first, nfa.star(nfa.cls(DIGIT)))
+
+
+# remove y replace.from como números de línea (EDIT_FORMAT="index")
+INDEX_FORMAT_BUILDERS: Dict[str, Callable[[CharNFA], Tuple[int, int]]] = {
+    "remove": line_number,
+    "replace.from": line_number,
+}
+
+
+def template_line_choices(template_text: str) -> List[str]:
+    """
+    Líneas no vacías de la plantilla tal como las compara apply_edits (sin
+    espacios extremos, sin duplicados). Se omiten las que necesitarían escapes
+    JSON, que el esquema no admite.
+    """
+    lines = (ln.strip() for ln in template_text.splitlines())
+    return list(dict.fromkeys(ln for ln in lines if ln and all(_is_str_char(ch) for ch in ln)))
+
+
+def template_line_builders(template_text: str, edit_format: str = "text") -> Dict[str, Callable[[CharNFA], Tuple[int, int]]]:
+    """
+    Sub-autómatas para remove/replace.from que solo aceptan líneas existentes
+    de la plantilla: el texto exacto ("text") o su número de línea ("index").
+    La alternativa de literales se determiniza en un trie de caracteres.
+    """
+    if edit_format == "index":
+        numbers = [str(i) for i, ln in enumerate(template_text.splitlines(), 1) if ln.strip()]
+
+        def line_ref(nfa: CharNFA) -> Tuple[int, int]:
+            return nfa.alt(*(nfa.lit(n) for n in numbers))
+    else:
+        choices = template_line_choices(template_text)
+
+        def line_ref(nfa: CharNFA) -> Tuple[int, int]:
+            return nfa.seq(nfa.lit('"'), nfa.alt(*(nfa.lit(c) for c in choices)), nfa.lit('"'))
+
+    return {"remove": line_ref, "replace.from": line_ref}
+
+
+# ============================================================================
+# ÍNDICE POR TOKEN (precompilado por tokenizer)
+# ============================================================================
+
+_BYTE_TOKEN = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+
+def token_strings(tokenizer: Any) -> List[str]:
+    """
+    Texto de cada token del vocabulario, conservando espacios iniciales.
+    Se decodifica cada token precedido de un ancla para que el tokenizer no
+    recorte el espacio inicial (SentencePiece). Tokens especiales -> "".
+    """
+    n = len(tokenizer)
+    try:
+        anchor_ids = tokenizer.encode("a", add_special_tokens=False)
+        anchor = tokenizer.decode(anchor_ids, skip_special_tokens=True)
+        pairs = [anchor_ids + [i] for i in range(n)]
+        decoded = tokenizer.batch_decode(pairs, skip_special_tokens=True)
+        strings = [d[len(anchor):] if d.startswith(anchor) else d for d in decoded]
+    except Exception as e:
+        logger.debug(f"Decodificación con ancla no disponible ({e}); usando decode por token")
+        strings = [tokenizer.decode([i], skip_special_tokens=True) for i in range(n)]
+
+    special = set(getattr(tokenizer, "all_special_ids", []) or [])
+    for i in special:
+        if 0 <= i < n:
+            strings[i] = ""
+    return strings
+
+
+class SchemaTokenIndex:
+    """
+    Tabla estado-del-DFA -> tokens permitidos, calculada bajo demanda y memorizada.
+    Los estados dentro de un string libre reutilizan una máscara global de tokens
+    "planos" (sin comillas/escapes/controles) y solo recorren el resto del vocabulario.
+    """
+
+    def __init__(self, strings: List[str], dfa: LazyDFA, eos_token_ids: List[int], base: Optional["SchemaTokenIndex"] = None):
+        self.strings = strings
+        self.dfa = dfa
+        self.eos_token_ids = [int(i) for i in eos_token_ids if i is not None]
+        self.vocab_size = len(strings)
+        self._allowed: Dict[int, Tuple[torch.Tensor, bool]] = {}
+        self._lock = threading.Lock()
+        if base is not None:
+            # Mismo vocabulario: se reutilizan las tablas por carácter
+            self.by_first_char = base.by_first_char
+            self.plain_mask = base.plain_mask
+            self.non_plain_ids = base.non_plain_ids
+            return
+
+        self.by_first_char: Dict[str, List[int]] = {}
+        plain = torch.zeros(self.vocab_size, dtype=torch.bool)
+        self.non_plain_ids: List[int] = []
+        for i, s in enumerate(strings):
+            if not s:
+                continue
+            self.by_first_char.setdefault(s[0], []).append(i)
+            if all(_is_str_char(ch) for ch in s):
+                plain[i] = True
+            else:
+                self.non_plain_ids.append(i)
+        self.plain_mask = plain
+
+    def allowed(self, sid: int) -> Tuple[torch.Tensor, bool]:
+        """Devuelve (ids permitidos, usar_mascara_plana) para el estado sid."""
+        cached = self._allowed.get(sid)
+        if cached is not None:
+            return cached
+
+        use_plain = self.dfa.string_target(sid) != DEAD
+        if use_plain:
+            candidates = self.non_plain_ids
+        else:
+            chars = self.dfa.candidate_chars(sid)
+            if chars is None:
+                chars = self.by_first_char.keys()
+            candidates = []
+            for ch in chars:
+                ids = self.by_first_char.get(ch)
+                if ids and self.dfa.step(sid, ch) != DEAD:
+                    candidates.extend(ids)
+
+        ids = [i for i in candidates if self.dfa.walk(sid, self.strings[i]) != DEAD]
+        if self.dfa.is_accept(sid):
+            ids.extend(self.eos_token_ids)
+        entry = (torch.tensor(sorted(set(ids)), dtype=torch.long), use_plain)
+        with self._lock:
+            self._allowed[sid] = entry
+        return entry
+
+    def advance(self, sid: int, token_id: int) -> int:
+        """Estado tras emitir token_id (DEAD si sale del esquema)."""
+        if sid == DEAD:
+            return DEAD
+        if token_id in self.eos_token_ids:
+            return sid if self.dfa.is_accept(sid) else DEAD
+        if token_id >= self.vocab_size:
+            return DEAD
+        return self.dfa.walk(sid, self.strings[token_id])
+
+    def warm_path(self, token_ids: List[int], sid: Optional[int] = None) -> int:
+        """Memoriza las máscaras de los estados que recorre una secuencia de tokens; devuelve el estado final."""
+        sid = self.dfa.start if sid is None else sid
+        for token_id in token_ids:
+            if sid == DEAD:
+                break
+            self.allowed(sid)
+            sid = self.advance(sid, int(token_id))
+        if sid != DEAD:
+            self.allowed(sid)
+        return sid
+
+    def precompile(self, max_states: int = 4096) -> int:
+        """Recorre (BFS) los estados alcanzables por tokens y memoriza sus máscaras."""
+        queue = [self.dfa.start]
+        seen = {self.dfa.start}
+        while queue and len(seen) < max_states:
+            sid = queue.pop()
+            ids, use_plain = self.allowed(sid)
+            nexts = {self.advance(sid, int(i)) for i in ids.tolist()}
+            if use_plain:
+                nexts.add(self.dfa.string_target(sid))
+            for nxt in nexts:
+                if nxt != DEAD and nxt not in seen:
+                    seen.add(nxt)
+                    queue.append(nxt)
+        return len(seen)
+
+
+_INDEX_CACHE: Dict[Tuple[Any, ...], SchemaTokenIndex] = {}
+_TEMPLATE_INDEX_CACHE: "OrderedDict[Tuple[Any, ...], SchemaTokenIndex]" = OrderedDict()
+_INDEX_LOCK = threading.Lock()
+
+
+def get_schema_index(tokenizer: Any, eos_token_ids: List[int], precompile: bool = True, edit_format: str = "text", template_text: Optional[str] = None, template_cache_size: int = 16) -> SchemaTokenIndex:
+    """
+    Índice del esquema de ediciones para este tokenizer y formato de edición
+    ("text" o "index"), compilado una sola vez por proceso.
+
+    Con template_text, remove/replace.from solo admiten líneas de esa plantilla.
+    Estos índices se construyen sobre el general (mismo vocabulario), se
+    rellenan bajo demanda y se guardan en un LRU por hash de la plantilla.
+    """
+    key = (getattr(tokenizer, "name_or_path", None), len(tokenizer), tuple(eos_token_ids), edit_format)
+    with _INDEX_LOCK:
+        index = _INDEX_CACHE.get(key)
+        if index is None:
+            t0 = time.time()
+            builders = INDEX_FORMAT_BUILDERS if edit_format == "index" else None
+            index = SchemaTokenIndex(token_strings(tokenizer), build_edit_schema_dfa(builders), eos_token_ids)
+            n_states = index.precompile() if precompile else 0
+            logger.info(
+                f"Índice de esquema JSON ({edit_format}) compilado: vocab={index.vocab_size}, estados={n_states}, "
+                f"{time.time() - t0:.2f}s"
+            )
+            _INDEX_CACHE[key] = index
+        if template_text is None:
+            return index
+
+        template_key = key + (hashlib.sha256(template_text.encode("utf-8")).hexdigest(),)
+        cached = _TEMPLATE_INDEX_CACHE.get(template_key)
+        if cached is not None:
+            _TEMPLATE_INDEX_CACHE.move_to_end(template_key)
+            return cached
+        t0 = time.time()
+        dfa = build_edit_schema_dfa(template_line_builders(template_text, edit_format))
+        cached = SchemaTokenIndex(index.strings, dfa, eos_token_ids, base=index)
+        _TEMPLATE_INDEX_CACHE[template_key] = cached
+        while len(_TEMPLATE_INDEX_CACHE) > max(1, template_cache_size):
+            _TEMPLATE_INDEX_CACHE.popitem(last=False)
+        logger.info(
+            f"Índice de líneas de plantilla ({edit_format}) construido: "
+            f"{len(template_line_choices(template_text))} líneas, {time.time() - t0:.2f}s"
+        )
+    return cached
+
+
+def warm_template_index(index: SchemaTokenIndex, tokenizer: Any, template_text: str, edit_format: str = "text") -> int:
+    """
+    Recorre remove y replace.from con cada línea de la plantilla, tokenizadas
+    como JSON, para que sus máscaras estén calculadas antes de generar.
+    Devuelve el número de estados memorizados.
+    """
+    if edit_format == "index":
+        refs = [str(i) for i, ln in enumerate(template_text.splitlines(), 1) if ln.strip()]
+    else:
+        refs = [json.dumps(c, ensure_ascii=False) for c in template_line_choices(template_text)]
+    before = len(index._allowed)
+    for head in ('{"remove":[', '{"remove":[],"replace":[{"from":'):
+        for ref in refs:
+            index.warm_path(tokenizer.encode(head + ref, add_special_tokens=False))
+    return len(index._allowed) - before
+
+
+# ============================================================================
+# LOGITS PROCESSOR
+# ============================================================================
+
+class SchemaConstrainedLogitsProcessor(LogitsProcessor):
+    """
+    Enmascara los logits para que la salida siga el esquema JSON de ediciones.
+    Avanza el DFA con los tokens generados desde la llamada anterior.
+    """
+
+    def __init__(self, index: SchemaTokenIndex, prompt_length: int):
+        self.index = index
+        self.prompt_length = int(prompt_length)
+        self._states: List[int] = []
+        self._seen = self.prompt_length
+        self.step_times: List[float] = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        t0 = time.perf_counter()
+        batch_size, seq_len = input_ids.shape
+        if not self._states:
+            self._states = [self.index.dfa.start] * batch_size
+
+        for row in range(batch_size):
+            for token_id in input_ids[row, self._seen:seq_len].tolist():
+                self._states[row] = self.index.advance(self._states[row], int(token_id))
+
+        mask = torch.ones_like(scores, dtype=torch.bool)
+        vocab = min(scores.shape[-1], self.index.vocab_size)
+        for row, sid in enumerate(self._states):
+            if sid == DEAD:
+                # Fuera del esquema (no debería ocurrir): no restringir
+                mask[row] = False
+                continue
+            ids, use_plain = self.index.allowed(sid)
+            if use_plain:
+                mask[row, :vocab] = ~self.index.plain_mask[:vocab].to(scores.device)
+            mask[row, ids.to(scores.device)] = False
+        self._seen = seq_len
+        scores = scores.masked_fill(mask, float("-inf"))
+        self.step_times.append(time.perf_counter() - t0)
+        return scores
+
+    @property
+    def is_complete(self) -> bool:
+        """True si todas las secuencias llegaron a un JSON completo del esquema."""
+        return bool(self._states) and all(s != DEAD and self.index.dfa.is_accept(s) for s in self._states)
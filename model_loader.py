@@ -1,11 +1,25 @@
 """
 Carga del modelo MedGemma en CPU optimizada
 """
+import json
 import logging
-from typing import Tuple, Dict, Any
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Tuple, Dict, Any, Iterator, List, Optional
 import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-from config import MODEL_ID, MODEL_DTYPE, CPU_DTYPE, HF_TOKEN
+import transformers
+from transformers import (
+    AutoConfig, AutoProcessor, AutoModelForImageTextToText, AutoModelForCausalLM, AutoTokenizer, GenerationConfig,
+)
+from transformers.integrations.accelerate import init_empty_weights
+from config import (
+    MODEL_ID, MODEL_DTYPE, CPU_DTYPE, HF_TOKEN, WEIGHT_SNAPSHOT_ENABLED, WEIGHT_SNAPSHOT_DIR,
+    QUANT_GROUP_SIZE, QUANT_VISION, DRAFT_MODEL_ID,
+)
+from quantization import parse_quant_mode, load_quantized_weights
 
 # Configurar logger
 logger = logging.getLogger(__name__)
@@ -25,8 +39,260 @@ MODEL_INFO = {
     "backend": "uninitialized",
     "device_name": "",
     "dtype": None,
+    "source": None,
+    "load_seconds": None,
+    "quantization": None,
+    "cpu_features": None,
+    "dtype_reason": None,
+    "draft_model": None,
+}
+
+DTYPE_MAP = {
+    "float16": torch.float16,
+    "fp16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "bf16": torch.bfloat16,
+    "float32": torch.float32,
+    "fp32": torch.float32,
 }
 
+# ============================================================================
+# CAPACIDADES DE CPU
+# ============================================================================
+
+# Sondas de torch.cpu (cpuinfo, multiplataforma) y flag equivalente de /proc/cpuinfo
+CPU_FEATURE_PROBES = {
+    "avx2": ("_is_avx2_supported", "avx2"),
+    "avx512": ("_is_avx512_supported", "avx512f"),
+    "avx512_bf16": ("_is_avx512_bf16_supported", "avx512_bf16"),
+    "amx": ("_is_amx_tile_supported", "amx_bf16"),
+}
+
+
+def _proc_cpuinfo_flags() -> set:
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def detect_cpu_features() -> Dict[str, Any]:
+    """
+    Detecta las extensiones de CPU relevantes para bf16. `bf16_native` es True
+    con AVX512-BF16 o AMX; sin ellas torch emula bf16 y suele ir más lento que fp32.
+    """
+    flags = None
+    features: Dict[str, Any] = {}
+    for name, (probe_name, flag) in CPU_FEATURE_PROBES.items():
+        probe = getattr(torch.cpu, probe_name, None)
+        try:
+            features[name] = bool(probe())
+        except Exception:
+            flags = _proc_cpuinfo_flags() if flags is None else flags
+            features[name] = flag in flags
+    try:
+        features["capability"] = torch.backends.cpu.get_cpu_capability()
+    except Exception:
+        features["capability"] = "unknown"
+    features["bf16_native"] = bool(features["avx512_bf16"] or features["amx"])
+    return features
+
+
+def select_cpu_dtype(name: str, features: Dict[str, Any]) -> Tuple[torch.dtype, str]:
+    """dtype de carga en CPU para CPU_DTYPE=`name` y motivo de la elección."""
+    name = str(name).lower()
+    quant = parse_quant_mode(name)
+    if quant:
+        return torch.float32, f"{quant}: pesos base en float32"
+    if name == "auto":
+        if features["bf16_native"]:
+            return torch.bfloat16, "auto: CPU con bf16 nativo (AVX512-BF16/AMX)"
+        return torch.float32, "auto: CPU sin bf16 nativo"
+    dtype = DTYPE_MAP.get(name)
+    if dtype is None:
+        return torch.float32, f"dtype desconocido '{name}': float32"
+    if dtype == torch.float16:
+        return torch.float32, "float16 no soportado en CPU: float32"
+    if dtype == torch.bfloat16 and not features["bf16_native"]:
+        return dtype, "bfloat16 forzado (emulado: CPU sin bf16 nativo)"
+    return dtype, f"{name} configurado"
+
+# ============================================================================
+# SNAPSHOT LOCAL DE PESOS
+# ============================================================================
+
+SNAPSHOT_MARKER = "radiapp_snapshot.json"
+
+# Hilo que escribe el snapshot tras una carga desde el Hub (None si no aplica)
+SNAPSHOT_THREAD = None
+
+
+def snapshot_dir(dtype: torch.dtype, quant: Optional[str] = None) -> Path:
+    """Directorio del snapshot de MODEL_ID en un dtype (y modo cuantizado) concreto."""
+    dtype_name = str(dtype).replace("torch.", "")
+    suffix = f"-{quant}" if quant else ""
+    return WEIGHT_SNAPSHOT_DIR / f"{MODEL_ID.replace('/', '--')}-{dtype_name}{suffix}"
+
+
+def quant_label(mode: Optional[str]) -> Optional[str]:
+    """Etiqueta del modo cuantizado configurado (MODEL_INFO y nombre del snapshot)."""
+    if not mode:
+        return None
+    label = f"{mode}-g{QUANT_GROUP_SIZE}" if mode == "int4_weight_only" else mode
+    return f"{label}+vision" if QUANT_VISION else label
+
+
+def is_snapshot_complete(path: Path) -> bool:
+    """True si el snapshot terminó de escribirse (el marcador se escribe al final)."""
+    marker = Path(path) / SNAPSHOT_MARKER
+    if not marker.exists():
+        return False
+    try:
+        meta = json.loads(marker.read_text(encoding="utf-8"))
+    except Exception:
+        return False
+    return meta.get("model_id") == MODEL_ID
+
+
+def _snapshot_quantization(source: str) -> Optional[str]:
+    """Modo cuantizado del marcador si `source` es un snapshot local cuantizado (si no, None)."""
+    marker = Path(source) / SNAPSHOT_MARKER
+    if not marker.exists():
+        return None
+    try:
+        return json.loads(marker.read_text(encoding="utf-8")).get("quantization")
+    except Exception:
+        return None
+
+
+def write_snapshot(model: Any, processor: Any, dtype: torch.dtype, quant: Optional[str] = None) -> Path:
+    """
+    Guarda modelo (safetensors, ya en `dtype` y, con `quant`, con las capas
+    ya cuantizadas) y processor en el directorio del snapshot. Escribe en un
+    directorio temporal y lo renombra al final, así un proceso interrumpido
+    nunca deja un snapshot a medias.
+    """
+    target = snapshot_dir(dtype, quant)
+    tmp = target.with_name(target.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
+    try:
+        model.save_pretrained(tmp, safe_serialization=True)
+        processor.save_pretrained(tmp)
+        if not (tmp / "config.json").exists() or not any(tmp.glob("*.safetensors")):
+            raise RuntimeError("save_pretrained no generó config.json + safetensors")
+        meta = {
+            "model_id": MODEL_ID,
+            "dtype": str(dtype).replace("torch.", ""),
+            "quantization": quant,
+            "transformers": transformers.__version__,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        (tmp / SNAPSHOT_MARKER).write_text(json.dumps(meta, indent=2), encoding="utf-8")
+        shutil.rmtree(target, ignore_errors=True)
+        tmp.rename(target)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    logger.info(f"Snapshot de pesos escrito en {target} ({time.perf_counter() - t0:.1f}s)")
+    return target
+
+
+def _write_snapshot_background(model: Any, processor: Any, dtype: torch.dtype, quant: Optional[str] = None) -> None:
+    """Primer arranque: escribe el snapshot sin bloquear el uso del modelo."""
+    global SNAPSHOT_THREAD
+
+    def _worker():
+        try:
+            write_snapshot(model, processor, dtype, quant)
+        except Exception as e:
+            logger.warning(f"No se pudo escribir el snapshot de pesos: {e}")
+
+    SNAPSHOT_THREAD = threading.Thread(target=_worker, name="weight-snapshot", daemon=True)
+    SNAPSHOT_THREAD.start()
+
+
+def _model_source(dtype: torch.dtype, quant: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
+    """Origen de los pesos (snapshot local o MODEL_ID) y kwargs de from_pretrained."""
+    path = snapshot_dir(dtype, quant)
+    if WEIGHT_SNAPSHOT_ENABLED and is_snapshot_complete(path):
+        return str(path), {"local_files_only": True}
+    return MODEL_ID, ({"token": HF_TOKEN} if HF_TOKEN else {})
+
+
+def _record_load(source: str, t0: float, model: Any, processor: Any, dtype: torch.dtype, quant: Optional[str] = None) -> None:
+    """Registra origen y tiempo de carga; tras cargar desde el Hub, crea el snapshot."""
+    from_snapshot = source != MODEL_ID
+    MODEL_INFO["source"] = "snapshot" if from_snapshot else "hub"
+    MODEL_INFO["load_seconds"] = round(time.perf_counter() - t0, 2)
+    logger.info(f"Arranque en frío: {MODEL_INFO['load_seconds']}s (origen: {MODEL_INFO['source']})")
+    if not from_snapshot and WEIGHT_SNAPSHOT_ENABLED:
+        _write_snapshot_background(model, processor, dtype, quant)
+
+# ============================================================================
+# CARGA CUANTIZADA CAPA A CAPA
+# ============================================================================
+
+def _checkpoint_files(source: str, source_kwargs: Dict[str, Any]) -> List[Path]:
+    """safetensors del snapshot local o de MODEL_ID (descargados a la caché del Hub)."""
+    path = Path(source)
+    if not path.is_dir():
+        from huggingface_hub import snapshot_download
+        path = Path(snapshot_download(
+            source, allow_patterns=["*.safetensors", "*.json"], token=source_kwargs.get("token"),
+            local_files_only=source_kwargs.get("local_files_only", False),
+        ))
+    files = sorted(path.glob("*.safetensors"))
+    if not files:
+        raise RuntimeError(f"No hay pesos safetensors en {path}")
+    return files
+
+
+def _checkpoint_tensors(files: List[Path], key_mapping: Dict[str, str]) -> Iterator[Tuple[str, torch.Tensor]]:
+    """Tensores de los safetensors de uno en uno, con los nombres del modelo actual."""
+    from safetensors import safe_open
+    for file in files:
+        with safe_open(str(file), framework="pt", device="cpu") as f:
+            for key in f.keys():
+                name = key
+                for pattern, replacement in key_mapping.items():
+                    name, n = re.subn(pattern, replacement, name)
+                    if n:
+                        break
+                yield name, f.get_tensor(key)
+
+
+def load_quantized_model(source: str, source_kwargs: Dict[str, Any], mode: str, dtype: torch.dtype) -> Any:
+    """
+    Crea el modelo sin pesos y lo rellena desde los safetensors cuantizando
+    cada capa al leerla (ver quantization.load_quantized_weights). Un
+    snapshot marcado con este mismo modo (quant_label) ya trae las capas
+    cuantizadas: se cargan sus buffers sin volver a cuantizar ninguna.
+    """
+    snapshot_quant = _snapshot_quantization(source)
+    if snapshot_quant is not None and snapshot_quant != quant_label(mode):
+        raise RuntimeError(f"El snapshot {source} está cuantizado como {snapshot_quant}, no como {quant_label(mode)}")
+    config = AutoConfig.from_pretrained(source, **source_kwargs)
+    with init_empty_weights():
+        model = AutoModelForImageTextToText.from_config(config, dtype=dtype)
+    tensors = _checkpoint_tensors(_checkpoint_files(source, source_kwargs), getattr(model, "_checkpoint_conversion_mapping", {}) or {})
+    load_quantized_weights(model, tensors, mode, QUANT_GROUP_SIZE, include_vision=QUANT_VISION, dtype=dtype,
+                           requantize=snapshot_quant is None)
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise RuntimeError(f"Pesos no encontrados en el checkpoint: {missing[:5]}")
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(source, **source_kwargs)
+    except Exception:
+        pass
+    return model.eval()
+
 # ============================================================================
 # CARGA DEL MODELO
 # ============================================================================
@@ -36,6 +302,7 @@ def load_model() -> Tuple[Any, AutoProcessor, bool]:
     global USE_DML, DEVICE
 
     logger.info("Iniciando carga de modelo MedGemma...")
+    t0 = time.perf_counter()
     if HF_TOKEN:
         logger.info("HF_TOKEN detectado: usando autenticación para Hugging Face")
 
@@ -59,45 +326,47 @@ def load_model() -> Tuple[Any, AutoProcessor, bool]:
             ) from err
         raise RuntimeError(f"No se pudo cargar el modelo en ninguna configuración: {err}") from err
     
-    # Cargar processor (independiente del device)
-    try:
-        processor_kwargs = {"use_fast": False}
-        if HF_TOKEN:
-            processor_kwargs["token"] = HF_TOKEN
-        processor = AutoProcessor.from_pretrained(MODEL_ID, **processor_kwargs)
-        logger.debug("Processor cargado correctamente")
-    except Exception as e:
-        logger.error(f"Error al cargar processor: {e}")
-        _raise_auth_help(e)
-    
-    dtype_map = {
-        "float16": torch.float16,
-        "fp16": torch.float16,
-        "float32": torch.float32,
-        "fp32": torch.float32,
-    }
+    # CPU_DTYPE: dtype, "auto" (bf16 si la CPU lo soporta) o modo cuantizado (int8/int4,
+    # cada capa se cuantiza al leerla; el resto queda en float32); si no es válido, se usa MODEL_DTYPE
+    cpu_dtype_name = str(CPU_DTYPE).lower()
+    if cpu_dtype_name not in DTYPE_MAP and cpu_dtype_name != "auto" and not parse_quant_mode(cpu_dtype_name):
+        cpu_dtype_name = str(MODEL_DTYPE).lower()
+    cpu_quant = parse_quant_mode(cpu_dtype_name)
+    cpu_quant_label = quant_label(cpu_quant)
+    cpu_features = detect_cpu_features()
+    cpu_preferred, cpu_dtype_reason = select_cpu_dtype(cpu_dtype_name, cpu_features)
 
     use_gpu = torch.cuda.is_available()
     if use_gpu:
-        preferred = dtype_map.get(str(MODEL_DTYPE).lower(), torch.float16)
+        if parse_quant_mode(MODEL_DTYPE):
+            logger.warning(f"MODEL_DTYPE={MODEL_DTYPE} solo aplica en CPU; GPU usa float16")
+        preferred = DTYPE_MAP.get(str(MODEL_DTYPE).lower(), torch.float16)
     else:
-        preferred = dtype_map.get(str(CPU_DTYPE).lower(), dtype_map.get(str(MODEL_DTYPE).lower(), torch.float32))
-        if preferred == torch.float16:
-            preferred = torch.float32
+        preferred = cpu_preferred
+
+    # Cargar processor (independiente del device; desde el snapshot si existe)
+    try:
+        processor_source, source_kwargs = _model_source(preferred, None if use_gpu else cpu_quant_label)
+        processor_kwargs = {"use_fast": False, **source_kwargs}
+        processor = AutoProcessor.from_pretrained(processor_source, **processor_kwargs)
+        logger.debug(f"Processor cargado correctamente desde {processor_source}")
+    except Exception as e:
+        logger.error(f"Error al cargar processor: {e}")
+        _raise_auth_help(e)
 
     # Intento principal: GPU (ROCm) si está disponible
     if use_gpu:
         try:
             # device_map='auto' distribuye capas entre GPU+CPU automáticamente (hibrido, más rápido)
+            source, source_kwargs = _model_source(preferred)
             model_kwargs = {
                 "dtype": preferred,
                 "low_cpu_mem_usage": True,
                 "device_map": "auto",  # Hibrido GPU+CPU: distribuye automáticamente
+                **source_kwargs,
             }
-            if HF_TOKEN:
-                model_kwargs["token"] = HF_TOKEN
             model = AutoModelForImageTextToText.from_pretrained(
-                MODEL_ID,
+                source,
                 **model_kwargs
             )
             model.eval()
@@ -107,40 +376,74 @@ def load_model() -> Tuple[Any, AutoProcessor, bool]:
             MODEL_INFO["dtype"] = preferred
             MODEL_INFO["device_name"] = torch.cuda.get_device_name(0)
             logger.info(f"Modelo cargado en GPU+CPU hibrido (ROCm): {MODEL_INFO['device_name']}")
+            _record_load(source, t0, model, processor, preferred)
             return model, processor, USE_DML
         except Exception as e_gpu:
             logger.warning(f"Fallo al cargar en GPU, usando CPU: {e_gpu}")
 
     # Fallback: CPU puro
     try:
-        cpu_preferred = dtype_map.get(str(CPU_DTYPE).lower(), dtype_map.get(str(MODEL_DTYPE).lower(), torch.float32))
-        if cpu_preferred == torch.float16:
-            cpu_preferred = torch.float32
-        model_kwargs = {
-            "dtype": cpu_preferred,
-            "low_cpu_mem_usage": True,
-            "device_map": None,
-        }
-        if HF_TOKEN:
-            model_kwargs["token"] = HF_TOKEN
-        model = AutoModelForImageTextToText.from_pretrained(
-            MODEL_ID,
-            **model_kwargs
-        )
-        model.eval()
+        logger.info(f"dtype CPU: {cpu_preferred} ({cpu_dtype_reason}) | capacidad {cpu_features['capability']}")
+        # Snapshot local: safetensors ya en cpu_preferred (y ya cuantizados), sin conversión ni red
+        source, source_kwargs = _model_source(cpu_preferred, cpu_quant_label)
+        if cpu_quant:
+            # Nunca se materializa el modelo en precisión completa: cada capa se cuantiza al leerla
+            model = load_quantized_model(source, source_kwargs, cpu_quant, cpu_preferred)
+            MODEL_INFO["quantization"] = cpu_quant_label
+        else:
+            model_kwargs = {
+                "dtype": cpu_preferred,
+                "low_cpu_mem_usage": True,
+                "device_map": None,
+                **source_kwargs,
+            }
+            model = AutoModelForImageTextToText.from_pretrained(
+                source,
+                **model_kwargs
+            )
+            model.eval()
         model = model.to("cpu")
         USE_DML = False
         DEVICE = "cpu"
         MODEL_INFO["backend"] = "cpu"
         MODEL_INFO["dtype"] = cpu_preferred
+        MODEL_INFO["cpu_features"] = cpu_features
+        MODEL_INFO["dtype_reason"] = cpu_dtype_reason
         MODEL_INFO["device_name"] = "CPU"
         logger.info("Modelo cargado en CPU")
+        _record_load(source, t0, model, processor, cpu_preferred, cpu_quant_label)
         return model, processor, USE_DML
     except Exception as e3:
         logger.critical(f"Fallo total al cargar modelo: {e3}")
         _raise_model_help(e3)
 
 
+def load_draft_model(processor: Any) -> Optional[Any]:
+    """
+    Carga el modelo borrador de DRAFT_MODEL_ID para decodificación especulativa.
+    Devuelve None si no está configurado o si su tokenizer no coincide con el
+    del modelo principal (los ids propuestos no serían comparables).
+    """
+    if not DRAFT_MODEL_ID:
+        return None
+    token_kwargs = {"token": HF_TOKEN} if HF_TOKEN else {}
+    t0 = time.perf_counter()
+    draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL_ID, **token_kwargs)
+    tokenizer = getattr(processor, "tokenizer", processor)
+    n = min(len(draft_tokenizer), len(tokenizer))
+    sample = list(range(0, n, max(1, n // 512)))
+    if draft_tokenizer.convert_ids_to_tokens(sample) != tokenizer.convert_ids_to_tokens(sample):
+        logger.warning(f"El tokenizer de {DRAFT_MODEL_ID} no coincide con el de {MODEL_ID}: especulativa desactivada")
+        return None
+    dtype = MODEL_INFO["dtype"] or torch.float32
+    draft = AutoModelForCausalLM.from_pretrained(DRAFT_MODEL_ID, dtype=dtype, low_cpu_mem_usage=True, **token_kwargs)
+    draft.eval()
+    draft = draft.to(DEVICE)
+    MODEL_INFO["draft_model"] = DRAFT_MODEL_ID
+    logger.info(f"Modelo borrador {DRAFT_MODEL_ID} cargado en {time.perf_counter() - t0:.1f}s ({dtype})")
+    return draft
+
+
 def get_device() -> Any:
     """Retorna el device actual."""
     return DEVICE
@@ -194,3 +497,11 @@ def prepare_inputs(inputs: Dict[str, Any], model: Any, dtype: Any = None) -> Dic
             )
             for k, v in inputs.items()
         }
+
+
+if __name__ == "__main__":
+    # Paso de primer arranque explícito: python model_loader.py (espera a que el snapshot quede escrito)
+    load_model()
+    if SNAPSHOT_THREAD is not None:
+        SNAPSHOT_THREAD.join()
+    print(json.dumps({k: str(v) for k, v in MODEL_INFO.items()}, indent=2))
@@ -0,0 +1,441 @@
+"""
+Vía rápida para estudios normales
+Clasificador logístico sobre el embedding de imagen (media de las features
+proyectadas, ya en la caché de visión) entrenado con el resultado de cada
+informe valorado: feedback con rating y borradores aprobados como ejemplo bueno
+"""
+import base64
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from example_index import example_key
+from report_processor import extract_json_block
+from config import NORMAL_SAMPLES_FILE, NORMAL_PENDING_FILE, NORMAL_FASTPATH_THRESHOLD, NORMAL_FASTPATH_MIN_SAMPLES, NORMAL_FASTPATH_RETRAIN_EVERY
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# EMBEDDING Y ETIQUETAS
+# ============================================================================
+
+def pool_image_features(features: Any) -> np.ndarray:
+    """Media de los tokens de imagen proyectados, normalizada (L2), en float32."""
+    array = features.detach().float().cpu().numpy() if hasattr(features, "detach") else np.asarray(features, dtype=np.float32)
+    pooled = array.reshape(-1, array.shape[-1]).mean(axis=0)
+    return pooled / max(float(np.linalg.norm(pooled)), 1e-8)
+
+
+def edits_are_normal(edits: Dict[str, Any]) -> bool:
+    """True si el JSON de ediciones deja la plantilla intacta y la conclusión sin positivos."""
+    if edits.get("remove") or edits.get("replace") or edits.get("add_findings"):
+        return False
+    conclusion = edits.get("conclusion")
+    if isinstance(conclusion, dict):
+        return not any(conclusion.get(k) for k in ("positives", "impression", "ddx"))
+    return not (isinstance(conclusion, str) and conclusion.strip())
+
+
+def _normalize_text(text: str) -> str:
+    return "\n".join(ln.strip() for ln in (text or "").splitlines() if ln.strip())
+
+
+def _report_key(report_text: str) -> str:
+    return hashlib.sha256(_normalize_text(report_text).encode("utf-8")).hexdigest()[:32]
+
+
+def _encode_embedding(embedding: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(embedding).astype(np.float16).tobytes()).decode("ascii")
+
+
+def _decode_embedding(text: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(text), dtype=np.float16).astype(np.float32)
+
+
+def outcome_label(report_text: str, rating: Any, version_final: str, template_key: Optional[str], edits_normal: bool) -> Optional[bool]:
+    """
+    Etiqueta de un informe valorado:
+    - versión final editada por el usuario: normal si coincide con la plantilla
+    - rating >= 4 sin editar: la etiqueta de las ediciones del modelo
+    - rating <= 2 de un borrador normal: tenía hallazgos
+    None si la valoración no permite etiquetarlo.
+    """
+    try:
+        rating = int(str(rating).strip())
+    except ValueError:
+        rating = 0
+    final = _normalize_text(version_final)
+    if final and final != _normalize_text(report_text):
+        return None if template_key is None else _report_key(final) == template_key
+    if rating >= 4:
+        return edits_normal
+    if rating and rating <= 2 and edits_normal:
+        return False
+    return None
+
+
+# ============================================================================
+# CLASIFICADOR
+# ============================================================================
+
+class NormalStudyClassifier:
+    """Regresión logística con L2 y pesos por clase (descenso de gradiente en numpy)."""
+
+    def __init__(self, l2: float = 1e-3, epochs: int = 300, lr: float = 0.5):
+        self.l2 = l2
+        self.epochs = epochs
+        self.lr = lr
+        self.weights: Optional[np.ndarray] = None
+        self.bias = 0.0
+
+    @property
+    def trained(self) -> bool:
+        return self.weights is not None
+
+    def fit(self, X: np.ndarray, y: np.ndarray) -> "NormalStudyClassifier":
+        X = np.asarray(X, dtype=np.float32)
+        y = np.asarray(y, dtype=np.float32)
+        n_pos = max(float(y.sum()), 1.0)
+        n_neg = max(float(len(y) - y.sum()), 1.0)
+        # Clases balanceadas: los estudios normales suelen ser mayoría
+        sample_w = np.where(y > 0, len(y) / (2 * n_pos), len(y) / (2 * n_neg)).astype(np.float32)
+        w = np.zeros(X.shape[1], dtype=np.float32)
+        b = 0.0
+        # Escala de los embeddings (norma 1): se amplifica para que converja en pocas épocas
+        scale = np.sqrt(X.shape[1])
+        Xs = X * scale
+        for _ in range(self.epochs):
+            p = 1.0 / (1.0 + np.exp(-(Xs @ w + b)))
+            err = (p - y) * sample_w
+            w -= self.lr * (Xs.T @ err / len(y) + self.l2 * w)
+            b -= self.lr * float(err.mean())
+        self.weights, self.bias = w * scale, b
+        return self
+
+    def predict_proba(self, x: np.ndarray) -> float:
+        """Probabilidad de estudio normal para un embedding."""
+        if self.weights is None:
+            raise RuntimeError("Clasificador sin entrenar")
+        logit = float(np.asarray(x, dtype=np.float32) @ self.weights + self.bias)
+        return float(1.0 / (1.0 + np.exp(-logit)))
+
+
+# ============================================================================
+# MUESTRAS, ENTRENAMIENTO Y ESTADÍSTICAS
+# ============================================================================
+
+class NormalFastPath:
+    """
+    Recuerda el embedding de los últimos informes generados (también en disco,
+    por hash del informe, para valoraciones posteriores a un reinicio); cuando
+    llega su valoración añade una muestra etiquetada (normal / con hallazgos)
+    al fichero de muestras y, cada retrain_every muestras nuevas, reentrena en
+    segundo plano. Lleva latencia y tasa de aciertos de la vía rápida.
+    """
+
+    def __init__(self, samples_file: Path, threshold: float = 0.9, min_samples: int = 30, min_per_class: int = 5, max_pending: int = 256, retrain_every: int = 10, pending_file: Optional[Path] = None):
+        self.samples_file = Path(samples_file)
+        self.pending_file = Path(pending_file) if pending_file is not None else self.samples_file.with_name("normal_pending.jsonl")
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.min_per_class = min_per_class
+        self.max_pending = max_pending
+        self.retrain_every = max(1, retrain_every)
+        self.classifier = NormalStudyClassifier()
+        self._pending: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._pending_loaded = False
+        self._pending_lines = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._new_samples = 0
+        self._retrain_thread: Optional[threading.Thread] = None
+        self._retrain_again = False
+        self.n_samples = 0
+        self.predictions = 0
+        self.flagged = 0
+        self.confirmed = 0
+        self.rejected = 0
+        self.predict_seconds = 0.0
+
+    # -- muestras ------------------------------------------------------------
+
+    def load_samples(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(embeddings, etiquetas) del fichero de muestras (JSONL, float16 en base64)."""
+        X: List[np.ndarray] = []
+        y: List[int] = []
+        if self.samples_file.exists():
+            with open(self.samples_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                        X.append(_decode_embedding(row["embedding"]))
+                        y.append(int(bool(row["normal"])))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        if not X:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        dim = len(X[-1])
+        keep = [i for i, x in enumerate(X) if len(x) == dim]
+        return np.stack([X[i] for i in keep]), np.array([y[i] for i in keep])
+
+    def _append_sample(self, embedding: np.ndarray, normal: bool, template_file: str) -> None:
+        self._append_samples([(embedding, normal, template_file)])
+
+    def _append_samples(self, samples: List[Tuple[np.ndarray, bool, str]]) -> None:
+        self.samples_file.parent.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now().isoformat(timespec="seconds")
+        with open(self.samples_file, "a", encoding="utf-8") as f:
+            for embedding, normal, template_file in samples:
+                row = {"timestamp": timestamp, "template": template_file, "normal": bool(normal), "embedding": _encode_embedding(embedding)}
+                f.write(json.dumps(row) + "\n")
+
+    def seed_from_history(self, feedback_csv: Path, examples: List[Tuple[Dict[str, Any], np.ndarray]]) -> int:
+        """
+        Siembra el fichero de muestras (una sola vez: si ya existe no hace nada)
+        con las valoraciones anteriores al clasificador:
+        - filas de feedback.csv cuyo informe sigue pendiente en disco o cuyo
+          JSON coincide con un ejemplo bueno con embedding
+        - ejemplos buenos (edits, embedding de la caché de visión) sin fila
+          asociada, etiquetados con edits_are_normal
+        Devuelve el número de muestras añadidas.
+        """
+        if self.samples_file.exists():
+            return 0
+        by_key = {example_key(edits): (edits, np.asarray(embedding, dtype=np.float32)) for edits, embedding in examples}
+        used, samples, rows = set(), [], []
+        if os.path.exists(feedback_csv):
+            with open(feedback_csv, "r", encoding="utf-8", newline="") as f:
+                rows = list(csv.DictReader(f))
+        with self._lock:
+            self._load_pending()
+        for row in rows:
+            output = row.get("output") or ""
+            key = _report_key(output)
+            with self._lock:
+                study = self._pending.pop(key, None)
+                if study is not None:
+                    self._persist_pending({"key": key, "done": True})
+            if study is not None:
+                normal = outcome_label(output, row.get("rating"), row.get("version_final") or "", study["template_key"], study["edits_normal"])
+                embedding = study["embedding"]
+            else:
+                try:
+                    key = example_key(json.loads(extract_json_block(output)))
+                except (ValueError, TypeError):
+                    continue
+                if key not in by_key or key in used:
+                    continue
+                used.add(key)
+                edits, embedding = by_key[key]
+                normal = outcome_label(output, row.get("rating"), row.get("version_final") or "", None, edits_are_normal(edits))
+            if normal is not None:
+                samples.append((embedding, normal, row.get("template") or ""))
+        samples += [(embedding, edits_are_normal(edits), "") for key, (edits, embedding) in by_key.items() if key not in used]
+        self._append_samples(samples)
+        with self._lock:
+            self.n_samples = len(samples)
+        logger.info(f"Muestras del clasificador de normales sembradas desde el historial: {len(samples)}")
+        return len(samples)
+
+    # -- informes pendientes de valoración (en disco) --------------------------
+
+    def _load_pending(self) -> None:
+        """Lee los informes pendientes del disco (con el lock tomado, una vez)."""
+        if self._pending_loaded:
+            return
+        self._pending_loaded = True
+        if not self.pending_file.exists():
+            return
+        with open(self.pending_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                    key = row["key"]
+                    self._pending_lines += 1
+                    if row.get("done"):
+                        self._pending.pop(key, None)
+                        continue
+                    self._pending[key] = {
+                        "embedding": _decode_embedding(row["embedding"]), "template_file": row["template_file"],
+                        "template_key": row["template_key"], "edits_normal": bool(row["edits_normal"]),
+                        "fast_path": bool(row["fast_path"]),
+                    }
+                except (ValueError, KeyError, TypeError):
+                    continue
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+
+    def _persist_pending(self, row: Dict[str, Any]) -> None:
+        """Añade una línea al fichero de pendientes (con el lock tomado); lo compacta si crece."""
+        self.pending_file.parent.mkdir(parents=True, exist_ok=True)
+        if self._pending_lines >= 2 * self.max_pending:
+            tmp = self.pending_file.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                for key, study in self._pending.items():
+                    f.write(json.dumps(self._pending_row(key, study)) + "\n")
+            os.replace(tmp, self.pending_file)
+            self._pending_lines = len(self._pending)
+        with open(self.pending_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row) + "\n")
+        self._pending_lines += 1
+
+    @staticmethod
+    def _pending_row(key: str, study: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "key": key, "embedding": _encode_embedding(study["embedding"]), "template_file": study["template_file"],
+            "template_key": study["template_key"], "edits_normal": bool(study["edits_normal"]), "fast_path": bool(study["fast_path"]),
+        }
+
+    def retrain(self) -> bool:
+        """Reentrena con todas las muestras; False si aún no hay suficientes."""
+        X, y = self.load_samples()
+        with self._lock:
+            self._loaded = True
+            self.n_samples = len(y)
+            if len(y) < self.min_samples or min(int(y.sum()), int(len(y) - y.sum())) < self.min_per_class:
+                self.classifier = NormalStudyClassifier()
+                return False
+        t0 = time.perf_counter()
+        classifier = NormalStudyClassifier().fit(X, y)
+        with self._lock:
+            self.classifier = classifier
+        logger.info(f"Clasificador de normales reentrenado: {len(y)} muestras ({int(y.sum())} normales), {time.perf_counter() - t0:.2f}s")
+        return True
+
+    def retrain_async(self) -> None:
+        """Reentrena en un hilo; si ya hay uno en marcha, repite al terminar."""
+        with self._lock:
+            if self._retrain_thread is not None:
+                self._retrain_again = True
+                return
+            self._retrain_thread = threading.Thread(target=self._retrain_worker, name="normal-classifier-retrain", daemon=True)
+            self._retrain_thread.start()
+
+    def _retrain_worker(self) -> None:
+        while True:
+            try:
+                self.retrain()
+            except Exception as e:
+                logger.warning(f"No se pudo reentrenar el clasificador de normales: {e}")
+            with self._lock:
+                if not self._retrain_again:
+                    self._retrain_thread = None
+                    return
+                self._retrain_again = False
+
+    def wait_for_retrain(self, timeout: Optional[float] = None) -> None:
+        """Espera al reentrenamiento en segundo plano (tests y benchmarks)."""
+        thread = self._retrain_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    # -- predicción ----------------------------------------------------------
+
+    def predict(self, embedding: np.ndarray) -> Optional[float]:
+        """
+        Probabilidad de estudio normal o None si el clasificador no está
+        entrenado. La primera vez lanza la carga en segundo plano (si el
+        arranque no lo hizo ya) en lugar de entrenar en la petición.
+        """
+        if not self._loaded:
+            with self._lock:
+                loading = self._retrain_thread is not None
+            if not loading:
+                self.retrain_async()
+            return None
+        classifier = self.classifier
+        if not classifier.trained:
+            return None
+        t0 = time.perf_counter()
+        prob = classifier.predict_proba(embedding)
+        with self._lock:
+            self.predictions += 1
+            self.flagged += prob >= self.threshold
+            self.predict_seconds += time.perf_counter() - t0
+        return prob
+
+    def is_normal(self, prob: Optional[float]) -> bool:
+        return prob is not None and prob >= self.threshold
+
+    # -- resultados ----------------------------------------------------------
+
+    def remember(self, report_text: str, embedding: np.ndarray, template_file: str, template_text: str, edits_normal: bool, fast_path: bool) -> None:
+        """Asocia el informe devuelto a su embedding hasta que llegue su valoración."""
+        key = _report_key(report_text)
+        study = {
+            "embedding": np.asarray(embedding, dtype=np.float32), "template_file": template_file,
+            "template_key": _report_key(template_text), "edits_normal": edits_normal, "fast_path": fast_path,
+        }
+        with self._lock:
+            self._load_pending()
+            self._pending[key] = study
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+            self._persist_pending(self._pending_row(key, study))
+
+    def embedding_for(self, report_text: str) -> Optional[np.ndarray]:
+        """Embedding del estudio de un informe aún sin valorar (None si no se recuerda)."""
+        with self._lock:
+            self._load_pending()
+            study = self._pending.get(_report_key(report_text))
+        return None if study is None else study["embedding"]
+
+    def record_outcome(self, report_text: str, rating: Any, version_final: str = "") -> Optional[bool]:
+        """
+        Etiqueta el estudio del informe valorado con outcome_label (el
+        reentrenamiento va en segundo plano: la primera vez que hay min_samples
+        y luego cada retrain_every muestras nuevas).
+        Devuelve la etiqueta añadida o None si el informe no es reconocible.
+        """
+        key = _report_key(report_text)
+        with self._lock:
+            self._load_pending()
+            study = self._pending.pop(key, None)
+            if study is not None:
+                self._persist_pending({"key": key, "done": True})
+        if study is None:
+            return None
+        normal = outcome_label(report_text, rating, version_final, study["template_key"], study["edits_normal"])
+        if normal is None:
+            return None
+
+        with self._lock:
+            if study["fast_path"]:
+                self.confirmed += normal
+                self.rejected += not normal
+        self._append_sample(study["embedding"], normal, study["template_file"])
+        with self._lock:
+            self._new_samples += 1
+            self.n_samples += 1
+            due = (not self._loaded or self._new_samples >= self.retrain_every
+                   or (not self.classifier.trained and self.n_samples == self.min_samples))
+            if due:
+                self._new_samples = 0
+        if due:
+            self.retrain_async()
+        return normal
+
+    def stats(self) -> Dict[str, Any]:
+        """Muestras, tasa de vía rápida, latencia media y confirmaciones."""
+        with self._lock:
+            reviewed = self.confirmed + self.rejected
+            return {
+                "trained": self.classifier.trained,
+                "samples": self.n_samples,
+                "predictions": self.predictions,
+                "fast_path_rate": self.flagged / self.predictions if self.predictions else 0.0,
+                "mean_latency_ms": 1000 * self.predict_seconds / self.predictions if self.predictions else 0.0,
+                "confirmed_rate": self.confirmed / reviewed if reviewed else None,
+            }
+
+
+NORMAL_FAST_PATH = NormalFastPath(NORMAL_SAMPLES_FILE, NORMAL_FASTPATH_THRESHOLD, NORMAL_FASTPATH_MIN_SAMPLES, retrain_every=NORMAL_FASTPATH_RETRAIN_EVERY, pending_file=NORMAL_PENDING_FILE)
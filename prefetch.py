@@ -0,0 +1,155 @@
+"""
+Preparación especulativa mientras el usuario rellena el formulario
+Al subir la imagen (o cambiar de plantilla) se lanza en segundo plano el
+trabajo que generate() hará después; generate() recoge el resultado si la
+entrada coincide. Cada sesión tiene un hueco por tipo de entrada: un cambio
+de entrada cancela el trabajo anterior de ese hueco.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+from PIL import Image
+from config import PREFETCH_WORKERS, PREFETCH_MAX_SESSIONS
+
+logger = logging.getLogger(__name__)
+
+
+def image_content_key(img: Image.Image) -> str:
+    """Huella de la imagen tal como llega de la UI (antes de convertir/redimensionar)."""
+    h = hashlib.sha256()
+    h.update(f"{img.mode}|{img.size[0]}x{img.size[1]}|".encode("utf-8"))
+    h.update(img.tobytes())
+    return h.hexdigest()[:32]
+
+
+class PrefetchCancelled(Exception):
+    """El trabajo quedó obsoleto (la entrada cambió) y se abandona."""
+
+
+class PrefetchTask:
+    """Trabajo en curso de un hueco; el job consulta check() entre etapas."""
+
+    def __init__(self, kind: str, key: Hashable):
+        self.kind = kind
+        self.key = key
+        self.future: Optional[Future] = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def check(self) -> None:
+        if self._cancelled.is_set():
+            raise PrefetchCancelled()
+
+
+class SpeculativePrefetcher:
+    """
+    Huecos (sesión, tipo) -> PrefetchTask ejecutados en un pool pequeño.
+    take(kind, key) devuelve el resultado del trabajo con esa clave, esperando si
+    aún está en curso (es justo el trabajo que generate() haría).
+    """
+
+    def __init__(self, max_workers: int = 2, max_sessions: int = 64):
+        self.max_sessions = max_sessions
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="radiapp-prefetch")
+        self._slots: "OrderedDict[Tuple[str, str], PrefetchTask]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.hits = 0
+        self.misses = 0
+        self.wait_seconds = 0.0
+
+    def submit(self, session: str, kind: str, key: Hashable, job: Callable[[PrefetchTask], Any]) -> PrefetchTask:
+        """Lanza job(task) para la entrada key; cancela el trabajo anterior del hueco si era otra."""
+        slot = (session, kind)
+        with self._lock:
+            current = self._slots.get(slot)
+            if current is not None and current.key == key and not current.cancelled:
+                self._slots.move_to_end(slot)
+                return current
+            if current is not None:
+                current.cancel()
+            task = PrefetchTask(kind, key)
+            self._slots[slot] = task
+            self._slots.move_to_end(slot)
+            while len(self._slots) > self.max_sessions:
+                _, stale = self._slots.popitem(last=False)
+                stale.cancel()
+            self.submitted += 1
+            task.future = self._executor.submit(self._run, task, job)
+        return task
+
+    def _run(self, task: PrefetchTask, job: Callable[[PrefetchTask], Any]) -> Any:
+        t0 = time.perf_counter()
+        try:
+            task.check()
+            result = job(task)
+        except PrefetchCancelled:
+            with self._lock:
+                self.cancelled += 1
+            logger.debug(f"Preparación anticipada cancelada ({task.kind})")
+            raise
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.warning(f"Preparación anticipada fallida ({task.kind}): {e}")
+            raise
+        with self._lock:
+            self.completed += 1
+        logger.info(f"Preparación anticipada lista ({task.kind}) en {time.perf_counter() - t0:.2f}s")
+        return result
+
+    def cancel(self, session: str, kind: str) -> None:
+        """Descarta el trabajo del hueco (p. ej. la imagen se ha quitado)."""
+        with self._lock:
+            task = self._slots.pop((session, kind), None)
+        if task is not None:
+            task.cancel()
+
+    def take(self, kind: str, key: Hashable) -> Optional[Any]:
+        """Resultado del trabajo para (kind, key) (espera si está en curso) o None si no hay/falló."""
+        with self._lock:
+            task = next((t for t in reversed(self._slots.values()) if t.kind == kind and t.key == key and not t.cancelled), None)
+            if task is None:
+                self.misses += 1
+                return None
+        t0 = time.perf_counter()
+        try:
+            result = task.future.result()
+        except (CancelledError, Exception):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self.wait_seconds += time.perf_counter() - t0
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "failed": self.failed,
+                "hits": self.hits,
+                "misses": self.misses,
+                "mean_wait_ms": 1000 * self.wait_seconds / self.hits if self.hits else 0.0,
+            }
+
+
+PREFETCHER = SpeculativePrefetcher(PREFETCH_WORKERS, PREFETCH_MAX_SESSIONS)
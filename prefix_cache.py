@@ -0,0 +1,216 @@
+"""
+Caché de prefijo KV para el prompt de MedGemma
+Reutiliza past_key_values del segmento estático del prompt (instrucciones,
+guía por modalidad y esquema JSON) entre peticiones
+"""
+import copy
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import torch
+from config import PREFIX_CACHE_MAX_MB, PREFIX_CACHE_BOUNDARY_MARGIN
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# UTILIDADES
+# ============================================================================
+
+def make_prefix_key(modalidad: str, prefix_text: str) -> Tuple[str, str]:
+    """Clave de caché: modalidad + huella del segmento estático."""
+    digest = hashlib.sha1(prefix_text.encode("utf-8")).hexdigest()[:16]
+    return (modalidad, digest)
+
+
+def kv_cache_nbytes(past_key_values: Any) -> int:
+    """Tamaño aproximado en bytes de un past_key_values (Cache o formato legacy)."""
+    tensors = []
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        for layer in layers:
+            tensors += [getattr(layer, "keys", None), getattr(layer, "values", None)]
+    elif hasattr(past_key_values, "key_cache"):
+        tensors += list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    elif isinstance(past_key_values, (list, tuple)):
+        for layer in past_key_values:
+            tensors += list(layer) if isinstance(layer, (list, tuple)) else [layer]
+    return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+
+def find_prefix_length(input_ids: torch.Tensor, image_token_id: Optional[int], margin: int = PREFIX_CACHE_BOUNDARY_MARGIN) -> int:
+    """
+    Longitud del prefijo compartido: tokens anteriores al bloque de imagen,
+    menos un margen por si la tokenización fusiona el límite texto/imagen.
+    Devuelve 0 si no hay token de imagen.
+    """
+    if image_token_id is None:
+        return 0
+    positions = (input_ids[0] == int(image_token_id)).nonzero()
+    if positions.numel() == 0:
+        return 0
+    return max(0, int(positions[0].item()) - int(margin))
+
+
+def prefill_segment(model: Any, input_ids: torch.Tensor, attention_mask: torch.Tensor, past_key_values: Any, start: int, end: int, **model_kwargs) -> Any:
+    """
+    Ejecuta un forward sobre input_ids[:, start:end] extendiendo past_key_values.
+    model_kwargs admite pixel_values si el segmento contiene los tokens de imagen,
+    o inputs_embeds (prompt completo) con las features de imagen ya insertadas.
+
+    Returns:
+        past_key_values actualizado (incluye tokens [0, end))
+    """
+    segment = {"input_ids": input_ids[:, start:end]}
+    inputs_embeds = model_kwargs.pop("inputs_embeds", None)
+    if inputs_embeds is not None:
+        segment = {"inputs_embeds": inputs_embeds[:, start:end]}
+    with torch.inference_mode():
+        outputs = model(
+            **segment,
+            attention_mask=attention_mask[:, :end],
+            past_key_values=past_key_values,
+            cache_position=torch.arange(start, end, device=input_ids.device),
+            use_cache=True,
+            logits_to_keep=1,
+            **model_kwargs,
+        )
+    return outputs.past_key_values
+
+
+# ============================================================================
+# CACHÉ LRU CON PRESUPUESTO EN BYTES
+# ============================================================================
+
+class PrefixKVCache:
+    """
+    Caché LRU de past_key_values del prefijo estático del prompt.
+    Cada entrada guarda los input_ids del prefijo para validar que la
+    petición actual comparte exactamente esos tokens antes de reutilizarla.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        self._entries: "OrderedDict[Any, Tuple[torch.Tensor, Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key: Any, input_ids: torch.Tensor) -> Optional[Tuple[int, Any]]:
+        """
+        Busca el prefijo para `key` y verifica que coincide con input_ids.
+
+        Returns:
+            (prefix_len, copia de past_key_values) o None si no hay acierto
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                prefix_ids, cache, _ = entry
+                n = prefix_ids.shape[-1]
+                if input_ids.shape[-1] > n and torch.equal(input_ids[0, :n].cpu(), prefix_ids):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    # Copia: generate() extiende el cache in-place
+                    return n, copy.deepcopy(cache)
+            self.misses += 1
+            return None
+
+    def store(self, key: Any, prefix_ids: torch.Tensor, past_key_values: Any) -> bool:
+        """Guarda una copia del prefijo; expulsa entradas LRU hasta cumplir el presupuesto."""
+        nbytes = kv_cache_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            logger.debug(f"Prefijo KV de {nbytes / 1024 / 1024:.1f} MB excede el presupuesto; no se guarda")
+            return False
+        entry = (prefix_ids.detach().cpu().clone(), copy.deepcopy(past_key_values), nbytes)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[2]
+            while self._entries and self.current_bytes + nbytes > self.max_bytes:
+                _, (_, _, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+            self._entries[key] = entry
+            self.current_bytes += nbytes
+        return True
+
+    def clear(self) -> None:
+        """Vacía la caché (p.ej. al recargar el modelo)."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de aciertos/fallos y uso de memoria."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "entries": len(self._entries),
+                "evictions": self.evictions,
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+# Instancia global del proceso
+PREFIX_CACHE = PrefixKVCache(PREFIX_CACHE_MAX_MB * 1024 * 1024)
+
+
+def prepare_prefix_cached_inputs(model: Any, inputs: Dict[str, Any], prefix_key: Any, cache: PrefixKVCache = PREFIX_CACHE, inputs_embeds: Optional[torch.Tensor] = None) -> Optional[Dict[str, Any]]:
+    """
+    Prefill con reutilización del prefijo estático.
+
+    Recupera (o calcula y guarda) el KV del prefijo, prefilla el resto del
+    prompt (imagen + plantilla + contexto) salvo el último token, y devuelve
+    los kwargs para model.generate(): input_ids completos, attention_mask y
+    past_key_values. generate() solo procesa el último token del prompt.
+    Si se pasa inputs_embeds (features de imagen cacheadas), el resto del
+    prompt se prefilla desde ellos en lugar de desde pixel_values.
+
+    Returns:
+        dict de kwargs para generate() o None si no hay prefijo reutilizable
+    """
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs["attention_mask"]
+    if input_ids.shape[0] != 1:
+        return None
+
+    image_token_id = getattr(getattr(model, "config", None), "image_token_id", None)
+    prefix_len = find_prefix_length(input_ids, image_token_id)
+    if prefix_len <= 0:
+        return None
+
+    hit = cache.lookup(prefix_key, input_ids)
+    if hit is not None:
+        prefix_len, past_key_values = hit
+    else:
+        past_key_values = prefill_segment(model, input_ids, attention_mask, None, 0, prefix_len)
+        cache.store(prefix_key, input_ids[0, :prefix_len], past_key_values)
+
+    # Resto del prompt (incluye imagen); el último token lo procesa generate()
+    seq_len = input_ids.shape[-1]
+    if inputs_embeds is not None:
+        extra = {"inputs_embeds": inputs_embeds}
+    else:
+        extra = {k: v for k, v in inputs.items() if k in ("pixel_values", "image_sizes")}
+    past_key_values = prefill_segment(model, input_ids, attention_mask, past_key_values, prefix_len, seq_len - 1, **extra)
+
+    stats = cache.stats()
+    logger.info(
+        f"Prefix KV cache: {'HIT' if hit is not None else 'MISS'} "
+        f"(prefijo={prefix_len} tokens, hits={stats['hits']}, misses={stats['misses']}, "
+        f"{stats['bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f} MB)"
+    )
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "past_key_values": past_key_values,
+    }
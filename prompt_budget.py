@@ -0,0 +1,124 @@
+"""
+Presupuesto de tokens del prompt
+El prompt se compone de secciones con un valor relativo; las opcionales se
+recortan elemento a elemento (ejemplos, casos parecidos, líneas de la guía)
+empezando por las de menos valor hasta que el texto cabe en el presupuesto de
+prefill. Los tokens se cuentan con el tokenizer real (con caché por texto)
+"""
+import logging
+import math
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """Aproximación sin tokenizer (~3.5 caracteres por token en español)."""
+    return math.ceil(len(text or "") / 3.5)
+
+
+class TokenCounter:
+    """
+    Cuenta tokens de texto con encode del tokenizer (o la estimación si no
+    hay). Las secciones se repiten entre peticiones (instrucciones, guías,
+    ejemplos), así que se recuerdan los últimos max_entries textos.
+    """
+
+    def __init__(self, encode: Optional[Callable[[str], Sequence[int]]] = None, max_entries: int = 4096):
+        self.encode = encode
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> int:
+        with self._lock:
+            count = self._counts.get(text)
+            if count is not None:
+                self._counts.move_to_end(text)
+                return count
+        count = len(self.encode(text)) if self.encode is not None else estimate_tokens(text)
+        with self._lock:
+            self._counts[text] = count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+
+_COUNTERS: Dict[int, Any] = {}
+_COUNTERS_LOCK = threading.Lock()
+
+
+def token_counter_for(tokenizer: Any) -> TokenCounter:
+    """TokenCounter (compartido) del tokenizer; estimación si es None."""
+    with _COUNTERS_LOCK:
+        entry = _COUNTERS.get(id(tokenizer))
+        if entry is None or entry[0] is not tokenizer:
+            encode = None if tokenizer is None else (lambda text: tokenizer.encode(text, add_special_tokens=False))
+            entry = (tokenizer, TokenCounter(encode))
+            _COUNTERS[id(tokenizer)] = entry
+        return entry[1]
+
+
+class PromptSection:
+    """
+    Sección del prompt: cabecera + elementos (uno por línea o bloque).
+    value=None la hace obligatoria; si no, se recortan sus elementos del
+    final (deben ir de más a menos valioso) hasta dejar min_items. Sin
+    elementos, la sección (cabecera incluida) desaparece.
+    """
+
+    __slots__ = ("name", "header", "items", "value", "min_items", "separator")
+
+    def __init__(self, name: str, items: List[str], header: str = "", value: Optional[int] = None, min_items: int = 0, separator: str = "\n"):
+        self.name = name
+        self.header = header
+        self.items = list(items)
+        self.value = value
+        self.min_items = min_items
+        self.separator = separator
+
+    @property
+    def trimmable(self) -> bool:
+        return self.value is not None and len(self.items) > self.min_items
+
+    def render(self) -> str:
+        if not self.items:
+            return ""
+        body = self.separator.join(self.items)
+        return f"{self.header}\n{body}" if self.header else body
+
+
+def render_sections(sections: List[PromptSection], joiner: str = "\n\n") -> str:
+    return joiner.join(text for text in (s.render() for s in sections) if text)
+
+
+def section_tokens(sections: List[PromptSection], count_tokens: Callable[[str], int]) -> Dict[str, int]:
+    """Tokens por sección (0 si quedó vacía)."""
+    return {s.name: (count_tokens(s.render()) if s.items else 0) for s in sections}
+
+
+def fit_to_budget(sections: List[PromptSection], count_tokens: Callable[[str], int], budget: int) -> Dict[str, int]:
+    """
+    Recorta las secciones opcionales, de menor a mayor value, un elemento cada
+    vez, hasta que la suma de tokens cabe en budget (<= 0: sin límite).
+    Devuelve los elementos quitados por sección.
+    """
+    removed: Dict[str, int] = {}
+    if budget <= 0:
+        return removed
+    tokens = section_tokens(sections, count_tokens)
+    total = sum(tokens.values())
+    while total > budget:
+        candidates = [s for s in sections if s.trimmable]
+        if not candidates:
+            logger.warning(f"El prompt ({total} tokens) no cabe en el presupuesto ({budget}) ni sin secciones opcionales")
+            break
+        section = min(candidates, key=lambda s: s.value)
+        section.items.pop()
+        removed[section.name] = removed.get(section.name, 0) + 1
+        total -= tokens[section.name]
+        tokens[section.name] = count_tokens(section.render()) if section.items else 0
+        total += tokens[section.name]
+    return removed
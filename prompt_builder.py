@@ -2,10 +2,26 @@
 Constructor de prompts para MedGemma
 Maneja few-shot learning, ejemplos buenos del usuario, y contexto por modalidad
 """
+import csv
 import json
+import logging
 import os
-from typing import List, Dict
-from config import FEWSHOT_EXAMPLES, MODALIDAD_PROMPTS, GOOD_EXAMPLES_FILE, IMAGE_TOKEN
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Dict, Optional, Tuple
+from config import (
+    FEWSHOT_EXAMPLES, MODALIDAD_PROMPTS, GOOD_EXAMPLES_FILE, GOOD_EXAMPLES_DB, GOOD_EXAMPLES_COMPACT_EVERY,
+    FEEDBACK_CSV, IMAGE_TOKEN, EDIT_FORMAT, SUPPORTED_MODALITIES,
+    FEWSHOT_RETRIEVAL_ENABLED, FEWSHOT_TOP_K, FEWSHOT_QUERY_INDICATION,
+    FEWSHOT_VISUAL_ENABLED, FEWSHOT_VISUAL_K, FEWSHOT_VISUAL_IVF_MIN, FEWSHOT_VISUAL_NPROBE,
+    PROMPT_COMPACT, PROMPT_TOKEN_BUDGET, PROMPT_PREFIX_TOKEN_BUDGET,
+)
+from example_index import ExampleIndex, VisualExampleIndex, example_key
+from example_store import GoodExampleStore
+from prompt_budget import PromptSection, fit_to_budget, render_sections, section_tokens, token_counter_for
+from report_processor import extract_json_block
+
+logger = logging.getLogger(__name__)
 
 
 def _normalize_examples(examples: List[Dict]) -> List[Dict]:
@@ -26,22 +42,126 @@ def _normalize_examples(examples: List[Dict]) -> List[Dict]:
     return normalized
 
 
+# Caché en memoria de los ejemplos buenos y de la sección few-shot renderizada.
+# Se invalida si cambian mtime o tamaño de la base (o de su WAL), o al guardar.
+_GOOD_EXAMPLES_LOCK = threading.Lock()
+_GOOD_EXAMPLES_CACHE: Dict[str, Any] = {"signature": None, "path": None, "examples": [], "fewshot": OrderedDict()}
+_STORES: Dict[str, GoodExampleStore] = {}
+# Secciones few-shot renderizadas por (modalidad, consulta) que se conservan
+_FEWSHOT_CACHE_SIZE = 256
+
+
+def get_good_example_store() -> GoodExampleStore:
+    """Almacén de GOOD_EXAMPLES_DB; la primera vez migra el good_examples.json antiguo."""
+    path = str(GOOD_EXAMPLES_DB)
+    with _GOOD_EXAMPLES_LOCK:
+        store = _STORES.get(path)
+        if store is None:
+            store = GoodExampleStore(GOOD_EXAMPLES_DB, compact_every=GOOD_EXAMPLES_COMPACT_EVERY)
+            if os.path.exists(GOOD_EXAMPLES_FILE):
+                with open(GOOD_EXAMPLES_FILE, "r", encoding="utf-8") as f:
+                    store.migrate(_normalize_examples(json.load(f)), SUPPORTED_MODALITIES)
+                os.replace(GOOD_EXAMPLES_FILE, f"{GOOD_EXAMPLES_FILE}.migrated")
+            _STORES[path] = store
+        return store
+
+
+def _cached_good_examples() -> Tuple[Tuple, List[Dict]]:
+    """Ejemplos normalizados del almacén (o FEWSHOT_EXAMPLES), recargados solo si cambió."""
+    store = get_good_example_store()
+    signature = store.signature()
+    with _GOOD_EXAMPLES_LOCK:
+        if _GOOD_EXAMPLES_CACHE["signature"] == signature:
+            return signature, _GOOD_EXAMPLES_CACHE["examples"]
+    with _GOOD_EXAMPLES_LOCK:
+        cached = _GOOD_EXAMPLES_CACHE["examples"] if _GOOD_EXAMPLES_CACHE["path"] == str(store.path) else []
+    if cached and "id" in cached[-1]:
+        # Almacén de solo inserciones: basta con leer los ejemplos nuevos
+        examples = cached + store.since(cached[-1]["id"])
+    else:
+        examples = store.all() or _normalize_examples(FEWSHOT_EXAMPLES)
+    with _GOOD_EXAMPLES_LOCK:
+        _GOOD_EXAMPLES_CACHE.update(signature=signature, path=str(store.path), examples=examples, fewshot=OrderedDict())
+    return signature, examples
+
+
+def invalidate_good_examples_cache() -> None:
+    """Fuerza a consultar el almacén (solo los ejemplos nuevos) en el siguiente acceso."""
+    with _GOOD_EXAMPLES_LOCK:
+        _GOOD_EXAMPLES_CACHE.update(signature=None, fewshot=OrderedDict())
+
+
 def load_good_examples() -> List[Dict]:
-    """Carga ejemplos aprobados por el usuario."""
-    if os.path.exists(GOOD_EXAMPLES_FILE):
-        with open(GOOD_EXAMPLES_FILE, "r", encoding="utf-8") as f:
-            return _normalize_examples(json.load(f))
-    return _normalize_examples(FEWSHOT_EXAMPLES)
+    """Carga ejemplos aprobados por el usuario (copia de la lista cacheada)."""
+    return list(_cached_good_examples()[1])
 
 
-def save_good_example(example: Dict):
-    """Guarda un nuevo ejemplo aprobado."""
-    examples = load_good_examples()
+def save_good_example(example: Dict, modalidad: Optional[str] = None, region: Optional[str] = None, embedding: Optional[Any] = None):
+    """
+    Guarda un nuevo ejemplo aprobado (una inserción en el almacén, sin
+    reescribir los anteriores). El primero arrastra los ejemplos base.
+    embedding (opcional): embedding de la imagen, para la búsqueda por similitud.
+    """
     normalized = _normalize_examples([example])
-    if normalized:
-        examples.append(normalized[0])
-    with open(GOOD_EXAMPLES_FILE, "w", encoding="utf-8") as f:
-        json.dump(examples, f, ensure_ascii=False, indent=2)
+    if not normalized:
+        return
+    get_good_example_store().append(normalized[0], modalidad, region, seed=_normalize_examples(FEWSHOT_EXAMPLES), embedding=embedding)
+    invalidate_good_examples_cache()
+
+
+def approved_example_embeddings() -> List[Tuple[Dict, Any]]:
+    """(JSON de ediciones, embedding de imagen) de los ejemplos buenos que lo guardaron."""
+    store = get_good_example_store()
+    ids, _, matrix = store.embeddings()
+    if not ids:
+        return []
+    examples = {row["id"]: row["example"] for row in store.all()}
+    return [(examples[row_id], matrix[i]) for i, row_id in enumerate(ids) if row_id in examples]
+
+
+# Salidas aprobadas de feedback.csv agrupadas por plantilla (en orden de escritura)
+_APPROVED_CACHE: Dict[str, Any] = {"signature": None, "by_template": {}}
+
+
+def load_approved_outputs(template_file: str, limit: int = 20) -> List[str]:
+    """
+    Salidas aprobadas (rating >= 4 en feedback.csv) para una plantilla, de la
+    más reciente a la más antigua. Incluye la versión final si el usuario la editó.
+    El CSV se relee solo si cambian mtime o tamaño.
+    """
+    if not template_file:
+        return []
+    try:
+        st = os.stat(FEEDBACK_CSV)
+        signature = (str(FEEDBACK_CSV), st.st_mtime_ns, st.st_size)
+    except OSError:
+        return []
+    with _GOOD_EXAMPLES_LOCK:
+        if _APPROVED_CACHE["signature"] == signature:
+            return _APPROVED_CACHE["by_template"].get(template_file, [])[::-1][:limit]
+    by_template: Dict[str, List[str]] = {}
+    with open(FEEDBACK_CSV, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            if (row.get("rating") or "").strip() not in ("4", "5"):
+                continue
+            output = (row.get("output") or "").strip()
+            final = (row.get("version_final") or "").strip()
+            by_template.setdefault(row.get("template") or "", []).extend(t for t in dict.fromkeys([output, final]) if t)
+    with _GOOD_EXAMPLES_LOCK:
+        _APPROVED_CACHE.update(signature=signature, by_template=by_template)
+    return by_template.get(template_file, [])[::-1][:limit]
+
+
+def build_lookup_corpus(template_file: str, template_text: str, limit: int = 20) -> List[str]:
+    """
+    Textos de los que la decodificación por prompt-lookup copia continuaciones,
+    por prioridad: ediciones aprobadas de esta plantilla, ejemplos buenos y la
+    plantilla línea a línea (los remove/replace copian sus líneas literalmente).
+    """
+    corpus = load_approved_outputs(template_file, limit)
+    corpus += [json.dumps(ex.get("example", ex), ensure_ascii=False) for ex in load_good_examples()[-limit:]]
+    corpus += [line.strip() for line in (template_text or "").splitlines() if line.strip()]
+    return corpus
 
 
 def get_prompt_by_modalidad(modalidad: str) -> str:
@@ -49,89 +169,247 @@ def get_prompt_by_modalidad(modalidad: str) -> str:
     return MODALIDAD_PROMPTS.get(modalidad, MODALIDAD_PROMPTS["Otro"])
 
 
-def format_fewshot_prompt(examples: List[Dict]) -> str:
+_FEWSHOT_HEADER = "📚 EJEMPLOS (MedGemma aprende de estos patrones):"
+
+
+def format_fewshot_items(examples: List[Dict], max_examples: int = 2, compact: bool = PROMPT_COMPACT) -> List[str]:
     """
-    Formatea ejemplos few-shot para incluir en el prompt.
-    Prioriza ejemplos del usuario (los últimos agregados) para máximo aprendizaje.
+    Un bloque por ejemplo (los últimos max_examples). compact: JSON en una
+    línea sin espacios en lugar de indent=2 (mismo contenido, menos tokens).
     """
-    text = "\n📚 EJEMPLOS (MedGemma aprende de estos patrones):\n"
-    text += "="*70 + "\n"
-    
-    # Mostrar últimos 2 ejemplos (más relevantes = user examples más recientes)
-    best_examples = examples[-2:] if len(examples) > 2 else examples
-    
+    best_examples = examples[-max_examples:] if len(examples) > max_examples else examples
+    items = []
     for i, ex in enumerate(best_examples, 1):
         label = ex.get('label', f'Ejemplo {i}')
         example_data = ex.get('example', ex)
-        text += f"\nEJEMPLO {i}: {label}\n"
-        text += json.dumps(example_data, ensure_ascii=False, indent=2)
-        text += "\n" + "-"*70
-    
-    return text
+        if compact:
+            items.append(f"EJEMPLO {i}: {label}\n{json.dumps(example_data, ensure_ascii=False, separators=(',', ':'))}")
+        else:
+            items.append(f"\nEJEMPLO {i}: {label}\n{json.dumps(example_data, ensure_ascii=False, indent=2)}\n" + "-"*70)
+    return items
+
+
+def _fewshot_header(compact: bool) -> str:
+    return _FEWSHOT_HEADER if compact else f"\n{_FEWSHOT_HEADER}\n" + "="*70
 
 
-def build_prompt(modalidad: str, region: str, indicacion: str, extras: str, template_text: str, image_token: str = IMAGE_TOKEN) -> str:
+def format_fewshot_prompt(examples: List[Dict], max_examples: int = 2, compact: bool = PROMPT_COMPACT) -> str:
     """
-    Construye prompt SIMPLIFICADO pero efectivo para MedGemma 4B.
-    Menos texto innecesario, más enfoque en JSON directo.
-    
-    Args:
-        modalidad: Tipo de estudio (TC, RM, RX, US, Otro)
-        region: Región anatómica
-        indicacion: Indicación clínica
-        extras: Notas adicionales
-        template_text: Plantilla a editar
-    
-    Returns:
-        str: Prompt completo para el modelo
+    Formatea ejemplos few-shot para incluir en el prompt.
+    Prioriza ejemplos del usuario (los últimos agregados) para máximo aprendizaje.
     """
-    good_examples = load_good_examples()
-    fewshot_section = format_fewshot_prompt(good_examples)
-    modalidad_guide = get_prompt_by_modalidad(modalidad)
-    
-    # Si image_token es None, usar IMAGE_TOKEN por defecto.
-    # Si image_token es "" (cadena vacía), no insertar token en el prompt.
-    token = IMAGE_TOKEN if image_token is None else image_token
-    token_prefix = f"{token}\n\n" if token else ""
+    items = format_fewshot_items(examples, max_examples, compact)
+    return f"{_fewshot_header(compact)}\n" + ("\n" if compact else "").join(items)
 
-    return f"""{token_prefix}
 
-TAREA: Eres radiólogo. Edita esta plantilla basándote en la imagen. Devuelve SOLO JSON válido dentro de un bloque ```json```.
+# Índice BM25 de los ejemplos buenos y pesos por valoración (feedback.csv)
+_EXAMPLE_INDEX = ExampleIndex(SUPPORTED_MODALITIES)
+_RATINGS_CACHE: Dict[str, Any] = {"signature": None, "weights": {}}
 
-PLANTILLA A EDITAR:
---- PLANTILLA ---
-{template_text}
---- FIN PLANTILLA ---
 
-INSTRUCCIONES CRÍTICAS:
-- Elimina líneas que contradicen la imagen (remove)
-- Reemplaza lo incorrecto (replace)
-- Agrega hallazgos anormales nuevos (add_findings)
-- Si no ves algo → regístralo en "lesiometro_missing"
-- Conclusión: solo positivo/anormal, NUNCA diagnóstico definitivo
-- NO inventes medidas, edad, contraste, etc.
+def load_rating_weights() -> Dict[str, float]:
+    """
+    Peso por ejemplo (clave example_key): valoración media / 5 de las filas de
+    feedback.csv cuya salida o versión final contiene ese JSON de ediciones.
+    Se relee solo si cambian mtime o tamaño del CSV.
+    """
+    try:
+        st = os.stat(FEEDBACK_CSV)
+        signature = (str(FEEDBACK_CSV), st.st_mtime_ns, st.st_size)
+    except OSError:
+        return {}
+    with _GOOD_EXAMPLES_LOCK:
+        if _RATINGS_CACHE["signature"] == signature:
+            return _RATINGS_CACHE["weights"]
+    ratings: Dict[str, List[int]] = {}
+    with open(FEEDBACK_CSV, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                rating = int((row.get("rating") or "").strip())
+            except ValueError:
+                continue
+            keys = set()
+            for text in (row.get("output"), row.get("version_final")):
+                try:
+                    keys.add(example_key(json.loads(extract_json_block(text or ""))))
+                except (ValueError, TypeError):
+                    continue
+            for key in keys:
+                ratings.setdefault(key, []).append(rating)
+    weights = {key: sum(values) / len(values) / 5.0 for key, values in ratings.items()}
+    with _GOOD_EXAMPLES_LOCK:
+        _RATINGS_CACHE.update(signature=signature, weights=weights)
+    return weights
 
-CONTEXTO:
-- Modalidad: {modalidad}
-- Región: {region}
-- Indicación: {indicacion}
-- Extras: {extras}
 
-{modalidad_guide}
+# Índice de embeddings de imagen de los casos aprobados (se sincroniza con el almacén)
+_VISUAL_INDEX = VisualExampleIndex(FEWSHOT_VISUAL_IVF_MIN, FEWSHOT_VISUAL_NPROBE)
+_VISUAL_STATE: Dict[str, Any] = {"signature": None, "path": None, "last_id": 0}
+_VISUAL_LOCK = threading.Lock()
 
-EJEMPLOS A SEGUIR:
-{fewshot_section}
 
-DEVUELVE JSON EXACTO (SIN EXPLICACIONES) y formátalo como bloque de código:
-```json
-{{"remove":[],"replace":[],"add_findings":[],"lesiometro_missing":[],"confidence_scores":{{}},"conclusion":{{"positives":[],"impression":[],"ddx":[],"recommendations":[]}}}}
-```
+def select_similar_examples(embedding: Optional[Any], modalidad: Optional[str], k: int = FEWSHOT_VISUAL_K, exclude: List[Dict] = ()) -> List[Dict]:
+    """
+    Los k casos aprobados de la modalidad con la imagen más parecida (coseno
+    sobre el embedding de imagen), sin repetir los de exclude.
+    """
+    if embedding is None or k <= 0 or not FEWSHOT_VISUAL_ENABLED:
+        return []
+    signature, examples = _cached_good_examples()
+    store = get_good_example_store()
+    with _VISUAL_LOCK:
+        if _VISUAL_STATE["path"] != str(store.path):
+            _VISUAL_INDEX.clear()
+            _VISUAL_STATE.update(signature=None, path=str(store.path), last_id=0)
+        if _VISUAL_STATE["signature"] != signature:
+            ids, modalities, matrix = store.embeddings(_VISUAL_STATE["last_id"])
+            by_id = {ex["id"]: ex for ex in examples if "id" in ex}
+            # Solo los que ya están en la lista cacheada (el resto, en la próxima sincronización)
+            keep = [i for i, row_id in enumerate(ids) if row_id in by_id]
+            if keep:
+                _VISUAL_INDEX.add(matrix[keep], [by_id[ids[i]] for i in keep], [modalities[i] for i in keep])
+                _VISUAL_STATE["last_id"] = ids[keep[-1]]
+            _VISUAL_STATE["signature"] = signature
+        excluded = {ex.get("id") for ex in exclude} - {None}
+        hits = _VISUAL_INDEX.search(embedding, modalidad, k + len(excluded))
+    return [ex for ex, _ in hits if ex.get("id") not in excluded][:k]
+
+
+_SIMILAR_HEADER = "CASOS APROBADOS CON IMAGEN PARECIDA (ediciones validadas por el radiólogo):"
+
+
+def format_similar_items(examples: List[Dict]) -> List[str]:
+    """Una línea por caso parecido, JSON compacto (van en el segmento dinámico del prompt)."""
+    return [
+        f"- {ex.get('label', 'Caso')}: {json.dumps(ex.get('example', {}), ensure_ascii=False, separators=(',', ':'))}"
+        for ex in examples
+    ]
+
+
+def _fewshot_query(region: str, indicacion: str) -> str:
+    return f"{region} {indicacion}".strip() if FEWSHOT_QUERY_INDICATION else (region or "")
+
 
-ESQUEMA JSON COMPLETO (referencia):
+def select_fewshot_examples(modalidad: Optional[str], region: str = "", indicacion: str = "", k: int = FEWSHOT_TOP_K) -> List[Dict]:
+    """
+    Los k ejemplos buenos más relevantes para el estudio (de más a menos), o
+    los k últimos si la recuperación está desactivada o no hay modalidad.
+    """
+    examples = _cached_good_examples()[1]
+    if not FEWSHOT_RETRIEVAL_ENABLED or modalidad is None:
+        return examples[-k:] if k > 0 else []
+    with _GOOD_EXAMPLES_LOCK:
+        _EXAMPLE_INDEX.sync(examples)
+    _EXAMPLE_INDEX.set_weights(load_rating_weights())
+    return _EXAMPLE_INDEX.search(_fewshot_query(region, indicacion), modalidad, k)
+
+
+def cached_fewshot_selection(modalidad: Optional[str] = None, region: str = "", indicacion: str = "", compact: bool = PROMPT_COMPACT) -> Tuple[Tuple[Dict, ...], Tuple[str, ...]]:
+    """
+    (ejemplos elegidos, bloques renderizados) del few-shot del estudio, del más
+    al menos relevante. Se seleccionan y renderizan una vez por versión del
+    almacén (y de las valoraciones) y por (modalidad, consulta).
+    """
+    signature, _ = _cached_good_examples()
+    retrieval = FEWSHOT_RETRIEVAL_ENABLED and modalidad is not None
+    if retrieval:
+        load_rating_weights()
+    key = (signature, _RATINGS_CACHE["signature"] if retrieval else None, modalidad,
+           _fewshot_query(region, indicacion) if retrieval else "", compact)
+    with _GOOD_EXAMPLES_LOCK:
+        cache = _GOOD_EXAMPLES_CACHE["fewshot"]
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    selected = tuple(select_fewshot_examples(modalidad, region, indicacion))
+    entry = (selected, tuple(format_fewshot_items(list(selected), FEWSHOT_TOP_K, compact)))
+    with _GOOD_EXAMPLES_LOCK:
+        cache = _GOOD_EXAMPLES_CACHE["fewshot"]
+        cache[key] = entry
+        while len(cache) > _FEWSHOT_CACHE_SIZE:
+            cache.popitem(last=False)
+    return entry
+
+
+def cached_fewshot_items(modalidad: Optional[str] = None, region: str = "", indicacion: str = "", compact: bool = PROMPT_COMPACT) -> Tuple[str, ...]:
+    """Bloques few-shot del estudio (ver cached_fewshot_selection)."""
+    return cached_fewshot_selection(modalidad, region, indicacion, compact)[1]
+
+
+def cached_fewshot_section(modalidad: Optional[str] = None, region: str = "", indicacion: str = "", compact: bool = PROMPT_COMPACT) -> str:
+    """Sección few-shot del estudio como texto (ver cached_fewshot_items)."""
+    items = cached_fewshot_items(modalidad, region, indicacion, compact)
+    return f"{_fewshot_header(compact)}\n" + ("\n" if compact else "").join(items)
+
+
+def number_template_lines(template_text: str) -> str:
+    """Plantilla con cada línea precedida de su número (base 1) para el formato "index"."""
+    return "\n".join(f"{i}| {ln}".rstrip() for i, ln in enumerate(template_text.splitlines(), 1))
+
+
+# Esquema de ediciones con una pista por campo (una sola vez en el prompt compacto)
+_SCHEMA_REFERENCE = {
+    "remove": None,
+    "replace": None,
+    "add_findings": ["hallazgo 1", "hallazgo 2"],
+    "lesiometro_missing": ["componente no evaluable"],
+    "confidence_scores": {"finding1": 0.95, "finding2": 0.6},
+    "conclusion": {
+        "positives": ["solo anormales"],
+        "impression": ["probabilístico"],
+        "ddx": ["dx1", "dx2"],
+        "recommendations": ["correlación clínica"],
+    },
+}
+_EMPTY_EDITS = '{"remove":[],"replace":[],"add_findings":[],"lesiometro_missing":[],"confidence_scores":{},"conclusion":{"positives":[],"impression":[],"ddx":[],"recommendations":[]}}'
+
+# Valor relativo de las secciones recortables (se recorta antes la de menor valor)
+_VALUE_SIMILAR, _VALUE_FEWSHOT, _VALUE_GUIDE = 1, 2, 3
+
+
+def build_prompt_sections(modalidad: str, region: str, indicacion: str, extras: str, template_text: str, edit_format: str = EDIT_FORMAT, image_embedding: Optional[Any] = None, compact: bool = PROMPT_COMPACT) -> Tuple[List[PromptSection], List[PromptSection]]:
+    """
+    Secciones del segmento estático y del dinámico (ver build_prompt_parts),
+    sin recortar. Las recortables (casos parecidos, few-shot y guía de la
+    modalidad) tienen sus elementos del más al menos valioso. Los few-shot
+    dependen de la región (y quizá de la indicación), así que van en el
+    dinámico: el estático solo depende de la modalidad.
+    """
+    if edit_format == "index":
+        remove_rule = "- Elimina líneas que contradicen la imagen (remove: número de línea de la plantilla)"
+        replace_rule = "- Reemplaza lo incorrecto (replace: from = número de línea, to = línea corregida)"
+        remove_schema, replace_schema = [12], [{"from": 7, "to": "línea corregida"}]
+        template_block = number_template_lines(template_text)
+    else:
+        remove_rule = "- Elimina líneas que contradicen la imagen (remove)"
+        replace_rule = "- Reemplaza lo incorrecto (replace)"
+        remove_schema, replace_schema = ["línea exacta a eliminar"], [{"from": "incorrecto", "to": "correcto"}]
+        template_block = template_text
+    schema = dict(_SCHEMA_REFERENCE, remove=remove_schema, replace=replace_schema)
+
+    task = f"""TAREA: Eres radiólogo. Edita la plantilla que aparece después de la imagen basándote en la imagen. Devuelve SOLO JSON válido dentro de un bloque ```json```.
+
+INSTRUCCIONES CRÍTICAS:
+{remove_rule}
+{replace_rule}
+- Agrega hallazgos anormales nuevos (add_findings)
+- Si no ves algo → regístralo en "lesiometro_missing"
+- Conclusión: solo positivo/anormal, NUNCA diagnóstico definitivo
+- NO inventes medidas, edad, contraste, etc."""
+
+    fewshot_examples, fewshot_items = cached_fewshot_selection(modalidad, region, indicacion, compact)
+    fewshot_items = list(fewshot_items)
+    if compact:
+        fewshot = PromptSection("fewshot", fewshot_items, "EJEMPLOS A SEGUIR:", _VALUE_FEWSHOT)
+        schema_text = f"ESQUEMA JSON COMPLETO (referencia):\n```json\n{json.dumps(schema, ensure_ascii=False, separators=(',', ':'))}\n```"
+        closing = "DEVUELVE SOLO el JSON del ESQUEMA (mismas claves, sin explicaciones) en un bloque ```json```."
+    else:
+        fewshot = PromptSection("fewshot", fewshot_items, f"EJEMPLOS A SEGUIR:\n{_fewshot_header(False)}", _VALUE_FEWSHOT, separator="")
+        schema_text = f"""ESQUEMA JSON COMPLETO (referencia):
 ```json
 {{
-    "remove": ["línea exacta a eliminar"],
-    "replace": [{{"from": "incorrecto", "to": "correcto"}}],
+    "remove": {json.dumps(remove_schema, ensure_ascii=False)},
+    "replace": {json.dumps(replace_schema, ensure_ascii=False)},
     "add_findings": ["hallazgo 1", "hallazgo 2"],
     "lesiometro_missing": ["componente no evaluable"],
     "confidence_scores": {{"finding1": 0.95, "finding2": 0.6}},
@@ -142,8 +420,103 @@ ESQUEMA JSON COMPLETO (referencia):
         "recommendations": ["correlación clínica"]
     }}
 }}
-```
-"""
+```"""
+        closing = f"DEVUELVE JSON EXACTO (SIN EXPLICACIONES) y formátalo como bloque de código:\n```json\n{_EMPTY_EDITS}\n```"
+    guide_lines = get_prompt_by_modalidad(modalidad).strip().splitlines()
+    prefix_sections = [
+        PromptSection("instrucciones", [task]),
+        PromptSection("guia_modalidad", guide_lines, value=_VALUE_GUIDE, min_items=1),
+        PromptSection("esquema", [schema_text]),
+    ]
+
+    similar = []
+    if image_embedding is not None:
+        # Los mismos few-shot de la sección (sin repetir la búsqueda BM25)
+        similar = select_similar_examples(image_embedding, modalidad, exclude=list(fewshot_examples))
+    suffix_sections = [
+        PromptSection("casos_parecidos", format_similar_items(similar), _SIMILAR_HEADER, _VALUE_SIMILAR),
+        fewshot,
+        PromptSection("plantilla", [f"PLANTILLA A EDITAR:\n--- PLANTILLA ---\n{template_block}\n--- FIN PLANTILLA ---"]),
+        PromptSection("contexto", [f"CONTEXTO:\n- Modalidad: {modalidad}\n- Región: {region}\n- Indicación: {indicacion}\n- Extras: {extras}"]),
+        PromptSection("cierre", [closing]),
+    ]
+    return prefix_sections, suffix_sections
+
+
+def fit_prompt_sections(prefix_sections: List[PromptSection], suffix_sections: List[PromptSection], count_tokens: Callable[[str], int], token_budget: int, prefix_budget: int = PROMPT_PREFIX_TOKEN_BUDGET) -> Dict[str, int]:
+    """
+    Recorta el segmento estático a prefix_budget (acotado por token_budget)
+    y el dinámico a lo que quede de token_budget. Devuelve los elementos
+    quitados por sección.
+    """
+    if token_budget <= 0:
+        return {}
+    removed = fit_to_budget(prefix_sections, count_tokens, min(prefix_budget, token_budget) if prefix_budget > 0 else token_budget)
+    prefix_tokens = sum(section_tokens(prefix_sections, count_tokens).values())
+    removed.update(fit_to_budget(suffix_sections, count_tokens, max(1, token_budget - prefix_tokens)))
+    return removed
+
+
+def build_prompt_parts(modalidad: str, region: str, indicacion: str, extras: str, template_text: str, edit_format: str = EDIT_FORMAT, image_embedding: Optional[Any] = None, count_tokens: Optional[Callable[[str], int]] = None, token_budget: int = PROMPT_TOKEN_BUDGET, prefix_budget: int = PROMPT_PREFIX_TOKEN_BUDGET, compact: bool = PROMPT_COMPACT) -> Tuple[str, str]:
+    """
+    Divide el prompt en segmento estático y segmento por petición.
+
+    El segmento estático (tarea, instrucciones, guía por modalidad y esquema
+    JSON) solo depende de la modalidad, por lo que va ANTES de la imagen y su
+    KV-cache se reutiliza entre todas las regiones de esa modalidad.
+    El segmento dinámico (few-shot recuperados por región, plantilla y
+    contexto) va después de la imagen.
+
+    Con edit_format="index" la plantilla va numerada y remove/replace.from
+    son números de línea en lugar de la línea copiada entera.
+
+    Con image_embedding, los casos aprobados de imagen más parecida van al
+    principio del segmento dinámico (cambian con cada imagen).
+
+    Presupuesto (count_tokens: el del tokenizer; sin él, una estimación):
+    el segmento estático se recorta a prefix_budget tokens (líneas de la guía)
+    sin mirar el dinámico, así su clave de caché solo depende de la modalidad;
+    del dinámico, que usa lo que quede de token_budget, solo se quitan casos
+    parecidos y ejemplos few-shot.
+
+    Returns:
+        tuple: (prefix_text, suffix_text)
+    """
+    prefix_sections, suffix_sections = build_prompt_sections(
+        modalidad, region, indicacion, extras, template_text, edit_format, image_embedding, compact,
+    )
+    removed = fit_prompt_sections(prefix_sections, suffix_sections, count_tokens or token_counter_for(None), token_budget, prefix_budget)
+    if removed:
+        logger.info(f"✂️ Prompt recortado al presupuesto de {token_budget} tokens: {removed}")
+    return render_sections(prefix_sections) + "\n", render_sections(suffix_sections) + "\n"
+
+
+def build_prompt(modalidad: str, region: str, indicacion: str, extras: str, template_text: str, image_token: str = IMAGE_TOKEN, edit_format: str = EDIT_FORMAT) -> str:
+    """
+    Construye prompt SIMPLIFICADO pero efectivo para MedGemma 4B.
+    Menos texto innecesario, más enfoque en JSON directo.
+    
+    Args:
+        modalidad: Tipo de estudio (TC, RM, RX, US, Otro)
+        region: Región anatómica
+        indicacion: Indicación clínica
+        extras: Notas adicionales
+        template_text: Plantilla a editar
+        edit_format: "text" (líneas copiadas) o "index" (números de línea)
+    
+    Returns:
+        str: Prompt completo para el modelo (con image_token entre el
+        segmento estático y el dinámico)
+    """
+    prefix, suffix = build_prompt_parts(modalidad, region, indicacion, extras, template_text, edit_format)
+    
+    # Si image_token es None, usar IMAGE_TOKEN por defecto.
+    # Si image_token es "" (cadena vacía), no insertar token en el prompt.
+    # Mismo orden que generate(): prefijo estático → imagen → segmento dinámico
+    token = IMAGE_TOKEN if image_token is None else image_token
+    image_block = f"\n{token}\n\n" if token else "\n"
+
+    return f"{prefix}{image_block}{suffix}"
 
 
 def build_repair_prompt(generated_text: str, template_text: str) -> str:
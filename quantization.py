@@ -0,0 +1,276 @@
+"""
+Cuantización de pesos para inferencia en CPU
+Sustituye las nn.Linear del modelo de lenguaje por capas int8 dinámicas
+(pesos y activaciones por fila) o int4 solo-pesos por grupos
+"""
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+# Alias aceptados en MODEL_DTYPE / CPU_DTYPE → modo canónico
+QUANT_MODES = {
+    "int8": "int8_dynamic",
+    "qint8": "int8_dynamic",
+    "int8_dynamic": "int8_dynamic",
+    "int4": "int4_weight_only",
+    "int4wo": "int4_weight_only",
+    "int4_weight_only": "int4_weight_only",
+}
+
+# Submódulos de Gemma3ForConditionalGeneration por parte del modelo
+LANGUAGE_MODULES = ("language_model",)
+VISION_MODULES = ("vision_tower", "multi_modal_projector")
+
+
+def parse_quant_mode(name: Optional[str]) -> Optional[str]:
+    """Modo canónico de cuantización o None si `name` es un dtype normal."""
+    return QUANT_MODES.get(str(name or "").strip().lower())
+
+
+def int4_supported() -> bool:
+    """True si esta build de torch tiene el kernel int4 de CPU."""
+    return hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu") and hasattr(torch.ops.aten, "_convert_weight_to_int4pack_for_cpu")
+
+
+# ============================================================================
+# CAPAS CUANTIZADAS
+# ============================================================================
+
+class Int8DynamicLinear(nn.Module):
+    """
+    Linear int8 simétrica: pesos cuantizados por canal de salida al cargar y
+    activaciones por fila en cada forward; matmul int8×int8→int32 (torch._int_mm).
+    """
+
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        self.register_buffer("weight_int8", (weight / scale).round().clamp(-127, 127).to(torch.int8))
+        self.register_buffer("weight_scale", scale.squeeze(1))
+        self.register_buffer("bias", linear.bias.detach().float() if linear.bias is not None else None)
+
+    @classmethod
+    def from_buffers(cls, linear: nn.Linear, buffers: Dict[str, torch.Tensor], group_size: int = 128) -> "Int8DynamicLinear":
+        """Capa ya cuantizada (snapshot): `linear` solo aporta las dimensiones."""
+        layer = cls.__new__(cls)
+        nn.Module.__init__(layer)
+        layer.in_features = linear.in_features
+        layer.out_features = linear.out_features
+        for name in ("weight_int8", "weight_scale", "bias"):
+            layer.register_buffer(name, buffers.get(name))
+        return layer
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x2d = x.reshape(-1, self.in_features).float()
+        x_scale = x2d.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        x_int8 = (x2d / x_scale).round().clamp(-127, 127).to(torch.int8)
+        out = torch._int_mm(x_int8, self.weight_int8.t()).float() * x_scale * self.weight_scale
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(*x.shape[:-1], self.out_features).to(x.dtype)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}"
+
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    Linear int4 asimétrica por grupos de `group_size` columnas; los pesos se
+    empaquetan con el layout del kernel de CPU y el matmul se hace en bfloat16.
+    """
+
+    def __init__(self, linear: nn.Linear, group_size: int = 128):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.group_size = group_size
+        weight = linear.weight.detach().float().reshape(self.out_features, -1, group_size)
+        w_min = weight.amin(dim=-1, keepdim=True)
+        w_max = weight.amax(dim=-1, keepdim=True)
+        scales = (w_max - w_min).clamp(min=1e-8) / 15
+        # El kernel reconstruye w = (q - 8) * scale + zero
+        zeros = w_min + scales * 8
+        q = ((weight - w_min) / scales).round().clamp(0, 15).to(torch.int32).reshape(self.out_features, self.in_features)
+        self.register_buffer("weight_int4", torch.ops.aten._convert_weight_to_int4pack_for_cpu(q, 1))
+        scales_and_zeros = torch.stack([scales.squeeze(-1), zeros.squeeze(-1)], dim=-1).transpose(0, 1).contiguous()
+        self.register_buffer("scales_and_zeros", scales_and_zeros.to(torch.bfloat16))
+        self.register_buffer("bias", linear.bias.detach().float() if linear.bias is not None else None)
+
+    @classmethod
+    def from_buffers(cls, linear: nn.Linear, buffers: Dict[str, torch.Tensor], group_size: int = 128) -> "Int4WeightOnlyLinear":
+        """Capa ya cuantizada (snapshot): `linear` solo aporta las dimensiones."""
+        layer = cls.__new__(cls)
+        nn.Module.__init__(layer)
+        layer.in_features = linear.in_features
+        layer.out_features = linear.out_features
+        layer.group_size = group_size
+        for name in ("weight_int4", "scales_and_zeros", "bias"):
+            layer.register_buffer(name, buffers.get(name))
+        return layer
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x2d = x.reshape(-1, self.in_features).to(torch.bfloat16)
+        out = torch.ops.aten._weight_int4pack_mm_for_cpu(x2d, self.weight_int4, self.group_size, self.scales_and_zeros)
+        out = out.float()
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(*x.shape[:-1], self.out_features).to(x.dtype)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+# ============================================================================
+# CUANTIZACIÓN DEL MODELO
+# ============================================================================
+
+def _module_bytes(model: nn.Module) -> int:
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+# Clase y buffers de cada modo (los de un snapshot ya cuantizado)
+QUANT_LAYERS = {
+    "int8_dynamic": (Int8DynamicLinear, ("weight_int8", "weight_scale")),
+    "int4_weight_only": (Int4WeightOnlyLinear, ("weight_int4", "scales_and_zeros")),
+}
+
+
+def _check_mode(mode: str) -> str:
+    canonical = parse_quant_mode(mode)
+    if canonical is None:
+        raise ValueError("Modo de cuantización no soportado")
+    if canonical == "int4_weight_only" and not int4_supported():
+        raise RuntimeError("Esta versión de torch no tiene kernels int4 para CPU")
+    return canonical
+
+
+def quantization_targets(model: nn.Module, mode: str, group_size: int = 128, include_vision: bool = False) -> List[Tuple[str, nn.Module, str, nn.Linear]]:
+    """(nombre completo, padre, nombre en el padre, capa) de las nn.Linear a cuantizar."""
+    prefixes = LANGUAGE_MODULES + (VISION_MODULES if include_vision else ())
+    targets = []
+    for name, module in model.named_modules():
+        parts = name.split(".")
+        # nn.MultiheadAttention lee out_proj.weight directamente: se deja intacta
+        if not any(p in parts for p in prefixes) or isinstance(module, nn.MultiheadAttention):
+            continue
+        for child_name, child in module.named_children():
+            if not isinstance(child, nn.Linear):
+                continue
+            if mode == "int4_weight_only" and child.in_features % group_size:
+                continue
+            targets.append((f"{name}.{child_name}" if name else child_name, module, child_name, child))
+    return targets
+
+
+def quantize_model(model: nn.Module, mode: str, group_size: int = 128, include_vision: bool = False) -> Dict[str, Any]:
+    """
+    Cuantiza in-place las nn.Linear del modelo de lenguaje (y de la torre de
+    visión si `include_vision`). lm_head queda en precisión completa: está
+    atado a los embeddings y domina la calidad de los logits.
+
+    Returns:
+        Dict con modo, capas sustituidas y tamaño del modelo antes/después
+    """
+    mode = _check_mode(mode)
+    bytes_before = _module_bytes(model)
+    targets = quantization_targets(model, mode, group_size, include_vision)
+    layer_cls = QUANT_LAYERS[mode][0]
+    for _, parent, child_name, child in targets:
+        quantized = layer_cls(child, group_size) if mode == "int4_weight_only" else layer_cls(child)
+        setattr(parent, child_name, quantized)
+
+    info = {
+        "mode": mode,
+        "layers": len(targets),
+        "vision": include_vision,
+        "bytes_before": bytes_before,
+        "bytes_after": _module_bytes(model),
+    }
+    logger.info(
+        f"Cuantización {mode}: {info['layers']} capas, "
+        f"{bytes_before / 1024 ** 3:.2f} GB → {info['bytes_after'] / 1024 ** 3:.2f} GB"
+    )
+    return info
+
+
+def load_quantized_weights(
+    model: nn.Module,
+    tensors: Iterable[Tuple[str, torch.Tensor]],
+    mode: str,
+    group_size: int = 128,
+    include_vision: bool = False,
+    dtype: torch.dtype = torch.float32,
+    requantize: bool = True,
+) -> Dict[str, Any]:
+    """
+    Carga los pesos de `tensors` (nombre, tensor; uno a uno desde los
+    safetensors) en un modelo creado sin pesos (parámetros en `meta`) y
+    cuantiza cada nn.Linear en cuanto tiene sus tensores: el pico de memoria
+    es el del modelo cuantizado más una capa, nunca el modelo completo en
+    `dtype`. Acepta también los buffers de un snapshot ya cuantizado; con
+    requantize=False solo acepta esos (una capa sin cuantizar es un error).
+
+    Returns:
+        Dict con modo, capas cuantizadas, cuántas venían ya cuantizadas y tensores ignorados
+    """
+    mode = _check_mode(mode)
+    layer_cls, quant_buffers = QUANT_LAYERS[mode]
+    targets = {name: (parent, child_name, child)
+               for name, parent, child_name, child in quantization_targets(model, mode, group_size, include_vision)}
+    modules = dict(model.named_modules())
+    pending: Dict[str, Dict[str, torch.Tensor]] = {}
+    prequantized = 0
+    done, unexpected = set(), []
+
+    for key, tensor in tensors:
+        module_name, _, attr = key.rpartition(".")
+        if module_name in targets:
+            parent, child_name, child = targets[module_name]
+            parts = pending.setdefault(module_name, {})
+            parts[attr] = tensor
+            needed = ("weight",) if "weight" in parts else quant_buffers
+            if not all(n in parts for n in needed) or (child.bias is not None and "bias" not in parts):
+                continue
+            del pending[module_name]
+            done.add(module_name)
+            if "weight" in parts and not requantize:
+                raise RuntimeError(f"Capa sin cuantizar en un checkpoint ya cuantizado: {module_name}")
+            if "weight" in parts:
+                linear = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None, device="meta")
+                linear.weight = nn.Parameter(parts["weight"], requires_grad=False)
+                if child.bias is not None:
+                    linear.bias = nn.Parameter(parts["bias"], requires_grad=False)
+                quantized = layer_cls(linear, group_size) if mode == "int4_weight_only" else layer_cls(linear)
+            else:
+                quantized = layer_cls.from_buffers(child, parts, group_size)
+                prequantized += 1
+            setattr(parent, child_name, quantized)
+            continue
+
+        module = modules.get(module_name)
+        if module is None:
+            unexpected.append(key)
+        elif attr in module._parameters:
+            value = tensor.to(dtype) if tensor.is_floating_point() else tensor
+            module._parameters[attr] = nn.Parameter(value, requires_grad=False)
+        elif attr in module._buffers:
+            current = module._buffers[attr]
+            module._buffers[attr] = tensor.to(current.dtype) if current is not None else tensor
+        else:
+            unexpected.append(key)
+
+    incomplete = sorted(name for name in targets if name not in done)
+    if incomplete:
+        raise RuntimeError(f"Capas sin todos sus tensores en el checkpoint: {incomplete[:5]}")
+    if unexpected:
+        logger.warning(f"{len(unexpected)} tensores del checkpoint sin destino en el modelo (p. ej. {unexpected[0]})")
+    info = {"mode": mode, "layers": len(done), "prequantized": prequantized, "vision": include_vision, "unexpected": len(unexpected)}
+    logger.info(f"Carga cuantizada {mode}: {len(done)} capas ({prequantized} ya cuantizadas en el checkpoint)")
+    return info
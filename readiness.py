@@ -0,0 +1,98 @@
+"""
+Estado de disponibilidad del modelo y warm-up en segundo plano
+La UI y el endpoint /health consultan READINESS mientras el modelo se carga
+y se ejecuta una generación sintética de calentamiento
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# ESTADO DE DISPONIBILIDAD
+# ============================================================================
+
+READINESS_LABELS = {
+    "idle": "⚪ Modelo sin cargar (se cargará con la primera generación)",
+    "loading": "🟡 Cargando modelo...",
+    "warming_up": "🟡 Calentando modelo (generación de prueba)...",
+    "ready": "🟢 Modelo listo",
+    "error": "🔴 Error al preparar el modelo",
+}
+
+
+class ReadinessState:
+    """Estado thread-safe: idle → loading → warming_up → ready (o error)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.status = "idle"
+        self.detail = ""
+        self.timings: Dict[str, float] = {}
+        self._since = time.time()
+
+    def set(self, status: str, detail: str = "") -> None:
+        if status not in READINESS_LABELS:
+            raise ValueError(f"Estado de disponibilidad inválido: {status}")
+        with self._lock:
+            now = time.time()
+            # Duración de la fase que termina (loading, warming_up)
+            self.timings[self.status] = round(now - self._since, 2)
+            self.status = status
+            self.detail = detail
+            self._since = now
+        logger.info(f"Disponibilidad: {status}{f' ({detail})' if detail else ''}")
+
+    @property
+    def is_ready(self) -> bool:
+        return self.status == "ready"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Dict serializable para el endpoint /health."""
+        with self._lock:
+            return {
+                "status": self.status,
+                "ready": self.status == "ready",
+                "detail": self.detail,
+                "since": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._since)),
+                "timings": {k: v for k, v in self.timings.items() if k in ("loading", "warming_up")},
+            }
+
+    def markdown(self) -> str:
+        """Texto breve para la UI."""
+        with self._lock:
+            label = READINESS_LABELS[self.status]
+            return f"{label} — {self.detail}" if self.detail else label
+
+
+# Instancia global del proceso
+READINESS = ReadinessState()
+
+
+def start_background_warmup(load_fn: Callable[[], Any], warmup_fn: Optional[Callable[[], Any]] = None, state: ReadinessState = READINESS) -> threading.Thread:
+    """
+    Carga el modelo y ejecuta el warm-up en un hilo daemon para que Gradio
+    sirva la UI desde el primer momento.
+    """
+    def _worker():
+        try:
+            state.set("loading")
+            load_fn()
+            if warmup_fn is not None:
+                state.set("warming_up")
+                t0 = time.perf_counter()
+                warmup_fn()
+                detail = f"warm-up en {time.perf_counter() - t0:.1f}s"
+            else:
+                detail = ""
+            state.set("ready", detail)
+        except Exception as e:
+            logger.error(f"Fallo en la carga/warm-up en segundo plano: {e}")
+            state.set("error", str(e))
+
+    thread = threading.Thread(target=_worker, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
@@ -5,7 +5,7 @@ Validación de imágenes, parsing JSON, edición de plantillas, auditoría
 import re
 import json
 import numpy as np
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Optional, Tuple
 from PIL import Image
 
 
@@ -84,28 +84,135 @@ def extract_json_block(text: str) -> str:
     raise ValueError("No se encontró un JSON balanceado en la salida del modelo.")
 
 
+def complete_partial_json(text: str) -> str:
+    """
+    Completa (best-effort) un JSON truncado, p.ej. durante streaming.
+    Recorta hasta el último valor completo y cierra strings/listas/objetos abiertos.
+    Si el JSON ya está balanceado, lo devuelve tal cual.
+    """
+    fence = re.search(r"```(?:json)?\s*", text, flags=re.IGNORECASE)
+    start = text.find("{", fence.end() if fence else 0)
+    if start == -1:
+        raise ValueError("No se encontró inicio de JSON en la salida del modelo.")
+
+    def _closers(stack: List[str]) -> str:
+        return "".join("}" if c == "{" else "]" for c in reversed(stack))
+
+    stack: List[str] = []
+    in_string = False
+    escape = False
+    string_is_key = False
+    expecting_key = False
+    last_cut = None  # (fin exclusivo, cierres necesarios)
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                if not string_is_key:
+                    last_cut = (i + 1, _closers(stack))
+            continue
+
+        if ch == '"':
+            in_string = True
+            string_is_key = bool(stack) and stack[-1] == "{" and expecting_key
+        elif ch in "{[":
+            stack.append(ch)
+            expecting_key = ch == "{"
+            last_cut = (i + 1, _closers(stack))
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                return text[start:i + 1]
+            expecting_key = False
+            last_cut = (i + 1, _closers(stack))
+        elif ch == ",":
+            # El valor anterior (número/literal incluido) está completo
+            last_cut = (i, _closers(stack))
+            expecting_key = bool(stack) and stack[-1] == "{"
+        elif ch == ":":
+            expecting_key = False
+
+    if last_cut is None:
+        raise ValueError("JSON parcial sin ningún valor completo.")
+    end, closers = last_cut
+    return text[start:end] + closers
+
+
 # ============================================================================
 # APLICACIÓN DE EDICIONES JSON
 # ============================================================================
 
-def apply_edits(template_text: str, edits_json: str) -> str:
+def _line_index(ref: Any, lines: List[str], edit_format: str = "text") -> Optional[int]:
+    """
+    Posición (base 0) de una referencia por número de línea (base 1) o None
+    si `ref` es texto. Un string numérico solo cuenta como índice con
+    edit_format="index" y si no coincide con ninguna línea de la plantilla;
+    en formato "text" es el texto de una línea.
+    """
+    if isinstance(ref, bool):
+        return None
+    if isinstance(ref, str):
+        if edit_format != "index":
+            return None
+        ref = ref.strip()
+        if not ref.isdigit() or any(ln.strip() == ref for ln in lines):
+            return None
+        ref = int(ref)
+    if isinstance(ref, int) and 1 <= ref <= len(lines):
+        return ref - 1
+    return None
+
+
+def apply_edits(template_text: str, edits_json: str, edit_format: str = "text") -> str:
     """
     Aplica ediciones JSON sobre plantilla.
     Soporta: remove, replace, add_findings, confidence_scores, conclusion.
+    remove y replace.from admiten la línea exacta o su número (entero; con
+    edit_format="index" también como string numérico).
     """
     data = json.loads(edits_json)
     lines = template_text.splitlines()
 
+    # 0) Referencias por número de línea: se resuelven sobre la plantilla
+    # original, antes de que remove desplace las posiciones
+    removes, replaces = [], []
+    removed_idx, replaced_idx = set(), {}
+    for s in data.get("remove", []):
+        idx = _line_index(s, lines, edit_format)
+        if idx is not None:
+            removed_idx.add(idx)
+        else:
+            removes.append(s)
+    for rep in data.get("replace", []):
+        if not isinstance(rep, dict):
+            continue
+        idx = _line_index(rep.get("from"), lines, edit_format)
+        if idx is None:
+            replaces.append(rep)
+            continue
+        to = rep.get("to")
+        if isinstance(to, str) and to.strip():
+            replaced_idx[idx] = to.strip()
+    if removed_idx or replaced_idx:
+        lines = [replaced_idx.get(i, ln) for i, ln in enumerate(lines) if i not in removed_idx]
+
     # 1) REMOVE exact lines
-    remove_set = set((s or "").strip() for s in data.get("remove", []) if isinstance(s, str))
+    remove_set = set((s or "").strip() for s in removes if isinstance(s, str))
     if remove_set:
         lines = [ln for ln in lines if ln.strip() not in remove_set]
 
     # 2) REPLACE exact lines
-    for rep in data.get("replace", []):
-        if not isinstance(rep, dict):
-            continue
-        frm = (rep.get("from") or "").strip()
+    for rep in replaces:
+        # Un número fuera de rango no referencia ninguna línea
+        frm = rep.get("from") if isinstance(rep.get("from"), str) else ""
+        frm = frm.strip()
         to = (rep.get("to") or "").strip()
         if not frm or not to:
             continue
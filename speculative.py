@@ -0,0 +1,329 @@
+"""
+Decodificación especulativa greedy (batch 1)
+Un proponente sugiere k tokens; el modelo principal los verifica en un único
+forward y se aceptan hasta el primer desacuerdo más el token que el modelo
+elige en esa posición, así la salida es idéntica a la decodificación greedy
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import torch
+from transformers import LogitsProcessorList, StoppingCriteriaList
+from continuous_batching import _Sequence, prefill
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# ROLLBACK DEL KV-CACHE (capas completas y de ventana deslizante)
+# ============================================================================
+
+def snapshot_cache(cache: Any) -> List[Tuple[Any, Any, int]]:
+    """
+    Referencias a keys/values de cada capa antes de un paso especulativo.
+    DynamicLayer y DynamicSlidingWindowLayer crean tensores nuevos al
+    actualizarse, así que guardar las referencias basta (sin copias).
+    """
+    return [(layer.keys, layer.values, layer.get_seq_length()) for layer in cache.layers]
+
+
+def rollback_cache(cache: Any, snapshot: List[Tuple[Any, Any, int]], keep_new: int) -> None:
+    """
+    Deja en el cache lo que había en `snapshot` más los primeros `keep_new`
+    tokens añadidos después. Las capas de ventana deslizante descartan tokens
+    antiguos al crecer, por eso se reconstruyen desde la referencia guardada
+    (DynamicCache.crop() no lo admite una vez superada la ventana).
+    """
+    for layer, (keys, values, length) in zip(cache.layers, snapshot):
+        added = layer.get_seq_length() - length
+        if added <= 0 or keep_new >= added:
+            continue
+        new_keys = layer.keys[..., layer.keys.shape[-2] - added:, :][..., :keep_new, :]
+        new_values = layer.values[..., layer.values.shape[-2] - added:, :][..., :keep_new, :]
+        if keys is not None:
+            new_keys = torch.cat([keys, new_keys], dim=-2)
+            new_values = torch.cat([values, new_values], dim=-2)
+        if getattr(layer, "is_sliding", False):
+            window = layer.sliding_window - 1
+            new_keys, new_values = new_keys[..., -window:, :], new_values[..., -window:, :]
+            layer.cumulative_length = length + keep_new
+        layer.keys, layer.values = new_keys, new_values
+
+
+# ============================================================================
+# PROPONENTES
+# ============================================================================
+
+class DraftModelProposer:
+    """
+    Proponente con un LM pequeño que comparte tokenizer con el modelo principal
+    (p. ej. gemma-3-270m / gemma-3-1b para MedGemma). El borrador no ve la
+    imagen: los tokens fuera de su vocabulario (soft tokens de imagen) se omiten.
+    Mantiene su propio KV-cache y lo rebobina a lo aceptado en cada paso.
+    """
+
+    name = "draft"
+
+    def __init__(self, draft_model: Any):
+        self.model = draft_model
+        self.vocab_size = int(draft_model.config.vocab_size)
+        self._cache = None
+        self._fed: List[int] = []
+        self._snapshot = None
+        self._snapshot_len = 0
+
+    def _to_draft(self, tokens: List[int]) -> List[int]:
+        return [t for t in tokens if t < self.vocab_size]
+
+    def start(self, prompt_tokens: List[int]) -> None:
+        """Reinicia el estado para una petición nueva."""
+        self._cache, self._fed, self._snapshot, self._snapshot_len = None, [], None, 0
+
+    def _feed(self, tokens: List[int]) -> torch.Tensor:
+        start = len(self._fed)
+        device = next(self.model.parameters()).device
+        with torch.inference_mode():
+            out = self.model(
+                input_ids=torch.tensor([tokens], device=device),
+                past_key_values=self._cache,
+                cache_position=torch.arange(start, start + len(tokens), device=device),
+                use_cache=True,
+                logits_to_keep=1,
+            )
+        self._cache = out.past_key_values
+        self._fed.extend(tokens)
+        return out.logits[0, -1]
+
+    def propose(self, tokens: List[int], k: int) -> List[int]:
+        """Hasta k tokens greedy del borrador a continuación de `tokens`."""
+        if k <= 0:
+            return []
+        seq = self._to_draft(tokens)
+        common = 0
+        for a, b in zip(self._fed, seq):
+            if a != b:
+                break
+            common += 1
+        if common < len(self._fed):
+            # Tokens del borrador rechazados en el paso anterior
+            if self._snapshot is None or common < self._snapshot_len:
+                self.start(tokens)
+                common = 0
+            else:
+                rollback_cache(self._cache, self._snapshot, common - self._snapshot_len)
+                self._fed = self._fed[:common]
+        if common == len(seq):
+            # Sin token nuevo que alimentar (no ocurre en el bucle normal)
+            return []
+        logits = self._feed(seq[common:])
+        self._snapshot, self._snapshot_len = snapshot_cache(self._cache), len(self._fed)
+        draft = [int(logits.argmax())]
+        while len(draft) < k:
+            draft.append(int(self._feed(draft[-1:]).argmax()))
+        return draft
+
+
+class PromptLookupProposer:
+    """
+    Proponente por búsqueda de n-gramas (prompt lookup): si los últimos n
+    tokens ya aparecieron en lo generado, en el corpus (ediciones aprobadas,
+    plantilla) o en el prompt, propone los tokens que los siguieron allí.
+    Sin modelo auxiliar: el coste por paso es una consulta a un diccionario.
+    """
+
+    name = "prompt_lookup"
+
+    def __init__(self, corpus: Optional[List[List[int]]] = None, ngram_max: int = 3, ngram_min: int = 1):
+        self.corpus = [list(c) for c in (corpus or []) if c]
+        self.ngram_max = int(ngram_max)
+        self.ngram_min = max(1, int(ngram_min))
+        self._sources: List[List[int]] = []
+        self._index: Dict[Tuple[int, ...], Tuple[int, int]] = {}
+        self._prompt_len = 0
+
+    def start(self, prompt_tokens: List[int]) -> None:
+        """Indexa corpus + prompt; ante n-gramas repetidos gana la fuente más prioritaria."""
+        self._prompt_len = len(prompt_tokens)
+        # Del menos al más prioritario: cada fuente sobrescribe a las anteriores
+        self._sources = [list(prompt_tokens)] + self.corpus[::-1]
+        self._index = {}
+        for src_id, source in enumerate(self._sources):
+            for n in range(self.ngram_min, self.ngram_max + 1):
+                for end in range(n, len(source)):
+                    self._index[tuple(source[end - n:end])] = (src_id, end)
+
+    def propose(self, tokens: List[int], k: int) -> List[int]:
+        """Hasta k tokens que siguieron al n-grama final más largo encontrado."""
+        if k <= 0:
+            return []
+        generated = tokens[self._prompt_len:]
+        for n in range(min(self.ngram_max, len(tokens)), self.ngram_min - 1, -1):
+            key = tokens[-n:]
+            # Repeticiones dentro de lo ya generado (la más reciente primero)
+            for end in range(len(generated) - 1, n - 1, -1):
+                if generated[end - n:end] == key:
+                    return generated[end:end + k]
+            hit = self._index.get(tuple(key))
+            if hit is not None:
+                src_id, end = hit
+                return self._sources[src_id][end:end + k]
+        return []
+
+
+# ============================================================================
+# BUCLE DE VERIFICACIÓN
+# ============================================================================
+
+def speculative_generate(model: Any, inputs: Dict[str, Any], proposer: Any, max_new_tokens: int, eos_token_ids: List[int], num_draft_tokens: int = 4, logits_processor: Optional[LogitsProcessorList] = None, stopping_criteria: Optional[StoppingCriteriaList] = None, streamer: Optional[Any] = None, max_time: Optional[float] = None) -> Tuple[torch.Tensor, Dict[str, Any]]:
+    """
+    Equivalente a model.generate(do_sample=False) para batch 1, verificando
+    en cada forward los tokens que sugiere `proposer`.
+
+    Admite inputs con past_key_values (prefijo cacheado), inputs_embeds
+    (caché de visión) o pixel_values.
+
+    Returns:
+        (Tensor (1, prompt + tokens generados), estadísticas de aceptación)
+    """
+    input_ids = inputs["input_ids"]
+    if input_ids.shape[0] != 1:
+        raise ValueError("speculative_generate admite una secuencia por petición")
+    device = input_ids.device
+    deadline = time.perf_counter() + max_time if max_time else None
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    cache, logits = prefill(model, inputs)
+    # Misma lógica de selección y parada que el motor continuo
+    state = _Sequence(
+        0, input_ids[0].tolist(), max_new_tokens, eos_token_ids,
+        logits_processor or LogitsProcessorList(), stopping_criteria or StoppingCriteriaList(),
+        streamer, deadline, None,
+    )
+    state.choose(logits[0])
+    proposer.start(state.tokens[:state.prompt_len])
+
+    stats = {"steps": 0, "drafted": 0, "accepted": 0, "verify_seconds": 0.0, "draft_seconds": 0.0}
+    t_decode = time.perf_counter()
+    while not state.done:
+        t0 = time.perf_counter()
+        draft = proposer.propose(state.tokens, min(int(num_draft_tokens), state.max_new_tokens - state.generated - 1))
+        t1 = time.perf_counter()
+
+        # El último token elegido aún no está en el cache: se verifica junto al borrador
+        verify = [state.tokens[-1]] + draft
+        past_len = len(state.tokens) - 1
+        snapshot = snapshot_cache(cache)
+        with torch.inference_mode():
+            out = model(
+                input_ids=torch.tensor([verify], device=device),
+                attention_mask=torch.ones(1, past_len + len(verify), dtype=torch.long, device=device),
+                past_key_values=cache,
+                cache_position=torch.arange(past_len, past_len + len(verify), device=device),
+                use_cache=True,
+            )
+        logits = out.logits[0]
+        accepted = 0
+        for i in range(len(verify)):
+            token = state.choose(logits[i])
+            if i < len(draft) and token == draft[i]:
+                accepted += 1
+            if state.done or i >= len(draft) or token != draft[i]:
+                break
+        # Quedan en el cache el token previo y los del borrador aceptados
+        rollback_cache(cache, snapshot, accepted + 1)
+
+        stats["steps"] += 1
+        stats["drafted"] += len(draft)
+        stats["accepted"] += accepted
+        stats["draft_seconds"] += t1 - t0
+        stats["verify_seconds"] += time.perf_counter() - t1
+
+    if streamer is not None:
+        streamer.end()
+    stats.update(_summary(stats, state.generated, time.perf_counter() - t_decode))
+    return torch.tensor([state.tokens], device=device), stats
+
+
+def _summary(stats: Dict[str, Any], generated: int, decode_seconds: float) -> Dict[str, Any]:
+    """Tasa de aceptación, tokens por paso y tiempo de decodificación medidos."""
+    steps = max(1, stats["steps"])
+    decoded = max(0, generated - 1)
+    return {
+        "generated": generated,
+        "acceptance_rate": stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0,
+        "tokens_per_step": decoded / steps if stats["steps"] else 0.0,
+        "decode_seconds": decode_seconds,
+    }
+
+
+# ============================================================================
+# ACELERACIÓN MEDIDA
+# ============================================================================
+
+class SpeculationTimer:
+    """
+    Tiempo de reloj de extremo a extremo (prefill incluido) por token generado
+    de las peticiones greedy con y sin decodificación especulativa. La
+    aceleración es el cociente de las dos medias, no una estimación.
+    """
+
+    def __init__(self):
+        self._totals = {True: [0.0, 0], False: [0.0, 0]}
+        self._lock = threading.Lock()
+
+    def record(self, speculative: bool, seconds: float, tokens: int) -> None:
+        if tokens <= 0:
+            return
+        with self._lock:
+            total = self._totals[bool(speculative)]
+            total[0] += seconds
+            total[1] += tokens
+
+    def stats(self) -> Dict[str, Any]:
+        """s/token con y sin especulativa y aceleración medida (None sin datos de ambos)."""
+        with self._lock:
+            rates = {key: (sec / tokens if tokens else None) for key, (sec, tokens) in self._totals.items()}
+            counts = {key: tokens for key, (_, tokens) in self._totals.items()}
+        with_spec, without = rates[True], rates[False]
+        return {
+            "seconds_per_token_speculative": with_spec,
+            "seconds_per_token_baseline": without,
+            "tokens_speculative": counts[True],
+            "tokens_baseline": counts[False],
+            "measured_speedup": without / with_spec if with_spec and without else None,
+        }
+
+
+# ============================================================================
+# REPARTO ENTRE ESPECULATIVA Y MOTOR CONTINUO
+# ============================================================================
+
+class SpeculationGate:
+    """
+    Cuenta las decodificaciones especulativas en curso. Se ejecutan fuera del
+    motor continuo (que no las ve en active/waiting), así que solo se admite
+    una y solo con el motor libre; las demás peticiones van al motor y
+    comparten su bucle de decodificación en lugar de competir por la CPU.
+    """
+
+    def __init__(self):
+        self._active = 0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def try_enter(self, engine_busy: bool) -> bool:
+        """True (y cuenta la petición) si puede especular; hay que llamar a leave() al terminar."""
+        with self._lock:
+            if engine_busy or self._active:
+                return False
+            self._active += 1
+            return True
+
+    def leave(self) -> None:
+        with self._lock:
+            self._active = max(0, self._active - 1)
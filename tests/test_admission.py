@@ -0,0 +1,163 @@
+"""
+Suite de tests para admission.py
+Tests para la cola acotada, la admisión por workers y KV-cache, las prioridades y la estimación del KV
+"""
+import pytest
+import threading
+import sys
+import os
+from types import SimpleNamespace
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, AdmissionRejected, estimate_kv_bytes
+
+MB = 1024 * 1024
+
+
+class TestEstimateKVBytes:
+    """Tests para la estimación del KV-cache por secuencia"""
+
+    def test_full_attention_layers(self):
+        """Test que el KV crece linealmente con los tokens en capas globales"""
+        cfg = SimpleNamespace(num_hidden_layers=2, num_key_value_heads=4, head_dim=8)
+
+        assert estimate_kv_bytes(cfg, 10, element_size=2) == 2 * 2 * 10 * 4 * 8 * 2
+
+    def test_sliding_layers_capped_at_window(self):
+        """Test que las capas de atención local solo guardan la ventana"""
+        cfg = SimpleNamespace(
+            num_hidden_layers=2, num_key_value_heads=1, head_dim=4, sliding_window=16,
+            layer_types=["sliding_attention", "full_attention"],
+        )
+
+        assert estimate_kv_bytes(cfg, 100, element_size=4) == 2 * (16 + 100) * 1 * 4 * 4
+
+
+class TestAdmissionController:
+    """Tests para la cola FIFO con workers, presupuesto de KV y rechazo"""
+
+    def test_admits_up_to_workers_then_queues(self):
+        """Test que admite hasta max_workers y encola el resto en orden"""
+        ctrl = AdmissionController(max_workers=2, max_queue=4)
+        tickets = [ctrl.enqueue() for _ in range(4)]
+
+        assert [t.admitted for t in tickets] == [True, True, False, False]
+        assert [ctrl.position(t) for t in tickets] == [0, 0, 1, 2]
+        ctrl.leave(tickets[0])
+        assert tickets[2].admitted and ctrl.position(tickets[3]) == 1
+
+    def test_rejects_when_queue_full(self):
+        """Test que rechaza cuando la cola está llena"""
+        ctrl = AdmissionController(max_workers=1, max_queue=1)
+        ctrl.enqueue()
+        ctrl.enqueue()
+
+        with pytest.raises(AdmissionRejected):
+            ctrl.enqueue()
+        assert ctrl.stats()["rejected"] == 1
+
+    def test_kv_budget_blocks_admission(self):
+        """Test que el KV reservado limita la admisión aunque haya workers libres"""
+        ctrl = AdmissionController(max_workers=4, max_queue=4, kv_budget_bytes=100 * MB)
+        big = ctrl.enqueue(70 * MB)
+        second = ctrl.enqueue(40 * MB)
+        small = ctrl.enqueue(10 * MB)
+
+        assert big.admitted and not second.admitted
+        # FIFO: la pequeña no se adelanta a la que espera
+        assert not small.admitted
+        ctrl.leave(big)
+        assert second.admitted and small.admitted
+        assert ctrl.stats()["reserved_kv_mb"] == 50.0
+
+    def test_rejects_request_over_budget(self):
+        """Test que una petición mayor que todo el presupuesto se rechaza"""
+        ctrl = AdmissionController(max_workers=1, max_queue=4, kv_budget_bytes=10 * MB)
+
+        with pytest.raises(AdmissionRejected):
+            ctrl.enqueue(11 * MB)
+
+    def test_wait_and_abandon(self):
+        """Test que wait despierta al admitir y que abandonar la cola la libera"""
+        ctrl = AdmissionController(max_workers=1, max_queue=4)
+        running = ctrl.enqueue()
+        gone = ctrl.enqueue()
+        waiting = ctrl.enqueue()
+
+        assert not ctrl.wait(waiting, timeout=0.01)
+        ctrl.leave(gone)
+        assert ctrl.position(waiting) == 1
+        threading.Timer(0.05, ctrl.leave, args=(running,)).start()
+        assert ctrl.wait(waiting, timeout=5)
+        assert ctrl.stats()["abandoned"] == 1
+
+    def test_estimated_wait_uses_service_time(self):
+        """Test que la espera estimada usa el tiempo de servicio medio por tandas de workers"""
+        ctrl = AdmissionController(max_workers=2, max_queue=8)
+        first = ctrl.enqueue()
+        ctrl.enqueue()
+        queued = [ctrl.enqueue() for _ in range(3)]
+        assert ctrl.estimated_wait(queued[0]) is None
+
+        ctrl.leave(first)
+        ctrl.service_ema = 10.0
+        assert ctrl.estimated_wait(queued[1]) == 10.0
+        assert ctrl.estimated_wait(queued[2]) == 10.0
+        assert ctrl.estimated_wait(queued[0]) == 0.0
+
+
+class TestPriorityClasses:
+    """Tests para las clases urgente/rutina"""
+
+    def test_urgent_jumps_queue_behind_other_urgent(self):
+        """Test que las urgentes se colocan delante de las de rutina y FIFO entre ellas"""
+        ctrl = AdmissionController(max_workers=1, max_queue=8)
+        ctrl.enqueue()
+        routine = ctrl.enqueue()
+        first_urgent = ctrl.enqueue(priority="urgent")
+        second_urgent = ctrl.enqueue(priority="urgent")
+
+        assert first_urgent.admitted
+        assert ctrl.position(second_urgent) == 1
+        assert ctrl.position(routine) == 2
+
+    def test_urgent_admitted_while_routine_runs(self):
+        """Test que una urgente no espera a la de rutina en ejecución y bloquea nuevas de rutina"""
+        ctrl = AdmissionController(max_workers=1, max_queue=8)
+        running = ctrl.enqueue()
+        urgent = ctrl.enqueue(priority="urgent")
+        routine = ctrl.enqueue()
+
+        assert urgent.admitted and ctrl.urgent_active()
+        ctrl.leave(running)
+        assert not routine.admitted
+        ctrl.leave(urgent)
+        assert routine.admitted and not ctrl.urgent_active()
+
+    def test_full_queue_still_admits_urgent_with_free_worker(self):
+        """Test que la cola llena de rutina no rechaza una urgente que puede entrar ya"""
+        ctrl = AdmissionController(max_workers=1, max_queue=1)
+        ctrl.enqueue()
+        ctrl.enqueue()
+
+        assert ctrl.enqueue(priority="urgent").admitted
+        with pytest.raises(AdmissionRejected):
+            ctrl.enqueue()
+
+    def test_ttft_stats_per_class(self):
+        """Test que el TTFT se agrega por clase (clases desconocidas cuentan como rutina)"""
+        ctrl = AdmissionController()
+        for seconds in (1.0, 2.0, 3.0):
+            ctrl.record_ttft("urgent", seconds)
+        ctrl.record_ttft("otra", 10.0)
+
+        ttft = ctrl.stats()["ttft"]
+        assert ttft["urgent"]["count"] == 3 and ttft["urgent"]["mean_seconds"] == 2.0
+        assert ttft["urgent"]["p95_seconds"] == 3.0
+        assert ttft["routine"]["mean_seconds"] == 10.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
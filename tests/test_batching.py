@@ -0,0 +1,142 @@
+"""
+Suite de tests para batching.py
+Tests para el micro-batching de peticiones de generación
+"""
+import pytest
+import threading
+import torch
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import (
+    BatchRequest,
+    BatchStreamerFanout,
+    MicroBatchScheduler,
+    collate_inputs,
+    split_outputs,
+)
+
+
+def _inputs(ids):
+    ids = torch.tensor([ids])
+    return {"input_ids": ids, "attention_mask": torch.ones_like(ids), "pixel_values": torch.zeros(1, 3, 2, 2)}
+
+
+class TestCollateInputs:
+    """Tests para la colación de inputs"""
+
+    def test_left_padding_and_stacked_pixels(self):
+        """Test que rellena a la izquierda y apila pixel_values"""
+        batch = collate_inputs([_inputs([1, 2, 3]), _inputs([4])], pad_token_id=0)
+
+        assert batch["input_ids"].tolist() == [[1, 2, 3], [0, 0, 4]]
+        assert batch["attention_mask"].tolist() == [[1, 1, 1], [0, 0, 1]]
+        assert batch["pixel_values"].shape[0] == 2
+
+    def test_split_outputs_restores_prompt_and_trims(self):
+        """Test que cada petición recibe su prompt original + sus tokens nuevos"""
+        requests = [BatchRequest(_inputs([1, 2, 3]), 2), BatchRequest(_inputs([4]), 3)]
+        out = torch.tensor([[1, 2, 3, 7, 8, 9], [0, 0, 4, 5, 6, 0]])
+
+        results = split_outputs(out, requests, padded_len=3)
+
+        assert results[0].tolist() == [[1, 2, 3, 7, 8]]
+        assert results[1].tolist() == [[4, 5, 6, 0]]
+
+
+class TestBatchStreamerFanout:
+    """Tests para el reparto de tokens por fila"""
+
+    def test_rows_routed_to_own_streamer(self):
+        """Test que cada fila llega a su streamer y los None se ignoran"""
+        class Recorder:
+            def __init__(self):
+                self.values, self.ended = [], False
+
+            def put(self, value):
+                self.values.append(value.tolist())
+
+            def end(self):
+                self.ended = True
+
+        a, b = Recorder(), Recorder()
+        fanout = BatchStreamerFanout([a, None, b])
+        fanout.put(torch.tensor([[1, 1], [2, 2], [3, 3]]))
+        fanout.put(torch.tensor([10, 20, 30]))
+        fanout.end()
+
+        assert a.values == [[[1, 1]], [10]]
+        assert b.values == [[[3, 3]], [30]]
+        assert a.ended and b.ended
+
+
+class TestMicroBatchScheduler:
+    """Tests para el scheduler"""
+
+    def test_concurrent_requests_grouped(self):
+        """Test que peticiones dentro de la ventana se ejecutan en un batch"""
+        sizes = []
+
+        def run_batch(requests):
+            sizes.append(len(requests))
+            return [req.inputs["value"] * 10 for req in requests]
+
+        scheduler = MicroBatchScheduler(run_batch, max_batch_size=4, max_wait_ms=200)
+        futures = [scheduler.submit({"value": i}, 8) for i in range(3)]
+
+        assert [f.result(timeout=5) for f in futures] == [0, 10, 20]
+        assert sizes == [3]
+        assert scheduler.stats()["avg_batch_size"] == 3
+        scheduler.shutdown()
+
+    def test_batch_size_limit(self):
+        """Test que no supera max_batch_size"""
+        sizes = []
+
+        def run_batch(requests):
+            sizes.append(len(requests))
+            return [None] * len(requests)
+
+        scheduler = MicroBatchScheduler(run_batch, max_batch_size=2, max_wait_ms=200)
+        futures = [scheduler.submit({}, 8) for _ in range(5)]
+        for f in futures:
+            f.result(timeout=5)
+
+        assert max(sizes) <= 2
+        assert sum(sizes) == 5
+        scheduler.shutdown()
+
+    def test_exception_propagates_to_all_requests(self):
+        """Test que un error del batch llega a cada petición"""
+        def run_batch(requests):
+            raise RuntimeError("fallo")
+
+        scheduler = MicroBatchScheduler(run_batch, max_batch_size=2, max_wait_ms=10)
+
+        with pytest.raises(RuntimeError):
+            scheduler.run({}, 8)
+        scheduler.shutdown()
+
+    def test_run_from_threads(self):
+        """Test que run() bloquea hasta el resultado desde varios hilos"""
+        scheduler = MicroBatchScheduler(lambda reqs: [r.max_new_tokens for r in reqs], max_batch_size=4, max_wait_ms=50)
+        results = {}
+
+        def worker(n):
+            results[n] = scheduler.run({}, n)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in (5, 6, 7)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=5)
+
+        assert results == {5: 5, 6: 6, 7: 7}
+        scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
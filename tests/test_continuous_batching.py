@@ -0,0 +1,194 @@
+"""
+Suite de tests para continuous_batching.py
+Tests para el motor de batching continuo y la contabilidad del KV-cache
+"""
+import pytest
+import threading
+import time
+import torch
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import Gemma3Config, Gemma3ForConditionalGeneration
+from transformers import StoppingCriteriaList
+from decoding import CancellationStoppingCriteria, CancellationToken
+from continuous_batching import (
+    ContinuousBatchingEngine,
+    KVBlockAllocator,
+    get_decode_engine,
+)
+
+NO_EOS = [9999]
+
+
+@pytest.fixture(scope="module")
+def tiny_model():
+    """Gemma3 diminuto con pesos aleatorios (ventana deslizante de 16 tokens)"""
+    cfg = Gemma3Config(
+        text_config=dict(vocab_size=300, hidden_size=64, intermediate_size=128, num_hidden_layers=4,
+                         num_attention_heads=2, num_key_value_heads=1, head_dim=32, sliding_window=16,
+                         max_position_embeddings=2048),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2,
+                           image_size=32, patch_size=8),
+        mm_tokens_per_image=4, image_token_index=299, boi_token_index=297, eoi_token_index=298,
+    )
+    torch.manual_seed(0)
+    return Gemma3ForConditionalGeneration(cfg).eval()
+
+
+def _inputs(n_text: int, seed: int):
+    g = torch.Generator().manual_seed(seed)
+    text = torch.randint(5, 290, (n_text,), generator=g).tolist()
+    ids = torch.tensor([[2] + text[:5] + [297] + [299] * 4 + [298] + text[5:]])
+    return {"input_ids": ids, "attention_mask": torch.ones_like(ids), "pixel_values": torch.randn(1, 3, 32, 32, generator=g)}
+
+
+class TestKVBlockAllocator:
+    """Tests para la contabilidad por bloques"""
+
+    def test_allocate_and_release(self):
+        """Test que reserva bloques redondeando hacia arriba y los libera"""
+        alloc = KVBlockAllocator(num_blocks=10, block_size=16)
+
+        alloc.allocate(1, 33)
+        assert alloc.free_blocks == 7
+        alloc.release(1)
+        assert alloc.free_blocks == 10
+
+    def test_rejects_when_exhausted(self):
+        """Test que falla si no quedan bloques"""
+        alloc = KVBlockAllocator(num_blocks=2, block_size=16)
+
+        assert not alloc.can_allocate(40)
+        with pytest.raises(ValueError):
+            alloc.allocate(1, 40)
+
+
+class TestContinuousBatchingEngine:
+    """Tests para el motor de decodificación"""
+
+    def test_single_request_matches_generate(self, tiny_model):
+        """Test que una petición aislada da la misma salida que model.generate()"""
+        engine = ContinuousBatchingEngine(tiny_model, max_slots=4, block_size=4, num_blocks=100)
+        inputs = _inputs(30, seed=1)
+
+        out = engine.generate(inputs, 20, NO_EOS)
+        expected = tiny_model.generate(**inputs, max_new_tokens=20, min_new_tokens=20, do_sample=False)
+
+        assert torch.equal(out, expected)
+        engine.shutdown()
+
+    def test_staggered_requests_match_generate(self, tiny_model):
+        """Test que peticiones admitidas en pasos distintos y de longitudes distintas no se contaminan"""
+        engine = ContinuousBatchingEngine(tiny_model, max_slots=3, block_size=4, num_blocks=200)
+        cases = [(10, 30), (40, 5), (25, 40), (8, 12), (50, 10)]
+        results = {}
+
+        def client(i, n_text, max_new):
+            time.sleep(0.01 * i)
+            results[i] = engine.generate(_inputs(n_text, seed=i), max_new, NO_EOS)
+
+        threads = [threading.Thread(target=client, args=(i, n, m)) for i, (n, m) in enumerate(cases)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=60)
+
+        for i, (n_text, max_new) in enumerate(cases):
+            expected = tiny_model.generate(**_inputs(n_text, seed=i), max_new_tokens=max_new, min_new_tokens=max_new, do_sample=False)
+            assert torch.equal(results[i], expected)
+        stats = engine.stats()
+        assert stats["max_concurrency"] > 1
+        assert stats["free_blocks"] == 200
+        engine.shutdown()
+
+    def test_eos_retires_sequence(self, tiny_model):
+        """Test que la secuencia termina en EOS y lo incluye en la salida"""
+        engine = ContinuousBatchingEngine(tiny_model, max_slots=2, block_size=4, num_blocks=100)
+        inputs = _inputs(12, seed=3)
+        reference = engine.generate(inputs, 10, NO_EOS)
+        eos = int(reference[0, inputs["input_ids"].shape[1] + 3])
+
+        out = engine.generate(inputs, 10, [eos])
+
+        assert int(out[0, -1]) == eos
+        assert out.shape[1] <= inputs["input_ids"].shape[1] + 4
+        engine.shutdown()
+
+    def test_cancelled_request_retires_within_one_step(self, tiny_model):
+        """Test que una petición cancelada deja el motor en el siguiente paso y libera su KV"""
+        engine = ContinuousBatchingEngine(tiny_model, max_slots=2, block_size=4, num_blocks=200)
+        inputs = _inputs(12, seed=5)
+        token = CancellationToken()
+        seen = []
+
+        class CancelAfter:
+            def put(self, value):
+                seen.append(value)
+                if len(seen) == 3:
+                    token.cancel()
+
+            def end(self):
+                pass
+
+        out = engine.generate(inputs, 500, NO_EOS, stopping_criteria=StoppingCriteriaList([CancellationStoppingCriteria(token)]), streamer=CancelAfter())
+
+        assert out.shape[1] - inputs["input_ids"].shape[1] <= 4
+        assert engine.stats()["free_blocks"] == 200
+        engine.shutdown()
+
+    def test_urgent_request_preempts_routine(self, tiny_model):
+        """Test que una urgente aparca a las de rutina, termina antes y estas reanudan sin cambiar su salida"""
+        engine = ContinuousBatchingEngine(tiny_model, max_slots=4, block_size=4, num_blocks=400)
+        started = threading.Event()
+        finished = {}
+
+        class Progress:
+            def __init__(self):
+                self.calls = 0
+
+            def put(self, value):
+                self.calls += 1
+                if self.calls == 6:
+                    started.set()
+
+            def end(self):
+                pass
+
+        def client(name, n_text, max_new, priority, streamer=None):
+            finished[name] = (engine.generate(_inputs(n_text, seed=n_text), max_new, NO_EOS, streamer=streamer, priority=priority), time.perf_counter())
+
+        routine = [threading.Thread(target=client, args=(f"rutina{i}", n, 60, 1, Progress())) for i, n in enumerate((10, 30))]
+        for t in routine:
+            t.start()
+        assert started.wait(timeout=30)
+        client("urgente", 20, 8, 0)
+        for t in routine:
+            t.join(timeout=60)
+
+        assert engine.stats()["preemptions"] >= 1
+        assert all(finished["urgente"][1] < finished[f"rutina{i}"][1] for i in range(2))
+        for name, n_text, max_new in (("rutina0", 10, 60), ("rutina1", 30, 60), ("urgente", 20, 8)):
+            expected = tiny_model.generate(**_inputs(n_text, seed=n_text), max_new_tokens=max_new, min_new_tokens=max_new, do_sample=False)
+            assert torch.equal(finished[name][0], expected)
+        assert engine.stats()["free_blocks"] == 400
+        engine.shutdown()
+
+    def test_request_over_budget_fails(self, tiny_model):
+        """Test que una petición mayor que el presupuesto de KV se rechaza"""
+        engine = ContinuousBatchingEngine(tiny_model, max_slots=2, block_size=4, num_blocks=2)
+
+        with pytest.raises(ValueError):
+            engine.generate(_inputs(12, seed=4), 10, NO_EOS)
+        engine.shutdown()
+
+    def test_engine_cached_per_model(self, tiny_model):
+        """Test que hay un motor por modelo"""
+        assert get_decode_engine(tiny_model, 2, 4, 10) is get_decode_engine(tiny_model, 2, 4, 10)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
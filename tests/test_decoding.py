@@ -0,0 +1,198 @@
+"""
+Suite de tests para decoding.py
+Tests para criterios de parada sobre la salida JSON, la cancelación y la cesión a urgentes
+"""
+import pytest
+import time
+import torch
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decoding import (
+    JsonBlockStoppingCriteria, CancellationStoppingCriteria, CancellationRegistry, CancellationToken,
+    PreemptionStoppingCriteria, PausableMaxTimeCriteria, FirstTokenCallback,
+)
+
+
+class CharTokenizer:
+    """Tokenizer mínimo: un token por carácter (id = ord)"""
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(chr(i) for i in ids)
+
+
+def _run(criteria, prompt, generated, batch=None):
+    """Simula generate(): llama al criterio tras cada token; devuelve nº de tokens generados al parar"""
+    tok = CharTokenizer()
+    rows = batch or [generated]
+    ids = torch.tensor([tok.encode(prompt)] * len(rows))
+    steps = max(len(r) for r in rows)
+    for step in range(steps):
+        new = torch.tensor([[ord(r[step]) if step < len(r) else 32] for r in rows])
+        ids = torch.cat([ids, new], dim=1)
+        done = criteria(ids, None)
+        if bool(done.all()):
+            return step + 1
+    return steps
+
+
+class TestJsonBlockStoppingCriteria:
+    """Tests para la parada al cerrar el bloque JSON"""
+
+    def test_stops_after_balanced_object(self):
+        """Test que para justo tras la llave de cierre del objeto"""
+        prompt = "PROMPT {\"schema\": {}}\n"
+        generated = '```json\n{"remove": [], "conclusion": {"positives": []}}\n```\nExplicación extra'
+        criteria = JsonBlockStoppingCriteria(CharTokenizer(), len(prompt))
+
+        steps = _run(criteria, prompt, generated)
+
+        assert generated[:steps].endswith("}}")
+        assert criteria.stopped_at == [steps]
+
+    def test_ignores_braces_inside_strings(self):
+        """Test que llaves y comillas escapadas dentro de strings no cuentan"""
+        prompt = "P"
+        generated = '{"add_findings": ["texto con } y \\" comilla {"]} resto'
+        criteria = JsonBlockStoppingCriteria(CharTokenizer(), len(prompt))
+
+        steps = _run(criteria, prompt, generated)
+
+        assert generated[:steps] == '{"add_findings": ["texto con } y \\" comilla {"]}'
+
+    def test_stops_on_closing_fence(self):
+        """Test que para al cerrar el fence aunque el JSON no esté balanceado"""
+        prompt = "P"
+        generated = '```json\n{"remove": []\n```\nmás texto'
+        criteria = JsonBlockStoppingCriteria(CharTokenizer(), len(prompt))
+
+        steps = _run(criteria, prompt, generated)
+
+        assert generated[:steps].endswith('[]\n```')
+
+    def test_prompt_json_is_ignored(self):
+        """Test que solo analiza tokens generados, no el esquema del prompt"""
+        prompt = '```json\n{"remove": []}\n```\n'
+        generated = 'Texto sin JSON todavía'
+        criteria = JsonBlockStoppingCriteria(CharTokenizer(), len(prompt))
+
+        steps = _run(criteria, prompt, generated)
+
+        assert steps == len(generated)
+        assert criteria.stopped_at == [None]
+
+    def test_batch_rows_tracked_independently(self):
+        """Test que cada secuencia del batch tiene su propio estado"""
+        prompt = "P"
+        rows = ['{"a": 1} fin', '{"a": {"b": 2}} fin largo']
+        criteria = JsonBlockStoppingCriteria(CharTokenizer(), len(prompt))
+
+        _run(criteria, prompt, None, batch=rows)
+
+        assert criteria.stopped_at == [len('{"a": 1}'), len('{"a": {"b": 2}}')]
+
+    def test_tokens_saved(self):
+        """Test que reporta tokens ahorrados respecto a max_new_tokens"""
+        prompt = "P"
+        generated = '{"remove": []} ' + "x" * 50
+        criteria = JsonBlockStoppingCriteria(CharTokenizer(), len(prompt))
+
+        steps = _run(criteria, prompt, generated)
+
+        assert criteria.tokens_saved(512) == 512 - steps
+
+
+
+class TestCancellation:
+    """Tests para la cancelación por el usuario (botón Detener)"""
+
+    def test_stops_only_cancelled_rows(self):
+        """Test que cada fila del batch para solo si se cancela su petición"""
+        first, second = CancellationToken(), CancellationToken()
+        criteria = CancellationStoppingCriteria([first, second, None])
+        ids = torch.zeros(3, 4, dtype=torch.long)
+
+        assert criteria(ids, None).tolist() == [False, False, False]
+        second.cancel()
+        assert criteria(ids, None).tolist() == [False, True, False]
+
+    def test_single_token_applies_to_batch(self):
+        """Test que una sola marca detiene todas las filas"""
+        token = CancellationToken()
+        criteria = CancellationStoppingCriteria(token)
+        token.cancel()
+
+        assert criteria(torch.zeros(2, 3, dtype=torch.long), None).tolist() == [True, True]
+        assert token.cancelled_at is not None
+
+    def test_registry_cancels_current_session_generation(self):
+        """Test que Detener encuentra la generación de su sesión y nada más"""
+        registry = CancellationRegistry()
+        token = registry.start("s1")
+
+        assert not registry.cancel("s2")
+        assert registry.cancel("s1") and token.cancelled
+        assert not registry.cancel("s1")
+        registry.finish("s1", token)
+        assert not registry.cancel("s1")
+
+    def test_finish_keeps_newer_generation(self):
+        """Test que terminar una generación antigua no borra la nueva de la sesión"""
+        registry = CancellationRegistry()
+        old = registry.start("s1")
+        new = registry.start("s1")
+        registry.finish("s1", old)
+
+        assert registry.cancel("s1") and new.cancelled and not old.cancelled
+
+
+class TestPriority:
+    """Tests para la cesión del paso a urgentes y la medida del TTFT"""
+
+    def test_preemption_waits_while_urgent_active(self):
+        """Test que la de rutina espera entre pasos mientras haya urgentes y nunca se detiene"""
+        checks = iter([True, True, True, False])
+        criteria = PreemptionStoppingCriteria(lambda: next(checks), poll=0.001)
+
+        assert criteria(torch.zeros(2, 3, dtype=torch.long), None).tolist() == [False, False]
+        assert criteria.paused_seconds > 0
+
+    def test_preemption_wait_interrupted_by_cancel(self):
+        """Test que Detener corta la espera aunque la urgente siga en ejecución"""
+        token = CancellationToken()
+        token.cancel()
+        criteria = PreemptionStoppingCriteria(lambda: True, poll=0.001, cancel_token=token)
+
+        assert criteria(torch.zeros(1, 3, dtype=torch.long), None).tolist() == [False]
+
+    def test_max_time_excludes_paused_time(self):
+        """Test que el tiempo aparcado por una urgente no cuenta para max_time"""
+        until = time.perf_counter() + 0.2
+        preemption = PreemptionStoppingCriteria(lambda: time.perf_counter() < until, poll=0.01)
+        max_time = PausableMaxTimeCriteria(0.1, [preemption])
+        ids = torch.zeros(1, 3, dtype=torch.long)
+
+        preemption(ids, None)
+        assert preemption.paused_seconds >= 0.1
+        assert max_time(ids, None).tolist() == [False]
+        assert PausableMaxTimeCriteria(0.0)(ids, None).tolist() == [True]
+
+    def test_first_token_callback_fires_once(self):
+        """Test que el callback del primer token se llama una sola vez"""
+        calls = []
+        criteria = FirstTokenCallback(lambda: calls.append(1))
+        ids = torch.zeros(1, 3, dtype=torch.long)
+
+        criteria(ids, None)
+        criteria(ids, None)
+        assert calls == [1]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,151 @@
+"""
+Suite de tests para example_index.py
+Tests para el índice BM25 de ejemplos few-shot: relevancia, filtro por
+modalidad, peso por valoración y actualización incremental
+"""
+import pytest
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from example_index import ExampleIndex, VisualExampleIndex, example_key, example_text, tokenize
+
+
+def _example(label, findings, modality=None, region=None):
+    return {"label": label, "modality": modality, "region": region, "example": {"add_findings": findings}}
+
+
+@pytest.fixture
+def examples():
+    return [
+        _example("TC - Cráneo (08:00)", ["Hematoma subdural agudo"], "TC", "Cráneo"),
+        _example("TC - Tórax (09:00)", ["Nódulo pulmonar en lóbulo superior"], "TC", "Tórax"),
+        _example("RX - Tórax (10:00)", ["Consolidación basal derecha"], "RX", "Tórax"),
+        _example("TC - Abdomen (11:00)", ["Apendicitis aguda"], "TC", "Abdomen"),
+    ]
+
+
+class TestTokenize:
+    """Tests para la tokenización"""
+
+    def test_accents_case_and_stopwords(self):
+        """Test que ignora tildes, mayúsculas y palabras vacías"""
+        assert tokenize("Hematoma de la región Temporal") == ["hematoma", "region", "temporal"]
+
+    def test_example_text_includes_findings_and_conclusion(self):
+        """Test que el texto indexado incluye hallazgos y conclusión"""
+        text = example_text({"label": "TC", "example": {"replace": [{"from": "a", "to": "Fractura"}],
+                                                        "conclusion": {"impression": ["Ictus"]}}})
+        assert "Fractura" in text and "Ictus" in text
+
+
+class TestExampleIndex:
+    """Tests para ExampleIndex"""
+
+    def test_ranks_by_region_and_findings(self, examples):
+        """Test que el más relevante para la consulta va primero"""
+        index = ExampleIndex(["TC", "RX"])
+        index.sync(examples)
+
+        assert index.search("tórax nódulo", "TC", k=1)[0]["label"] == "TC - Tórax (09:00)"
+        assert index.search("apendicitis", "TC", k=1)[0]["label"] == "TC - Abdomen (11:00)"
+
+    def test_modality_filter(self, examples):
+        """Test que solo devuelve ejemplos de la modalidad (o sin modalidad)"""
+        index = ExampleIndex(["TC", "RX"])
+        index.sync(examples + [_example("Base", ["Tórax normal"])])
+
+        labels = [ex["label"] for ex in index.search("tórax", "RX", k=5)]
+        assert labels == ["RX - Tórax (10:00)", "Base"]
+
+    def test_modality_inferred_from_label(self):
+        """Test que sin modalidad explícita se deduce de la etiqueta"""
+        index = ExampleIndex(["RM"])
+        index.add({"label": "RM - Rodilla (09:30)", "example": {"add_findings": ["Rotura meniscal"]}})
+
+        assert index.search("rodilla", "TC") == []
+        assert len(index.search("rodilla", "RM")) == 1
+
+    def test_rating_weights(self, examples):
+        """Test que la valoración reordena ejemplos igual de relevantes"""
+        twins = [_example("TC - Tórax (1)", ["Derrame"], "TC", "Tórax"),
+                 _example("TC - Tórax (2)", ["Derrame"], "TC", "Tórax")]
+        twins[0]["example"]["remove"] = ["x"]
+        index = ExampleIndex()
+        index.sync(twins)
+        assert index.search("derrame", "TC", k=1)[0] is twins[1]
+
+        index.set_weights({example_key(twins[0]["example"]): 1.0, example_key(twins[1]["example"]): 0.2})
+        assert index.search("derrame", "TC", k=1)[0] is twins[0]
+
+    def test_no_match_falls_back_to_most_recent(self, examples):
+        """Test que sin coincidencias devuelve los más recientes de la modalidad"""
+        index = ExampleIndex()
+        index.sync(examples)
+
+        labels = [ex["label"] for ex in index.search("xyz", "TC", k=2)]
+        assert labels == ["TC - Abdomen (11:00)", "TC - Tórax (09:00)"]
+
+    def test_incremental_sync(self, examples):
+        """Test que sync solo añade lo nuevo y reconstruye si la lista cambia"""
+        index = ExampleIndex()
+        assert index.sync(examples[:2]) == 2
+        assert index.sync(examples) == 2
+        assert index.search("apendicitis", "TC", k=1)[0]["label"] == "TC - Abdomen (11:00)"
+
+        assert index.sync(examples[1:]) == 3
+        assert len(index) == 3
+
+
+class TestVisualExampleIndex:
+    """Tests para VisualExampleIndex"""
+
+    @pytest.fixture
+    def vectors(self):
+        return np.random.default_rng(0).normal(size=(500, 32)).astype(np.float32)
+
+    def test_exact_top_k_matches_brute_force(self, vectors):
+        """Test que la búsqueda exacta devuelve los de mayor coseno, en orden"""
+        index = VisualExampleIndex()
+        index.add(vectors, list(range(len(vectors))), ["TC"] * len(vectors))
+        query = vectors[7] + 0.1
+
+        normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        expected = list(np.argsort(-(normed @ (query / np.linalg.norm(query))))[:3])
+        hits = index.search(query, "TC", k=3)
+        assert [i for i, _ in hits] == expected
+        assert hits[0][1] >= hits[1][1] >= hits[2][1]
+
+    def test_modality_filter(self, vectors):
+        """Test que solo devuelve casos de la modalidad (o sin modalidad)"""
+        index = VisualExampleIndex()
+        index.add(vectors[:3], ["tc", "rx", "base"], ["TC", "RX", None])
+
+        assert sorted(p for p, _ in index.search(vectors[0], "RX", k=5)) == ["base", "rx"]
+        assert index.search(vectors[0], "RM", k=5)[0][0] == "base"
+
+    def test_ivf_finds_near_duplicates(self, vectors):
+        """Test que con IVF un caso casi idéntico sigue siendo el primero"""
+        index = VisualExampleIndex(ivf_min=200, n_probe=4)
+        index.add(vectors[:300], list(range(300)), ["TC"] * 300)
+        index.add(vectors[300:], list(range(300, 500)), ["TC"] * 200)
+
+        for i in (3, 250, 450):
+            assert index.search(vectors[i] * 1.01, "TC", k=1)[0][0] == i
+
+    def test_wrong_dimension_is_ignored(self, vectors):
+        """Test que vectores o consultas de otra dimensión no rompen el índice"""
+        index = VisualExampleIndex()
+        index.add(vectors[:2], [0, 1], ["TC", "TC"])
+
+        assert index.add(np.ones((1, 8)), [2], ["TC"]) == 0
+        assert index.search(np.ones(8), "TC") == []
+        assert len(index) == 2
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,131 @@
+"""
+Suite de tests para example_store.py
+Tests para el almacén de ejemplos buenos: inserción concurrente, índice por
+modalidad, migración y compactación del WAL
+"""
+import pytest
+import threading
+import sys
+import os
+import numpy as np
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from example_store import GoodExampleStore, infer_modality_region
+
+
+def _example(label):
+    return {"label": label, "example": {"remove": [], "add_findings": [label]}}
+
+
+class TestGoodExampleStore:
+    """Tests para GoodExampleStore"""
+
+    def test_read_missing_store_does_not_create_file(self, tmp_path):
+        """Test que leer un almacén inexistente no crea la base"""
+        store = GoodExampleStore(tmp_path / "ejemplos.sqlite3")
+
+        assert store.all() == [] and store.count() == 0
+        assert not store.exists()
+
+    def test_append_keeps_order_and_content(self, tmp_path):
+        """Test que los ejemplos se leen en orden de inserción con su contenido"""
+        store = GoodExampleStore(tmp_path / "ejemplos.sqlite3")
+        first = store.append(_example("uno"), "TC", "Cráneo")
+        store.append(_example("dos"))
+
+        rows = store.all()
+        assert [r["label"] for r in rows] == ["uno", "dos"]
+        assert rows[0]["example"]["add_findings"] == ["uno"]
+        assert [r["label"] for r in store.since(first)] == ["dos"]
+
+    def test_concurrent_appends_are_not_lost(self, tmp_path):
+        """Test que aprobaciones simultáneas desde varios hilos no se pisan"""
+        store = GoodExampleStore(tmp_path / "ejemplos.sqlite3")
+        seed = [_example("base1"), _example("base2")]
+
+        def approve(worker):
+            for i in range(25):
+                store.append(_example(f"{worker}-{i}"), seed=seed)
+
+        threads = [threading.Thread(target=approve, args=(w,)) for w in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        labels = [r["label"] for r in store.all()]
+        assert labels[:2] == ["base1", "base2"]
+        assert len(labels) == 2 + 8 * 25
+
+    def test_index_by_modality_and_region(self, tmp_path):
+        """Test que se filtra por modalidad y región"""
+        store = GoodExampleStore(tmp_path / "ejemplos.sqlite3")
+        store.append(_example("a"), "TC", "Cráneo")
+        store.append(_example("b"), "TC", "Tórax")
+        store.append(_example("c"), "RX", "Tórax")
+
+        assert [r["label"] for r in store.by_modality("TC")] == ["a", "b"]
+        assert [r["label"] for r in store.by_modality("TC", "Tórax")] == ["b"]
+
+    def test_migrate_only_into_empty_store(self, tmp_path):
+        """Test que la migración deduce modalidad/región y no duplica datos existentes"""
+        store = GoodExampleStore(tmp_path / "ejemplos.sqlite3")
+
+        assert store.migrate([_example("RM - Rodilla (09:30)"), _example("US abdomen")], ["RM", "US"]) == 2
+        assert [(r["modality"], r["region"]) for r in store.all()] == [("RM", "Rodilla"), ("US", None)]
+        assert store.migrate([_example("otro")]) == 0
+        assert store.count() == 2
+
+    def test_embeddings_roundtrip(self, tmp_path):
+        """Test que el embedding de imagen se guarda (float16) y se lee incremental"""
+        store = GoodExampleStore(tmp_path / "ejemplos.sqlite3")
+        first = store.append(_example("a"), "TC", embedding=np.array([0.6, 0.8], dtype=np.float32))
+        store.append(_example("sin imagen"))
+        store.append(_example("b"), "RX", embedding=np.array([1.0, 0.0], dtype=np.float32))
+
+        ids, modalities, matrix = store.embeddings()
+        assert modalities == ["TC", "RX"] and matrix.shape == (2, 2)
+        assert np.allclose(matrix[0], [0.6, 0.8], atol=1e-3)
+        assert store.embeddings(first)[0] == ids[1:]
+
+    def test_old_store_gets_embedding_column(self, tmp_path):
+        """Test que una base sin la columna embedding se actualiza al abrirla"""
+        import sqlite3
+        path = tmp_path / "ejemplos.sqlite3"
+        conn = sqlite3.connect(str(path))
+        conn.execute("CREATE TABLE examples (id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, "
+                     "label TEXT NOT NULL, modality TEXT, region TEXT, example TEXT NOT NULL)")
+        conn.close()
+
+        store = GoodExampleStore(path)
+        store.append(_example("a"), embedding=np.ones(4))
+        assert store.embeddings()[2].shape == (1, 4)
+
+    def test_periodic_compaction_truncates_wal(self, tmp_path):
+        """Test que cada compact_every inserciones el WAL se vuelca y se trunca"""
+        path = tmp_path / "ejemplos.sqlite3"
+        store = GoodExampleStore(path, compact_every=5)
+        for i in range(5):
+            store.append(_example(str(i)))
+
+        assert os.path.getsize(f"{path}-wal") == 0
+        assert store.count() == 5
+
+
+class TestInferModalityRegion:
+    """Tests para deducir modalidad y región de la etiqueta"""
+
+    def test_ui_label(self):
+        """Test que reconoce la etiqueta que genera la UI al aprobar"""
+        assert infer_modality_region("TC - Cráneo simple (14:05)") == ("TC", "Cráneo simple")
+
+    def test_free_label(self):
+        """Test que con etiqueta libre solo reconoce modalidades conocidas"""
+        assert infer_modality_region("RX tórax con consolidación", ["RX", "TC"]) == ("RX", None)
+        assert infer_modality_region("Hematoma", ["RX", "TC"]) == (None, None)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,278 @@
+"""
+Suite de tests para json_constraint.py
+Tests para el autómata del esquema JSON y el logits processor restringido
+"""
+import pytest
+import json
+import torch
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_constraint import (
+    DEAD,
+    build_edit_schema_dfa,
+    INDEX_FORMAT_BUILDERS,
+    template_line_builders,
+    warm_template_index,
+    SchemaTokenIndex,
+    SchemaConstrainedLogitsProcessor,
+    get_schema_index,
+)
+
+VALID_JSON = (
+    '{"remove":["Sin hallazgos"],"replace":[{"from":"a","to":"b"}],'
+    '"add_findings":["Hematoma de 12 mm"],"lesiometro_missing":[],'
+    '"confidence_scores":{"Hematoma":0.95},'
+    '"conclusion":{"positives":["x"],"impression":[],"ddx":["dx1","dx2"],"recommendations":[]}}'
+)
+
+VOCAB = [
+    "", '{"remove":', '["', '"]', '"],', '[', ']', '],', ',"', '","', "Sin", " hallazgos",
+    '"replace":', '[{"from":"', '","to":"', '"}]', '"add_findings":', "Hematoma", " de", " 12", " mm",
+    '"lesiometro_missing":', '"confidence_scores":', '{"', '":', "0", ".", "95", "}", '"conclusion":',
+    '{"positives":', '"impression":', '"ddx":', '"recommendations":', "x", "dx", "1", "2", "}}", "a", "b",
+]
+# Caracteres sueltos (como en un tokenizer real) para que ningún prefijo quede sin continuación
+VOCAB += sorted(set(VALID_JSON) - set(VOCAB))
+EOS = 0
+
+
+class FakeTokenizer:
+    """Tokenizer mínimo sobre VOCAB (id 0 = EOS especial)"""
+
+    name_or_path = "fake-tokenizer"
+    all_special_ids = [EOS]
+
+    def __len__(self):
+        return len(VOCAB)
+
+    def encode(self, text, add_special_tokens=False):
+        return [VOCAB.index("a")] if text == "a" else []
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(VOCAB[i] for i in ids if not (skip_special_tokens and i == EOS))
+
+    def batch_decode(self, batch, skip_special_tokens=True):
+        return [self.decode(ids, skip_special_tokens) for ids in batch]
+
+
+class TestSchemaDFA:
+    """Tests para el autómata de caracteres"""
+
+    def test_accepts_valid_compact_json(self):
+        """Test que acepta un JSON válido del esquema"""
+        dfa = build_edit_schema_dfa()
+        sid = dfa.walk(dfa.start, VALID_JSON)
+
+        assert sid != DEAD
+        assert dfa.is_accept(sid)
+        json.loads(VALID_JSON)
+
+    def test_rejects_wrong_key_order(self):
+        """Test que rechaza claves fuera de orden"""
+        dfa = build_edit_schema_dfa()
+
+        assert dfa.walk(dfa.start, '{"replace":[]') == DEAD
+
+    def test_rejects_escapes_and_newlines_in_strings(self):
+        """Test que no permite escapes ni saltos de línea dentro de strings"""
+        dfa = build_edit_schema_dfa()
+
+        assert dfa.walk(dfa.start, '{"remove":["a\\n') == DEAD
+        assert dfa.walk(dfa.start, '{"remove":["a\n') == DEAD
+
+    def test_rejects_out_of_range_confidence(self):
+        """Test que los scores de confianza están entre 0 y 1"""
+        dfa = build_edit_schema_dfa()
+        prefix = '{"remove":[],"replace":[],"add_findings":[],"lesiometro_missing":[],"confidence_scores":{"a":'
+
+        assert dfa.walk(dfa.start, prefix + "0.5") != DEAD
+        assert dfa.walk(dfa.start, prefix + "2") == DEAD
+
+    def test_index_format_accepts_line_numbers(self):
+        """Test que en formato index remove y replace.from son números de línea"""
+        dfa = build_edit_schema_dfa(INDEX_FORMAT_BUILDERS)
+        text = VALID_JSON.replace('["Sin hallazgos"]', "[3,12]").replace('"from":"a"', '"from":7')
+        sid = dfa.walk(dfa.start, text)
+
+        assert sid != DEAD
+        assert dfa.is_accept(sid)
+        assert dfa.walk(dfa.start, '{"remove":["Sin') == DEAD
+        assert dfa.walk(dfa.start, '{"remove":[0') == DEAD
+
+    def test_incomplete_json_not_accepted(self):
+        """Test que un prefijo válido no es estado de aceptación"""
+        dfa = build_edit_schema_dfa()
+        sid = dfa.walk(dfa.start, VALID_JSON[:-1])
+
+        assert sid != DEAD
+        assert not dfa.is_accept(sid)
+
+
+class TestSchemaTokenIndex:
+    """Tests para el índice por token"""
+
+    def _index(self):
+        return SchemaTokenIndex(FakeTokenizer().batch_decode([[i] for i in range(len(VOCAB))]), build_edit_schema_dfa(), [EOS])
+
+    def test_start_state_allows_only_object_opening(self):
+        """Test que al inicio solo se permite abrir el objeto"""
+        index = self._index()
+        ids, use_plain = index.allowed(index.dfa.start)
+
+        allowed = [VOCAB[i] for i in ids.tolist()]
+        assert '{"remove":' in allowed
+        assert all('{"remove":'.startswith(tok) for tok in allowed)
+        assert use_plain is False
+
+    def test_string_state_uses_plain_mask(self):
+        """Test que dentro de un string se permiten tokens de texto libre"""
+        index = self._index()
+        sid = index.dfa.walk(index.dfa.start, '{"remove":["')
+        ids, use_plain = index.allowed(sid)
+
+        assert use_plain is True
+        assert bool(index.plain_mask[VOCAB.index(" hallazgos")])
+        assert VOCAB.index('"]') in ids.tolist()
+
+    def test_eos_only_at_accept(self):
+        """Test que EOS solo se permite con el JSON completo"""
+        index = self._index()
+        done = index.dfa.walk(index.dfa.start, VALID_JSON)
+
+        assert EOS in index.allowed(done)[0].tolist()
+        assert index.advance(index.dfa.start, EOS) == DEAD
+
+    def test_precompile_visits_reachable_states(self):
+        """Test que la precompilación recorre estados alcanzables"""
+        index = self._index()
+
+        assert index.precompile() > 10
+
+    def test_get_schema_index_cached_per_tokenizer(self):
+        """Test que el índice se compila una sola vez por tokenizer"""
+        tok = FakeTokenizer()
+
+        assert get_schema_index(tok, [EOS]) is get_schema_index(tok, [EOS])
+        assert get_schema_index(tok, [EOS], edit_format="index") is not get_schema_index(tok, [EOS])
+
+
+TEMPLATE = "HALLAZGOS:\n  Sin hallazgos  \n\nHematoma de 12 mm\nCon \"comillas\""
+
+
+class TestTemplateLineConstraint:
+    """Tests para la restricción de remove/replace.from a líneas de la plantilla"""
+
+    def test_accepts_only_template_lines(self):
+        """Test que remove solo acepta líneas completas de la plantilla"""
+        dfa = build_edit_schema_dfa(template_line_builders(TEMPLATE))
+
+        assert dfa.is_accept(dfa.walk(dfa.start, VALID_JSON.replace('"from":"a"', '"from":"Hematoma de 12 mm"')))
+        assert dfa.walk(dfa.start, '{"remove":["Sin hall"') == DEAD
+        assert dfa.walk(dfa.start, '{"remove":["Otra') == DEAD
+        # Líneas que necesitarían escapes JSON no son seleccionables
+        assert dfa.walk(dfa.start, '{"remove":["Con ') == DEAD
+
+    def test_index_format_accepts_existing_line_numbers(self):
+        """Test que en formato index solo se aceptan números de líneas no vacías"""
+        dfa = build_edit_schema_dfa(template_line_builders(TEMPLATE, "index"))
+
+        assert dfa.walk(dfa.start, '{"remove":[2,4]') != DEAD
+        assert dfa.walk(dfa.start, '{"remove":[3') == DEAD
+        assert dfa.walk(dfa.start, '{"remove":[6') == DEAD
+
+    def test_template_index_cached_by_content(self):
+        """Test que el índice por plantilla se cachea por contenido con LRU"""
+        tok = FakeTokenizer()
+        first = get_schema_index(tok, [EOS], template_text=TEMPLATE)
+
+        assert get_schema_index(tok, [EOS], template_text=TEMPLATE) is first
+        assert first is not get_schema_index(tok, [EOS])
+        assert first.plain_mask is get_schema_index(tok, [EOS]).plain_mask
+        get_schema_index(tok, [EOS], template_text="otra plantilla", template_cache_size=1)
+        assert get_schema_index(tok, [EOS], template_text=TEMPLATE) is not first
+
+    def test_greedy_decode_only_edits_template_lines(self):
+        """Test que con logits aleatorios remove/replace.from son líneas de la plantilla"""
+        index = get_schema_index(FakeTokenizer(), [EOS], template_text=TEMPLATE)
+        generator = torch.Generator().manual_seed(1)
+        ids = torch.zeros(1, 0, dtype=torch.long)
+        proc = SchemaConstrainedLogitsProcessor(index, 0)
+        bias = torch.tensor([2.0 if any(c in tok for c in '"]}') else 0.0 for tok in VOCAB] + [0.0] * 5)
+
+        for _ in range(3000):
+            token = int(proc(ids, torch.randn(1, len(VOCAB) + 5, generator=generator) + bias).argmax(-1))
+            if token == EOS:
+                break
+            ids = torch.cat([ids, torch.tensor([[token]])], dim=1)
+
+        data = json.loads(FakeTokenizer().decode(ids[0].tolist()))
+        lines = {"HALLAZGOS:", "Sin hallazgos", "Hematoma de 12 mm"}
+        assert set(data["remove"]) <= lines
+        assert {r["from"] for r in data["replace"]} <= lines
+
+    def test_warm_template_index_memoizes_line_paths(self):
+        """Test que el precalentamiento recorre remove/replace.from de cada línea"""
+        class GreedyTokenizer(FakeTokenizer):
+            def encode(self, text, add_special_tokens=False):
+                ids = []
+                while text:
+                    tok = max((t for t in VOCAB[1:] if text.startswith(t)), key=len)
+                    ids.append(VOCAB.index(tok))
+                    text = text[len(tok):]
+                return ids
+
+        tok = GreedyTokenizer()
+        lines = "Sin hallazgos\nHematoma de 12 mm"
+        index = get_schema_index(tok, [EOS], template_text=lines)
+        n_states = warm_template_index(index, tok, lines)
+
+        assert n_states > 0
+        sid = index.dfa.walk(index.dfa.start, '{"remove":["Sin hallazgos"')
+        assert sid != DEAD and sid in index._allowed
+        sid = index.dfa.walk(index.dfa.start, '{"remove":[],"replace":[{"from":"Hematoma de 12 mm"')
+        assert sid != DEAD and sid in index._allowed
+        assert warm_template_index(index, tok, lines) == 0
+
+
+class TestSchemaConstrainedLogitsProcessor:
+    """Tests para el logits processor"""
+
+    def test_greedy_decode_produces_valid_json(self):
+        """Test que con logits aleatorios la salida es JSON válido del esquema"""
+        index = get_schema_index(FakeTokenizer(), [EOS])
+        generator = torch.Generator().manual_seed(0)
+        prompt = torch.tensor([[VOCAB.index("a")] * 3])
+        ids = prompt
+        proc = SchemaConstrainedLogitsProcessor(index, prompt.shape[1])
+        # Sesgo hacia cierres para que los strings terminen en pocos pasos
+        bias = torch.tensor([2.0 if any(c in tok for c in '"]}') else 0.0 for tok in VOCAB] + [0.0] * 5)
+
+        for _ in range(2000):
+            scores = proc(ids, torch.randn(1, len(VOCAB) + 5, generator=generator) + bias)
+            token = int(scores.argmax(-1))
+            if token == EOS:
+                break
+            ids = torch.cat([ids, torch.tensor([[token]])], dim=1)
+
+        text = FakeTokenizer().decode(ids[0, prompt.shape[1]:].tolist())
+        data = json.loads(text)
+        assert list(data.keys()) == ["remove", "replace", "add_findings", "lesiometro_missing", "confidence_scores", "conclusion"]
+        assert proc.is_complete
+        assert len(proc.step_times) > 0
+
+    def test_masks_extra_model_vocab(self):
+        """Test que los ids fuera del tokenizer quedan bloqueados"""
+        index = get_schema_index(FakeTokenizer(), [EOS])
+        proc = SchemaConstrainedLogitsProcessor(index, 0)
+
+        scores = proc(torch.zeros(1, 0, dtype=torch.long), torch.zeros(1, len(VOCAB) + 5))
+
+        assert torch.isinf(scores[0, len(VOCAB):]).all()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
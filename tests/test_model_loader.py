@@ -105,5 +105,158 @@ class TestErrorHandling:
             load_model()
 
 
+
+class TestWeightSnapshot:
+    """Tests para el snapshot local de pesos"""
+
+    def _tiny_model(self):
+        from transformers import Gemma3Config, Gemma3ForConditionalGeneration
+        cfg = Gemma3Config(
+            text_config=dict(vocab_size=300, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                             num_attention_heads=2, num_key_value_heads=1, head_dim=32),
+            vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2,
+                               image_size=32, patch_size=8),
+            mm_tokens_per_image=4, image_token_index=299, boi_token_index=297, eoi_token_index=298,
+        )
+        return Gemma3ForConditionalGeneration(cfg).to(torch.bfloat16).eval()
+
+    def test_write_and_reload_snapshot(self, tmp_path):
+        """Test que el snapshot se recarga en el mismo dtype y con los mismos pesos"""
+        import model_loader
+        from transformers import AutoModelForImageTextToText
+        model = self._tiny_model()
+
+        with patch.object(model_loader, "WEIGHT_SNAPSHOT_DIR", tmp_path):
+            path = model_loader.write_snapshot(model, MagicMock(), torch.bfloat16)
+            assert model_loader.is_snapshot_complete(path)
+
+        reloaded = AutoModelForImageTextToText.from_pretrained(path, dtype=torch.bfloat16, local_files_only=True)
+        assert reloaded.dtype == torch.bfloat16
+        for (name, a), (_, b) in zip(model.state_dict().items(), reloaded.state_dict().items()):
+            assert torch.equal(a, b), name
+
+    def test_failed_write_leaves_no_snapshot(self, tmp_path):
+        """Test que un fallo al guardar no deja un snapshot a medias"""
+        import model_loader
+
+        with patch.object(model_loader, "WEIGHT_SNAPSHOT_DIR", tmp_path):
+            with pytest.raises(RuntimeError):
+                model_loader.write_snapshot(MagicMock(), MagicMock(), torch.float32)
+            assert not model_loader.is_snapshot_complete(model_loader.snapshot_dir(torch.float32))
+        assert list(tmp_path.iterdir()) == []
+
+    def test_quantized_load_and_snapshot(self, tmp_path):
+        """Test que int8 se carga capa a capa desde el checkpoint y el snapshot guarda las capas ya cuantizadas"""
+        import model_loader
+        from quantization import Int8DynamicLinear
+        model = self._tiny_model()
+        model.save_pretrained(tmp_path / "hub")
+        ids = torch.tensor([[2, 10, 11, 297] + [299] * 4 + [298, 12, 13, 14]])
+        inputs = {"input_ids": ids, "attention_mask": torch.ones_like(ids), "pixel_values": torch.randn(1, 3, 32, 32)}
+
+        with patch.object(model_loader, "WEIGHT_SNAPSHOT_DIR", tmp_path / "snapshots"):
+            quantized = model_loader.load_quantized_model(str(tmp_path / "hub"), {"local_files_only": True}, "int8_dynamic", torch.float32)
+            path = model_loader.write_snapshot(quantized, MagicMock(), torch.float32, model_loader.quant_label("int8_dynamic"))
+            reloaded = model_loader.load_quantized_model(str(path), {"local_files_only": True}, "int8_dynamic", torch.float32)
+
+        assert path.name.endswith("float32-int8_dynamic")
+        assert isinstance(reloaded.model.language_model.layers[0].mlp.up_proj, Int8DynamicLinear)
+        assert reloaded.lm_head.weight.dtype == torch.float32
+        with torch.no_grad():
+            assert torch.equal(quantized(**inputs).logits, reloaded(**inputs).logits)
+
+    def test_quantized_snapshot_is_not_quantized_again(self, tmp_path):
+        """Test que desde un snapshot cuantizado se cargan los buffers sin cuantizar ninguna capa de nuevo"""
+        import model_loader
+        from quantization import Int8DynamicLinear
+        model = self._tiny_model()
+        model.save_pretrained(tmp_path / "hub")
+        infos = []
+        load = model_loader.load_quantized_weights
+
+        with patch.object(model_loader, "WEIGHT_SNAPSHOT_DIR", tmp_path / "snapshots"):
+            quantized = model_loader.load_quantized_model(str(tmp_path / "hub"), {"local_files_only": True}, "int8_dynamic", torch.float32)
+            path = model_loader.write_snapshot(quantized, MagicMock(), torch.float32, model_loader.quant_label("int8_dynamic"))
+            with patch("model_loader.load_quantized_weights", side_effect=lambda *a, **kw: infos.append((kw, load(*a, **kw))) or infos[-1][1]), \
+                 patch.object(Int8DynamicLinear, "__init__", side_effect=AssertionError("cuantizada de nuevo")):
+                model_loader.load_quantized_model(str(path), {"local_files_only": True}, "int8_dynamic", torch.float32)
+            with pytest.raises(RuntimeError, match="cuantizado como"):
+                model_loader.load_quantized_model(str(path), {"local_files_only": True}, "int4_weight_only", torch.float32)
+
+        kwargs, info = infos[0]
+        assert kwargs["requantize"] is False
+        assert info["prequantized"] == info["layers"] > 0
+
+    @patch('model_loader.AutoModelForImageTextToText.from_pretrained')
+    @patch('model_loader.AutoProcessor.from_pretrained')
+    def test_load_model_prefers_complete_snapshot(self, mock_processor, mock_model, tmp_path):
+        """Test que con snapshot completo se carga localmente sin Hub"""
+        import model_loader
+        mock_processor.return_value = MagicMock()
+        mock_model.return_value = MagicMock()
+
+        with patch.object(model_loader, "WEIGHT_SNAPSHOT_DIR", tmp_path), \
+             patch('model_loader.is_snapshot_complete', return_value=True), \
+             patch('model_loader.torch.cuda.is_available', return_value=False):
+            load_model()
+            expected = str(model_loader.snapshot_dir(model_loader.MODEL_INFO["dtype"]))
+
+        assert mock_model.call_args.args[0] == expected
+        assert mock_model.call_args.kwargs["local_files_only"] is True
+        assert mock_processor.call_args.args[0] == expected
+        assert model_loader.MODEL_INFO["source"] == "snapshot"
+        assert model_loader.MODEL_INFO["load_seconds"] is not None
+
+
+class TestCpuDtypeSelection:
+    """Tests para la detección de bf16 en CPU"""
+
+    NATIVE = {"avx512_bf16": True, "amx": False, "capability": "AVX512", "bf16_native": True}
+    EMULATED = {"avx512_bf16": False, "amx": False, "capability": "AVX2", "bf16_native": False}
+
+    def test_detect_cpu_features_keys(self):
+        """Test que la detección devuelve las capacidades esperadas"""
+        from model_loader import detect_cpu_features
+        features = detect_cpu_features()
+
+        assert {"avx2", "avx512", "avx512_bf16", "amx", "capability", "bf16_native"} <= set(features)
+        assert features["bf16_native"] == (features["avx512_bf16"] or features["amx"])
+
+    def test_auto_picks_bf16_only_when_native(self):
+        """Test que auto elige bf16 solo con soporte nativo"""
+        from model_loader import select_cpu_dtype
+
+        assert select_cpu_dtype("auto", self.NATIVE)[0] == torch.bfloat16
+        assert select_cpu_dtype("auto", self.EMULATED)[0] == torch.float32
+
+    def test_explicit_dtypes(self):
+        """Test que bf16 forzado se respeta, fp16 cae a fp32 y los modos cuantizados cargan fp32"""
+        from model_loader import select_cpu_dtype
+
+        dtype, reason = select_cpu_dtype("bf16", self.EMULATED)
+        assert dtype == torch.bfloat16 and "emulado" in reason
+        assert select_cpu_dtype("float16", self.NATIVE)[0] == torch.float32
+        assert select_cpu_dtype("int8", self.NATIVE)[0] == torch.float32
+
+    @patch('model_loader.AutoModelForImageTextToText.from_pretrained')
+    @patch('model_loader.AutoProcessor.from_pretrained')
+    def test_decision_recorded_in_model_info(self, mock_processor, mock_model):
+        """Test que MODEL_INFO registra dtype, motivo y capacidades de la CPU"""
+        import model_loader
+        mock_processor.return_value = MagicMock()
+        mock_model.return_value = MagicMock()
+
+        with patch.object(model_loader, "CPU_DTYPE", "auto"), \
+             patch.object(model_loader, "WEIGHT_SNAPSHOT_ENABLED", False), \
+             patch('model_loader.detect_cpu_features', return_value=self.NATIVE), \
+             patch('model_loader.torch.cuda.is_available', return_value=False):
+            load_model()
+
+        assert mock_model.call_args.kwargs["dtype"] == torch.bfloat16
+        assert model_loader.MODEL_INFO["dtype"] == torch.bfloat16
+        assert model_loader.MODEL_INFO["dtype_reason"].startswith("auto")
+        assert model_loader.MODEL_INFO["cpu_features"] == self.NATIVE
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
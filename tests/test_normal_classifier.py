@@ -0,0 +1,201 @@
+"""
+Suite de tests para normal_classifier.py
+Tests para el clasificador de estudios normales y su registro de resultados
+"""
+import pytest
+import threading
+import numpy as np
+import torch
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from normal_classifier import NormalFastPath, NormalStudyClassifier, edits_are_normal, pool_image_features
+
+EMPTY_EDITS = {
+    "remove": [], "replace": [], "add_findings": [], "lesiometro_missing": ["contraste"], "confidence_scores": {},
+    "conclusion": {"positives": [], "impression": [], "ddx": [], "recommendations": ["correlación clínica"]},
+}
+TEMPLATE = "HALLAZGOS:\nSin alteraciones.\nCONCLUSIÓN:"
+
+
+def _clusters(n, dim=32, seed=0):
+    """Embeddings normalizados de dos grupos separables (1 = normal)"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(2, dim))
+    y = np.arange(n) % 2
+    X = centers[y] + 0.3 * rng.normal(size=(n, dim))
+    return (X / np.linalg.norm(X, axis=1, keepdims=True)).astype(np.float32), y
+
+
+class TestEmbeddingAndLabels:
+    """Tests para el pooling del embedding y la etiqueta de las ediciones"""
+
+    def test_pool_image_features_is_unit_mean(self):
+        """Test que el pooling promedia los tokens de imagen y normaliza"""
+        features = torch.randn(1, 8, 16)
+        pooled = pool_image_features(features)
+
+        assert pooled.shape == (16,)
+        assert np.isclose(np.linalg.norm(pooled), 1.0, atol=1e-5)
+        expected = features[0].mean(0).numpy()
+        assert np.allclose(pooled, expected / np.linalg.norm(expected), atol=1e-5)
+
+    def test_edits_are_normal(self):
+        """Test que solo las ediciones sin cambios ni positivos cuentan como normales"""
+        assert edits_are_normal(EMPTY_EDITS)
+        assert not edits_are_normal(dict(EMPTY_EDITS, add_findings=["Hematoma"]))
+        assert not edits_are_normal(dict(EMPTY_EDITS, conclusion={"positives": ["Hematoma"]}))
+
+
+class TestNormalStudyClassifier:
+    """Tests para la regresión logística"""
+
+    def test_separates_clusters(self):
+        """Test que separa dos grupos de embeddings"""
+        X, y = _clusters(60)
+        clf = NormalStudyClassifier().fit(X, y)
+        X_test, y_test = _clusters(20, seed=0)
+
+        preds = np.array([clf.predict_proba(x) >= 0.5 for x in X_test])
+        assert (preds == y_test.astype(bool)).mean() >= 0.9
+
+    def test_untrained_raises(self):
+        """Test que predecir sin entrenar lanza error"""
+        with pytest.raises(RuntimeError):
+            NormalStudyClassifier().predict_proba(np.zeros(4))
+
+
+class TestNormalFastPath:
+    """Tests para el registro de valoraciones y el reentrenamiento"""
+
+    def test_untrained_until_enough_samples(self, tmp_path):
+        """Test que sin muestras suficientes no hay predicción"""
+        fast_path = NormalFastPath(tmp_path / "samples.jsonl", min_samples=10)
+
+        assert fast_path.predict(np.ones(32, dtype=np.float32)) is None
+        assert not fast_path.is_normal(None)
+
+    def test_outcomes_train_classifier(self, tmp_path):
+        """Test que las valoraciones etiquetan muestras y activan el clasificador"""
+        fast_path = NormalFastPath(tmp_path / "samples.jsonl", threshold=0.8, min_samples=20, min_per_class=5)
+        X, y = _clusters(24)
+        for i, (x, label) in enumerate(zip(X, y)):
+            report = f"Informe {i}"
+            fast_path.remember(report, x, "TC.json", TEMPLATE, bool(label), fast_path=False)
+            assert fast_path.record_outcome(report, "5") == bool(label)
+        fast_path.wait_for_retrain()
+
+        assert fast_path.stats()["trained"]
+        assert fast_path.stats()["samples"] == 24
+        normal = X[y == 1][0]
+        assert fast_path.is_normal(fast_path.predict(normal))
+        stats = fast_path.stats()
+        assert stats["predictions"] == 1
+        assert stats["fast_path_rate"] == 1.0
+        assert stats["mean_latency_ms"] >= 0.0
+
+    def test_first_prediction_loads_in_background(self, tmp_path):
+        """Test que la primera predicción no entrena en la petición: None hasta que el modelo está listo"""
+        X, y = _clusters(24)
+        trainer = NormalFastPath(tmp_path / "samples.jsonl", min_samples=20, min_per_class=5)
+        for i, (x, label) in enumerate(zip(X, y)):
+            trainer.remember(f"Informe {i}", x, "TC.json", TEMPLATE, bool(label), fast_path=False)
+            trainer.record_outcome(f"Informe {i}", "5")
+        trainer.wait_for_retrain()
+        fast_path = NormalFastPath(tmp_path / "samples.jsonl", min_samples=20, min_per_class=5)
+        threads = []
+        retrain = fast_path.retrain
+        fast_path.retrain = lambda: (threads.append(threading.current_thread().name), retrain())[1]
+
+        assert fast_path.predict(X[y == 1][0]) is None
+        fast_path.wait_for_retrain()
+
+        assert threads == ["normal-classifier-retrain"]
+        assert fast_path.predict(X[y == 1][0]) is not None
+
+    def test_retrains_in_background_every_n_samples(self, tmp_path):
+        """Test que la valoración no reentrena en el handler: solo cada retrain_every muestras y en otro hilo"""
+        fast_path = NormalFastPath(tmp_path / "samples.jsonl", min_samples=100, retrain_every=5)
+        fast_path.predict(np.ones(4, dtype=np.float32))
+        fast_path.wait_for_retrain()
+        threads = []
+        fast_path.retrain = lambda: threads.append(threading.current_thread().name)
+
+        for i in range(12):
+            fast_path.remember(f"Informe {i}", np.ones(4, dtype=np.float32), "TC.json", TEMPLATE, True, fast_path=False)
+            fast_path.record_outcome(f"Informe {i}", "5")
+        fast_path.wait_for_retrain()
+
+        assert threads == ["normal-classifier-retrain"] * 2
+        assert fast_path.stats()["samples"] == 12
+
+    def test_edited_final_version_labels_by_template(self, tmp_path):
+        """Test que una versión final editada es normal solo si queda igual a la plantilla"""
+        fast_path = NormalFastPath(tmp_path / "samples.jsonl")
+        emb = np.ones(4, dtype=np.float32)
+
+        fast_path.remember("borrador A", emb, "TC.json", TEMPLATE, False, fast_path=False)
+        assert fast_path.record_outcome("borrador A", "3", version_final=TEMPLATE + "\n") is True
+        fast_path.remember("borrador B", emb, "TC.json", TEMPLATE, True, fast_path=True)
+        assert fast_path.record_outcome("borrador B", "4", version_final=TEMPLATE + "\nHematoma.") is False
+        assert fast_path.stats()["confirmed_rate"] == 0.0
+
+    def test_rejected_normal_draft_and_unknown_reports(self, tmp_path):
+        """Test que un borrador normal mal valorado es anormal y un informe desconocido se ignora"""
+        fast_path = NormalFastPath(tmp_path / "samples.jsonl")
+        fast_path.remember("borrador", np.ones(4, dtype=np.float32), "TC.json", TEMPLATE, True, fast_path=True)
+
+        assert fast_path.record_outcome("otro informe", "5") is None
+        assert fast_path.record_outcome("borrador", "2") is False
+        X, y = fast_path.load_samples()
+        assert X.shape == (1, 4) and y.tolist() == [0]
+
+    def test_pending_reports_survive_restart(self, tmp_path):
+        """Test que un informe recordado antes de reiniciar se etiqueta al valorarlo después"""
+        emb = np.arange(4, dtype=np.float32)
+        NormalFastPath(tmp_path / "samples.jsonl").remember("borrador", emb, "TC.json", TEMPLATE, True, fast_path=False)
+
+        restarted = NormalFastPath(tmp_path / "samples.jsonl")
+        assert np.allclose(restarted.embedding_for("borrador"), emb)
+        assert restarted.record_outcome("borrador", "5") is True
+        assert NormalFastPath(tmp_path / "samples.jsonl").embedding_for("borrador") is None
+
+    def test_pending_file_is_compacted(self, tmp_path):
+        """Test que el fichero de pendientes no crece sin límite"""
+        fast_path = NormalFastPath(tmp_path / "samples.jsonl", max_pending=4)
+        for i in range(20):
+            fast_path.remember(f"Informe {i}", np.ones(4, dtype=np.float32), "TC.json", TEMPLATE, True, fast_path=False)
+
+        lines = (tmp_path / "normal_pending.jsonl").read_text(encoding="utf-8").splitlines()
+        assert len(lines) <= 8
+        assert NormalFastPath(tmp_path / "samples.jsonl", max_pending=4).embedding_for("Informe 19") is not None
+
+    def test_seed_from_history_once(self, tmp_path):
+        """Test que la siembra etiqueta feedback y ejemplos buenos una sola vez"""
+        import csv
+        import json
+        abnormal = dict(EMPTY_EDITS, add_findings=["Hematoma subdural"])
+        fast_path = NormalFastPath(tmp_path / "samples.jsonl")
+        fast_path.remember("pendiente", np.full(4, 2.0, dtype=np.float32), "TC.json", TEMPLATE, True, fast_path=False)
+        feedback = tmp_path / "feedback.csv"
+        with open(feedback, "w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["timestamp", "template", "modalidad", "region", "indicacion", "output", "rating", "comentario", "version_final"])
+            w.writerow(["1", "TC.json", "TC", "Cráneo", "", "pendiente", "2", "", ""])
+            w.writerow(["2", "TC.json", "TC", "Cráneo", "", f"```json\n{json.dumps(abnormal)}\n```", "5", "", ""])
+            w.writerow(["3", "TC.json", "TC", "Cráneo", "", "sin JSON ni embedding", "5", "", ""])
+        examples = [(abnormal, np.zeros(4, dtype=np.float32)), (EMPTY_EDITS, np.ones(4, dtype=np.float32))]
+
+        assert fast_path.seed_from_history(feedback, examples) == 3
+        X, y = fast_path.load_samples()
+        assert y.tolist() == [0, 0, 1]
+        assert X[0].tolist() == [2.0] * 4
+        assert fast_path.seed_from_history(feedback, examples) == 0
+        assert fast_path.embedding_for("pendiente") is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,113 @@
+"""
+Suite de tests para prefetch.py
+Tests para la preparación anticipada en segundo plano y su cancelación
+"""
+import pytest
+import threading
+import sys
+import os
+from PIL import Image
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefetch import SpeculativePrefetcher, image_content_key
+
+
+def _blocking_job(started, release, result):
+    """Job que espera a release y comprueba la cancelación antes de terminar"""
+    def job(task):
+        started.set()
+        release.wait(5)
+        task.check()
+        return result
+    return job
+
+
+class TestImageContentKey:
+    """Tests para la huella de la imagen subida"""
+
+    def test_same_pixels_same_key(self):
+        """Test que dos imágenes con los mismos píxeles comparten clave"""
+        a = Image.new("RGB", (8, 8), (10, 20, 30))
+        b = Image.new("RGB", (8, 8), (10, 20, 30))
+
+        assert image_content_key(a) == image_content_key(b)
+        assert image_content_key(a) != image_content_key(Image.new("RGB", (8, 8), (10, 20, 31)))
+        assert image_content_key(a) != image_content_key(a.convert("L"))
+
+
+class TestSpeculativePrefetcher:
+    """Tests para los huecos por sesión, la recogida y la cancelación"""
+
+    def test_take_returns_result_for_matching_key(self):
+        """Test que take devuelve el resultado solo para la misma entrada"""
+        prefetcher = SpeculativePrefetcher(max_workers=1)
+        prefetcher.submit("s1", "image", "k1", lambda task: {"valor": 1})
+
+        assert prefetcher.take("image", "k1") == {"valor": 1}
+        assert prefetcher.take("image", "k2") is None
+        assert prefetcher.take("template", "k1") is None
+        assert prefetcher.stats()["hits"] == 1
+
+    def test_take_waits_for_running_job(self):
+        """Test que take espera al trabajo en curso en lugar de repetirlo"""
+        prefetcher = SpeculativePrefetcher(max_workers=1)
+        started, release = threading.Event(), threading.Event()
+        prefetcher.submit("s1", "image", "k1", _blocking_job(started, release, "listo"))
+        started.wait(5)
+        threading.Timer(0.05, release.set).start()
+
+        assert prefetcher.take("image", "k1") == "listo"
+
+    def test_same_key_reuses_task(self):
+        """Test que repetir el evento con la misma entrada no relanza el trabajo"""
+        prefetcher = SpeculativePrefetcher(max_workers=1)
+        first = prefetcher.submit("s1", "image", "k1", lambda task: 1)
+
+        assert prefetcher.submit("s1", "image", "k1", lambda task: 2) is first
+        assert prefetcher.stats()["submitted"] == 1
+
+    def test_new_input_cancels_stale_work(self):
+        """Test que una entrada nueva en el mismo hueco cancela el trabajo anterior"""
+        prefetcher = SpeculativePrefetcher(max_workers=1)
+        started, release = threading.Event(), threading.Event()
+        stale = prefetcher.submit("s1", "image", "vieja", _blocking_job(started, release, "vieja"))
+        started.wait(5)
+        prefetcher.submit("s1", "image", "nueva", lambda task: "nueva")
+        release.set()
+
+        assert stale.cancelled
+        assert prefetcher.take("image", "vieja") is None
+        assert prefetcher.take("image", "nueva") == "nueva"
+        assert prefetcher.stats()["cancelled"] == 1
+
+    def test_sessions_do_not_cancel_each_other(self):
+        """Test que cada sesión tiene su propio hueco"""
+        prefetcher = SpeculativePrefetcher(max_workers=2)
+        prefetcher.submit("s1", "image", "k1", lambda task: "uno")
+        prefetcher.submit("s2", "image", "k2", lambda task: "dos")
+
+        assert prefetcher.take("image", "k1") == "uno"
+        assert prefetcher.take("image", "k2") == "dos"
+
+    def test_cancel_and_failure_return_none(self):
+        """Test que un hueco cancelado o un trabajo fallido no entregan resultado"""
+        prefetcher = SpeculativePrefetcher(max_workers=1, max_sessions=1)
+        prefetcher.submit("s1", "image", "k1", lambda task: 1)
+        prefetcher.cancel("s1", "image")
+        assert prefetcher.take("image", "k1") is None
+
+        def failing(task):
+            raise RuntimeError("fallo")
+
+        prefetcher.submit("s1", "template", "t", failing)
+        assert prefetcher.take("template", "t") is None
+        # max_sessions=1: el hueco más antiguo se descarta
+        prefetcher.submit("s2", "template", "t2", lambda task: 2)
+        assert prefetcher.take("template", "t") is None
+        assert prefetcher.take("template", "t2") == 2
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,142 @@
+"""
+Suite de tests para prefix_cache.py
+Tests para la caché LRU de prefijo KV del prompt estático
+"""
+import pytest
+import torch
+from unittest.mock import MagicMock
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefix_cache import (
+    PrefixKVCache,
+    make_prefix_key,
+    kv_cache_nbytes,
+    find_prefix_length,
+    prepare_prefix_cached_inputs,
+)
+
+
+def _fake_kv(seq_len: int, layers: int = 2):
+    """past_key_values legacy: tupla de (key, value) por capa"""
+    return tuple(
+        (torch.zeros(1, 1, seq_len, 4), torch.zeros(1, 1, seq_len, 4))
+        for _ in range(layers)
+    )
+
+
+class TestPrefixKey:
+    """Tests para claves de caché"""
+
+    def test_make_prefix_key_depends_on_modalidad_and_text(self):
+        """Test que la clave cambia con modalidad y con el prefijo (few-shot)"""
+        assert make_prefix_key("TC", "abc") == make_prefix_key("TC", "abc")
+        assert make_prefix_key("TC", "abc") != make_prefix_key("RX", "abc")
+        assert make_prefix_key("TC", "abc") != make_prefix_key("TC", "abd")
+
+    def test_kv_cache_nbytes_legacy_format(self):
+        """Test que calcula bytes de un past_key_values legacy"""
+        kv = _fake_kv(10, layers=2)
+        # 2 capas * (key + value) * 10 tokens * 4 dims * 4 bytes
+        assert kv_cache_nbytes(kv) == 2 * 2 * 10 * 4 * 4
+
+
+class TestFindPrefixLength:
+    """Tests para la detección del límite prefijo/imagen"""
+
+    def test_prefix_ends_before_image_tokens(self):
+        """Test que el prefijo termina antes del primer token de imagen menos el margen"""
+        ids = torch.tensor([[1, 2, 3, 4, 5, 6, 7, 99, 99, 8]])
+        assert find_prefix_length(ids, 99, margin=2) == 5
+
+    def test_no_image_token_returns_zero(self):
+        """Test que sin token de imagen no hay prefijo reutilizable"""
+        ids = torch.tensor([[1, 2, 3]])
+        assert find_prefix_length(ids, 99) == 0
+        assert find_prefix_length(ids, None) == 0
+
+
+class TestPrefixKVCache:
+    """Tests para la caché LRU"""
+
+    def test_lookup_miss_then_hit(self):
+        """Test que cuenta fallos y aciertos"""
+        cache = PrefixKVCache(max_bytes=10 ** 6)
+        ids = torch.tensor([[1, 2, 3, 4, 5, 6]])
+
+        assert cache.lookup("k", ids) is None
+        cache.store("k", ids[0, :3], _fake_kv(3))
+        hit = cache.lookup("k", ids)
+
+        assert hit is not None
+        assert hit[0] == 3
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+
+    def test_lookup_returns_copy(self):
+        """Test que el cache devuelto es una copia independiente"""
+        cache = PrefixKVCache(max_bytes=10 ** 6)
+        ids = torch.tensor([[1, 2, 3, 4]])
+        cache.store("k", ids[0, :2], _fake_kv(2))
+
+        _, kv = cache.lookup("k", ids)
+        kv[0][0].fill_(1.0)
+        _, kv2 = cache.lookup("k", ids)
+
+        assert float(kv2[0][0].sum()) == 0.0
+
+    def test_lookup_rejects_different_tokens(self):
+        """Test que no reutiliza si los tokens del prefijo no coinciden"""
+        cache = PrefixKVCache(max_bytes=10 ** 6)
+        cache.store("k", torch.tensor([1, 2, 3]), _fake_kv(3))
+
+        assert cache.lookup("k", torch.tensor([[1, 2, 9, 4]])) is None
+
+    def test_lru_eviction_respects_byte_budget(self):
+        """Test que expulsa la entrada menos reciente al superar el presupuesto"""
+        entry_bytes = kv_cache_nbytes(_fake_kv(3))
+        cache = PrefixKVCache(max_bytes=entry_bytes * 2)
+        ids = torch.tensor([[1, 2, 3, 4]])
+
+        cache.store("a", ids[0, :3], _fake_kv(3))
+        cache.store("b", ids[0, :3], _fake_kv(3))
+        cache.lookup("a", ids)  # "a" pasa a ser la más reciente
+        cache.store("c", ids[0, :3], _fake_kv(3))
+
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["evictions"] == 1
+        assert stats["bytes"] <= stats["max_bytes"]
+        assert cache.lookup("b", ids) is None
+        assert cache.lookup("a", ids) is not None
+
+    def test_store_rejects_entry_larger_than_budget(self):
+        """Test que no guarda prefijos que exceden el presupuesto completo"""
+        cache = PrefixKVCache(max_bytes=10)
+
+        assert cache.store("k", torch.tensor([1, 2, 3]), _fake_kv(3)) is False
+        assert cache.stats()["entries"] == 0
+
+
+class TestPrepareCachedInputs:
+    """Tests para el prefill con prefijo reutilizado"""
+
+    def test_returns_none_without_image_tokens(self):
+        """Test que sin bloque de imagen se usa el camino normal"""
+        model = MagicMock()
+        model.config.image_token_id = 99
+        inputs = {
+            "input_ids": torch.tensor([[1, 2, 3]]),
+            "attention_mask": torch.ones(1, 3, dtype=torch.long),
+        }
+
+        assert prepare_prefix_cached_inputs(model, inputs, "k", PrefixKVCache(10 ** 6)) is None
+        model.assert_not_called()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,80 @@
+"""
+Suite de tests para prompt_budget.py
+Tests para el conteo de tokens con caché y el recorte de secciones del prompt
+al presupuesto de prefill
+"""
+import pytest
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_budget import PromptSection, TokenCounter, estimate_tokens, fit_to_budget, render_sections, token_counter_for
+
+
+def _words(text):
+    return len(text.split())
+
+
+class TestTokenCounter:
+    """Tests para TokenCounter"""
+
+    def test_caches_by_text(self):
+        """Test que cada texto se tokeniza una sola vez"""
+        calls = []
+        counter = TokenCounter(lambda text: calls.append(text) or text.split())
+
+        assert counter("a b c") == 3 and counter("a b c") == 3
+        assert calls == ["a b c"]
+
+    def test_estimate_without_tokenizer(self):
+        """Test que sin tokenizer usa la estimación por caracteres"""
+        assert TokenCounter()("x" * 35) == estimate_tokens("x" * 35) == 10
+
+    def test_shared_per_tokenizer(self):
+        """Test que el contador se comparte por tokenizer"""
+        class Tok:
+            def encode(self, text, add_special_tokens=False):
+                return text.split()
+        tok = Tok()
+
+        assert token_counter_for(tok) is token_counter_for(tok)
+        assert token_counter_for(tok)("uno dos") == 2
+
+
+class TestFitToBudget:
+    """Tests para fit_to_budget"""
+
+    @pytest.fixture
+    def sections(self):
+        return [
+            PromptSection("obligatoria", ["w " * 10]),
+            PromptSection("guia", ["titulo", "g1 g1", "g2 g2"], value=3, min_items=1),
+            PromptSection("ejemplos", ["e1 " * 5, "e2 " * 5], "EJEMPLOS:", value=2),
+            PromptSection("parecidos", ["p1 " * 5], "CASOS:", value=1),
+        ]
+
+    def test_no_trim_within_budget(self, sections):
+        """Test que si cabe no se toca nada"""
+        assert fit_to_budget(sections, _words, 1000) == {}
+        assert fit_to_budget(sections, _words, 0) == {}
+
+    def test_trims_lowest_value_first(self, sections):
+        """Test que se recorta primero la sección de menos valor, elemento a elemento"""
+        removed = fit_to_budget(sections, _words, 22)
+
+        assert removed == {"parecidos": 1, "ejemplos": 1}
+        assert sections[2].items == ["e1 " * 5]
+        assert "CASOS:" not in render_sections(sections)
+
+    def test_required_sections_and_min_items_are_kept(self, sections):
+        """Test que las obligatorias y min_items sobreviven aunque no quepa"""
+        removed = fit_to_budget(sections, _words, 1)
+
+        assert removed == {"parecidos": 1, "ejemplos": 2, "guia": 2}
+        assert [s.items for s in sections[:2]] == [["w " * 10], ["titulo"]]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
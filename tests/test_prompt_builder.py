@@ -17,8 +17,18 @@ from prompt_builder import (
     save_good_example,
     get_prompt_by_modalidad,
     format_fewshot_prompt,
-    build_prompt
+    build_prompt,
+    build_prompt_parts,
+    load_approved_outputs,
+    build_lookup_corpus,
+    cached_fewshot_section,
+    get_good_example_store,
+    select_fewshot_examples,
+    select_similar_examples,
+    load_rating_weights,
 )
+from example_index import example_key
+from example_store import GoodExampleStore
 
 
 class TestGoodExamplesManagement:
@@ -32,7 +42,7 @@ class TestGoodExamplesManagement:
         assert len(result) >= 0, "Lista puede estar vacía"
     
     def test_save_good_example_creates_file(self):
-        """Test que save_good_example guarda ejemplo en archivo"""
+        """Test que save_good_example guarda ejemplo en el almacén"""
         example = {
             "label": "Test ejemplo",
             "remove": ["línea test"],
@@ -40,20 +50,178 @@ class TestGoodExamplesManagement:
         }
         
         with tempfile.TemporaryDirectory() as tmpdir:
-            test_file = os.path.join(tmpdir, "test_examples.json")
+            test_db = os.path.join(tmpdir, "test_examples.sqlite3")
             
-            with patch('prompt_builder.GOOD_EXAMPLES_FILE', test_file):
+            with patch('prompt_builder.GOOD_EXAMPLES_DB', test_db), \
+                 patch('prompt_builder.GOOD_EXAMPLES_FILE', os.path.join(tmpdir, "no_existe.json")):
                 # Primera vez crea archivo
                 save_good_example(example)
                 
-                assert os.path.exists(test_file), "Debe crear archivo"
+                assert os.path.exists(test_db), "Debe crear archivo"
                 
-                # Verificar contenido
-                with open(test_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                # Verificar contenido (ejemplos base + el nuevo)
+                data = load_good_examples()
                 
-                assert len(data) > 0, "Debe tener al menos 1 ejemplo"
-                assert any(ex.get('label') == 'Test ejemplo' for ex in data)
+                assert len(data) > 1, "Debe incluir los ejemplos base"
+                assert data[-1]['label'] == 'Test ejemplo'
+                assert data[-1]['example']['add_findings'] == ["hallazgo test"]
+
+    def test_legacy_json_is_migrated(self, tmp_path):
+        """Test que el good_examples.json antiguo se importa una vez y se renombra"""
+        legacy = tmp_path / "good_examples.json"
+        legacy.write_text(json.dumps([
+            {"label": "TC - Cráneo (10:15)", "remove": ["a"]},
+            {"label": "RX tórax", "example": {"remove": []}},
+        ]), encoding="utf-8")
+
+        with patch('prompt_builder.GOOD_EXAMPLES_DB', str(tmp_path / "ejemplos.sqlite3")), \
+             patch('prompt_builder.GOOD_EXAMPLES_FILE', str(legacy)):
+            data = load_good_examples()
+
+        assert [ex["label"] for ex in data] == ["TC - Cráneo (10:15)", "RX tórax"]
+        assert (data[0]["modality"], data[0]["region"]) == ("TC", "Cráneo")
+        assert data[1]["modality"] == "RX"
+        assert not legacy.exists() and (tmp_path / "good_examples.json.migrated").exists()
+
+
+class TestGoodExamplesCache:
+    """Tests para la caché en memoria de ejemplos buenos y de la sección few-shot"""
+
+    @pytest.fixture
+    def examples_file(self, tmp_path):
+        path = tmp_path / "ejemplos.sqlite3"
+        with patch("prompt_builder.GOOD_EXAMPLES_DB", str(path)), \
+             patch("prompt_builder.GOOD_EXAMPLES_FILE", str(tmp_path / "no_existe.json")):
+            store = get_good_example_store()
+            store.append({"label": "Previo", "example": {"remove": ["línea"]}})
+            yield store
+
+    def test_prompt_building_does_not_reread_file(self, examples_file):
+        """Test que tras la primera carga el prompt se construye sin abrir el fichero"""
+        prefix, _ = build_prompt_parts("TC", "Cráneo", "", "", "Plantilla")
+
+        with patch("builtins.open", side_effect=AssertionError("lectura de disco")):
+            assert build_prompt_parts("TC", "Cráneo", "", "", "Plantilla")[0] == prefix
+            assert load_good_examples()[0]["label"] == "Previo"
+
+    def test_external_change_invalidates(self, examples_file):
+        """Test que una escritura de otro proceso (cambia mtime/tamaño de la base) fuerza la recarga"""
+        assert "Previo" in cached_fewshot_section()
+        other = GoodExampleStore(examples_file.path)
+        other.append({"label": "Otro proceso", "example": {"remove": []}})
+        other.close()
+
+        assert load_good_examples()[-1]["label"] == "Otro proceso"
+        assert "Otro proceso" in cached_fewshot_section()
+
+    def test_save_is_visible_immediately(self, examples_file):
+        """Test que guardar un ejemplo actualiza la caché sin esperar al mtime"""
+        cached_fewshot_section()
+
+        save_good_example({"label": "Nuevo", "remove": []})
+
+        assert [ex["label"] for ex in load_good_examples()] == ["Previo", "Nuevo"]
+        assert "Nuevo" in cached_fewshot_section()
+
+    def test_returned_list_is_a_copy(self, examples_file):
+        """Test que modificar la lista devuelta no altera la caché"""
+        load_good_examples().append({"label": "Intruso", "example": {}})
+
+        assert len(load_good_examples()) == 1
+
+
+class TestFewshotRetrieval:
+    """Tests para la selección de ejemplos few-shot por recuperación"""
+
+    @pytest.fixture
+    def store(self, tmp_path):
+        path = tmp_path / "ejemplos.sqlite3"
+        with patch("prompt_builder.GOOD_EXAMPLES_DB", str(path)), \
+             patch("prompt_builder.GOOD_EXAMPLES_FILE", str(tmp_path / "no_existe.json")), \
+             patch("prompt_builder.FEEDBACK_CSV", str(tmp_path / "feedback.csv")):
+            store = get_good_example_store()
+            store.append({"label": "RX - Tórax (10:00)", "example": {"add_findings": ["Consolidación basal derecha"]}}, "RX", "Tórax")
+            store.append({"label": "TC - Cráneo (11:00)", "example": {"add_findings": ["Hematoma subdural"]}}, "TC", "Cráneo")
+            store.append({"label": "TC - Abdomen (12:00)", "example": {"add_findings": ["Apendicitis aguda"]}}, "TC", "Abdomen")
+            yield store
+
+    def test_selects_by_modality_and_region(self, store):
+        """Test que el estudio recibe los ejemplos de su modalidad y región"""
+        assert [ex["label"] for ex in select_fewshot_examples("RX", "Tórax", k=1)] == ["RX - Tórax (10:00)"]
+        assert select_fewshot_examples("TC", "Abdomen", k=2)[0]["label"] == "TC - Abdomen (12:00)"
+
+    def test_regions_share_prefix_key(self, store):
+        """Test de regresión: dos regiones de la misma modalidad comparten el prefijo cacheado; los few-shot van tras la imagen"""
+        from prefix_cache import make_prefix_key
+        prefix_craneo, suffix_craneo = build_prompt_parts("TC", "Cráneo", "", "", "Plantilla")
+        prefix_abdomen, suffix_abdomen = build_prompt_parts("TC", "Abdomen", "", "", "Plantilla")
+
+        assert make_prefix_key("TC", prefix_craneo) == make_prefix_key("TC", prefix_abdomen)
+        assert "Hematoma subdural" in suffix_craneo and "Apendicitis aguda" in suffix_abdomen
+        assert "RX - Tórax" not in suffix_craneo
+
+    def test_new_approval_is_retrieved(self, store):
+        """Test que un ejemplo recién aprobado se indexa y se recupera"""
+        select_fewshot_examples("RX", "Rodilla")
+        save_good_example({"label": "RX - Rodilla (13:00)", "add_findings": ["Derrame articular"]}, "RX", "Rodilla")
+
+        assert select_fewshot_examples("RX", "Rodilla", k=1)[0]["label"] == "RX - Rodilla (13:00)"
+
+    def test_similar_image_case_goes_to_suffix(self, store):
+        """Test que el caso de imagen más parecida va tras la imagen y el prefijo no cambia"""
+        import numpy as np
+        store.append({"label": "TC - Cráneo (14:00)", "example": {"add_findings": ["Hemorragia subaracnoidea"]}},
+                     "TC", "Cráneo", embedding=np.array([1.0, 0.0, 0.0]))
+        store.append({"label": "TC - Cráneo (15:00)", "example": {"add_findings": ["Infarto lacunar"]}},
+                     "TC", "Cráneo", embedding=np.array([0.0, 1.0, 0.0]))
+        for hour in (16, 17):
+            store.append({"label": f"TC - Tórax ({hour}:00)", "example": {"add_findings": ["Derrame"]}}, "TC", "Tórax")
+        plain_prefix, plain_suffix = build_prompt_parts("TC", "Tórax", "", "", "Plantilla")
+
+        prefix, suffix = build_prompt_parts("TC", "Tórax", "", "", "Plantilla", image_embedding=np.array([0.1, 0.9, 0.0]))
+
+        assert prefix == plain_prefix
+        assert "Infarto lacunar" in suffix and "Hemorragia" not in suffix
+        assert suffix.endswith(plain_suffix)
+
+    def test_similar_case_not_repeated(self, store):
+        """Test que un caso parecido que ya está entre los few-shot no se repite"""
+        import numpy as np
+        store.append({"label": "TC - Cráneo (14:00)", "example": {"add_findings": ["Hemorragia"]}},
+                     "TC", "Cráneo", embedding=np.array([1.0, 0.0]))
+
+        assert select_similar_examples(np.array([1.0, 0.1]), "TC")[0]["label"] == "TC - Cráneo (14:00)"
+        assert select_similar_examples(np.array([1.0, 0.1]), "TC", exclude=load_good_examples()) == []
+
+    def test_similar_cases_reuse_fewshot_selection(self, store):
+        """Test que los casos parecidos excluyen los few-shot ya elegidos sin repetir la búsqueda BM25"""
+        import numpy as np
+        import prompt_builder
+        store.append({"label": "TC - Cráneo (14:00)", "example": {"add_findings": ["Hemorragia"]}},
+                     "TC", "Cráneo", embedding=np.array([1.0, 0.0]))
+        calls = []
+        select = prompt_builder.select_fewshot_examples
+
+        with patch("prompt_builder.select_fewshot_examples", side_effect=lambda *a, **kw: calls.append(a) or select(*a, **kw)):
+            _, suffix = build_prompt_parts("TC", "Cráneo", "", "", "Plantilla", image_embedding=np.array([1.0, 0.1]))
+
+        assert len(calls) == 1
+        assert "Hemorragia" in suffix and "CASOS APROBADOS CON IMAGEN PARECIDA" not in suffix
+
+    def test_rating_weights_from_feedback(self, store, tmp_path):
+        """Test que los pesos salen de la valoración media de feedback.csv"""
+        import csv
+        edits = {"add_findings": ["Hematoma subdural"]}
+        with open(tmp_path / "feedback.csv", "w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["timestamp", "template", "modalidad", "region", "indicacion", "output", "rating", "comentario", "version_final"])
+            w.writerow(["1", "t.json", "TC", "Cráneo", "", json.dumps(edits), "5", "", ""])
+            w.writerow(["2", "t.json", "TC", "Cráneo", "", "```json\n" + json.dumps(edits) + "\n```", "3", "", ""])
+            w.writerow(["3", "t.json", "TC", "Cráneo", "", "sin JSON", "1", "", ""])
+
+        weights = load_rating_weights()
+
+        assert weights == {example_key(edits): pytest.approx(0.8)}
 
 
 class TestModalidadPrompts:
@@ -172,6 +340,176 @@ class TestPromptBuilding:
         assert result[:1] != "", "El .strip() NO debe estar presente"
 
 
+class TestPromptParts:
+    """Tests para la división prefijo estático / segmento por petición"""
+
+    def test_build_prompt_puts_image_between_prefix_and_suffix(self):
+        """Test que build_prompt sigue el orden de generate(): prefijo → imagen → dinámico"""
+        prefix, suffix = build_prompt_parts("TC", "Cráneo", "Trauma", "", "Plantilla test")
+
+        result = build_prompt("TC", "Cráneo", "Trauma", "", "Plantilla test", image_token="<image>")
+
+        assert result.startswith(prefix)
+        assert result.endswith(suffix)
+        assert result.index("ESQUEMA JSON") < result.index("<image>") < result.index("PLANTILLA A EDITAR")
+        assert "<image>" not in build_prompt("TC", "Cráneo", "Trauma", "", "Plantilla test", image_token="")
+
+    def test_prefix_independent_of_template_and_context(self):
+        """Test que el prefijo solo depende de modalidad y región (cacheable)"""
+        prefix_a, suffix_a = build_prompt_parts("TC", "Cráneo", "Trauma", "", "Plantilla A")
+        prefix_b, suffix_b = build_prompt_parts("TC", "Cráneo", "Cefalea", "Contraste", "Plantilla B")
+
+        assert prefix_a == prefix_b
+        assert suffix_a != suffix_b
+        assert "Plantilla A" in suffix_a
+        assert "Plantilla A" not in prefix_a
+
+    def test_prefix_contains_static_sections(self):
+        """Test que el prefijo incluye instrucciones y esquema, y los ejemplos van en el sufijo"""
+        prefix, suffix = build_prompt_parts("TC", "Cráneo", "", "", "Plantilla")
+
+        assert "INSTRUCCIONES" in prefix
+        assert "ESQUEMA JSON" in prefix
+        assert "EJEMPLOS" in suffix and "EJEMPLOS" not in prefix
+        assert "CONTEXTO" in suffix
+
+    def test_prefix_changes_with_modalidad(self):
+        """Test que cada modalidad tiene su propio prefijo"""
+        prefix_tc, _ = build_prompt_parts("TC", "Cráneo", "", "", "Plantilla")
+        prefix_rm, _ = build_prompt_parts("RM", "Cráneo", "", "", "Plantilla")
+
+        assert prefix_tc != prefix_rm
+
+
+class TestPromptBudget:
+    """Tests para el prompt compacto y el presupuesto de tokens"""
+
+    def test_compact_prompt_is_shorter_and_has_one_schema(self):
+        """Test que el prompt compacto ocupa menos y no repite el esquema al final"""
+        compact = "".join(build_prompt_parts("TC", "Cráneo", "Trauma", "", "Plantilla", compact=True))
+        legacy = "".join(build_prompt_parts("TC", "Cráneo", "Trauma", "", "Plantilla", compact=False))
+
+        assert len(compact) < 0.85 * len(legacy)
+        assert compact.count("```json\n") == 1
+        assert legacy.count("```json\n") == 2
+
+    def test_compact_json_blocks_are_valid(self):
+        """Test de regresión: todo el JSON del prompt compacto (ejemplos y esquema) es válido"""
+        prefix, suffix = build_prompt_parts("TC", "Cráneo", "Trauma", "", "Plantilla", compact=True)
+        lines = (prefix + suffix).splitlines()
+        blocks = [lines[i + 1] for i, line in enumerate(lines) if line.startswith("EJEMPLO ") or line == "```json"]
+
+        assert len(blocks) >= 2
+        for block in blocks:
+            assert isinstance(json.loads(block), dict)
+
+    def test_budget_trims_optional_sections_keeps_template(self):
+        """Test que con poco presupuesto se quitan ejemplos y guía pero no la plantilla"""
+        template = "HALLAZGOS:\n" + "\n".join(f"Línea {i} normal." for i in range(40))
+        full_prefix, full_suffix = build_prompt_parts("TC", "Cráneo", "", "", template, token_budget=0)
+
+        prefix, suffix = build_prompt_parts("TC", "Cráneo", "", "", template, count_tokens=lambda t: len(t.split()), token_budget=300, prefix_budget=150)
+
+        assert "EJEMPLO 1" in full_suffix and "EJEMPLO 1" not in suffix
+        assert template in suffix
+        assert "DESCRIPTORES CRÍTICOS PARA TC" in prefix and "ESQUEMA JSON" in prefix
+        assert len(prefix) < len(full_prefix)
+
+    def test_budget_disabled_by_default(self):
+        """Test que por defecto no se recorta nada (presupuesto pendiente de medir)"""
+        template = "HALLAZGOS:\n" + "\n".join(f"Línea {i} normal." for i in range(40))
+
+        assert build_prompt_parts("TC", "Cráneo", "", "", template, count_tokens=lambda t: 10 ** 6) == \
+            build_prompt_parts("TC", "Cráneo", "", "", template, token_budget=0)
+
+    def test_long_extras_do_not_change_prefix(self):
+        """Test de regresión: unos extras largos no recortan el prefijo cacheado (misma clave de prefijo)"""
+        from prefix_cache import make_prefix_key
+        template = "HALLAZGOS:\n" + "\n".join(f"Línea {i} normal." for i in range(40))
+        prefix, _ = build_prompt_parts("TC", "Cráneo", "", "", template)
+
+        long_prefix, long_suffix = build_prompt_parts("TC", "Cráneo", "", "nota " * 600, template)
+
+        assert long_prefix == prefix
+        assert make_prefix_key("TC", long_prefix) == make_prefix_key("TC", prefix)
+        assert "nota nota" in long_suffix
+
+
+class TestIndexEditFormat:
+    """Tests para el prompt con la plantilla numerada (formato "index")"""
+
+    def test_index_format_numbers_template_lines(self):
+        """Test que la plantilla va numerada y el esquema pide números de línea"""
+        prefix, suffix = build_prompt_parts("TC", "Cráneo", "", "", "HALLAZGOS:\nNormal.", edit_format="index")
+
+        assert "1| HALLAZGOS:\n2| Normal." in suffix
+        assert '"remove": [12]' in prefix
+        assert '"remove":[12]' in build_prompt_parts("TC", "Cráneo", "", "", "x", edit_format="index", compact=True)[0]
+
+    def test_text_format_keeps_template_verbatim(self):
+        """Test que el formato text no numera la plantilla"""
+        prefix, suffix = build_prompt_parts("TC", "Cráneo", "", "", "HALLAZGOS:\nNormal.", edit_format="text")
+
+        assert "HALLAZGOS:\nNormal." in suffix
+        assert "1| " not in suffix
+
+
+class TestLookupCorpus:
+    """Tests para el corpus de la decodificación por prompt-lookup"""
+
+    @pytest.fixture
+    def feedback_csv(self, tmp_path):
+        """feedback.csv temporal con valoraciones de dos plantillas"""
+        path = tmp_path / "feedback.csv"
+        rows = [
+            ["timestamp", "template", "modalidad", "region", "indicacion", "output", "rating", "comentario", "version_final"],
+            ["1", "TC_craneo.json", "TC", "Cráneo", "", "salida antigua", "5", "", "salida antigua"],
+            ["2", "TC_craneo.json", "TC", "Cráneo", "", "salida mala", "2", "", ""],
+            ["3", "RM_rodilla.json", "RM", "Rodilla", "", "otra plantilla", "5", "", ""],
+            ["4", "TC_craneo.json", "TC", "Cráneo", "", "salida nueva", "4", "", "versión editada"],
+        ]
+        import csv
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            csv.writer(f).writerows(rows)
+        return path
+
+    def test_load_approved_outputs_filters_template_and_rating(self, feedback_csv):
+        """Test que solo devuelve salidas aprobadas de la plantilla, la más reciente primero"""
+        with patch("prompt_builder.FEEDBACK_CSV", str(feedback_csv)):
+            result = load_approved_outputs("TC_craneo.json")
+
+        assert result == ["versión editada", "salida nueva", "salida antigua"]
+
+    def test_load_approved_outputs_cached_until_csv_changes(self, feedback_csv):
+        """Test que el CSV se parsea una vez y se relee al añadir una valoración"""
+        import csv
+        with patch("prompt_builder.FEEDBACK_CSV", str(feedback_csv)):
+            load_approved_outputs("TC_craneo.json")
+            with patch("prompt_builder.csv.DictReader", side_effect=AssertionError("releído")):
+                assert load_approved_outputs("RM_rodilla.json") == ["otra plantilla"]
+            with open(feedback_csv, "a", encoding="utf-8", newline="") as f:
+                csv.writer(f).writerow(["5", "TC_craneo.json", "TC", "Cráneo", "", "salida última", "5", "", ""])
+            result = load_approved_outputs("TC_craneo.json")
+
+        assert result[0] == "salida última"
+
+    def test_load_approved_outputs_missing_file(self, tmp_path):
+        """Test que sin feedback.csv retorna lista vacía"""
+        with patch("prompt_builder.FEEDBACK_CSV", str(tmp_path / "no_existe.csv")):
+            assert load_approved_outputs("TC_craneo.json") == []
+
+    def test_build_lookup_corpus_order(self, feedback_csv):
+        """Test que el corpus ordena aprobadas, ejemplos buenos y líneas de plantilla"""
+        examples = [{"label": "ej", "remove": ["línea x"], "add_findings": []}]
+        with patch("prompt_builder.FEEDBACK_CSV", str(feedback_csv)), \
+             patch("prompt_builder.load_good_examples", return_value=examples):
+            corpus = build_lookup_corpus("TC_craneo.json", "Línea uno.\n\n  Línea dos.  ")
+
+        assert corpus[0] == "versión editada"
+        assert "línea x" in corpus[3]
+        assert corpus[-2:] == ["Línea uno.", "Línea dos."]
+
+
 class TestEdgeCases:
     """Tests para casos límite"""
     
@@ -0,0 +1,166 @@
+"""
+Suite de tests para quantization.py
+Tests para las capas int8 dinámicas / int4 solo-pesos y la cuantización del modelo
+"""
+import pytest
+import torch
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import Gemma3Config, Gemma3ForConditionalGeneration
+from transformers.integrations.accelerate import init_empty_weights
+from quantization import (
+    Int4WeightOnlyLinear,
+    Int8DynamicLinear,
+    int4_supported,
+    load_quantized_weights,
+    parse_quant_mode,
+    quantize_model,
+)
+
+
+@pytest.fixture
+def tiny_model():
+    """Gemma3 diminuto con pesos aleatorios"""
+    cfg = Gemma3Config(
+        text_config=dict(vocab_size=300, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=2, num_key_value_heads=1, head_dim=32, sliding_window=16),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2,
+                           image_size=32, patch_size=8),
+        mm_tokens_per_image=4, image_token_index=299, boi_token_index=297, eoi_token_index=298,
+    )
+    torch.manual_seed(0)
+    return Gemma3ForConditionalGeneration(cfg).eval()
+
+
+def _inputs():
+    ids = torch.tensor([[2, 10, 11, 297] + [299] * 4 + [298, 12, 13, 14]])
+    return {"input_ids": ids, "attention_mask": torch.ones_like(ids), "pixel_values": torch.randn(1, 3, 32, 32)}
+
+
+class TestParseQuantMode:
+    """Tests para los alias de CPU_DTYPE"""
+
+    def test_aliases(self):
+        """Test que int8/int4 se normalizan y los dtypes normales devuelven None"""
+        assert parse_quant_mode("INT8") == "int8_dynamic"
+        assert parse_quant_mode("int4") == "int4_weight_only"
+        assert parse_quant_mode("float32") is None
+        assert parse_quant_mode(None) is None
+
+
+class TestQuantizedLinear:
+    """Tests para las capas cuantizadas"""
+
+    def test_int8_close_to_linear(self):
+        """Test que la salida int8 se aproxima a la de la Linear original"""
+        torch.manual_seed(0)
+        linear = torch.nn.Linear(64, 32)
+        x = torch.randn(2, 5, 64)
+
+        out = Int8DynamicLinear(linear)(x)
+
+        assert out.shape == (2, 5, 32)
+        assert torch.allclose(out, linear(x), atol=0.05)
+
+    @pytest.mark.skipif(not int4_supported(), reason="torch sin kernels int4 de CPU")
+    def test_int4_close_to_linear(self):
+        """Test que la salida int4 se aproxima a la de la Linear original"""
+        torch.manual_seed(0)
+        linear = torch.nn.Linear(64, 32)
+        x = torch.randn(3, 64)
+
+        out = Int4WeightOnlyLinear(linear, group_size=32)(x)
+
+        assert out.dtype == x.dtype
+        assert (out - linear(x)).abs().max() < 0.3
+
+
+class TestQuantizeModel:
+    """Tests para la sustitución de capas en el modelo"""
+
+    def test_language_model_only_by_default(self, tiny_model):
+        """Test que cuantiza el modelo de lenguaje y deja visión y lm_head intactos"""
+        info = quantize_model(tiny_model, "int8")
+
+        assert info["layers"] == 14
+        assert info["bytes_after"] < info["bytes_before"]
+        assert isinstance(tiny_model.lm_head, torch.nn.Linear)
+        assert not any(isinstance(m, Int8DynamicLinear) for m in tiny_model.model.vision_tower.modules())
+
+    def test_include_vision(self, tiny_model):
+        """Test que include_vision cuantiza también la torre de visión"""
+        quantize_model(tiny_model, "int8", include_vision=True)
+
+        assert any(isinstance(m, Int8DynamicLinear) for m in tiny_model.model.vision_tower.modules())
+
+    @pytest.mark.skipif(not int4_supported(), reason="torch sin kernels int4 de CPU")
+    def test_int4_model_generates(self, tiny_model):
+        """Test que el modelo int4 genera con la misma forma de salida"""
+        quantize_model(tiny_model, "int4", group_size=32)
+
+        out = tiny_model.generate(**_inputs(), max_new_tokens=5, do_sample=False)
+
+        assert out.shape == (1, 17)
+
+    def test_unknown_mode_rejected(self, tiny_model):
+        """Test que un modo desconocido lanza ValueError"""
+        with pytest.raises(ValueError):
+            quantize_model(tiny_model, "float16")
+
+
+
+class TestLoadQuantizedWeights:
+    """Tests para la carga capa a capa en un modelo sin pesos"""
+
+    @staticmethod
+    def _empty_like(model):
+        with init_empty_weights():
+            return Gemma3ForConditionalGeneration(model.config).eval()
+
+    def test_matches_quantize_after_load(self, tiny_model):
+        """Test que cuantizar al leer da el mismo modelo que cargar y cuantizar después"""
+        inputs = _inputs()
+        empty = self._empty_like(tiny_model)
+
+        info = load_quantized_weights(empty, tiny_model.state_dict().items(), "int8")
+        empty.tie_weights()
+        quantize_model(tiny_model, "int8")
+
+        assert info["layers"] == 14 and info["prequantized"] == 0
+        assert not any(p.is_meta for p in empty.parameters())
+        with torch.no_grad():
+            assert torch.equal(empty(**inputs).logits, tiny_model(**inputs).logits)
+
+    def test_loads_prequantized_buffers(self, tiny_model):
+        """Test que un checkpoint ya cuantizado se carga sin volver a cuantizar"""
+        inputs = _inputs()
+        quantize_model(tiny_model, "int8")
+        empty = self._empty_like(tiny_model)
+
+        info = load_quantized_weights(empty, tiny_model.state_dict().items(), "int8")
+        empty.tie_weights()
+
+        assert info["prequantized"] == 14
+        with torch.no_grad():
+            assert torch.equal(empty(**inputs).logits, tiny_model(**inputs).logits)
+
+    def test_incomplete_layer_rejected(self, tiny_model):
+        """Test que una capa sin todos sus tensores lanza RuntimeError"""
+        tensors = [(k, v) for k, v in tiny_model.state_dict().items() if not k.endswith("layers.0.mlp.up_proj.weight")]
+
+        with pytest.raises(RuntimeError):
+            load_quantized_weights(self._empty_like(tiny_model), tensors, "int8")
+
+
+    def test_unquantized_layer_rejected_without_requantize(self, tiny_model):
+        """Test que con requantize=False una capa en float (no cuantizada en el snapshot) lanza RuntimeError"""
+        with pytest.raises(RuntimeError, match="sin cuantizar"):
+            load_quantized_weights(self._empty_like(tiny_model), tiny_model.state_dict().items(), "int8", requantize=False)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
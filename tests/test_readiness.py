@@ -0,0 +1,84 @@
+"""
+Suite de tests para readiness.py
+Tests para el estado de disponibilidad y el warm-up en segundo plano
+"""
+import pytest
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from readiness import READINESS_LABELS, ReadinessState, start_background_warmup
+
+
+class TestReadinessState:
+    """Tests para las transiciones de estado"""
+
+    def test_initial_state_idle(self):
+        """Test que el estado inicial es idle y no listo"""
+        state = ReadinessState()
+
+        assert state.status == "idle"
+        assert not state.is_ready
+        assert state.snapshot()["ready"] is False
+
+    def test_invalid_status_rejected(self):
+        """Test que un estado desconocido lanza ValueError"""
+        with pytest.raises(ValueError):
+            ReadinessState().set("cargando")
+
+    def test_timings_recorded_per_phase(self):
+        """Test que se registra la duración de loading y warming_up"""
+        state = ReadinessState()
+        state.set("loading")
+        state.set("warming_up")
+        state.set("ready", "ok")
+
+        snap = state.snapshot()
+        assert snap["status"] == "ready"
+        assert snap["ready"] is True
+        assert set(snap["timings"]) == {"loading", "warming_up"}
+
+    def test_markdown_includes_detail(self):
+        """Test que el texto de la UI incluye el detalle"""
+        state = ReadinessState()
+        state.set("error", "sin memoria")
+
+        assert state.markdown() == f"{READINESS_LABELS['error']} — sin memoria"
+
+
+class TestStartBackgroundWarmup:
+    """Tests para el hilo de carga + warm-up"""
+
+    def test_success_runs_load_then_warmup(self):
+        """Test que carga, calienta y termina en ready"""
+        state = ReadinessState()
+        calls = []
+
+        def load():
+            calls.append(("load", state.status))
+
+        def warmup():
+            calls.append(("warmup", state.status))
+
+        start_background_warmup(load, warmup, state=state).join(timeout=5)
+
+        assert calls == [("load", "loading"), ("warmup", "warming_up")]
+        assert state.is_ready
+
+    def test_failure_sets_error(self):
+        """Test que un fallo en la carga deja el estado en error con el mensaje"""
+        state = ReadinessState()
+
+        def load():
+            raise RuntimeError("pesos corruptos")
+
+        start_background_warmup(load, state=state).join(timeout=5)
+
+        assert state.status == "error"
+        assert "pesos corruptos" in state.detail
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
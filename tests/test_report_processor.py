@@ -15,6 +15,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from report_processor import (
     validate_image_quality,
     extract_json_block,
+    complete_partial_json,
     apply_edits
 )
 
@@ -129,6 +130,38 @@ class TestJSONExtraction:
             extract_json_block(text)
 
 
+class TestPartialJSONCompletion:
+    """Tests para completar JSON truncado (streaming / salida cortada)"""
+    
+    def test_complete_partial_json_closes_open_containers(self):
+        """Test que cierra listas y objetos abiertos tras el último valor completo"""
+        text = '```json\n{"remove": ["línea 1", "línea 2"], "replace": [{"from": "a", "to'
+        
+        data = json.loads(complete_partial_json(text))
+        
+        assert data["remove"] == ["línea 1", "línea 2"]
+        assert data["replace"] == [{"from": "a"}]
+    
+    def test_complete_partial_json_drops_incomplete_string(self):
+        """Test que descarta el string a medio generar"""
+        text = '{"add_findings": ["Hematoma epidural", "Desviación de lín'
+        
+        data = json.loads(complete_partial_json(text))
+        
+        assert data == {"add_findings": ["Hematoma epidural"]}
+    
+    def test_complete_partial_json_returns_balanced_json_unchanged(self):
+        """Test que un JSON completo se devuelve sin texto adicional"""
+        text = '{"remove": [], "conclusion": {"positives": ["x"]}} texto extra'
+        
+        assert complete_partial_json(text) == '{"remove": [], "conclusion": {"positives": ["x"]}}'
+    
+    def test_complete_partial_json_no_json(self):
+        """Test que lanza ValueError si no hay inicio de JSON"""
+        with pytest.raises(ValueError):
+            complete_partial_json("Texto sin llaves")
+
+
 class TestApplyEdits:
     """Tests para aplicación de ediciones JSON sobre plantilla"""
     
@@ -231,6 +264,52 @@ class TestApplyEdits:
             apply_edits(template, edits)
 
 
+class TestApplyEditsLineIndex:
+    """Tests para ediciones por número de línea (formato "index")"""
+
+    TEMPLATE = "HALLAZGOS:\nNormal.\nSin masas.\nNormal.\nCONCLUSIÓN:"
+
+    def test_remove_by_index_only_removes_that_line(self):
+        """Test que remove por número elimina solo esa línea aunque haya duplicadas"""
+        result = apply_edits(self.TEMPLATE, json.dumps({"remove": [2]}))
+
+        assert result.splitlines() == ["HALLAZGOS:", "Sin masas.", "Normal.", "CONCLUSIÓN:"]
+
+    def test_indices_refer_to_original_template(self):
+        """Test que los números se resuelven antes de que remove desplace líneas"""
+        edits = json.dumps({"remove": [2], "replace": [{"from": 3, "to": "Masa de 2 cm."}]})
+        result = apply_edits(self.TEMPLATE, edits)
+
+        assert result.splitlines() == ["HALLAZGOS:", "Masa de 2 cm.", "Normal.", "CONCLUSIÓN:"]
+
+    def test_mixed_text_and_index_formats(self):
+        """Test que acepta referencias por texto y por número en el mismo JSON"""
+        edits = json.dumps({"remove": ["Sin masas.", 4], "replace": [{"from": "Normal.", "to": "Alterado."}]})
+        result = apply_edits(self.TEMPLATE, edits)
+
+        assert result.splitlines() == ["HALLAZGOS:", "Alterado.", "CONCLUSIÓN:"]
+
+    def test_out_of_range_and_bool_indices_ignored(self):
+        """Test que números fuera de rango o booleanos no modifican la plantilla"""
+        edits = json.dumps({"remove": [0, 99, True], "replace": [{"from": 42, "to": "x"}]})
+
+        assert apply_edits(self.TEMPLATE, edits) == self.TEMPLATE
+
+    def test_numeric_string_matching_a_line_is_text(self):
+        """Test que en formato index un string numérico que coincide con una línea se trata como texto"""
+        template = "HALLAZGOS:\n2\nFin"
+
+        assert apply_edits(template, json.dumps({"remove": ["2"]}), "index") == "HALLAZGOS:\nFin"
+        assert apply_edits(template, json.dumps({"remove": ["3"]}), "index") == "HALLAZGOS:\n2"
+
+    def test_text_format_never_reads_numeric_strings_as_lines(self):
+        """Test de regresión: en formato text un string numérico es texto y no sobrescribe esa línea"""
+        edits = json.dumps({"remove": ["2"], "replace": [{"from": "3", "to": "Masa de 2 cm."}]})
+
+        assert apply_edits(self.TEMPLATE, edits, "text") == self.TEMPLATE
+        assert apply_edits(self.TEMPLATE, edits) == self.TEMPLATE
+
+
 class TestEdgeCases:
     """Tests para casos límite"""
     
@@ -0,0 +1,306 @@
+"""
+Suite de tests para speculative.py
+Tests para la verificación especulativa greedy y el rollback del KV-cache
+"""
+import pytest
+import random
+import threading
+import time
+import torch
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import Gemma3Config, Gemma3ForCausalLM, Gemma3ForConditionalGeneration, StoppingCriteriaList
+from decoding import PausableMaxTimeCriteria, PreemptionStoppingCriteria
+from continuous_batching import ContinuousBatchingEngine
+from speculative import DraftModelProposer, PromptLookupProposer, SpeculationGate, SpeculationTimer, rollback_cache, snapshot_cache, speculative_generate
+
+NO_EOS = [9999]
+
+
+@pytest.fixture(scope="module")
+def tiny_model():
+    """Gemma3 diminuto con pesos aleatorios (ventana deslizante de 16 tokens)"""
+    cfg = Gemma3Config(
+        text_config=dict(vocab_size=300, hidden_size=64, intermediate_size=128, num_hidden_layers=4,
+                         num_attention_heads=2, num_key_value_heads=1, head_dim=32, sliding_window=16,
+                         max_position_embeddings=2048),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2,
+                           image_size=32, patch_size=8),
+        mm_tokens_per_image=4, image_token_index=299, boi_token_index=297, eoi_token_index=298,
+    )
+    torch.manual_seed(0)
+    return Gemma3ForConditionalGeneration(cfg).eval()
+
+
+@pytest.fixture(scope="module")
+def draft_model(tiny_model):
+    """Borrador: el modelo de lenguaje del principal con pesos ligeramente perturbados"""
+    draft = Gemma3ForCausalLM(tiny_model.config.text_config).eval()
+    state = {f"model.{k}": v for k, v in tiny_model.model.language_model.state_dict().items()}
+    state["lm_head.weight"] = tiny_model.lm_head.weight
+    draft.load_state_dict(state, strict=False)
+    torch.manual_seed(1)
+    with torch.no_grad():
+        for p in draft.parameters():
+            p.add_(torch.randn_like(p) * 0.001)
+    return draft
+
+
+def _inputs(n_text: int, seed: int):
+    g = torch.Generator().manual_seed(seed)
+    text = torch.randint(5, 290, (n_text,), generator=g).tolist()
+    ids = torch.tensor([[2] + text[:5] + [297] + [299] * 4 + [298] + text[5:]])
+    return {"input_ids": ids, "attention_mask": torch.ones_like(ids), "pixel_values": torch.randn(1, 3, 32, 32, generator=g)}
+
+
+class OracleProposer:
+    """Propone la continuación greedy real, corrompiendo una fracción de tokens"""
+
+    name = "oracle"
+
+    def __init__(self, reference, error_rate):
+        self.reference = reference
+        self.error_rate = error_rate
+        self.rng = random.Random(0)
+
+    def start(self, prompt_tokens):
+        pass
+
+    def propose(self, tokens, k):
+        draft = self.reference[len(tokens):len(tokens) + k]
+        return [t if self.rng.random() >= self.error_rate else (t + 1) % 290 for t in draft]
+
+
+class TestRollbackCache:
+    """Tests para el rollback del KV-cache"""
+
+    def test_rollback_matches_shorter_prefill(self, tiny_model):
+        """Test que tras rebobinar el cache equivale al de un prefill sin los tokens rechazados"""
+        ids = torch.randint(5, 290, (1, 40))
+        with torch.inference_mode():
+            cache = tiny_model(input_ids=ids[:, :30], use_cache=True).past_key_values
+            snapshot = snapshot_cache(cache)
+            tiny_model(input_ids=ids[:, 30:], past_key_values=cache, use_cache=True,
+                       cache_position=torch.arange(30, 40))
+            rollback_cache(cache, snapshot, 4)
+            expected = tiny_model(input_ids=ids[:, :34], use_cache=True).past_key_values
+
+        for layer, ref in zip(cache.layers, expected.layers):
+            assert layer.get_seq_length() == ref.get_seq_length() == 34
+            assert torch.allclose(layer.keys, ref.keys, atol=1e-5)
+
+
+class TestSpeculativeGenerate:
+    """Tests para el bucle de verificación"""
+
+    @pytest.mark.parametrize("error_rate,num_draft_tokens", [(0.0, 4), (0.3, 3), (0.3, 6)])
+    def test_matches_greedy_generate(self, tiny_model, error_rate, num_draft_tokens):
+        """Test que la salida es la de model.generate() greedy, acierte o no el proponente"""
+        expected = tiny_model.generate(**_inputs(30, seed=1), max_new_tokens=40, min_new_tokens=40, do_sample=False)
+        proposer = OracleProposer(expected[0].tolist(), error_rate)
+
+        out, stats = speculative_generate(tiny_model, _inputs(30, seed=1), proposer, 40, NO_EOS, num_draft_tokens)
+
+        assert torch.equal(out, expected)
+        if error_rate == 0.0:
+            assert stats["acceptance_rate"] == 1.0
+            assert stats["tokens_per_step"] > num_draft_tokens
+
+    def test_draft_model_matches_greedy(self, tiny_model, draft_model):
+        """Test que con un modelo borrador la salida coincide y acepta tokens"""
+        ids = torch.randint(5, 290, (1, 30), generator=torch.Generator().manual_seed(2))
+        inputs = {"input_ids": ids, "attention_mask": torch.ones_like(ids)}
+        expected = tiny_model.generate(**inputs, max_new_tokens=50, min_new_tokens=50, do_sample=False)
+
+        out, stats = speculative_generate(tiny_model, dict(inputs), DraftModelProposer(draft_model), 50, NO_EOS, 4)
+
+        assert torch.equal(out, expected)
+        assert stats["accepted"] > 0
+
+    def test_stops_at_eos(self, tiny_model):
+        """Test que termina en EOS aunque el borrador proponga más tokens"""
+        inputs = _inputs(12, seed=3)
+        reference = tiny_model.generate(**inputs, max_new_tokens=10, min_new_tokens=10, do_sample=False)[0].tolist()
+        eos = reference[inputs["input_ids"].shape[1] + 3]
+
+        out, _ = speculative_generate(tiny_model, _inputs(12, seed=3), OracleProposer(reference, 0.0), 10, [eos], 6)
+
+        assert int(out[0, -1]) == eos
+        assert out.shape[1] <= inputs["input_ids"].shape[1] + 4
+
+    def test_rejects_batches(self, tiny_model):
+        """Test que batch > 1 lanza ValueError"""
+        inputs = _inputs(5, seed=4)
+        inputs["input_ids"] = inputs["input_ids"].repeat(2, 1)
+        with pytest.raises(ValueError):
+            speculative_generate(tiny_model, inputs, OracleProposer([], 0.0), 5, NO_EOS)
+
+
+class TestPromptLookupProposer:
+    """Tests para el proponente por búsqueda de n-gramas"""
+
+    def test_proposes_continuation_from_corpus(self):
+        """Test que propone lo que siguió al n-grama final en el corpus"""
+        proposer = PromptLookupProposer([[10, 11, 12, 13, 14, 15]], ngram_max=3)
+        proposer.start([1, 2, 3])
+        assert proposer.propose([1, 2, 3, 11, 12], 3) == [13, 14, 15]
+
+    def test_prefers_longest_ngram(self):
+        """Test que el n-grama más largo gana a uno corto más prioritario"""
+        proposer = PromptLookupProposer([[7, 12, 50, 51], [11, 12, 60, 61]], ngram_max=3)
+        proposer.start([1])
+        assert proposer.propose([1, 11, 12], 2) == [60, 61]
+
+    def test_first_corpus_entry_has_priority(self):
+        """Test que ante el mismo n-grama gana la primera entrada del corpus"""
+        proposer = PromptLookupProposer([[5, 6, 70], [5, 6, 80]], ngram_max=2)
+        proposer.start([5, 6, 90])
+        assert proposer.propose([5, 6, 90, 5, 6], 1) == [70]
+
+    def test_generated_tokens_take_precedence(self):
+        """Test que las repeticiones en lo generado se consultan antes que el índice"""
+        proposer = PromptLookupProposer([[20, 21, 22]], ngram_max=2)
+        proposer.start([1, 2])
+        assert proposer.propose([1, 2, 20, 21, 99, 20, 21], 2) == [99, 20]
+
+    def test_no_match_returns_empty(self):
+        """Test que sin coincidencias no propone nada"""
+        proposer = PromptLookupProposer([[1, 2, 3]])
+        proposer.start([4, 5])
+        assert proposer.propose([4, 5, 42], 4) == []
+
+    def test_matches_greedy_generate(self, tiny_model):
+        """Test que con un corpus que contiene la salida esperada se acepta y coincide con greedy"""
+        expected = tiny_model.generate(**_inputs(20, seed=5), max_new_tokens=30, min_new_tokens=30, do_sample=False)
+        generated = expected[0, 20:].tolist()
+        proposer = PromptLookupProposer([generated[5:25], [3, 4, 5]], ngram_max=3)
+
+        out, stats = speculative_generate(tiny_model, _inputs(20, seed=5), proposer, 30, NO_EOS, 6)
+
+        assert torch.equal(out, expected)
+        assert stats["accepted"] > 0
+        assert stats["steps"] < 29
+
+
+
+class TestPausedMaxTime:
+    """Tests para max_time cuando una de rutina cede el paso a una urgente"""
+
+    @staticmethod
+    def _paused_criteria(pause: float, max_time: float):
+        """Pausa de pause segundos en el primer paso; max_time sin contarla"""
+        started = []
+
+        def urgent_active():
+            started.append(started[0] if started else time.perf_counter())
+            return time.perf_counter() - started[0] < pause
+
+        preemption = PreemptionStoppingCriteria(urgent_active, poll=0.01)
+        return StoppingCriteriaList([preemption, PausableMaxTimeCriteria(max_time, [preemption])])
+
+    def test_speculative_reaches_max_new_tokens_after_pause(self, tiny_model):
+        """Test que la especulativa pausada más que max_time llega a max_new_tokens"""
+        criteria = self._paused_criteria(pause=0.5, max_time=0.3)
+        inputs = _inputs(20, seed=6)
+        prompt_len = inputs["input_ids"].shape[1]
+
+        out, _ = speculative_generate(tiny_model, inputs, PromptLookupProposer([]), 20, NO_EOS,
+                                      stopping_criteria=criteria)
+
+        assert criteria[0].paused_seconds >= 0.5
+        assert out.shape[1] == prompt_len + 20
+
+    def test_generate_reaches_max_new_tokens_after_pause(self, tiny_model):
+        """Test que model.generate() pausado más que max_time llega a max_new_tokens"""
+        criteria = self._paused_criteria(pause=0.5, max_time=0.3)
+        inputs = _inputs(20, seed=6)
+        prompt_len = inputs["input_ids"].shape[1]
+
+        out = tiny_model.generate(**inputs, max_new_tokens=20, min_new_tokens=20, do_sample=False,
+                                  stopping_criteria=criteria)
+
+        assert criteria[0].paused_seconds >= 0.5
+        assert out.shape[1] == prompt_len + 20
+
+
+class TestSpeculationGate:
+    """Tests para el reparto entre decodificación especulativa y motor continuo"""
+
+    def test_admits_one_speculation_with_idle_engine(self):
+        """Test que solo se admite una especulativa y nunca con el motor ocupado"""
+        gate = SpeculationGate()
+
+        assert not gate.try_enter(engine_busy=True)
+        assert gate.try_enter(engine_busy=False)
+        assert not gate.try_enter(engine_busy=False)
+        gate.leave()
+        assert gate.active == 0
+        assert gate.try_enter(engine_busy=False)
+
+    def test_concurrent_request_goes_to_engine(self, tiny_model):
+        """Test que, con una especulativa en curso, la segunda petición se decodifica en el motor"""
+        gate = SpeculationGate()
+        engine = ContinuousBatchingEngine(tiny_model, max_slots=4, block_size=4, num_blocks=100)
+        expected = tiny_model.generate(**_inputs(30, seed=1), max_new_tokens=20, min_new_tokens=20, do_sample=False)
+        started, release = threading.Event(), threading.Event()
+        routes = {}
+
+        def hold(input_ids, scores, **kwargs):
+            started.set()
+            release.wait(timeout=30)
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool)
+
+        def request(name, inputs, criteria):
+            busy = engine.stats()["active"] + engine.stats()["waiting"] > 0
+            if gate.try_enter(busy):
+                routes[name] = "especulativa"
+                try:
+                    speculative_generate(tiny_model, inputs, OracleProposer([], 0.0), 20, NO_EOS, 4, stopping_criteria=criteria)
+                finally:
+                    gate.leave()
+            else:
+                routes[name] = "motor"
+                routes[f"{name}_out"] = engine.generate(inputs, 20, NO_EOS)
+
+        first = threading.Thread(target=request, args=("a", _inputs(30, seed=2), StoppingCriteriaList([hold])))
+        first.start()
+        assert started.wait(timeout=30)
+        second = threading.Thread(target=request, args=("b", _inputs(30, seed=1), None))
+        second.start()
+        second.join(timeout=60)
+        release.set()
+        first.join(timeout=60)
+        engine.shutdown()
+
+        assert routes["a"] == "especulativa"
+        assert routes["b"] == "motor"
+        assert torch.equal(routes["b_out"], expected)
+        assert gate.active == 0
+
+
+class TestSpeculationTimer:
+    """Tests para la aceleración medida de extremo a extremo"""
+
+    def test_speedup_is_ratio_of_measured_rates(self):
+        """Test que la aceleración es el cociente de los s/token medidos con y sin especulativa"""
+        timer = SpeculationTimer()
+        assert timer.stats()["measured_speedup"] is None
+
+        timer.record(False, 10.0, 100)
+        timer.record(True, 2.0, 40)
+        timer.record(True, 3.0, 60)
+        timer.record(True, 1.0, 0)
+        stats = timer.stats()
+
+        assert stats["seconds_per_token_baseline"] == pytest.approx(0.1)
+        assert stats["seconds_per_token_speculative"] == pytest.approx(0.05)
+        assert stats["measured_speedup"] == pytest.approx(2.0)
+        assert stats["tokens_speculative"] == 100
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,141 @@
+"""
+Suite de tests para vision_cache.py
+Tests para la caché de embeddings de imagen (memoria + disco)
+"""
+import pytest
+import torch
+from unittest.mock import MagicMock
+from PIL import Image
+import sys
+import os
+
+# Agregar path del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vision_cache import (
+    VisionEmbeddingCache,
+    image_cache_key,
+    get_image_features_cached,
+    merge_image_features,
+)
+
+
+def _features(value: float = 1.0, tokens: int = 4, dim: int = 8, dtype=torch.float32):
+    """Features proyectadas ficticias: (imágenes, tokens, hidden)"""
+    return torch.full((1, tokens, dim), value, dtype=dtype)
+
+
+class TestImageCacheKey:
+    """Tests para la clave de caché"""
+
+    def test_same_pixels_same_key(self):
+        """Test que dos imágenes con los mismos píxeles comparten clave"""
+        a = Image.new("RGB", (16, 16), color=(10, 20, 30))
+        b = Image.new("RGB", (16, 16), color=(10, 20, 30))
+        assert image_cache_key(a, "m", torch.float16) == image_cache_key(b, "m", torch.float16)
+
+    def test_key_depends_on_pixels_model_and_dtype(self):
+        """Test que la clave cambia con píxeles, modelo y dtype"""
+        img = Image.new("RGB", (16, 16), color=(10, 20, 30))
+        other = Image.new("RGB", (16, 16), color=(10, 20, 31))
+        key = image_cache_key(img, "m", torch.float16)
+
+        assert key != image_cache_key(other, "m", torch.float16)
+        assert key != image_cache_key(img, "otro", torch.float16)
+        assert key != image_cache_key(img, "m", torch.float32)
+
+
+class TestVisionEmbeddingCache:
+    """Tests para la caché de dos niveles"""
+
+    def test_memory_hit_and_miss(self):
+        """Test de acierto y fallo en memoria"""
+        cache = VisionEmbeddingCache(max_bytes=10_000)
+
+        assert cache.get("a") is None
+        cache.put("a", _features())
+        assert torch.equal(cache.get("a"), _features())
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_lru_eviction_by_bytes(self):
+        """Test que expulsa la entrada menos usada al superar el presupuesto"""
+        one = _features().numel() * 4
+        cache = VisionEmbeddingCache(max_bytes=2 * one)
+        cache.put("a", _features(1.0))
+        cache.put("b", _features(2.0))
+        cache.get("a")
+        cache.put("c", _features(3.0))
+
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_disk_tier_survives_restart(self, tmp_path):
+        """Test que una nueva instancia lee la entrada desde disco"""
+        feats = _features(0.5, dtype=torch.bfloat16)
+        VisionEmbeddingCache(max_bytes=10_000, disk_dir=tmp_path, disk_max_bytes=10_000).put("k", feats)
+
+        cache = VisionEmbeddingCache(max_bytes=10_000, disk_dir=tmp_path, disk_max_bytes=10_000)
+        loaded = cache.get("k")
+
+        assert loaded.dtype == torch.bfloat16
+        assert torch.equal(loaded, feats)
+        assert cache.stats()["disk_hits"] == 1
+        # Promocionada a memoria
+        cache.get("k")
+        assert cache.stats()["hits"] == 1
+
+    def test_disk_budget_evicts_oldest_files(self, tmp_path):
+        """Test que el nivel en disco respeta su presupuesto"""
+        one = _features().numel() * 4
+        cache = VisionEmbeddingCache(max_bytes=10_000, disk_dir=tmp_path, disk_max_bytes=one)
+        cache.put("a", _features(1.0))
+        cache.put("b", _features(2.0))
+
+        assert sorted(p.stem for p in tmp_path.glob("*.bin")) == ["b"]
+
+
+class TestModelIntegration:
+    """Tests para la integración con el modelo"""
+
+    def _model(self, image_token_id: int = 9, vocab: int = 20, dim: int = 8):
+        model = MagicMock()
+        model.config.image_token_id = image_token_id
+        embedding = torch.nn.Embedding(vocab, dim)
+        model.get_input_embeddings.return_value = embedding
+        model.get_image_features.return_value = _features(7.0, tokens=2, dim=dim)
+        return model
+
+    def test_features_computed_once(self):
+        """Test que el vision tower solo se ejecuta en el primer uso"""
+        model = self._model()
+        cache = VisionEmbeddingCache(max_bytes=10_000)
+        pixel_values = torch.zeros(1, 3, 4, 4)
+
+        get_image_features_cached(model, pixel_values, "img", cache)
+        get_image_features_cached(model, pixel_values, "img", cache)
+
+        assert model.get_image_features.call_count == 1
+
+    def test_merge_places_features_at_image_tokens(self):
+        """Test que las features sustituyen a los embeddings de los tokens de imagen"""
+        model = self._model()
+        ids = torch.tensor([[1, 2, 9, 9, 3]])
+
+        embeds = merge_image_features(model, ids, _features(7.0, tokens=2))
+
+        assert torch.all(embeds[0, 2:4] == 7.0)
+        assert torch.equal(embeds[0, 0], model.get_input_embeddings().weight[1].detach())
+
+    def test_merge_rejects_token_count_mismatch(self):
+        """Test que falla si el nº de tokens de imagen no coincide con las features"""
+        model = self._model()
+        ids = torch.tensor([[1, 9, 3]])
+
+        with pytest.raises(ValueError):
+            merge_image_features(model, ids, _features(7.0, tokens=2))
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
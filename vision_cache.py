@@ -0,0 +1,234 @@
+"""
+Caché de embeddings de imagen para MedGemma
+Guarda la salida del vision tower + proyector multimodal por contenido de la
+imagen (tras thumbnail), modelo y dtype, para no recalcular SigLIP al repetir
+un estudio con otra plantilla, indicación o límite de tokens
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+import torch
+from PIL import Image
+from config import VISION_CACHE_MAX_MB, VISION_CACHE_DIR, VISION_CACHE_DISK_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# CLAVE DE CACHÉ
+# ============================================================================
+
+def image_cache_key(img: Image.Image, model_id: str, dtype: Any) -> str:
+    """
+    Huella del contenido de la imagen ya redimensionada + modelo + dtype.
+    Dos imágenes con los mismos píxeles producen la misma clave.
+    """
+    h = hashlib.sha256()
+    h.update(f"{model_id}|{dtype}|{img.mode}|{img.size[0]}x{img.size[1]}|".encode("utf-8"))
+    h.update(img.tobytes())
+    return h.hexdigest()[:32]
+
+
+# ============================================================================
+# CACHÉ LRU EN MEMORIA + NIVEL EN DISCO
+# ============================================================================
+
+class VisionEmbeddingCache:
+    """
+    Caché de dos niveles para features de imagen proyectadas.
+    Memoria: LRU con presupuesto en bytes (tensores en CPU).
+    Disco: un fichero binario por clave + metadatos JSON; se lee con
+    torch.from_file (memory-mapped) y sobrevive a reinicios.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[Path] = None, disk_max_bytes: int = 0):
+        self.max_bytes = int(max_bytes)
+        self.disk_dir = Path(disk_dir) if disk_dir and disk_max_bytes > 0 else None
+        self.disk_max_bytes = int(disk_max_bytes)
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ------------------------------------------------------------------ disco
+
+    def _disk_paths(self, key: str):
+        return self.disk_dir / f"{key}.bin", self.disk_dir / f"{key}.json"
+
+    def _disk_load(self, key: str) -> Optional[torch.Tensor]:
+        if self.disk_dir is None:
+            return None
+        data_path, meta_path = self._disk_paths(key)
+        if not (data_path.exists() and meta_path.exists()):
+            return None
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            dtype = getattr(torch, meta["dtype"])
+            shape = tuple(meta["shape"])
+            numel = 1
+            for dim in shape:
+                numel *= dim
+            tensor = torch.from_file(str(data_path), shared=False, size=numel, dtype=dtype).view(shape)
+            os.utime(data_path)
+            return tensor
+        except Exception as e:
+            logger.warning(f"Entrada de caché de visión corrupta ({key}): {e}")
+            return None
+
+    def _disk_store(self, key: str, tensor: torch.Tensor) -> None:
+        if self.disk_dir is None:
+            return
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes > self.disk_max_bytes:
+            return
+        try:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            data_path, meta_path = self._disk_paths(key)
+            # Escritura atómica: primero datos, luego metadatos (marcan la entrada como válida)
+            tmp_path = data_path.with_suffix(".tmp")
+            tensor.contiguous().view(torch.uint8).numpy().tofile(str(tmp_path))
+            os.replace(tmp_path, data_path)
+            meta = {"dtype": str(tensor.dtype).replace("torch.", ""), "shape": list(tensor.shape)}
+            meta_path.write_text(json.dumps(meta), encoding="utf-8")
+            self._disk_evict()
+        except Exception as e:
+            logger.warning(f"No se pudo escribir la caché de visión en disco: {e}")
+
+    def _disk_evict(self) -> None:
+        """Borra los ficheros menos usados recientemente hasta cumplir el presupuesto."""
+        files = sorted(self.disk_dir.glob("*.bin"), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in files)
+        while files and total > self.disk_max_bytes:
+            oldest = files.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+            oldest.with_suffix(".json").unlink(missing_ok=True)
+
+    # ---------------------------------------------------------------- memoria
+
+    def _memory_put(self, key: str, tensor: torch.Tensor) -> None:
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old.numel() * old.element_size()
+        while self._entries and self.current_bytes + nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.numel() * evicted.element_size()
+            self.evictions += 1
+        self._entries[key] = tensor
+        self.current_bytes += nbytes
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        """Devuelve las features (CPU) o None; un acierto en disco se promociona a memoria."""
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return tensor
+            tensor = self._disk_load(key)
+            if tensor is not None:
+                self.disk_hits += 1
+                self._memory_put(key, tensor)
+                return tensor
+            self.misses += 1
+            return None
+
+    def put(self, key: str, tensor: torch.Tensor) -> None:
+        """Guarda las features en memoria y en disco."""
+        tensor = tensor.detach().to("cpu").contiguous()
+        with self._lock:
+            self._memory_put(key, tensor)
+            self._disk_store(key, tensor)
+
+    def clear(self) -> None:
+        """Vacía el nivel en memoria (el de disco se conserva)."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de aciertos/fallos y uso de memoria."""
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": ((self.hits + self.disk_hits) / total) if total else 0.0,
+                "entries": len(self._entries),
+                "evictions": self.evictions,
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+# Instancia global del proceso
+VISION_CACHE = VisionEmbeddingCache(
+    VISION_CACHE_MAX_MB * 1024 * 1024,
+    disk_dir=VISION_CACHE_DIR,
+    disk_max_bytes=VISION_CACHE_DISK_MAX_MB * 1024 * 1024,
+)
+
+
+# ============================================================================
+# INTEGRACIÓN CON EL MODELO
+# ============================================================================
+
+def get_image_features_cached(model: Any, pixel_values: torch.Tensor, key: str, cache: VisionEmbeddingCache = VISION_CACHE) -> torch.Tensor:
+    """
+    Features proyectadas de la imagen (vision tower + proyector) desde caché
+    o calculadas con model.get_image_features(). Se devuelven en el device y
+    dtype del modelo.
+    """
+    features = cache.get(key)
+    hit = features is not None
+    if not hit:
+        with torch.inference_mode():
+            features = model.get_image_features(pixel_values)
+        cache.put(key, features)
+
+    stats = cache.stats()
+    logger.info(
+        f"Vision cache: {'HIT' if hit else 'MISS'} "
+        f"(hits={stats['hits']}, disco={stats['disk_hits']}, misses={stats['misses']}, "
+        f"{stats['bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f} MB)"
+    )
+    embed_weight = model.get_input_embeddings().weight
+    return features.to(device=embed_weight.device, dtype=embed_weight.dtype)
+
+
+def merge_image_features(model: Any, input_ids: torch.Tensor, image_features: torch.Tensor) -> torch.Tensor:
+    """
+    inputs_embeds del prompt con las features de imagen insertadas en las
+    posiciones de image_token_id (equivalente a lo que hace forward() con
+    pixel_values).
+    """
+    image_token_id = model.config.image_token_id
+    special_image_mask = input_ids == image_token_id
+    llm_input_ids = input_ids
+    # Igual que Gemma3: el token de imagen puede quedar fuera del vocabulario de texto
+    if image_token_id >= model.get_input_embeddings().num_embeddings:
+        llm_input_ids = input_ids.clone()
+        llm_input_ids[special_image_mask] = 0
+
+    with torch.inference_mode():
+        inputs_embeds = model.get_input_embeddings()(llm_input_ids)
+        n_tokens = int(special_image_mask.sum().item())
+        if n_tokens != image_features.shape[0] * image_features.shape[1]:
+            raise ValueError(
+                f"Tokens de imagen ({n_tokens}) y features ({tuple(image_features.shape)}) no coinciden"
+            )
+        mask = special_image_mask.unsqueeze(-1).expand_as(inputs_embeds)
+        inputs_embeds = inputs_embeds.masked_scatter(mask, image_features.to(inputs_embeds.dtype))
+    return inputs_embeds